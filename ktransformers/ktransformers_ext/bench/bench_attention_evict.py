@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Description  : Decode attention of one sequence after importance based block eviction,
+               time and error against the full cache for several token budgets.
+"""
+import os, sys
+import time
+
+sys.path.append(os.path.dirname(__file__) + "/../build")
+import cpuinfer_ext
+import torch
+
+layer_num = 4
+kv_head_num = 8
+q_head_num = 32
+head_dim = 128
+block_len = 128
+anchor_num = 1
+
+anchor_type = cpuinfer_ext.kvcache.AnchorType.DYNAMIC
+kv_type = cpuinfer_ext.kvcache.ggml_type.FP16
+retrieval_type = cpuinfer_ext.kvcache.RetrievalType.LAYER
+layer_step: int = 1
+token_step: int = 1
+layer_offset: int = 0
+max_thread_num: int = 64
+max_batch_size: int = 1
+max_block_num: int = 256
+CPUInfer = cpuinfer_ext.CPUInfer(max_thread_num)
+
+# fraction of blocks holding keys aligned with the query
+relevant_ratio = 0.1
+init_block_num = 1
+local_block_num = 2
+
+warm_up_iter = 100
+test_iter = 1000
+
+
+def build_cache(cache_seqlen: int, seed: int):
+    """A cache with one sequence whose importance comes from a probe query close to the test query."""
+    gen = torch.Generator().manual_seed(seed)
+    config = cpuinfer_ext.kvcache.KVCacheConfig(
+        layer_num,
+        kv_head_num,
+        q_head_num,
+        head_dim,
+        block_len,
+        anchor_num,
+        anchor_type,
+        kv_type,
+        retrieval_type,
+        layer_step,
+        token_step,
+        layer_offset,
+        max_block_num,
+        max_batch_size,
+        max_thread_num,
+    )
+    local_kvcache = cpuinfer_ext.kvcache.KVCache(config)
+    seq_id = local_kvcache.alloc_seq()
+    assert local_kvcache.extend_seq(seq_id, cache_seqlen)
+    seq_ids = torch.tensor([seq_id], dtype=torch.int32).contiguous()
+    block_num = (cache_seqlen + block_len - 1) // block_len
+    # the first sequence of a fresh cache takes blocks 0, 1, 2, ...
+    block_table = torch.arange(block_num, dtype=torch.int32).unsqueeze(0).contiguous()
+    offset = torch.zeros(1, dtype=torch.int32).contiguous()
+
+    direction = torch.randn((q_head_num, head_dim), generator=gen)
+    direction = direction / direction.norm(dim=-1, keepdim=True)
+    query = (direction * 2).to(torch.float16).view(1, 1, q_head_num, head_dim).contiguous()
+    probe = direction + 0.3 * torch.randn((q_head_num, head_dim), generator=gen) / head_dim**0.5
+
+    relevant = torch.rand(block_num, generator=gen) < relevant_ratio
+    relevant = relevant.repeat_interleave(block_len)[:cache_seqlen]
+    for layer_idx in range(layer_num):
+        k_cache = torch.randn((1, cache_seqlen, kv_head_num, head_dim), generator=gen)
+        k_cache[0, relevant] += direction.view(kv_head_num, -1, head_dim).mean(1) * 4
+        v_cache = torch.randn((1, cache_seqlen, kv_head_num, head_dim), generator=gen)
+        k_cache = k_cache.to(torch.float16).contiguous()
+        v_cache = v_cache.to(torch.float16).contiguous()
+        CPUInfer.submit(
+            local_kvcache.update_kvcache_seqs(
+                k_cache.data_ptr(),
+                v_cache.data_ptr(),
+                layer_idx,
+                seq_ids.data_ptr(),
+                1,
+                cache_seqlen,
+            )
+        )
+        # attention of the probe query: (cache_seqlen, q_head_num)
+        keys = k_cache[0].float().repeat_interleave(q_head_num // kv_head_num, dim=1)
+        scores = torch.einsum("shd,hd->sh", keys, probe) / head_dim**0.5
+        importance = torch.zeros((1, block_num * block_len, q_head_num), dtype=torch.float16)
+        importance[0, :cache_seqlen] = scores.softmax(dim=0).to(torch.float16)
+        importance = importance.contiguous()
+        CPUInfer.submit(
+            local_kvcache.update_importance(
+                importance.data_ptr(),
+                layer_idx,
+                block_table.data_ptr(),
+                1,
+                block_num,
+                offset.data_ptr(),
+                cache_seqlen,
+            )
+        )
+        CPUInfer.sync()
+    CPUInfer.submit(local_kvcache.calc_anchor_seqs(seq_ids.data_ptr(), 1))
+    CPUInfer.sync()
+    return local_kvcache, seq_ids, query
+
+
+def attn_all_layers(local_kvcache, seq_ids, query, i=0):
+    outputs = []
+    for layer_idx in range(layer_num):
+        output = torch.empty((1, 1, q_head_num, head_dim), dtype=torch.float16).contiguous()
+        attn_lse = torch.empty((1, 1, q_head_num), dtype=torch.float32).contiguous()
+        CPUInfer.submit(
+            local_kvcache.attn_seqs(
+                query.data_ptr(),
+                output.data_ptr(),
+                attn_lse.data_ptr(),
+                layer_idx,
+                i,
+                seq_ids.data_ptr(),
+                1,
+                -1,
+                -1,
+                -1,
+            )
+        )
+        CPUInfer.sync()
+        outputs.append(output.float())
+    return torch.stack(outputs)
+
+
+def bench_attention_evict(cache_seqlen: int, budgets):
+    with torch.inference_mode(mode=True):
+        full_kvcache, seq_ids, query = build_cache(cache_seqlen, 0)
+        reference = attn_all_layers(full_kvcache, seq_ids, query)
+        del full_kvcache
+
+        print("cache sequence length: ", cache_seqlen)
+        for budget in budgets:
+            local_kvcache, seq_ids, query = build_cache(cache_seqlen, 0)
+            CPUInfer.submit(
+                local_kvcache.evict_seq(int(seq_ids[0]), budget, init_block_num, local_block_num)
+            )
+            CPUInfer.sync()
+            kept_len = local_kvcache.get_seq_len(int(seq_ids[0]))
+            output = attn_all_layers(local_kvcache, seq_ids, query)
+            error = ((output - reference).norm() / reference.norm()).item()
+
+            # warm up
+            for i in range(warm_up_iter):
+                attn_all_layers(local_kvcache, seq_ids, query, i)
+
+            # test
+            start = time.perf_counter()
+            for i in range(test_iter):
+                attn_all_layers(local_kvcache, seq_ids, query, i)
+            end = time.perf_counter()
+            total_time = end - start
+            print("budget: ", budget, "kept tokens: ", kept_len)
+            print("Relative error: ", error)
+            print("Time(s): ", total_time)
+            print("Iteration: ", test_iter)
+            print("Time(us) per iteration: ", total_time / test_iter * 1000000)
+            del local_kvcache
+        print("")
+
+
+bench_attention_evict(16384, [16384, 8192, 4096, 2048])
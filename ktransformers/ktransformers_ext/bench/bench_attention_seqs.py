@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Description  : Decode attention of several sequences held by one KVCache, one batched
+               attn_seqs call against one call per sequence.
+"""
+import os, sys
+import time
+
+sys.path.append(os.path.dirname(__file__) + "/../build")
+import cpuinfer_ext
+import torch
+
+layer_num = 10
+kv_head_num = 8
+q_head_num = 32
+head_dim = 128
+block_len = 128
+anchor_num = 1
+
+anchor_type = cpuinfer_ext.kvcache.AnchorType.DYNAMIC
+kv_type = cpuinfer_ext.kvcache.ggml_type.FP16
+retrieval_type = cpuinfer_ext.kvcache.RetrievalType.LAYER
+layer_step: int = 1
+token_step: int = 1
+layer_offset: int = 0
+max_thread_num: int = 64
+max_batch_size: int = 8
+max_block_num: int = 1024
+CPUInfer = cpuinfer_ext.CPUInfer(max_thread_num)
+
+warm_up_iter = 100
+test_iter = 1000
+
+
+def bench_attention_seqs(batch_size: int, cache_seqlen: int):
+    with torch.inference_mode(mode=True):
+        config = cpuinfer_ext.kvcache.KVCacheConfig(
+            layer_num,
+            kv_head_num,
+            q_head_num,
+            head_dim,
+            block_len,
+            anchor_num,
+            anchor_type,
+            kv_type,
+            retrieval_type,
+            layer_step,
+            token_step,
+            layer_offset,
+            max_block_num,
+            max_batch_size,
+            max_thread_num,
+        )
+        local_kvcache = cpuinfer_ext.kvcache.KVCache(config)
+
+        seq_ids = []
+        for _ in range(batch_size):
+            seq_id = local_kvcache.alloc_seq()
+            assert local_kvcache.extend_seq(seq_id, cache_seqlen)
+            seq_ids.append(seq_id)
+        seq_ids = torch.tensor(seq_ids, dtype=torch.int32, device="cpu").contiguous()
+
+        for layer_idx in range(layer_num):
+            k_cache = torch.randn(
+                (batch_size, cache_seqlen, kv_head_num, head_dim),
+                dtype=torch.float16,
+                device="cpu",
+            ).contiguous()
+            v_cache = torch.randn(
+                (batch_size, cache_seqlen, kv_head_num, head_dim),
+                dtype=torch.float16,
+                device="cpu",
+            ).contiguous()
+            CPUInfer.submit(
+                local_kvcache.update_kvcache_seqs(
+                    k_cache.data_ptr(),
+                    v_cache.data_ptr(),
+                    layer_idx,
+                    seq_ids.data_ptr(),
+                    batch_size,
+                    cache_seqlen,
+                )
+            )
+            CPUInfer.sync()
+
+        input = torch.randn(
+            (batch_size, 1, q_head_num, head_dim), dtype=torch.float16, device="cpu"
+        ).contiguous()
+        input = input / 100
+        output = torch.empty(
+            (batch_size, 1, q_head_num, head_dim), dtype=torch.float16, device="cpu"
+        ).contiguous()
+        attn_lse = torch.empty(
+            (batch_size, 1, q_head_num), dtype=torch.float32, device="cpu"
+        ).contiguous()
+
+        def batched(i):
+            CPUInfer.submit(
+                local_kvcache.attn_seqs(
+                    input.data_ptr(),
+                    output.data_ptr(),
+                    attn_lse.data_ptr(),
+                    i % layer_num,
+                    0,
+                    seq_ids.data_ptr(),
+                    batch_size,
+                    -1,
+                    -1,
+                    -1,
+                )
+            )
+            CPUInfer.sync()
+
+        def sequential(i):
+            for b in range(batch_size):
+                CPUInfer.submit(
+                    local_kvcache.attn_seqs(
+                        input[b].data_ptr(),
+                        output[b].data_ptr(),
+                        attn_lse[b].data_ptr(),
+                        i % layer_num,
+                        0,
+                        seq_ids[b:].data_ptr(),
+                        1,
+                        -1,
+                        -1,
+                        -1,
+                    )
+                )
+                CPUInfer.sync()
+
+        print("sequences: ", batch_size, "cache sequence length: ", cache_seqlen)
+        for name, run in (("batched", batched), ("sequential", sequential)):
+            # warm up
+            for i in range(warm_up_iter):
+                run(i)
+
+            # test
+            start = time.perf_counter()
+            for i in range(test_iter):
+                run(i)
+            end = time.perf_counter()
+            total_time = end - start
+            print(name)
+            print("Time(s): ", total_time)
+            print("Iteration: ", test_iter)
+            print("Time(us) per iteration: ", total_time / test_iter * 1000000)
+            print(
+                "Bandwidth: ",
+                batch_size
+                * cache_seqlen
+                * kv_head_num
+                * head_dim
+                * 2
+                * 2
+                * test_iter
+                / total_time
+                / 1000
+                / 1000
+                / 1000,
+                "GB/s",
+            )
+        print("")
+
+
+bench_attention_seqs(1, 4096)
+bench_attention_seqs(4, 4096)
+bench_attention_seqs(8, 4096)
+bench_attention_seqs(4, 16384)
+bench_attention_seqs(8, 16384)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Description  : Check the fp16 block anchors of calc_anchor_all_layers against a float16 transcription of the
+               scalar loops they replaced, for every anchor type. The old loops rounded through fp16 after every
+               accumulation step and added DYNAMIC anchors in ascending order of (importance, position), so the
+               anchors must match exactly. Importances are small integers to exercise the ties. Run with a
+               partly filled last block and with a sequence of whole blocks, where the block right after the
+               end is not skipped and gets the anchors of the keys an earlier sequence left in it, as before.
+"""
+import os, sys
+
+sys.path.append(os.path.dirname(__file__) + "/../build")
+import cpuinfer_ext
+import torch
+
+layer_num = 2
+kv_head_num = 2
+q_head_num = 8
+head_dim = 128
+block_len = 128
+max_block_num = 8
+retrieval_type = cpuinfer_ext.kvcache.RetrievalType.LAYER
+max_thread_num = 4
+CPUInfer = cpuinfer_ext.CPUInfer(max_thread_num)
+AnchorType = cpuinfer_ext.kvcache.AnchorType
+
+
+def old_anchor(keys, importance, anchor_type, anchor_num):
+    """
+    The scalar loops for one block, keys: [kv_head_num, block_len, head_dim], importance: [block_len, q_head_num].
+    Returns [anchor_num, q_head_num, head_dim], anchors the old loops did not clear stay zero.
+    """
+    n_gqa = q_head_num // kv_head_num
+    anchor = torch.zeros((anchor_num, q_head_num, head_dim), dtype=torch.float16)
+
+    def add(a, b):
+        return (a.float() + b.float()).half()
+
+    if anchor_type == AnchorType.DYNAMIC:
+        for head_id in range(q_head_num):
+            order = sorted(range(block_len), key=lambda k: (importance[k, head_id].item(), k))
+            # the priority queue popped the smallest of the top anchor_num first
+            for k in order[-anchor_num:]:
+                anchor[0, head_id] = add(anchor[0, head_id], keys[head_id // n_gqa, k])
+    elif anchor_type == AnchorType.BLOCK_MEAN:
+        for head_id in range(q_head_num):
+            for k in range(block_len):
+                anchor[0, head_id] = add(anchor[0, head_id], keys[head_id // n_gqa, k].float() / block_len)
+    elif anchor_type == AnchorType.BLOCK_MAX:
+        for head_id in range(q_head_num):
+            for k in range(block_len):
+                anchor[0, head_id] = torch.maximum(anchor[0, head_id], keys[head_id // n_gqa, k])
+    elif anchor_type == AnchorType.FIXED:
+        stride = block_len // anchor_num
+        for head_id in range(q_head_num):
+            for tot in range(anchor_num):
+                anchor[0, head_id] = add(anchor[0, head_id], keys[head_id // n_gqa, tot * stride].float() / anchor_num)
+    elif anchor_type == AnchorType.QUEST:
+        # max from fp16(FLT_MIN), which is 0, min from fp16(FLT_MAX), which is inf, stored at the kv head index
+        anchor[1] = torch.tensor(torch.finfo(torch.float32).max).half()
+        for head_id in range(kv_head_num):
+            for k in range(block_len):
+                anchor[0, head_id] = torch.maximum(anchor[0, head_id], keys[head_id, k])
+                anchor[1, head_id] = torch.minimum(anchor[1, head_id], keys[head_id, k])
+    return anchor
+
+
+def check(cache_seqlen, anchor_type, anchor_num):
+    config = cpuinfer_ext.kvcache.KVCacheConfig(
+        layer_num,
+        kv_head_num,
+        q_head_num,
+        head_dim,
+        block_len,
+        anchor_num,
+        anchor_type,
+        cpuinfer_ext.kvcache.ggml_type.FP16,
+        retrieval_type,
+        1,
+        1,
+        0,
+        max_block_num,
+        1,
+        max_thread_num,
+    )
+    local_kvcache = cpuinfer_ext.kvcache.KVCache(config)
+    block_table = torch.randperm(max_block_num, dtype=torch.int32).view(1, -1)
+    cache_seqlens = torch.tensor([cache_seqlen], dtype=torch.int32)
+    seqlens_zero = torch.zeros((1,), dtype=torch.int32)
+    # every block is written, the blocks past cache_seqlen hold what an earlier sequence left
+    total_len = max_block_num * block_len
+    keys = torch.randn((layer_num, kv_head_num, total_len, head_dim)).half()
+    importances = torch.randint(0, 4, (layer_num, total_len, q_head_num)).half()
+    for layer_idx in range(layer_num):
+        k_in = keys[layer_idx].transpose(0, 1).contiguous()
+        v_in = torch.randn_like(k_in)
+        CPUInfer.submit(
+            local_kvcache.update_kvcache_fp16(
+                k_in.data_ptr(),
+                v_in.data_ptr(),
+                layer_idx,
+                block_table.data_ptr(),
+                1,
+                max_block_num,
+                seqlens_zero.data_ptr(),
+                total_len,
+            )
+        )
+        importance_in = importances[layer_idx].contiguous()
+        CPUInfer.submit(
+            local_kvcache.update_importance(
+                importance_in.data_ptr(),
+                layer_idx,
+                block_table.data_ptr(),
+                1,
+                max_block_num,
+                seqlens_zero.data_ptr(),
+                total_len,
+            )
+        )
+        CPUInfer.sync()
+    CPUInfer.submit(
+        local_kvcache.calc_anchor_all_layers(block_table.data_ptr(), cache_seqlens.data_ptr(), 1, max_block_num)
+    )
+    CPUInfer.sync()
+
+    anchor = torch.empty((anchor_num, q_head_num, head_dim), dtype=torch.float16)
+    for layer_idx in range(layer_num):
+        # blocks are skipped from the one after seqlen / block_len on
+        for block_id in range(min(cache_seqlen // block_len + 1, max_block_num)):
+            local_kvcache.get_anchor_one_block(anchor.data_ptr(), layer_idx, block_table[0, block_id].item())
+            tokens = slice(block_id * block_len, (block_id + 1) * block_len)
+            expected = old_anchor(
+                keys[layer_idx, :, tokens], importances[layer_idx, tokens], anchor_type, anchor_num
+            )
+            # anchors the old loops did not write are not compared
+            written = 1 if anchor_type in (AnchorType.DYNAMIC, AnchorType.FIXED) else anchor_num
+            assert torch.equal(anchor[:written], expected[:written]), (anchor_type, layer_idx, block_id)
+
+
+with torch.inference_mode(mode=True):
+    # the last block partly filled, then whole blocks only
+    for cache_seqlen in (4 * block_len - 17, 3 * block_len):
+        for anchor_type, anchor_num in (
+            (AnchorType.DYNAMIC, 4),
+            (AnchorType.BLOCK_MEAN, 1),
+            (AnchorType.BLOCK_MAX, 1),
+            (AnchorType.FIXED, 4),
+            (AnchorType.QUEST, 2),
+        ):
+            check(cache_seqlen, anchor_type, anchor_num)
+            print("cache_seqlen: ", cache_seqlen, anchor_type, "anchor_num: ", anchor_num, "identical to the scalar loops")
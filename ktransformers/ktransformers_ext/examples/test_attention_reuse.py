@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Description  : Decode one sequence with block retrieval (LAYER and KVHEAD) and a token_step of 4, so that
+               the steps between two retrievals reuse the blocks selected last. The token of the step that
+               opens a new block has a key aligned with every query head and a marker value, so attending
+               it puts the marker in the output. Checks that the new token is attended in the reuse step
+               that opens its block, and in the next one.
+"""
+import os, sys
+
+sys.path.append(os.path.dirname(__file__) + "/../build")
+import cpuinfer_ext
+import torch
+
+layer_num = 1
+kv_head_num = 2
+q_head_num = 8
+head_dim = 128
+block_len = 128
+anchor_num = 1
+max_block_num = 16
+token_step = 4
+init_block_num, local_block_num, pick_block_num = 1, 1, 2
+# the first decode step fills the last prefilled block, the second opens a new one
+prefill_len = 8 * block_len - 1
+max_thread_num = 2
+CPUInfer = cpuinfer_ext.CPUInfer(max_thread_num)
+marker = 3.0
+
+
+def decode(retrieval_type):
+    """Returns, per decode step, how close the output of every head is to the marker value."""
+    config = cpuinfer_ext.kvcache.KVCacheConfig(
+        layer_num,
+        kv_head_num,
+        q_head_num,
+        head_dim,
+        block_len,
+        anchor_num,
+        cpuinfer_ext.kvcache.AnchorType.DYNAMIC,
+        cpuinfer_ext.kvcache.ggml_type.FP16,
+        retrieval_type,
+        1,
+        token_step,
+        0,
+        max_block_num,
+        1,
+        max_thread_num,
+    )
+    local_kvcache = cpuinfer_ext.kvcache.KVCache(config)
+    block_table = torch.arange(max_block_num, dtype=torch.int32).view(1, -1)
+    seqlens_zero = torch.zeros((1,), dtype=torch.int32)
+    k = (torch.randn((1, prefill_len, kv_head_num, head_dim)) / 10).half()
+    v = (torch.randn((1, prefill_len, kv_head_num, head_dim)) / 10).half()
+    CPUInfer.submit(
+        local_kvcache.update_kvcache_fp16(
+            k.data_ptr(), v.data_ptr(), 0, block_table.data_ptr(), 1, max_block_num, seqlens_zero.data_ptr(), prefill_len
+        )
+    )
+    # submit runs asynchronously, the tensors passed by pointer are kept alive until sync
+    prefill_seqlens = torch.tensor([prefill_len], dtype=torch.int32)
+    CPUInfer.submit(
+        local_kvcache.calc_anchor_all_layers(block_table.data_ptr(), prefill_seqlens.data_ptr(), 1, max_block_num)
+    )
+    CPUInfer.sync()
+
+    direction = torch.nn.functional.normalize(torch.randn(head_dim), dim=0)
+    q = (direction * 8).half().expand(1, 1, q_head_num, head_dim).contiguous()
+    closeness = []
+    for generate_token_idx in range(3):
+        seqlen = prefill_len + generate_token_idx
+        if generate_token_idx == 1:
+            # the token that opens block 8, its key dominates the softmax of every head
+            k_new = (direction * 12).half().expand(1, 1, kv_head_num, head_dim).contiguous()
+            v_new = torch.full((1, 1, kv_head_num, head_dim), marker, dtype=torch.float16)
+        else:
+            k_new = (torch.randn((1, 1, kv_head_num, head_dim)) / 10).half()
+            v_new = (torch.randn((1, 1, kv_head_num, head_dim)) / 10).half()
+        past_seqlens = torch.tensor([seqlen], dtype=torch.int32)
+        cache_seqlens = torch.tensor([seqlen + 1], dtype=torch.int32)
+        CPUInfer.submit(
+            local_kvcache.update_kvcache_fp16(
+                k_new.data_ptr(),
+                v_new.data_ptr(),
+                0,
+                block_table.data_ptr(),
+                1,
+                max_block_num,
+                past_seqlens.data_ptr(),
+                1,
+            )
+        )
+        output = torch.empty((1, 1, q_head_num, head_dim), dtype=torch.float16)
+        attn_lse = torch.empty((1, 1, q_head_num), dtype=torch.float32)
+        CPUInfer.submit(
+            local_kvcache.attn(
+                q.data_ptr(),
+                output.data_ptr(),
+                attn_lse.data_ptr(),
+                0,
+                generate_token_idx,
+                1,
+                1,
+                max_block_num,
+                block_table.data_ptr(),
+                cache_seqlens.data_ptr(),
+                pick_block_num,
+                init_block_num,
+                local_block_num,
+            )
+        )
+        CPUInfer.sync()
+        closeness.append((output.float() - marker).abs().max().item())
+    return closeness
+
+
+with torch.inference_mode(mode=True):
+    results = {}
+    for retrieval_type in (cpuinfer_ext.kvcache.RetrievalType.LAYER, cpuinfer_ext.kvcache.RetrievalType.KVHEAD):
+        torch.manual_seed(0)
+        results[retrieval_type] = decode(retrieval_type)
+        print(retrieval_type, "max |output - marker| per step: ", results[retrieval_type])
+    for retrieval_type, closeness in results.items():
+        # before the marker token, the outputs are far from it
+        assert closeness[0] > marker / 2, (retrieval_type, closeness)
+        # the step that opens the block and the next step, both reuse steps, attend the marker token
+        assert closeness[1] < marker / 4 and closeness[2] < marker / 4, (retrieval_type, closeness)
@@ -379,6 +379,162 @@ class KVCacheBindings {
         }
     };
 
+    class ExtendSeqsBindings {
+      public:
+        struct Args {
+            CPUInfer *cpuinfer;
+            KVCache *kv_cache;
+            const int *seq_ids;
+            int batch_size;
+            int q_len;
+        };
+        static void inner(void *args) {
+            Args *args_ = (Args *)args;
+            args_->cpuinfer->enqueue(&KVCache::extend_seqs, args_->kv_cache,
+                                     args_->seq_ids, args_->batch_size,
+                                     args_->q_len);
+        }
+        static std::pair<intptr_t, intptr_t>
+        cpuinfer_interface(KVCache &kv_cache, intptr_t seq_ids, int batch_size,
+                           int q_len) {
+            Args *args = new Args{nullptr, &kv_cache, (const int *)seq_ids,
+                                  batch_size, q_len};
+            return std::make_pair((intptr_t)&inner, (intptr_t)args);
+        }
+    };
+
+    class UpdateKVCacheSeqsBindings {
+      public:
+        struct Args {
+            CPUInfer *cpuinfer;
+            KVCache *kv_cache;
+            const ggml_fp16_t *k_in;
+            const ggml_fp16_t *v_in;
+            int layer_id;
+            const int *seq_ids;
+            int batch_size;
+            int q_len;
+        };
+        static void inner(void *args) {
+            Args *args_ = (Args *)args;
+            args_->cpuinfer->enqueue(&KVCache::update_kvcache_seqs,
+                                     args_->kv_cache, args_->k_in, args_->v_in,
+                                     args_->layer_id, args_->seq_ids,
+                                     args_->batch_size, args_->q_len);
+        }
+        static std::pair<intptr_t, intptr_t>
+        cpuinfer_interface(KVCache &kv_cache, intptr_t k_in, intptr_t v_in,
+                           int layer_id, intptr_t seq_ids, int batch_size,
+                           int q_len) {
+            Args *args = new Args{nullptr,
+                                  &kv_cache,
+                                  (const ggml_fp16_t *)k_in,
+                                  (const ggml_fp16_t *)v_in,
+                                  layer_id,
+                                  (const int *)seq_ids,
+                                  batch_size,
+                                  q_len};
+            return std::make_pair((intptr_t)&inner, (intptr_t)args);
+        }
+    };
+
+    class AttnSeqsBindings {
+      public:
+        struct Args {
+            CPUInfer *cpuinfer;
+            KVCache *kv_cache;
+            const ggml_fp16_t *q_in;
+            ggml_fp16_t *output;
+            float *attn_lse;
+            int layer_idx;
+            int generate_token_idx;
+            const int *seq_ids;
+            int batch_size;
+            int pick_block_num;
+            int init_block_num;
+            int local_block_num;
+        };
+        static void inner(void *args) {
+            Args *args_ = (Args *)args;
+            args_->cpuinfer->enqueue(
+                &KVCache::attn_seqs, args_->kv_cache, args_->q_in,
+                args_->output, args_->attn_lse, args_->layer_idx,
+                args_->generate_token_idx, args_->seq_ids, args_->batch_size,
+                args_->pick_block_num, args_->init_block_num,
+                args_->local_block_num);
+        }
+        static std::pair<intptr_t, intptr_t>
+        cpuinfer_interface(KVCache &kv_cache, intptr_t q_in, intptr_t output,
+                           intptr_t attn_lse, int layer_idx,
+                           int generate_token_idx, intptr_t seq_ids,
+                           int batch_size, int pick_block_num,
+                           int init_block_num, int local_block_num) {
+            Args *args = new Args{nullptr,
+                                  &kv_cache,
+                                  (const ggml_fp16_t *)q_in,
+                                  (ggml_fp16_t *)output,
+                                  (float *)attn_lse,
+                                  layer_idx,
+                                  generate_token_idx,
+                                  (const int *)seq_ids,
+                                  batch_size,
+                                  pick_block_num,
+                                  init_block_num,
+                                  local_block_num};
+            return std::make_pair((intptr_t)&inner, (intptr_t)args);
+        }
+    };
+
+    class CalcAnchorSeqsBindings {
+      public:
+        struct Args {
+            CPUInfer *cpuinfer;
+            KVCache *kv_cache;
+            const int *seq_ids;
+            int batch_size;
+        };
+        static void inner(void *args) {
+            Args *args_ = (Args *)args;
+            args_->cpuinfer->enqueue(&KVCache::calc_anchor_seqs,
+                                     args_->kv_cache, args_->seq_ids,
+                                     args_->batch_size);
+        }
+        static std::pair<intptr_t, intptr_t>
+        cpuinfer_interface(KVCache &kv_cache, intptr_t seq_ids,
+                           int batch_size) {
+            Args *args = new Args{nullptr, &kv_cache, (const int *)seq_ids,
+                                  batch_size};
+            return std::make_pair((intptr_t)&inner, (intptr_t)args);
+        }
+    };
+
+    class EvictSeqBindings {
+      public:
+        struct Args {
+            CPUInfer *cpuinfer;
+            KVCache *kv_cache;
+            int seq_id;
+            int max_len;
+            int init_block_num;
+            int local_block_num;
+        };
+        static void inner(void *args) {
+            Args *args_ = (Args *)args;
+            args_->cpuinfer->enqueue(&KVCache::evict_seq, args_->kv_cache,
+                                     args_->seq_id, args_->max_len,
+                                     args_->init_block_num,
+                                     args_->local_block_num);
+        }
+        static std::pair<intptr_t, intptr_t>
+        cpuinfer_interface(KVCache &kv_cache, int seq_id, int max_len,
+                           int init_block_num, int local_block_num) {
+            Args *args = new Args{nullptr,        &kv_cache,     seq_id,
+                                  max_len,        init_block_num,
+                                  local_block_num};
+            return std::make_pair((intptr_t)&inner, (intptr_t)args);
+        }
+    };
+
     class LoadKVCacheBindings {
       public:
         struct Args {
@@ -603,14 +759,27 @@ PYBIND11_MODULE(cpuinfer_ext, m) {
                          int intermediate_size, int stride, int group_min_len,
                          int group_max_len, intptr_t gate_proj,
                          intptr_t up_proj, intptr_t down_proj, int gate_type,
-                         int up_type, int down_type, int hidden_type) {
+                         int up_type, int down_type, int hidden_type,
+                         bool huge_pages, bool lock_memory) {
             return MOEConfig(expert_num, routed_expert_num, hidden_size,
                              intermediate_size, stride, group_min_len,
                              group_max_len, (void *)gate_proj, (void *)up_proj,
                              (void *)down_proj, (ggml_type)gate_type,
                              (ggml_type)up_type, (ggml_type)down_type,
-                             (ggml_type)hidden_type);
-        }));
+                             (ggml_type)hidden_type, huge_pages, lock_memory);
+        }),
+        py::arg("expert_num"), py::arg("routed_expert_num"), py::arg("hidden_size"),
+        py::arg("intermediate_size"), py::arg("stride"), py::arg("group_min_len"),
+        py::arg("group_max_len"), py::arg("gate_proj"), py::arg("up_proj"),
+        py::arg("down_proj"), py::arg("gate_type"), py::arg("up_type"),
+        py::arg("down_type"), py::arg("hidden_type"),
+        py::arg("huge_pages") = false, py::arg("lock_memory") = false);
+    // MOE copies the weights to every numa node, huge_pages and lock_memory apply to the copies
+#ifdef USE_NUMA
+    moe_module.attr("copies_weights") = true;
+#else
+    moe_module.attr("copies_weights") = false;
+#endif
     py::class_<MOE>(moe_module, "MOE")
         .def(py::init<MOEConfig>())
         .def("warm_up", &MOEBindings::WarmUpBindinds::cpuinfer_interface)
@@ -678,5 +847,26 @@ PYBIND11_MODULE(cpuinfer_ext, m) {
              &KVCacheBindings::ClearImportanceAllLayersBindings::
                  cpuinfer_interface)
         .def("calc_anchor_all_layers",
-             &KVCacheBindings::CalcAnchorAllLayersBindinds::cpuinfer_interface);
+             &KVCacheBindings::CalcAnchorAllLayersBindinds::cpuinfer_interface)
+        .def("get_anchor_one_block",
+             [](KVCache &kvcache, intptr_t anchor, int layer_id,
+                int block_idx) {
+                 kvcache.get_anchor_one_block((ggml_fp16_t *)anchor, layer_id,
+                                              block_idx, nullptr);
+             })
+        .def("alloc_seq", &KVCache::alloc_seq)
+        .def("free_seq", &KVCache::free_seq)
+        .def("get_seq_len", &KVCache::get_seq_len)
+        .def("get_seq_evicted_len", &KVCache::get_seq_evicted_len)
+        .def("get_seq_block_table", &KVCache::get_seq_block_table)
+        .def("extend_seq", &KVCache::extend_seq)
+        .def("extend_seqs",
+             &KVCacheBindings::ExtendSeqsBindings::cpuinfer_interface)
+        .def("update_kvcache_seqs",
+             &KVCacheBindings::UpdateKVCacheSeqsBindings::cpuinfer_interface)
+        .def("attn_seqs", &KVCacheBindings::AttnSeqsBindings::cpuinfer_interface)
+        .def("calc_anchor_seqs",
+             &KVCacheBindings::CalcAnchorSeqsBindings::cpuinfer_interface)
+        .def("evict_seq",
+             &KVCacheBindings::EvictSeqBindings::cpuinfer_interface);
 }
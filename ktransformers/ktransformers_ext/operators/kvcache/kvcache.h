@@ -399,7 +399,130 @@ class KVCache {
     void get_all_kvcache_one_layer(int layer_id, ggml_fp16_t *k_in,
                                    ggml_fp16_t *v_in, Backend *backend);
 
+    /**
+     * @brief Allocates a sequence slot.
+     *
+     * The cache holds up to max_batch_size independent sequences. Blocks are
+     * taken from a shared pool of max_block_num blocks as sequences grow, so a
+     * cache should either be driven through sequences or through explicit
+     * block tables holding the blocks of its sequences, not arbitrary ones.
+     *
+     * @return The sequence id, or -1 if all slots are in use.
+     */
+    int alloc_seq();
+
+    /**
+     * @brief Releases a sequence slot and returns its blocks to the pool.
+     *
+     * Once no sequence is left, the pool is put back in its initial order, so
+     * the next sequence gets blocks 0, 1, 2, ... whatever evictions came
+     * before.
+     *
+     * @param seq_id The sequence id returned by alloc_seq.
+     */
+    void free_seq(int seq_id);
+
+    /**
+     * @brief Gets the number of tokens stored for a sequence.
+     *
+     * @param seq_id The sequence id returned by alloc_seq.
+     * @return The sequence length.
+     */
+    int get_seq_len(int seq_id);
+
+    /**
+     * @brief Gets the number of tokens evict_seq has dropped from a sequence.
+     *
+     * The sequence length plus this is the position the next token of the
+     * sequence is at.
+     *
+     * @param seq_id The sequence id returned by alloc_seq.
+     * @return The number of evicted tokens.
+     */
+    int get_seq_evicted_len(int seq_id);
+
+    /**
+     * @brief Gets the blocks of a sequence, in the order of its tokens.
+     *
+     * @param seq_id The sequence id returned by alloc_seq.
+     * @return The block table of the sequence.
+     */
+    std::vector<int> get_seq_block_table(int seq_id);
+
+    /**
+     * @brief Reserves room for q_len more tokens of a sequence.
+     *
+     * Allocates blocks as needed and advances the sequence length. The new
+     * tokens are then written layer by layer with update_kvcache_seqs. Must
+     * not be called while tasks using the sequence are queued.
+     *
+     * @param seq_id The sequence id returned by alloc_seq.
+     * @param q_len The number of tokens to append.
+     * @return false if the block pool is exhausted, the sequence is unchanged
+     * in that case.
+     */
+    bool extend_seq(int seq_id, int q_len);
+
+    /**
+     * @brief extend_seq as a task, for every sequence in seq_ids.
+     *
+     * Runs in order with the tasks queued before and after it, so a decode
+     * step can grow its sequences without waiting for the queue, also when
+     * it is replayed from a cuda graph. The block pool must not run out.
+     */
+    void extend_seqs(const int *seq_ids, int batch_size, int q_len,
+                     Backend *backend);
+
+    /**
+     * @brief Writes the last q_len tokens of every sequence in seq_ids.
+     *
+     * k_in and v_in are [batch_size, q_len, kv_head_num, head_dim].
+     */
+    void update_kvcache_seqs(const ggml_fp16_t *k_in, const ggml_fp16_t *v_in,
+                             int layer_id, const int *seq_ids, int batch_size,
+                             int q_len, Backend *backend);
+
+    /**
+     * @brief Computes decode attention for one query token of each sequence.
+     *
+     * All sequences of the batch are scheduled on the backend thread pool in
+     * one job. q_in and output are [batch_size, 1, q_head_num, head_dim],
+     * attn_lse is [batch_size, 1, q_head_num].
+     */
+    void attn_seqs(const ggml_fp16_t *q_in, ggml_fp16_t *output,
+                   float *attn_lse, int layer_idx, int generate_token_idx,
+                   const int *seq_ids, int batch_size, int pick_block_num,
+                   int init_block_num, int local_block_num, Backend *backend);
+
+    /**
+     * @brief Computes the anchors of all blocks of the given sequences.
+     */
+    void calc_anchor_seqs(const int *seq_ids, int batch_size,
+                          Backend *backend);
+
+    /**
+     * @brief Drops the least important blocks of a sequence longer than
+     * max_len.
+     *
+     * A block scores the importance accumulated by update_importance over
+     * all its tokens, heads and layers, ties go to the older block, so a
+     * cache without importance falls back to a sliding window. The first
+     * init_block_num and the last local_block_num blocks are never dropped,
+     * the last block is always kept. The remaining blocks close up in the
+     * block table and keep their anchors, keys keep the rotation of the
+     * position they were written at. Dropped blocks go back to the pool with
+     * their importance and anchors cleared, and the retrieval history of the
+     * sequence is reset.
+     *
+     * @param seq_id The sequence id returned by alloc_seq.
+     * @param max_len The token budget of the sequence.
+     */
+    void evict_seq(int seq_id, int max_len, int init_block_num,
+                   int local_block_num, Backend *backend);
+
   private:
+    void calc_anchor_one_block_fp16(int layer_id, int block_idx);
+
     // Persistent data
     KVCacheConfig config_;
     int n_gqa_;                            // q_head_num / kv_head_num
@@ -476,7 +599,8 @@ class KVCache {
     std::vector<std::vector<std::vector<float>>> block_similar_q_head_;
 
     std::vector<int> cache_seqlens_;               // [batch_size]
-    std::vector<int> selected_blocks_num_history_; // [layer_num // layer_step]
+    std::vector<std::vector<int>>
+        selected_blocks_num_history_; // [layer_num // layer_step, batch_size]
 
     std::vector<std::vector<std::vector<int>>> selected_blocks_history_;
     // [layer_num // layer_step, batch_size, max_block_num]
@@ -540,6 +664,27 @@ class KVCache {
     // tmp space
     std::vector<float> q_fp32; // [n_gqa * head_dim]
 
+    // Sequences
+    std::mutex seq_mutex_;
+    std::vector<int> seq_lens_; // [max_batch_size], -1 for a free slot
+    std::vector<int> seq_evicted_lens_; // [max_batch_size]
+    std::vector<std::vector<int>>
+        seq_block_table_;          // [max_batch_size, blocks of the sequence]
+    std::vector<int> free_blocks_; // block pool, popped from the back
+    std::vector<int>
+        seq_batch_block_table_; // [max_batch_size * max_block_num]
+    std::vector<int> seq_batch_seqlens_; // [max_batch_size]
+
+    // Maps a batch entry to its slot in the retrieval history: the sequence id
+    // in attn_seqs, the batch index otherwise.
+    const int *history_slots_ = nullptr;
+    int history_slot_(int batch_idx) {
+        return history_slots_ ? history_slots_[batch_idx] : batch_idx;
+    }
+
+    int gather_seqs_(const int *seq_ids, int batch_size, int len_offset);
+    void release_block_(int block_idx);
+
     void quantize_q_(const uint16_t *q_in_data, int batch_size);
     void attn_initialize_layer_(int batch_size, int layer_idx, int *block_table,
                                 int &max_block_num, int *cache_seqlens);
@@ -945,8 +945,7 @@ void KVCache::calculate_block_similarity_layer_(
                             1, 1, config_.q_head_num * config_.head_dim,
                             anchor_.data() +
                                 (layer_idx * config_.max_block_num +
-                                 block_table_before_retrieval_[batch_id]
-                                                              [block_idx]) *
+                                 block_idx) *
                                     config_.anchor_num * config_.q_head_num *
                                     config_.head_dim,
                             config_.q_head_num * config_.head_dim,
@@ -1034,12 +1033,14 @@ void KVCache::select_block_layer_(int batch_size, int layer_idx,
 
     for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
 
+        int layer_group =
+            (layer_idx - config_.layer_offset) / config_.layer_step;
+        int slot = history_slot_(batch_idx);
         if (cache_seqlens_[batch_idx] / config_.block_len <=
             init_block_num + pick_block_num + local_block_num) {
             block_table_after_retrieval_[batch_idx].swap(
                 block_table_before_retrieval_[batch_idx]);
-            selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                         config_.layer_step] = 0;
+            selected_blocks_num_history_[layer_group][slot] = 0;
             continue;
         }
 
@@ -1088,12 +1089,10 @@ void KVCache::select_block_layer_(int batch_size, int layer_idx,
                 i * config_.block_len;
         }
         for (int j = 0; j < i; j++) {
-            selected_blocks_history_[(layer_idx - config_.layer_offset) /
-                                     config_.layer_step][batch_idx][j] =
+            selected_blocks_history_[layer_group][slot][j] =
                 block_table_after_retrieval_[batch_idx][j];
         }
-        selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                     config_.layer_step] = i;
+        selected_blocks_num_history_[layer_group][slot] = i;
     }
 
     // Timer end
@@ -1117,53 +1116,44 @@ void KVCache::retrieval_kvcache_layer_(const uint16_t *q_in_data,
     // Timer start
     auto start = std::chrono::high_resolution_clock::now();
     max_block_num_after_retrieval_ = 0;
+    int layer_group = (layer_idx - config_.layer_offset) / config_.layer_step;
     if (pick_block_num != -1 &&
         (generate_token_idx % config_.token_step != 0 ||
          (layer_idx % config_.layer_step != config_.layer_offset))) {
-
-        if (selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                         config_.layer_step] == 0) {
-            max_block_num_after_retrieval_ = max_block_num;
-            block_table_after_retrieval_.swap(block_table_before_retrieval_);
-        } else {
-            max_block_num_after_retrieval_ = selected_blocks_num_history_
-                [(layer_idx - config_.layer_offset) / config_.layer_step];
-            for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
-                for (int i = 0; i < max_block_num_after_retrieval_; i++) {
-                    block_table_after_retrieval_[batch_idx][i] =
-                        selected_blocks_history_[(layer_idx -
-                                                  config_.layer_offset) /
-                                                 config_.layer_step][batch_idx]
-                                                [i];
-                }
-
-                if (cache_seqlens[batch_idx] % config_.block_len == 1) {
-                    selected_blocks_num_history_[(layer_idx -
-                                                  config_.layer_offset) /
-                                                 config_.layer_step] += 1;
-                    int x =
-                        selected_blocks_num_history_[(layer_idx -
-                                                      config_.layer_offset) /
-                                                     config_.layer_step];
-                    int last_block_idx =
-                        block_table_before_retrieval_[batch_idx]
-                                                     [cache_seqlens[batch_idx] /
-                                                      config_.block_len];
-                    selected_blocks_history_[(layer_idx -
-                                              config_.layer_offset) /
-                                             config_.layer_step][batch_idx]
-                                            [x - 1] = last_block_idx;
-                    block_table_after_retrieval_[batch_idx][x - 1] =
-                        last_block_idx;
-                }
-                cache_seqlens_[batch_idx] =
-                    (cache_seqlens_[batch_idx] % config_.block_len) +
-                    selected_blocks_num_history_[(layer_idx -
-                                                  config_.layer_offset) /
-                                                 config_.layer_step] *
-                        config_.block_len -
-                    config_.block_len;
+        // Reuse the blocks selected for this sequence at the last retrieval.
+        for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+            int slot = history_slot_(batch_idx);
+            int &selected_num = selected_blocks_num_history_[layer_group][slot];
+            if (selected_num == 0) {
+                max_block_num_after_retrieval_ =
+                    std::max(max_block_num_after_retrieval_, max_block_num);
+                block_table_after_retrieval_[batch_idx].swap(
+                    block_table_before_retrieval_[batch_idx]);
+                continue;
             }
+            for (int i = 0; i < selected_num; i++) {
+                block_table_after_retrieval_[batch_idx][i] =
+                    selected_blocks_history_[layer_group][slot][i];
+            }
+
+            if (cache_seqlens[batch_idx] % config_.block_len == 1) {
+                selected_num += 1;
+                int last_block_idx =
+                    block_table_before_retrieval_[batch_idx]
+                                                 [cache_seqlens[batch_idx] /
+                                                  config_.block_len];
+                selected_blocks_history_[layer_group][slot][selected_num - 1] =
+                    last_block_idx;
+                block_table_after_retrieval_[batch_idx][selected_num - 1] =
+                    last_block_idx;
+            }
+            // Counted after the block of the new token is appended, so the
+            // token is attended in the step that opens its block.
+            max_block_num_after_retrieval_ =
+                std::max(max_block_num_after_retrieval_, selected_num);
+            cache_seqlens_[batch_idx] =
+                (cache_seqlens_[batch_idx] % config_.block_len) +
+                selected_num * config_.block_len - config_.block_len;
         }
     } else if (pick_block_num != -1) {
         max_block_num_after_retrieval_ =
@@ -1176,8 +1166,10 @@ void KVCache::retrieval_kvcache_layer_(const uint16_t *q_in_data,
         select_block_layer_(batch_size, layer_idx, max_block_num,
                             init_block_num, local_block_num, pick_block_num);
     } else {
-        selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                     config_.layer_step] = 0;
+        for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+            selected_blocks_num_history_[layer_group]
+                                        [history_slot_(batch_idx)] = 0;
+        }
         max_block_num_after_retrieval_ = max_block_num;
         block_table_after_retrieval_.swap(block_table_before_retrieval_);
     }
@@ -1569,14 +1561,17 @@ void KVCache::retrieval_kvcache_kvhead_(const uint16_t *q_in_data,
     // Timer start
     auto start = std::chrono::high_resolution_clock::now();
     max_block_num_after_retrieval_ = 0;
+    int layer_group = (layer_idx - config_.layer_offset) / config_.layer_step;
     if (pick_block_num != -1 &&
         (generate_token_idx % config_.token_step != 0 ||
          (layer_idx % config_.layer_step != config_.layer_offset))) {
-
-        if (selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                         config_.layer_step] == 0) {
-            max_block_num_after_retrieval_ = max_block_num;
-            for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+        // Reuse the blocks selected for this sequence at the last retrieval.
+        for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+            int slot = history_slot_(batch_idx);
+            int &selected_num = selected_blocks_num_history_[layer_group][slot];
+            if (selected_num == 0) {
+                max_block_num_after_retrieval_ =
+                    std::max(max_block_num_after_retrieval_, max_block_num);
                 for (int i = 0; i < max_block_num; i++) {
                     for (int j = 0; j < config_.kv_head_num; j++) {
                         block_table_after_retrieval_kvhead_[batch_idx][i][j] =
@@ -1584,50 +1579,40 @@ void KVCache::retrieval_kvcache_kvhead_(const uint16_t *q_in_data,
                                                                 [j];
                     }
                 }
+                continue;
             }
-        } else {
-
-            max_block_num_after_retrieval_ = selected_blocks_num_history_
-                [(layer_idx - config_.layer_offset) / config_.layer_step];
-
-            for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
-                for (int i = 0; i < max_block_num_after_retrieval_; i++) {
-                    for (int j = 0; j < config_.kv_head_num; j++) {
-                        block_table_after_retrieval_kvhead_[batch_idx][i][j] =
-                            selected_blocks_history_kvhead_
-                                [(layer_idx - config_.layer_offset) /
-                                 config_.layer_step][batch_idx][i][j];
-                    }
+            for (int i = 0; i < selected_num; i++) {
+                for (int j = 0; j < config_.kv_head_num; j++) {
+                    block_table_after_retrieval_kvhead_[batch_idx][i][j] =
+                        selected_blocks_history_kvhead_[layer_group][slot][i]
+                                                       [j];
                 }
+            }
 
-                if (cache_seqlens[batch_idx] % config_.block_len == 1) {
-                    selected_blocks_num_history_[(layer_idx -
-                                                  config_.layer_offset) /
-                                                 config_.layer_step] += 1;
-                    int x =
-                        selected_blocks_num_history_[(layer_idx -
-                                                      config_.layer_offset) /
-                                                     config_.layer_step];
-                    for (int i = 0; i < config_.kv_head_num; i++) {
-                        int last_block_idx =
-                            block_table_before_retrieval_kvhead_
-                                [batch_idx][cache_seqlens[batch_idx] /
-                                            config_.block_len][i];
-                        selected_blocks_history_kvhead_[(layer_idx -
-                                                         config_.layer_offset) /
-                                                        config_.layer_step]
-                                                       [batch_idx][x - 1][i] =
+            if (cache_seqlens[batch_idx] % config_.block_len == 1) {
+                selected_num += 1;
+                for (int i = 0; i < config_.kv_head_num; i++) {
+                    int last_block_idx =
+                        block_table_before_retrieval_kvhead_
+                            [batch_idx][cache_seqlens[batch_idx] /
+                                        config_.block_len][i];
+                    selected_blocks_history_kvhead_[layer_group][slot]
+                                                   [selected_num - 1][i] =
+                                                       last_block_idx;
+                    block_table_after_retrieval_kvhead_[batch_idx]
+                                                       [selected_num - 1][i] =
                                                            last_block_idx;
-                        block_table_after_retrieval_kvhead_[batch_idx][x - 1]
-                                                           [i] = last_block_idx;
-                    }
                 }
-                cache_seqlens_[batch_idx] = std::min(
-                    cache_seqlens_[batch_idx],
-                    (cache_seqlens_[batch_idx] % config_.block_len) +
-                        (init_block_num + pick_block_num + local_block_num) *
-                            config_.block_len);
             }
+            // Counted after the block of the new token is appended, so the
+            // token is attended in the step that opens its block.
+            max_block_num_after_retrieval_ =
+                std::max(max_block_num_after_retrieval_, selected_num);
+            cache_seqlens_[batch_idx] = std::min(
+                cache_seqlens_[batch_idx],
+                (cache_seqlens_[batch_idx] % config_.block_len) +
+                    (init_block_num + pick_block_num + local_block_num) *
+                        config_.block_len);
         }
     } else if (pick_block_num != -1) {
         max_block_num_after_retrieval_ =
@@ -1640,10 +1625,10 @@ void KVCache::retrieval_kvcache_kvhead_(const uint16_t *q_in_data,
         select_block_kvhead_(batch_size, layer_idx, max_block_num,
                              init_block_num, local_block_num, pick_block_num);
     } else {
-        selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                     config_.layer_step] = 0;
         max_block_num_after_retrieval_ = max_block_num;
         for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+            selected_blocks_num_history_[layer_group]
+                                        [history_slot_(batch_idx)] = 0;
             for (int i = 0; i < max_block_num; i++) {
                 for (int j = 0; j < config_.kv_head_num; j++) {
                     block_table_after_retrieval_kvhead_[batch_idx][i][j] =
@@ -2061,12 +2046,13 @@ void KVCache::select_block_kvhead_(int batch_size, int layer_idx,
     // Timer start
     auto start = std::chrono::high_resolution_clock::now();
 
+    int layer_group = (layer_idx - config_.layer_offset) / config_.layer_step;
     for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+        int slot = history_slot_(batch_idx);
         int cache_len_after_retrieval = 0;
         if (cache_seqlens_[batch_idx] / config_.block_len <=
             init_block_num + pick_block_num + local_block_num) {
-            selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                         config_.layer_step] = 0;
+            selected_blocks_num_history_[layer_group][slot] = 0;
             for (int i = 0; i < max_block_num; i++) {
                 for (int j = 0; j < config_.kv_head_num; j++) {
                     block_table_after_retrieval_kvhead_[batch_idx][i][j] =
@@ -2125,16 +2111,14 @@ void KVCache::select_block_kvhead_(int batch_size, int layer_idx,
                     i * config_.block_len;
             }
             for (int j = 0; j < i; j++) {
-                selected_blocks_history_kvhead_
-                    [(layer_idx - config_.layer_offset) / config_.layer_step]
-                    [batch_idx][j][head_id] =
-                        block_table_after_retrieval_kvhead_[batch_idx][j]
-                                                           [head_id];
+                selected_blocks_history_kvhead_[layer_group][slot][j]
+                                               [head_id] =
+                    block_table_after_retrieval_kvhead_[batch_idx][j]
+                                                       [head_id];
             }
         }
         cache_seqlens_[batch_idx] = cache_len_after_retrieval;
-        selected_blocks_num_history_[(layer_idx - config_.layer_offset) /
-                                     config_.layer_step] =
+        selected_blocks_num_history_[layer_group][slot] =
             (cache_len_after_retrieval + config_.block_len - 1) /
             config_.block_len;
     }
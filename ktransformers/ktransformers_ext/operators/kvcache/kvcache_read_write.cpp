@@ -17,16 +17,20 @@ void KVCache::get_anchor_one_block(ggml_fp16_t *anchor, int layer_id,
     // Timer start
     auto start = std::chrono::high_resolution_clock::now();
 
-    layer_id_ = layer_id;
-    block_idx = block_idx;
-    seq_len_ = config_.block_len;
-    anchor_data_ = const_cast<uint16_t *>(anchor);
+    // anchors of a block are laid out as [anchor_num, q_head_num, head_dim]
+    const size_t block_anchor_len =
+        (size_t)config_.anchor_num * config_.q_head_num * config_.head_dim;
+    memcpy(anchor,
+           anchor_.data() +
+               ((size_t)layer_id * config_.max_block_num + block_idx) *
+                   block_anchor_len,
+           sizeof(ggml_fp16_t) * block_anchor_len);
 
     // Timer end
     auto end = std::chrono::high_resolution_clock::now();
     std::chrono::duration<double> duration = end - start;
-    printf("layer %d block %d time of reading anchor: %f s\n", layer_id,
-           block_idx, duration.count());
+    // printf("layer %d block %d time of reading anchor: %f s\n", layer_id,
+    //        block_idx, duration.count());
 }
 
 void KVCache::update_anchor_one_block(const ggml_fp16_t *anchor, int layer_id,
@@ -72,8 +76,9 @@ void KVCache::update_importance_one_block(const ggml_fp16_t *importance,
         config_.block_len, nullptr,
         [&](int task_id) {
             int k = task_id;
-            memcpy(importance_[layer_id_][block_idx].data() + k,
-                   importance_data_ + k, sizeof(uint16_t));
+            memcpy(importance_[layer_id_][block_idx][k].data(),
+                   importance_data_ + k * config_.q_head_num,
+                   sizeof(uint16_t) * config_.q_head_num);
         },
         nullptr);
 
@@ -99,9 +104,9 @@ void KVCache::get_importance_one_block(ggml_fp16_t *importance, int layer_id,
         config_.block_len, nullptr,
         [&](int task_id) {
             int k = task_id;
-            memcpy(importance_data_ + k,
-                   importance_[layer_id_][block_idx].data() + k,
-                   sizeof(uint16_t));
+            memcpy(importance_data_ + k * config_.q_head_num,
+                   importance_[layer_id_][block_idx][k].data(),
+                   sizeof(uint16_t) * config_.q_head_num);
         },
         nullptr);
 
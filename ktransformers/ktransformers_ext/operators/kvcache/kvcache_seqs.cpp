@@ -0,0 +1,227 @@
+/**
+ * @Description  : Sequence slots of the cpu kvcache: allocation, batched
+ *                 update and attention over several sequences, anchors and
+ *                 eviction of one sequence.
+ **/
+
+#include "kvcache.h"
+
+int KVCache::alloc_seq() {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    for (int seq_id = 0; seq_id < config_.max_batch_size; seq_id++) {
+        if (seq_lens_[seq_id] == -1) {
+            seq_lens_[seq_id] = 0;
+            seq_evicted_lens_[seq_id] = 0;
+            seq_block_table_[seq_id].clear();
+            for (auto &history : selected_blocks_num_history_) {
+                history[seq_id] = 0;
+            }
+            return seq_id;
+        }
+    }
+    return -1;
+}
+
+void KVCache::free_seq(int seq_id) {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    assert(seq_id >= 0 && seq_id < config_.max_batch_size);
+    // Push back in reverse so the next allocation pops the lowest block first.
+    for (auto it = seq_block_table_[seq_id].rbegin();
+         it != seq_block_table_[seq_id].rend(); it++) {
+        release_block_(*it);
+    }
+    seq_block_table_[seq_id].clear();
+    seq_lens_[seq_id] = -1;
+    if (std::all_of(seq_lens_.begin(), seq_lens_.end(),
+                    [](int seq_len) { return seq_len == -1; })) {
+        std::sort(free_blocks_.begin(), free_blocks_.end(),
+                  std::greater<int>());
+    }
+}
+
+// Returns a block to the pool. update_importance accumulates, so the
+// importance of the block is cleared for its next owner, and so is its anchor.
+void KVCache::release_block_(int block_idx) {
+    const size_t anchor_block_size =
+        (size_t)config_.anchor_num * config_.q_head_num * config_.head_dim;
+    for (int layer_id = 0; layer_id < config_.layer_num; layer_id++) {
+        for (auto &token : importance_[layer_id][block_idx]) {
+            std::fill(token.begin(), token.end(), GGML_FP32_TO_FP16(0.0f));
+        }
+        auto anchor_block =
+            anchor_.begin() +
+            ((size_t)layer_id * config_.max_block_num + block_idx) *
+                anchor_block_size;
+        std::fill(anchor_block, anchor_block + anchor_block_size,
+                  GGML_FP32_TO_FP16(0.0f));
+    }
+    free_blocks_.push_back(block_idx);
+}
+
+int KVCache::get_seq_len(int seq_id) {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    assert(seq_id >= 0 && seq_id < config_.max_batch_size);
+    return seq_lens_[seq_id];
+}
+
+int KVCache::get_seq_evicted_len(int seq_id) {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    assert(seq_id >= 0 && seq_id < config_.max_batch_size);
+    return seq_evicted_lens_[seq_id];
+}
+
+std::vector<int> KVCache::get_seq_block_table(int seq_id) {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    assert(seq_id >= 0 && seq_id < config_.max_batch_size);
+    return seq_block_table_[seq_id];
+}
+
+bool KVCache::extend_seq(int seq_id, int q_len) {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    assert(seq_id >= 0 && seq_id < config_.max_batch_size);
+    assert(seq_lens_[seq_id] >= 0);
+    int new_len = seq_lens_[seq_id] + q_len;
+    int need_block_num = (new_len + config_.block_len - 1) / config_.block_len;
+    int add_block_num = need_block_num - (int)seq_block_table_[seq_id].size();
+    if (add_block_num > (int)free_blocks_.size()) {
+        return false;
+    }
+    for (int i = 0; i < add_block_num; i++) {
+        int block_idx = free_blocks_.back();
+        free_blocks_.pop_back();
+        seq_block_table_[seq_id].push_back(block_idx);
+        for (int layer_id = 0; layer_id < config_.layer_num; layer_id++) {
+            past_block_num_[layer_id] =
+                std::max(past_block_num_[layer_id], (uint64_t)block_idx + 1);
+        }
+    }
+    seq_lens_[seq_id] = new_len;
+    return true;
+}
+
+void KVCache::extend_seqs(const int *seq_ids, int batch_size, int q_len,
+                          Backend *backend) {
+    for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+        bool extended = extend_seq(seq_ids[batch_idx], q_len);
+        assert(extended);
+        (void)extended;
+    }
+}
+
+// Builds the padded block table and lengths of the batch in
+// seq_batch_block_table_ and seq_batch_seqlens_, the lengths are shifted by
+// len_offset. Returns the row stride of the block table.
+int KVCache::gather_seqs_(const int *seq_ids, int batch_size,
+                          int len_offset) {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    assert(batch_size <= config_.max_batch_size);
+    int max_block_num = 1;
+    for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+        assert(seq_lens_[seq_ids[batch_idx]] >= 0);
+        max_block_num = std::max(
+            max_block_num, (int)seq_block_table_[seq_ids[batch_idx]].size());
+    }
+    for (int batch_idx = 0; batch_idx < batch_size; batch_idx++) {
+        const std::vector<int> &blocks = seq_block_table_[seq_ids[batch_idx]];
+        int *row = seq_batch_block_table_.data() + batch_idx * max_block_num;
+        std::copy(blocks.begin(), blocks.end(), row);
+        // Padding is never attended, it only has to be a valid block.
+        std::fill(row + blocks.size(), row + max_block_num, 0);
+        seq_batch_seqlens_[batch_idx] =
+            seq_lens_[seq_ids[batch_idx]] + len_offset;
+    }
+    return max_block_num;
+}
+
+void KVCache::update_kvcache_seqs(const ggml_fp16_t *k_in,
+                                  const ggml_fp16_t *v_in, int layer_id,
+                                  const int *seq_ids, int batch_size,
+                                  int q_len, Backend *backend) {
+    int max_block_num = gather_seqs_(seq_ids, batch_size, -q_len);
+    update_kvcache_fp16(k_in, v_in, layer_id, seq_batch_block_table_.data(),
+                        batch_size, max_block_num, seq_batch_seqlens_.data(),
+                        q_len, backend);
+}
+
+void KVCache::attn_seqs(const ggml_fp16_t *q_in, ggml_fp16_t *output,
+                        float *attn_lse, int layer_idx, int generate_token_idx,
+                        const int *seq_ids, int batch_size, int pick_block_num,
+                        int init_block_num, int local_block_num,
+                        Backend *backend) {
+    int max_block_num = gather_seqs_(seq_ids, batch_size, 0);
+    // The selected blocks are remembered per sequence, so a sequence keeps
+    // its history whichever batch position it takes.
+    history_slots_ = seq_ids;
+    attn(q_in, output, attn_lse, layer_idx, generate_token_idx, 1, batch_size,
+         max_block_num, seq_batch_block_table_.data(),
+         seq_batch_seqlens_.data(), pick_block_num, init_block_num,
+         local_block_num, backend);
+    history_slots_ = nullptr;
+}
+
+void KVCache::calc_anchor_seqs(const int *seq_ids, int batch_size,
+                               Backend *backend) {
+    int max_block_num = gather_seqs_(seq_ids, batch_size, 0);
+    calc_anchor_all_layers(seq_batch_block_table_.data(),
+                           seq_batch_seqlens_.data(), batch_size,
+                           max_block_num, backend);
+}
+
+void KVCache::evict_seq(int seq_id, int max_len, int init_block_num,
+                        int local_block_num, Backend *backend) {
+    std::lock_guard<std::mutex> lock(seq_mutex_);
+    assert(seq_id >= 0 && seq_id < config_.max_batch_size);
+    assert(seq_lens_[seq_id] >= 0);
+    std::vector<int> &blocks = seq_block_table_[seq_id];
+    const int over_len = seq_lens_[seq_id] - max_len;
+    // Only the last block can be partially filled, dropping full blocks keeps
+    // the sequence contiguous.
+    const int first = std::max(init_block_num, 0);
+    const int last = (int)blocks.size() - std::max(local_block_num, 1);
+    if (over_len <= 0 || last <= first) {
+        return;
+    }
+    const int evict_num = std::min(
+        (over_len + config_.block_len - 1) / config_.block_len, last - first);
+
+    // (importance, position) of each candidate block
+    std::vector<std::pair<float, int>> scores(last - first);
+    backend->do_work_stealing_job(
+        last - first, nullptr,
+        [&](int task_id) {
+            int block_idx = blocks[first + task_id];
+            float score = 0;
+            for (int layer_id = 0; layer_id < config_.layer_num; layer_id++) {
+                for (const auto &token : importance_[layer_id][block_idx]) {
+                    for (ggml_fp16_t importance : token) {
+                        score += GGML_FP16_TO_FP32(importance);
+                    }
+                }
+            }
+            scores[task_id] = std::make_pair(score, first + task_id);
+        },
+        nullptr);
+    std::partial_sort(scores.begin(), scores.begin() + evict_num,
+                      scores.end());
+
+    std::vector<bool> evicted(blocks.size(), false);
+    for (int i = 0; i < evict_num; i++) {
+        evicted[scores[i].second] = true;
+    }
+    std::vector<int> kept;
+    kept.reserve(blocks.size() - evict_num);
+    for (int i = 0; i < (int)blocks.size(); i++) {
+        if (evicted[i]) {
+            release_block_(blocks[i]);
+        } else {
+            kept.push_back(blocks[i]);
+        }
+    }
+    blocks.swap(kept);
+    seq_lens_[seq_id] -= evict_num * config_.block_len;
+    seq_evicted_lens_[seq_id] += evict_num * config_.block_len;
+    // The history holds blocks of the sequence, some may be gone now.
+    for (auto &history : selected_blocks_num_history_) {
+        history[seq_id] = 0;
+    }
+}
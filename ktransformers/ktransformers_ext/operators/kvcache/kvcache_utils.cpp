@@ -116,6 +116,18 @@ KVCache::KVCache(KVCacheConfig config) {
     BatchResize(config.max_batch_size);
     BlockResize(config.max_block_num);
     q_fp32.resize(n_gqa_ * config.head_dim);
+
+    seq_lens_.assign(config.max_batch_size, -1);
+    seq_evicted_lens_.assign(config.max_batch_size, 0);
+    seq_block_table_.resize(config.max_batch_size);
+    // popped from the back, so sequences get ascending and mostly contiguous
+    // blocks
+    for (int i = config.max_block_num - 1; i >= 0; i--) {
+        free_blocks_.push_back(i);
+    }
+    seq_batch_block_table_.resize(config.max_batch_size *
+                                  config.max_block_num);
+    seq_batch_seqlens_.resize(config.max_batch_size);
 }
 
 void KVCache::ThreadResize(int thread_num) {
@@ -196,6 +208,9 @@ void KVCache::BatchResize(int batch_size) {
             attn_lse_[i][j].resize(n_gqa_);
         }
     }
+    for (int i = 0; i < selected_blocks_num_history_.size(); i++) {
+        selected_blocks_num_history_[i].resize(batch_size);
+    }
     avg_q.resize(batch_size);
     avg_q_fp16.resize(batch_size);
     for (int i = 0; i < batch_size; i++) {
@@ -322,6 +337,139 @@ void KVCache::BlockResize(int max_block_num) {
     }
 }
 
+namespace {
+// The anchors live in fp16 and the scalar kernels accumulated into them one key
+// at a time, so every step is rounded through fp16 to keep anchors identical.
+inline float round_fp16(float x) {
+    return GGML_FP16_TO_FP32(GGML_FP32_TO_FP16(x));
+}
+} // namespace
+
+// Computes the anchors of one fp16 block for all heads. Keys are converted one
+// row at a time and every kernel runs over contiguous head_dim floats. Anchors
+// that only depend on the kv head are computed once per GQA group.
+void KVCache::calc_anchor_one_block_fp16(int layer_id, int block_idx) {
+    const int head_dim = config_.head_dim;
+    const int block_len = config_.block_len;
+    const int q_head_num = config_.q_head_num;
+    ggml_fp16_t *anchor_block =
+        anchor_.data() +
+        (size_t)layer_id * config_.max_block_num * config_.anchor_num *
+            q_head_num * head_dim +
+        (size_t)block_idx * config_.anchor_num * q_head_num * head_dim;
+    auto anchor_row = [&](int anchor_id, int head_id) {
+        return anchor_block + ((size_t)anchor_id * q_head_num + head_id) * head_dim;
+    };
+    auto key_row = [&](int kv_head_id, int k) {
+        return k_cache_fp16_[layer_id][kv_head_id][block_idx].data() +
+               (size_t)k * head_dim;
+    };
+
+    std::vector<float> acc(head_dim), acc_min(head_dim), row(head_dim);
+    switch (config_.anchor_type) {
+    case AnchorType::DYNAMIC: {
+        // keys of the anchor_num most important tokens of each head, added in
+        // ascending order of (importance, position) like the priority queue did
+        std::vector<std::pair<float, int>> importances(block_len);
+        const auto &importance = importance_[layer_id][block_idx];
+        const int top_num = std::min(config_.anchor_num, block_len);
+        for (int head_id = 0; head_id < q_head_num; head_id++) {
+            for (int k = 0; k < block_len; k++) {
+                importances[k] = std::make_pair(
+                    GGML_FP16_TO_FP32(importance[k][head_id]), k);
+            }
+            std::partial_sort(importances.begin(), importances.begin() + top_num,
+                              importances.end(), std::greater<>());
+            std::fill(acc.begin(), acc.end(), 0.0f);
+            for (int i = top_num - 1; i >= 0; i--) {
+                ggml_fp16_to_fp32_row(key_row(head_id / n_gqa_, importances[i].second),
+                                      row.data(), head_dim);
+                for (int l = 0; l < head_dim; l++) {
+                    acc[l] = round_fp16(acc[l] + row[l]);
+                }
+            }
+            ggml_fp32_to_fp16_row(acc.data(), anchor_row(0, head_id), head_dim);
+        }
+        break;
+    }
+    case AnchorType::BLOCK_MEAN:
+    case AnchorType::BLOCK_MAX:
+    case AnchorType::FIXED_ANCHOR: {
+        // the fixed anchors are summed into slot 0, which is the only one cleared
+        const int cleared_num = config_.anchor_type == AnchorType::FIXED_ANCHOR
+                                    ? 1
+                                    : config_.anchor_num;
+        for (int anchor_id = 0; anchor_id < cleared_num; anchor_id++) {
+            std::fill(anchor_row(anchor_id, 0),
+                      anchor_row(anchor_id, 0) + q_head_num * head_dim,
+                      GGML_FP32_TO_FP16(0.0f));
+        }
+        const int stride = block_len / config_.anchor_num;
+        for (int kv_head_id = 0; kv_head_id < config_.kv_head_num; kv_head_id++) {
+            std::fill(acc.begin(), acc.end(), 0.0f);
+            if (config_.anchor_type == AnchorType::BLOCK_MEAN) {
+                for (int k = 0; k < block_len; k++) {
+                    ggml_fp16_to_fp32_row(key_row(kv_head_id, k), row.data(), head_dim);
+                    for (int l = 0; l < head_dim; l++) {
+                        acc[l] = round_fp16(acc[l] + row[l] / block_len);
+                    }
+                }
+            } else if (config_.anchor_type == AnchorType::BLOCK_MAX) {
+                // max is exact, no rounding needed
+                for (int k = 0; k < block_len; k++) {
+                    ggml_fp16_to_fp32_row(key_row(kv_head_id, k), row.data(), head_dim);
+                    for (int l = 0; l < head_dim; l++) {
+                        acc[l] = std::max(acc[l], row[l]);
+                    }
+                }
+            } else {
+                for (int tot = 0; tot < config_.anchor_num; tot++) {
+                    ggml_fp16_to_fp32_row(key_row(kv_head_id, tot * stride),
+                                          row.data(), head_dim);
+                    for (int l = 0; l < head_dim; l++) {
+                        acc[l] = round_fp16(acc[l] + row[l] / config_.anchor_num);
+                    }
+                }
+            }
+            for (int g = 0; g < n_gqa_; g++) {
+                ggml_fp32_to_fp16_row(acc.data(),
+                                      anchor_row(0, kv_head_id * n_gqa_ + g),
+                                      head_dim);
+            }
+        }
+        break;
+    }
+    case AnchorType::QUEST: {
+        // anchor 0 is the elementwise max of the keys and anchor 1 the min,
+        // stored at the kv head index; the max starts from fp16(FLT_MIN)
+        const ggml_fp16_t max_init =
+            GGML_FP32_TO_FP16(std::numeric_limits<float>::min());
+        const ggml_fp16_t min_init =
+            GGML_FP32_TO_FP16(std::numeric_limits<float>::max());
+        std::fill(anchor_row(0, 0), anchor_row(0, 0) + q_head_num * head_dim,
+                  max_init);
+        std::fill(anchor_row(1, 0), anchor_row(1, 0) + q_head_num * head_dim,
+                  min_init);
+        for (int head_id = 0; head_id < config_.kv_head_num; head_id++) {
+            std::fill(acc.begin(), acc.end(), GGML_FP16_TO_FP32(max_init));
+            std::fill(acc_min.begin(), acc_min.end(), GGML_FP16_TO_FP32(min_init));
+            for (int indice = 0; indice < block_len; indice++) {
+                ggml_fp16_to_fp32_row(key_row(head_id, indice), row.data(), head_dim);
+                for (int l = 0; l < head_dim; l++) {
+                    acc[l] = std::max(row[l], acc[l]);
+                    acc_min[l] = std::min(row[l], acc_min[l]);
+                }
+            }
+            ggml_fp32_to_fp16_row(acc.data(), anchor_row(0, head_id), head_dim);
+            ggml_fp32_to_fp16_row(acc_min.data(), anchor_row(1, head_id), head_dim);
+        }
+        break;
+    }
+    default:
+        assert(false);
+    }
+}
+
 void KVCache::calc_anchor_all_layers(int *block_table, int *cache_seqlens,
                                      int batch_size, int max_block_num,
                                      Backend *backend) {
@@ -345,6 +493,11 @@ void KVCache::calc_anchor_all_layers(int *block_table, int *cache_seqlens,
             }
             int block_idx = block_table[batch_id * max_block_num + block_id];
 
+            if (config_.kv_type == ggml_type::GGML_TYPE_F16) {
+                calc_anchor_one_block_fp16(layer_id, block_idx);
+                return;
+            }
+
             std::vector<float> block_fp32(32);
             if (config_.anchor_type == AnchorType::DYNAMIC) {
 
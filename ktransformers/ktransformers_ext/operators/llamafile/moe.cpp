@@ -14,6 +14,9 @@
 #ifdef USE_NUMA
 #include <numa.h>
 #include <numaif.h>
+#include <sys/mman.h>
+#include <cerrno>
+#include <cstring>
 #endif
 
 MOE::MOE(MOEConfig config) {
@@ -41,6 +44,9 @@ MOE::MOE(MOEConfig config) {
         if (!down_proj_numa_[i]) {
             std::cout << "Memory allocation failed for down_proj_numa_ on node " << i << std::endl;
         }
+        back_numa_copy(gate_proj_numa_[i], exp_inter_hidden_mul_* ggml_type_size(config.gate_type) / ggml_blck_size(config.gate_type), "gate_proj_numa_", i);
+        back_numa_copy(up_proj_numa_[i], exp_inter_hidden_mul_* ggml_type_size(config.up_type) / ggml_blck_size(config.up_type), "up_proj_numa_", i);
+        back_numa_copy(down_proj_numa_[i], exp_inter_hidden_mul_* ggml_type_size(config.down_type) / ggml_blck_size(config.down_type), "down_proj_numa_", i);
         memcpy(gate_proj_numa_[i], gate_proj_, exp_inter_hidden_mul_* ggml_type_size(config.gate_type) / ggml_blck_size(config.gate_type));
         memcpy(up_proj_numa_[i], up_proj_, exp_inter_hidden_mul_* ggml_type_size(config.up_type) / ggml_blck_size(config.up_type));
         memcpy(down_proj_numa_[i], down_proj_, exp_inter_hidden_mul_* ggml_type_size(config.down_type) / ggml_blck_size(config.down_type));
@@ -102,6 +108,21 @@ MOE::MOE(MOEConfig config) {
     m_local_down_output_ptr_.resize(config_.expert_num);
 }
 
+#ifdef USE_NUMA
+// numa_alloc_onnode maps whole pages, so the copy is advised and locked before memcpy faults it in
+void MOE::back_numa_copy(void* ptr, size_t size, const char* name, int node) {
+    if (!ptr) {
+        return;
+    }
+    if (config_.huge_pages && madvise(ptr, size, MADV_HUGEPAGE) != 0) {
+        std::cout << "madvise(MADV_HUGEPAGE) failed for " << name << " on node " << node << ": " << strerror(errno) << std::endl;
+    }
+    if (config_.lock_memory && mlock(ptr, size) != 0) {
+        std::cout << "mlock failed for " << name << " on node " << node << ": " << strerror(errno) << std::endl;
+    }
+}
+#endif
+
 MOE::~MOE() {
     shared_mem_buffer.dealloc(this);
 
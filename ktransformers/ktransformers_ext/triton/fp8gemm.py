@@ -1,4 +1,6 @@
 # Adopted from https://huggingface.co/deepseek-ai/DeepSeek-V3/blob/main/inference/kernel.py
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple
 
 import torch
@@ -99,6 +101,8 @@ def weight_dequant(x: torch.Tensor, s: torch.Tensor, block_size: int = 128) -> t
     """
     assert x.is_contiguous() and s.is_contiguous(), 'Input tensors must be contiguous'
     assert x.dim() == 2 and s.dim() == 2, 'Input tensors must have 2 dimensions'
+    if x.device.type == "cpu":
+        return weight_dequant_cpu(x, s, block_size)
     M, N = x.size()
     y = torch.empty_like(x, dtype=torch.get_default_dtype())
     grid = lambda meta: (triton.cdiv(M, meta['BLOCK_SIZE']), triton.cdiv(N, meta['BLOCK_SIZE']))
@@ -107,6 +111,54 @@ def weight_dequant(x: torch.Tensor, s: torch.Tensor, block_size: int = 128) -> t
     return y
 
 
+def weight_dequant_cpu(x: torch.Tensor, s: torch.Tensor, block_size: int = 128, num_threads: int = None) -> torch.Tensor:
+    """
+    Dequantizes the given weight tensor on the cpu with the math of `weight_dequant_kernel`, every
+    element is converted to float32, multiplied by the float32 scale of its block and rounded to the
+    default dtype, so the result is bit exact with the kernel.
+
+    The rows are split into bands of whole blocks which `num_threads` threads dequantize with a few
+    tensor operations each, there is no Python work per block.
+
+    Args:
+        x (torch.Tensor): The quantized weight tensor of shape (M, N).
+        s (torch.Tensor): The scale tensor of shape (ceil(M / block_size), ceil(N / block_size)).
+        block_size (int, optional): The block size to use for dequantization. Defaults to 128.
+        num_threads (int, optional): The number of threads. Defaults to the cpu count, at most 8.
+
+    Returns:
+        torch.Tensor: The dequantized weight tensor of the same shape as `x`.
+    """
+    assert x.dim() == 2 and s.dim() == 2, 'Input tensors must have 2 dimensions'
+    M, N = x.size()
+    m, n = triton.cdiv(M, block_size), triton.cdiv(N, block_size)
+    assert s.size() == (m, n), f'Scale tensor of shape {tuple(s.shape)} does not match blocks of ({M}, {N})'
+    x = x.cpu()
+    s = s.cpu().float()
+    y = torch.empty((M, N), dtype=torch.get_default_dtype())
+
+    def dequant_band(i):
+        start, end = i * block_size, min((i + 1) * block_size, M)
+        scale = s[i]
+        if N % block_size == 0:
+            band = x[start:end].to(torch.float32).view(end - start, n, block_size)
+            y[start:end] = band.mul_(scale.view(1, n, 1)).view(end - start, N)
+        else:
+            band = x[start:end].to(torch.float32)
+            y[start:end] = band.mul_(scale.repeat_interleave(block_size)[:N])
+
+    num_threads = min(num_threads or min(8, os.cpu_count() or 1), m)
+    if num_threads <= 1:
+        for i in range(m):
+            dequant_band(i)
+    else:
+        with ThreadPoolExecutor(num_threads, thread_name_prefix="weight_dequant") as executor:
+            # result() raises the first error of a band
+            for future in [executor.submit(dequant_band, i) for i in range(m)]:
+                future.result()
+    return y
+
+
 fp8_gemm_configs = [
     Config({'BLOCK_SIZE_M': block_m, 'BLOCK_SIZE_N': block_n, 'BLOCK_SIZE_K': 128}, num_stages=num_stages, num_warps=8)
     for block_m in [16, 32, 64] for block_n in [32, 64, 128] for num_stages in [3, 4, 5, 6]
@@ -28,7 +28,8 @@ from ktransformers.models.modeling_qwen2_moe import Qwen2MoeForCausalLM
 from ktransformers.models.modeling_deepseek_v3 import DeepseekV3ForCausalLM
 from ktransformers.models.modeling_llama import LlamaForCausalLM
 from ktransformers.models.modeling_mixtral import MixtralForCausalLM
-from ktransformers.util.utils import prefill_and_generate, get_compute_capability
+from ktransformers.util.utils import prefill_and_generate, get_compute_capability, get_all_used_cuda_device
+from ktransformers.util.chunk_tuner import ChunkSizeTuner, hardware_profile
 from ktransformers.server.config.config import Config
 from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled
 from ktransformers.util.vendors import device_manager, get_device, to_device, GPUVendor
@@ -63,7 +64,9 @@ def local_chat(
     prompt_file : str | None = None,
     mode: str = "normal",
     force_think: bool = False,
-    chunk_prefill_size: int = 8192
+    chunk_prefill_size: int = 8192,
+    chunk_prefill_autotune: bool = False,
+    lazy_load: bool = False,
 ):
 
     torch.set_grad_enabled(False)
@@ -74,6 +77,8 @@ def local_chat(
     config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
     if mode == 'long_context':
         assert config.architectures[0] == "LlamaForCausalLM", "only LlamaForCausalLM support long_context mode"
+        assert not (use_cuda_graph and Config().long_context_config.get("attn_sparsity", False)), \
+            "long_context attn_sparsity cannot run in a cuda graph, set use_cuda_graph to False"
         torch.set_default_dtype(torch.float16)
     else:
         torch.set_default_dtype(config.torch_dtype)
@@ -109,7 +114,7 @@ def local_chat(
         gguf_path = input(
             "please input the path of your gguf file(gguf file in the dir containing input gguf file must all belong to current model):"
         )
-    optimize_and_load_gguf(model, optimize_config_path, gguf_path, config)
+    optimize_and_load_gguf(model, optimize_config_path, gguf_path, config, lazy=lazy_load)
     
     try:
         model.generation_config = GenerationConfig.from_pretrained(model_path)
@@ -127,6 +132,15 @@ def local_chat(
     model.eval()
     logging.basicConfig(level=logging.INFO)
 
+    chunk_tuner = None
+    if chunk_prefill_autotune:
+        device_map = model.gguf_loader.tensor_device_map
+        chunk_tuner = ChunkSizeTuner(
+            Config().chunk_tuning_path,
+            f"{model_path}:{gguf_path}:{optimize_config_path}:{hardware_profile(get_all_used_cuda_device(device_map))}:{cpu_infer}",
+            chunk_prefill_size,
+        )
+
     system = platform.system()
     if system == "Windows":
         os.system("cls")
@@ -167,17 +181,19 @@ def local_chat(
                 [input_tensor, token_thinks], dim=1
             )
         if mode == 'long_context':
-            assert Config().long_context_config['max_seq_len'] > input_tensor.shape[1] + max_new_tokens, \
+            # with a kvcache budget decode evicts from the cpu kvcache, only the prompt has to fit
+            budget = Config().long_context_config.get('kvcache_budget', 0)
+            assert Config().long_context_config['max_seq_len'] > input_tensor.shape[1] + (0 if budget else max_new_tokens), \
             "please change max_seq_len in  ~/.ktransformers/config.yaml"
         
         if system != "Windows" and (config.architectures[0] == "DeepseekV2ForCausalLM" or config.architectures[0] == "DeepseekV3ForCausalLM") and flashinfer_enabled and get_compute_capability() >= 8 and device_manager.gpu_vendor == GPUVendor.NVIDIA:
             generated = prefill_and_generate(
-                model, tokenizer, input_tensor.cuda(), max_new_tokens, use_cuda_graph, mode = mode, force_think = force_think, chunk_prefill_size = chunk_prefill_size,
+                model, tokenizer, input_tensor.cuda(), max_new_tokens, use_cuda_graph, mode = mode, force_think = force_think, chunk_prefill_size = chunk_prefill_size, chunk_tuner = chunk_tuner,
                 use_flashinfer_mla = True, num_heads = config.num_attention_heads, head_dim_ckv = config.kv_lora_rank, head_dim_kpe = config.qk_rope_head_dim, q_head_dim = config.qk_rope_head_dim + config.qk_nope_head_dim
             )
         else:
             generated = prefill_and_generate(
-                model, tokenizer, input_tensor.cuda(), max_new_tokens, use_cuda_graph, mode = mode, force_think = force_think, chunk_prefill_size = chunk_prefill_size,
+                model, tokenizer, input_tensor.cuda(), max_new_tokens, use_cuda_graph, mode = mode, force_think = force_think, chunk_prefill_size = chunk_prefill_size, chunk_tuner = chunk_tuner,
             )
 
 
@@ -153,7 +153,9 @@ def local_chat(
                 [input_tensor, token_thinks], dim=1
             )
         if mode == 'long_context':
-            assert Config().long_context_config['max_seq_len'] > input_tensor.shape[1] + max_new_tokens, \
+            # with a kvcache budget decode evicts from the cpu kvcache, only the prompt has to fit
+            budget = Config().long_context_config.get('kvcache_budget', 0)
+            assert Config().long_context_config['max_seq_len'] > input_tensor.shape[1] + (0 if budget else max_new_tokens), \
             "please change max_seq_len in  ~/.ktransformers/config.yaml"
         
         if system != "Windows" and (config.architectures[0] == "DeepseekV2ForCausalLM" or config.architectures[0] == "DeepseekV3ForCausalLM") and flashinfer_enabled and get_compute_capability() >= 8:
@@ -11,6 +11,45 @@ import torch
 import transformers
 from transformers import Cache, PretrainedConfig
 from typing import List, Optional, Dict, Any, Tuple
+from ktransformers.models.modeling_llama import rotate_half
+
+# storage dtype and the largest representable magnitude of each quantized kv format
+KV_QUANT_TYPES = {
+    "int8": (torch.int8, 127.0),
+    "fp8": (torch.float8_e4m3fn, 448.0),
+    "int4": (torch.int8, 7.0),
+}
+
+def kv_quant_from_args(args) -> Optional[str]:
+    """Map the cache_q4 / cache_8bit server arguments to a `StaticCache` kv_quant."""
+    if getattr(args, "cache_q4", False):
+        return "int4"
+    if getattr(args, "cache_8bit", False):
+        return getattr(args, "cache_8bit_format", "fp8")
+    return None
+
+def quantize_kv(x: torch.Tensor, kv_quant: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric quantization of `x` with one float32 scale per row of the last dim.
+    int4 packs two values into each int8, so the last dim of the result is halved.
+    """
+    storage_dtype, qmax = KV_QUANT_TYPES[kv_quant]
+    x = x.float()
+    scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+    x = x / scale
+    if kv_quant == "fp8":
+        return x.to(storage_dtype), scale
+    q = x.round_().clamp_(-qmax - 1 if kv_quant == "int4" else -qmax, qmax).to(torch.int8)
+    if kv_quant == "int4":
+        q = (q[..., 0::2] & 0xF) | (q[..., 1::2] << 4)
+    return q, scale
+
+def dequantize_kv(q: torch.Tensor, scale: torch.Tensor, kv_quant: str, dtype: torch.dtype) -> torch.Tensor:
+    if kv_quant == "int4":
+        # arithmetic shifts sign-extend both nibbles
+        q = torch.stack(((q << 4) >> 4, q >> 4), dim=-1).flatten(-2)
+    return (q.float() * scale).to(dtype)
+
 class StaticCache(transformers.StaticCache):
     """
     Static Cache class to be used with `torch.compile(model)`.
@@ -27,10 +66,25 @@ class StaticCache(transformers.StaticCache):
             If a `dict`, it should contain the `device` key with the device name as the value.
         dtype (*optional*, defaults to `torch.float32`):
             The default `dtype` to use when initializing the layer.
+        kv_quant (`str`, *optional*):
+            Store the cache as "int8", "fp8" or "int4" instead of `dtype`. Scales are kept per head and token, or
+            per page slot for MLA, and `update` dequantizes a layer into a buffer shared by all layers on a device.
+            An attention that reads the quantized storage with `read_scales` passes `"dequantize": False` in
+            `cache_kwargs` and gets the storage back instead.
+        sink_tokens (`int`, *optional*):
+            Enable the attention sink window policy: `evict` keeps the first `sink_tokens` tokens and drops the
+            oldest tokens after them, so a sequence can run past `max_cache_len`.
     """
 
-    def __init__(self, config: PretrainedConfig, max_batch_size: int, max_cache_len: int, device: torch.device| dict, dtype=None) -> None:
+    def __init__(self, config: PretrainedConfig, max_batch_size: int, max_cache_len: int, device: torch.device| dict, dtype=None, kv_quant: Optional[str] = None, sink_tokens: Optional[int] = None) -> None:
         Cache.__init__(self)
+        if sink_tokens is not None and not 0 <= sink_tokens < max_cache_len:
+            raise ValueError(f"sink_tokens should be in [0, {max_cache_len}), got {sink_tokens}")
+        self.sink_tokens = sink_tokens
+        # tokens dropped by `evict` since the last reset
+        self.evicted_tokens = 0
+        # per layer, (device, event) of copies that still read the layer on a side stream, see `wait_pending_reads`
+        self.pending_reads: Dict[int, List[Tuple[torch.device, Any]]] = {}
         self.max_batch_size = max_batch_size
         self.max_cache_len = config.max_position_embeddings if max_cache_len is None else max_cache_len
         # Some model define a custom `head_dim` != config.hidden_size // config.num_attention_heads
@@ -80,6 +134,15 @@ class StaticCache(transformers.StaticCache):
             value_shape = cache_shape
             self.is_MLA = False
 
+        if kv_quant is not None and kv_quant not in KV_QUANT_TYPES:
+            raise ValueError(f"kv_quant should be one of {list(KV_QUANT_TYPES)}, got {kv_quant}")
+        self.kv_quant = kv_quant
+        self.key_scale: List[torch.Tensor] = []
+        self.value_scale: List[torch.Tensor] = []
+        # device -> full precision (key, value) of the layer being computed, only used by a quantized cache
+        self.dequant_buffers: Dict[Any, Tuple[torch.Tensor, Optional[torch.Tensor]]] = dict()
+        self.dequant_buffer_list = []
+
         self.past_tokens = []
         self.num_hidden_layers = config.num_hidden_layers
         for idx in range(self.num_hidden_layers):
@@ -90,7 +153,11 @@ class StaticCache(transformers.StaticCache):
             else:
                 target_device = device
             
-            if self.is_MLA:
+            if self.kv_quant is not None:
+                self._init_quantized_layer(
+                    latent_shape if self.is_MLA else key_shape, None if self.is_MLA else value_shape, target_device
+                )
+            elif self.is_MLA:
                 new_layer_key_cache = torch.zeros(latent_shape, dtype=self.dtype, device=target_device)
                 new_layer_value_cache = None
                 torch._dynamo.mark_static_address(new_layer_key_cache)
@@ -99,11 +166,80 @@ class StaticCache(transformers.StaticCache):
                 new_layer_value_cache = torch.zeros(value_shape, dtype=self.dtype, device=target_device)
                 torch._dynamo.mark_static_address(new_layer_key_cache)
                 torch._dynamo.mark_static_address(new_layer_value_cache)
-                
-            self.key_cache.append(new_layer_key_cache)
-            self.value_cache.append(new_layer_value_cache)
+
+            if self.kv_quant is None:
+                self.key_cache.append(new_layer_key_cache)
+                self.value_cache.append(new_layer_value_cache)
             self.past_tokens.append(0)
 
+    def _init_quantized_layer(self, key_shape, value_shape, target_device):
+        storage_dtype, _ = KV_QUANT_TYPES[self.kv_quant]
+        packed = 2 if self.kv_quant == "int4" else 1
+        # MLA rows hold the compressed kv and k_pe, which have very different ranges, so each gets its own scale
+        scale_dim = 2 if self.is_MLA else 1
+
+        def storage(shape):
+            q = torch.zeros(shape[:-1] + (shape[-1] // packed,), dtype=storage_dtype, device=target_device)
+            scale = torch.zeros(shape[:-1] + (scale_dim,), dtype=torch.float32, device=target_device)
+            torch._dynamo.mark_static_address(q)
+            torch._dynamo.mark_static_address(scale)
+            return q, scale
+
+        k_q, k_scale = storage(key_shape)
+        v_q, v_scale = (None, None) if value_shape is None else storage(value_shape)
+        self.key_cache.append(k_q)
+        self.key_scale.append(k_scale)
+        self.value_cache.append(v_q)
+        self.value_scale.append(v_scale)
+        if target_device not in self.dequant_buffers:
+            k_buf = torch.zeros(key_shape, dtype=self.dtype, device=target_device)
+            v_buf = None if value_shape is None else torch.zeros(value_shape, dtype=self.dtype, device=target_device)
+            torch._dynamo.mark_static_address(k_buf)
+            if v_buf is not None:
+                torch._dynamo.mark_static_address(v_buf)
+            self.dequant_buffers[target_device] = (k_buf, v_buf)
+        self.dequant_buffer_list.append(self.dequant_buffers[target_device])
+
+    def _quantized_update(self, key_states, value_states, layer_idx, cache_position, dequantize=True):
+        k_q, k_scale = self.key_cache[layer_idx], self.key_scale[layer_idx]
+        k_buf, v_buf = self.dequant_buffer_list[layer_idx]
+        # inside cuda graph capture the length is not known on host, so the whole layer is dequantized
+        if k_q.is_cuda and torch.cuda.is_current_stream_capturing():
+            length = self.max_cache_len
+        else:
+            length = self.past_tokens[layer_idx]
+        if self.is_MLA:
+            page_idx = cache_position // self.page_size
+            page_offset = cache_position % self.page_size
+            packed_rank = k_q.shape[-1] * self.kv_lora_rank // k_buf.shape[-1]
+            q, scale = quantize_kv(key_states, self.kv_quant)
+            k_q[page_idx, page_offset, :, :packed_rank] = q
+            k_scale[page_idx, page_offset, :, :1] = scale
+            q, scale = quantize_kv(value_states, self.kv_quant)
+            k_q[page_idx, page_offset, :, packed_rank:] = q
+            k_scale[page_idx, page_offset, :, 1:] = scale
+            if not dequantize:
+                return k_q, self.page_table_list[layer_idx]
+
+            used_pages = min((length + self.page_size - 1) // self.page_size, self.max_pages)
+            k_buf[:used_pages, ..., :self.kv_lora_rank] = dequantize_kv(
+                k_q[:used_pages, ..., :packed_rank], k_scale[:used_pages, ..., :1], self.kv_quant, self.dtype
+            )
+            k_buf[:used_pages, ..., self.kv_lora_rank:] = dequantize_kv(
+                k_q[:used_pages, ..., packed_rank:], k_scale[:used_pages, ..., 1:], self.kv_quant, self.dtype
+            )
+            return k_buf, self.page_table_list[layer_idx]
+
+        v_q, v_scale = self.value_cache[layer_idx], self.value_scale[layer_idx]
+        k_q[:, :, cache_position], k_scale[:, :, cache_position] = quantize_kv(key_states, self.kv_quant)
+        v_q[:, :, cache_position], v_scale[:, :, cache_position] = quantize_kv(value_states, self.kv_quant)
+        if not dequantize:
+            return k_q, v_q
+        # positions after length are left stale, the causal mask never lets attention read them
+        k_buf[:, :, :length] = dequantize_kv(k_q[:, :, :length], k_scale[:, :, :length], self.kv_quant, self.dtype)
+        v_buf[:, :, :length] = dequantize_kv(v_q[:, :, :length], v_scale[:, :, :length], self.kv_quant, self.dtype)
+        return k_buf, v_buf
+
     def update(
         self,
         key_states: torch.Tensor,
@@ -130,9 +266,14 @@ class StaticCache(transformers.StaticCache):
             A tuple containing the updated key and value states.
         """
         cache_position = cache_kwargs.get("cache_position")
+        self.wait_pending_reads(layer_idx)
         k_out = self.key_cache[layer_idx]
         v_out = self.value_cache[layer_idx]
         self.past_tokens[layer_idx] += cache_position.size(0)
+        if self.kv_quant is not None:
+            return self._quantized_update(
+                key_states, value_states, layer_idx, cache_position, cache_kwargs.get("dequantize", True)
+            )
         #print(cache_position)
         if self.is_MLA:
             page_idx = cache_position // self.page_size
@@ -165,26 +306,154 @@ class StaticCache(transformers.StaticCache):
         """Returns the maximum sequence length of the cached states."""
         return self.max_cache_len
 
+    def _layer_storage(self, layer_idx: int) -> List[torch.Tensor]:
+        """All tensors holding the cache of a layer, the token dim is -2 for non-MLA, pages are flattened for MLA."""
+        tensors = [self.key_cache[layer_idx], self.value_cache[layer_idx]]
+        if self.kv_quant is not None:
+            tensors += [self.key_scale[layer_idx], self.value_scale[layer_idx]]
+        tensors = [t for t in tensors if t is not None]
+        if self.is_MLA:
+            return [t.view(-1, t.shape[-1]) for t in tensors]
+        return tensors
+
+    def read_scales(self, layer_idx: int) -> Optional[torch.Tensor]:
+        """
+        Scales of the quantized MLA storage of a layer, for a decode kernel that reads the storage itself instead of
+        the dequantized buffer. None when the buffer has to be read: full precision, packed int4, or fp8 on a gpu
+        older than sm89, where triton cannot load fp8.
+        """
+        if not self.is_MLA or self.kv_quant not in ("int8", "fp8"):
+            return None
+        k_q = self.key_cache[layer_idx]
+        if not k_q.is_cuda or (self.kv_quant == "fp8" and torch.cuda.get_device_capability(k_q.device) < (8, 9)):
+            return None
+        return self.key_scale[layer_idx]
+
+    def wait_pending_reads(self, layer_idx: int):
+        """Make the compute stream wait for the side stream copies that read the layer, before it writes the layer."""
+        for device, event in self.pending_reads.pop(layer_idx, ()):
+            torch.cuda.current_stream(device).wait_event(event)
+
     def reset(self):
         """Resets the cache values while preserving the objects"""
         for layer_idx in range(len(self.key_cache)):
+            self.wait_pending_reads(layer_idx)
             # In-place ops prevent breaking the static address
-            self.key_cache[layer_idx].zero_()
-            if self.value_cache[layer_idx] is not None:
-                self.value_cache[layer_idx].zero_()
+            for t in self._layer_storage(layer_idx):
+                t.zero_()
             self.past_tokens[layer_idx] = 0
+        self.evicted_tokens = 0
+
+    def _token_slice(self, t: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        return t[start:end] if self.is_MLA else t[..., start:end, :]
+
+    def _rotate_keys(self, layer_idx: int, start: int, end: int, cos: torch.Tensor, sin: torch.Tensor):
+        """Apply the rotation given by `cos` and `sin` to the rope part of the keys cached in [start, end)."""
+        rope_dim = cos.shape[-1]
+
+        def rotate(k: torch.Tensor) -> torch.Tensor:
+            k = k.float()
+            return k * cos + rotate_half(k) * sin
+
+        k = self.key_cache[layer_idx]
+        cos, sin = cos.to(k.device), sin.to(k.device)
+        if self.is_MLA:
+            k = k.view(-1, k.shape[-1])
+        k = self._token_slice(k, start, end)
+        if self.kv_quant is None:
+            # MLA stores k_pe after the compressed kv, other models rotate the leading dims of the head
+            rope = k[..., self.kv_lora_rank:] if self.is_MLA else k[..., :rope_dim]
+            rope.copy_(rotate(rope))
+            return
+        scale = self.key_scale[layer_idx]
+        if self.is_MLA:
+            scale = scale.view(-1, scale.shape[-1])
+        scale = self._token_slice(scale, start, end)
+        if self.is_MLA:
+            packed_rank = k.shape[-1] * self.kv_lora_rank // (self.kv_lora_rank + self.qk_rope_head_dim)
+            k_pe = dequantize_kv(k[..., packed_rank:], scale[..., 1:], self.kv_quant, torch.float32)
+            k[..., packed_rank:], scale[..., 1:] = quantize_kv(rotate(k_pe), self.kv_quant)
+            return
+        full = dequantize_kv(k, scale, self.kv_quant, torch.float32)
+        full[..., :rope_dim] = rotate(full[..., :rope_dim])
+        k[...], scale[...] = quantize_kv(full, self.kv_quant)
+
+    def evict(self, num_tokens: int, cos: torch.Tensor, sin: torch.Tensor) -> int:
+        """
+        Drop the `num_tokens` oldest tokens after the sink tokens and move the later ones down in place. Moved keys are
+        rotated by `cos` and `sin`, which should move them back `num_tokens` positions (see
+        `ktransformers.operators.RoPE.rope_shift`), so every cached token keeps the position of its new slot.
+        Only the first sequence of a paged MLA cache is moved. Returns the number of tokens dropped.
+        """
+        if self.sink_tokens is None:
+            raise ValueError("the cache was created without sink_tokens")
+        length = self.past_tokens[0]
+        num_tokens = min(num_tokens, length - self.sink_tokens)
+        if num_tokens <= 0:
+            return 0
+        start, end = self.sink_tokens, length - num_tokens
+        for layer_idx in range(self.num_hidden_layers):
+            self.wait_pending_reads(layer_idx)
+            # In-place ops prevent breaking the static address
+            for t in self._layer_storage(layer_idx):
+                # source and destination overlap when the window is longer than the evicted span
+                moved = self._token_slice(t, start + num_tokens, length).clone()
+                self._token_slice(t, start, end).copy_(moved)
+                self._token_slice(t, end, length).zero_()
+            self._rotate_keys(layer_idx, start, end, cos, sin)
+            self.past_tokens[layer_idx] = end
+        self.evicted_tokens += num_tokens
+        return num_tokens
 
     def remove_suffix(self, start_pos):
         for layer_idx in range(len(self.key_cache)):
+            self.wait_pending_reads(layer_idx)
             # In-place ops prevent breaking the static address
-            if self.is_MLA:
-                k_cache = self.key_cache[layer_idx]
-                k_cache.view(-1, k_cache.shape[-1])[start_pos:].zero_()
-            else:
-                self.key_cache[layer_idx][..., start_pos:, :].zero_()
-                self.value_cache[layer_idx][..., start_pos:, :].zero_()
+            for t in self._layer_storage(layer_idx):
+                if self.is_MLA:
+                    t[start_pos:].zero_()
+                else:
+                    t[..., start_pos:, :].zero_()
             self.past_tokens[layer_idx] = start_pos
+        if self.sink_tokens is not None and start_pos <= self.sink_tokens:
+            # what is left was never moved
+            self.evicted_tokens = 0
     
     def get_max_cache_shape(self) -> Tuple[int, int, int, int]:
         """Returns the maximum shape of the cache."""
         return self.max_cache_len
+
+    def dump_prefix(self, path: str, length: int):
+        """Serialize the first `length` cached tokens of every layer to `path`."""
+        def to_cpu(t: torch.Tensor) -> torch.Tensor:
+            # copy only the prefix, saving a view would serialize the whole cache storage
+            t = t[:length] if self.is_MLA else t[..., :length, :]
+            return torch.empty(t.shape, dtype=t.dtype, device="cpu").copy_(t)
+
+        layers = [[to_cpu(t) for t in self._layer_storage(layer_idx)] for layer_idx in range(self.num_hidden_layers)]
+        torch.save({"length": length, "is_MLA": self.is_MLA, "kv_quant": self.kv_quant, "layers": layers}, path)
+
+    def load_prefix(self, path: str) -> int:
+        """
+        Memory-map a prefix written by `dump_prefix` back into the cache and return its length.
+        Entries after the prefix are left as they are, call `remove_suffix` to clear them.
+        """
+        snapshot = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+        length = snapshot["length"]
+        if (
+            "layers" not in snapshot
+            or snapshot["is_MLA"] != self.is_MLA
+            or snapshot["kv_quant"] != self.kv_quant
+            or len(snapshot["layers"]) != self.num_hidden_layers
+        ):
+            raise ValueError(f"kv cache snapshot {path} does not match the cache layout")
+        for layer_idx in range(self.num_hidden_layers):
+            self.wait_pending_reads(layer_idx)
+            for t, saved in zip(self._layer_storage(layer_idx), snapshot["layers"][layer_idx]):
+                if self.is_MLA:
+                    t[:length].copy_(saved)
+                else:
+                    t[..., :length, :].copy_(saved)
+            self.past_tokens[layer_idx] = length
+        self.evicted_tokens = 0
+        return length
@@ -5,6 +5,7 @@ Version      : 0.1.0
 Copyright (c) 2024 by KVCache.AI, All Rights Reserved. 
 """
 
+from typing import Tuple
 from torch import nn
 from transformers import ROPE_INIT_FUNCTIONS
 from ktransformers.models.modeling_llama import (
@@ -359,3 +360,17 @@ class DynamicNTKScalingRotaryEmbedding(
             self.orig_module.rope_type,
             self.orig_module.config,
         )
+
+
+@torch.no_grad()
+def rope_shift(rotary_emb: nn.Module, shift: int, device) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    cos and sin of shape (rotary dim,) that move a key rotated by `rotary_emb` `shift` positions,
+    as `k * cos + rotate_half(k) * sin`. Any attention scaling the module folds into cos and sin
+    (the yarn mscale) is divided out, the cached key already carries it.
+    """
+    position_ids = torch.tensor([[shift]], device=device)
+    cos, sin = rotary_emb(torch.empty(0, device=device, dtype=torch.float32), position_ids)
+    cos, sin = cos.flatten().float(), sin.flatten().float()
+    norm = torch.sqrt(cos * cos + sin * sin)
+    return cos / norm, sin / norm
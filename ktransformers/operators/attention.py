@@ -238,8 +238,12 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
         
         # decode
         if q_len == 1:
+            kv_scale = None
             if past_key_value is not None:
                 cache_kwargs = {"sin": sin, "cos": cos, "cache_position": cache_position}  # Specific to RoPE models
+                # a quantized cache is read as stored, the kernel applies the scales
+                kv_scale = past_key_value.read_scales(self.layer_idx) if hasattr(past_key_value, "read_scales") else None
+                cache_kwargs["dequantize"] = kv_scale is None
                 compressed_kv_with_k_pe, page_table = past_key_value.update(compressed_kv, k_pe, self.layer_idx, cache_kwargs)
                 compressed_kv = compressed_kv_with_k_pe [:, :, :, :self.kv_lora_rank] # for speed
                 # compressed_kv_with_k_pe [bsz, q_len, 1, self.kv_lora_rank + self.qk_rope_head_dim]
@@ -285,7 +289,8 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                              position_ids.squeeze(0).to(torch.int32)+1, attn_logits,
                              4, #num_kv_splits # follow vLLM, fix it TODO
                              self.softmax_scale,
-                             past_key_value.page_size)
+                             past_key_value.page_size,
+                             kv_scale=kv_scale)
             
             # attn_output [bsz, q_len, self.num_heads, self.kv_lora_rank]
             # out_absorb [self.num_heads, self.v_head_dim, self.kv_lora_rank]
@@ -518,6 +523,59 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
             attn_output = self.o_proj(attn_output)
             return attn_output, None, past_key_value
         
+    def forward_no_cache(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        # without a kv cache there are no pages for the absorbed decode kernels to read,
+        # so every q_len, 1 included, attends over the decompressed kv of the input only
+        bsz, q_len, _ = hidden_states.size()
+
+        if self.q_lora_rank is None:
+            q = self.q_proj(hidden_states)
+        else:
+            q = self.q_b_proj(self.q_a_layernorm(self.q_a_proj(hidden_states)))
+        q = q.view(bsz, q_len, self.num_heads, self.q_head_dim).transpose(1, 2)
+        q_nope, q_pe = torch.split(
+            q, [self.qk_nope_head_dim, self.qk_rope_head_dim], dim=-1
+        )
+
+        compressed_kv = self.kv_a_proj_with_mqa(hidden_states)
+        compressed_kv, k_pe = torch.split(
+            compressed_kv, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1
+        )
+        k_pe = k_pe.view(bsz, q_len, 1, self.qk_rope_head_dim).transpose(1, 2)
+        kv = (
+            self.kv_b_proj(self.kv_a_layernorm(compressed_kv))
+            .view(bsz, q_len, self.num_heads, self.qk_nope_head_dim + self.v_head_dim)
+            .transpose(1, 2)
+        )
+        k_nope, value_states = torch.split(kv, [self.qk_nope_head_dim, self.v_head_dim], dim=-1)
+
+        if position_ids is None:
+            position_ids = torch.arange(q_len, device=hidden_states.device).unsqueeze(0)
+        cos, sin = self.rotary_emb(q_pe, position_ids)
+        q_pe, k_pe = apply_rotary_pos_emb(q_pe, k_pe, cos, sin)
+        # q_pe [bsz, self.num_heads, q_len, self.qk_rope_head_dim] k_pe [bsz, 1, q_len, self.qk_rope_head_dim]
+
+        query_states = torch.cat([q_nope, q_pe], dim=-1)
+        key_states = torch.cat([k_nope, k_pe.expand(-1, self.num_heads, -1, -1)], dim=-1)
+        if attention_mask is not None:
+            attn_output = F.scaled_dot_product_attention(
+                query_states, key_states, value_states,
+                attn_mask=attention_mask[:, :, :, :q_len], scale=self.softmax_scale
+            )
+        else:
+            attn_output = F.scaled_dot_product_attention(
+                query_states, key_states, value_states, is_causal=True, scale=self.softmax_scale
+            )
+        # attn_output [bsz, self.num_heads, q_len, self.v_head_dim]
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.num_heads * self.v_head_dim)
+        attn_output = self.o_proj(attn_output)
+        return attn_output, None, None
+
     def forward_windows(
         self,
         hidden_states: torch.Tensor,
@@ -595,6 +653,8 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
         cache_position: Optional[torch.LongTensor] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if past_key_value is None:
+            return self.forward_no_cache(hidden_states, attention_mask, position_ids)
         if os.name == 'nt' or get_compute_capability()<8 or device_manager.gpu_vendor != GPUVendor.NVIDIA:
             return self.forward_windows(
                 hidden_states,
@@ -607,7 +667,8 @@ class KDeepseekV2Attention(BaseInjectedModule, DeepseekV2Attention):
                 **kwargs,
             )
         else:
-            if flashinfer_enabled:
+            # flashinfer only reads a full precision cache, a quantized one would be dequantized on every step
+            if flashinfer_enabled and not (hasattr(past_key_value, "read_scales") and past_key_value.read_scales(self.layer_idx) is not None):
                 return self.forward_linux_flashinfer(
                     hidden_states,
                     attention_mask,
@@ -325,12 +325,14 @@ class CPUInferKVCache:
             block_idx,
         )
 
+    # importance: (block_len, q_head_num)
     def update_importance_one_block(
         self, importance: torch.Tensor, layer_id: int, block_idx: int
     ):
         assert (
-            importance.dim() == 1
+            importance.dim() == 2
             and importance.size(0) == self.config.block_len
+            and importance.size(1) == self.config.q_head_num
             and importance.dtype == torch.float16
             and importance.is_contiguous()
             and importance.device == torch.device("cpu")
@@ -355,8 +357,9 @@ class CPUInferKVCache:
         self, importance: torch.Tensor, layer_id: int, block_idx: int
     ):
         assert (
-            importance.dim() == 1
+            importance.dim() == 2
             and importance.size(0) == self.config.block_len
+            and importance.size(1) == self.config.q_head_num
             and importance.dtype == torch.float16
             and importance.is_contiguous()
             and importance.device == torch.device("cpu")
@@ -724,6 +727,146 @@ class CPUInferKVCache:
     ):
         raise NotImplementedError
 
+    # Sequences: the cache holds up to max_batch_size independent sequences whose blocks
+    # come from a shared pool of max_block_num blocks. alloc_seq, free_seq and extend_seq
+    # run immediately, so they must not race with queued tasks using the same sequence.
+    def alloc_seq(self) -> int:
+        seq_id = self.kvcache.alloc_seq()
+        if seq_id < 0:
+            raise RuntimeError(f"all {self.config.max_batch_size} kvcache sequences are in use")
+        return seq_id
+
+    def free_seq(self, seq_id: int):
+        self.kvcache.free_seq(seq_id)
+
+    def get_seq_len(self, seq_id: int) -> int:
+        return self.kvcache.get_seq_len(seq_id)
+
+    # tokens evict_seq dropped, get_seq_len plus this is the position of the next token
+    def get_seq_evicted_len(self, seq_id: int) -> int:
+        return self.kvcache.get_seq_evicted_len(seq_id)
+
+    def get_seq_block_table(self, seq_id: int) -> torch.Tensor:
+        return torch.tensor(self.kvcache.get_seq_block_table(seq_id), dtype=torch.int32)
+
+    def extend_seq(self, seq_id: int, q_len: int):
+        assert q_len > 0, "q_len: {}".format(q_len)
+        if not self.kvcache.extend_seq(seq_id, q_len):
+            raise RuntimeError(f"kvcache block pool exhausted extending sequence {seq_id} by {q_len} tokens")
+
+    # extend_seq of every sequence in seq_ids as a task, ordered with the tasks around it
+    def extend_seqs(self, seq_ids: torch.Tensor, q_len: int):
+        assert q_len > 0, "q_len: {}".format(q_len)
+        self._check_seq_ids(seq_ids)
+        return self.kvcache.extend_seqs(seq_ids.data_ptr(), seq_ids.size(0), q_len)
+
+    @staticmethod
+    def _check_seq_ids(seq_ids: torch.Tensor):
+        assert (
+            seq_ids.dim() == 1
+            and seq_ids.dtype == torch.int
+            and seq_ids.is_contiguous()
+            and seq_ids.device == torch.device("cpu")
+        ), "seq_ids dim: {}, dtype: {}, contiguous: {}, device: {}".format(
+            seq_ids.dim(), seq_ids.dtype, seq_ids.is_contiguous(), seq_ids.device
+        )
+
+    # k_in: (bsz, q_len, kv_head_num, head_dim), written to the last q_len positions of each
+    # sequence, so extend_seq has to be called first
+    def update_kvcache_seqs(
+        self,
+        k_in: torch.Tensor,
+        v_in: torch.Tensor,
+        layer_id: int,
+        seq_ids: torch.Tensor,
+    ):
+        self._check_seq_ids(seq_ids)
+        assert (
+            k_in.dim() == 4
+            and k_in.size(0) == seq_ids.size(0)
+            and k_in.size(2) == self.config.kv_head_num
+            and k_in.size(3) == self.config.head_dim
+            and k_in.dtype == torch.float16
+            and k_in.is_contiguous()
+            and k_in.shape == v_in.shape
+            and v_in.dtype == torch.float16
+            and v_in.is_contiguous()
+        ), "k_in size: {}, v_in size: {}".format(k_in.size(), v_in.size())
+        return self.kvcache.update_kvcache_seqs(
+            k_in.data_ptr(),
+            v_in.data_ptr(),
+            layer_id,
+            seq_ids.data_ptr(),
+            seq_ids.size(0),
+            k_in.size(1),
+        )
+
+    # q_in: (bsz, 1, q_head_num, head_dim), one decode token per sequence
+    # output: (bsz, 1, q_head_num, head_dim)
+    # attn_lse: (bsz, 1, q_head_num)
+    def attn_seqs(
+        self,
+        q_in: torch.Tensor,
+        output: torch.Tensor,
+        attn_lse: torch.Tensor,
+        layer_idx: int,
+        seq_ids: torch.Tensor,
+        generate_token_idx: int = 0,
+        pick_block_num: int = -1,
+        init_block_num: int = -1,
+        local_block_num: int = -1,
+    ):
+        self._check_seq_ids(seq_ids)
+        batch_size = seq_ids.size(0)
+        assert (
+            batch_size <= self.config.max_batch_size
+        ), "batch_size: {}".format(batch_size)
+        assert (
+            q_in.dim() == 4
+            and q_in.size(0) == batch_size
+            and q_in.size(1) == 1
+            and q_in.size(2) == self.config.q_head_num
+            and q_in.size(3) == self.config.head_dim
+            and q_in.dtype == torch.float16
+            and q_in.is_contiguous()
+        ), "q_in size: {}".format(q_in.size())
+        assert (
+            output.shape == q_in.shape
+            and output.dtype == torch.float16
+            and output.is_contiguous()
+        ), "output size: {}".format(output.size())
+        assert (
+            attn_lse.shape == q_in.shape[:3]
+            and attn_lse.dtype == torch.float32
+            and attn_lse.is_contiguous()
+        ), "attn_lse size: {}".format(attn_lse.size())
+        assert (
+            layer_idx >= 0 and layer_idx < self.config.layer_num
+        ), "layer_idx: {}".format(layer_idx)
+        return self.kvcache.attn_seqs(
+            q_in.data_ptr(),
+            output.data_ptr(),
+            attn_lse.data_ptr(),
+            layer_idx,
+            generate_token_idx,
+            seq_ids.data_ptr(),
+            batch_size,
+            pick_block_num,
+            init_block_num,
+            local_block_num,
+        )
+
+    def calc_anchor_seqs(self, seq_ids: torch.Tensor):
+        self._check_seq_ids(seq_ids)
+        return self.kvcache.calc_anchor_seqs(seq_ids.data_ptr(), seq_ids.size(0))
+
+    # Drops the least important full blocks of a sequence until it fits in max_len tokens,
+    # keeping the first init_block_num and the last local_block_num blocks. Importance is the
+    # one accumulated by update_importance, the sequence length is read back with get_seq_len.
+    def evict_seq(self, seq_id: int, max_len: int, init_block_num: int = 1, local_block_num: int = 1):
+        assert max_len >= 0, "max_len: {}".format(max_len)
+        return self.kvcache.evict_seq(seq_id, max_len, init_block_num, local_block_num)
+
 
 class CPUInfer:
     cpuinfer = None
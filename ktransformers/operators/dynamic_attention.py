@@ -25,6 +25,130 @@ except:
 
 import math
 import json
+from typing import Optional
+
+
+class StagingBufferPool:
+    """
+    Pinned host buffers for k/v transfers between the gpu and the cpu kvcache, reused across calls.
+
+    Slots are handed out round robin, so with two slots the host to device copy of one layer can
+    still be in flight while the cpu kvcache fills the other slot for the next layer. A slot is only
+    reused after the event recorded for its last copy has completed. Buffers grow geometrically up
+    to max_rows and are never shrunk, so pinned memory is allocated a handful of times per process.
+    """
+
+    def __init__(self, row_shape, dtype: torch.dtype, num_slots: int = 2, max_rows: Optional[int] = None):
+        self.row_shape = tuple(row_shape)
+        self.max_rows = max_rows
+        self.dtype = dtype
+        self.pin_memory = torch.cuda.is_available()
+        self.slots = [[None, None, None] for _ in range(num_slots)]  # k, v, pending event
+        self.next_slot = 0
+        self.allocations = 0
+
+    def acquire(self, num_rows: int):
+        """Returns (slot, k, v) where k and v are views of num_rows rows."""
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % len(self.slots)
+        k, v, event = self.slots[slot]
+        if event is not None:
+            event.synchronize()
+            self.slots[slot][2] = None
+        if k is None or k.shape[0] < num_rows:
+            rows = num_rows if k is None else max(num_rows, 2 * k.shape[0])
+            if self.max_rows is not None:
+                rows = max(min(rows, self.max_rows), num_rows)
+            # drop the old buffers first so that both are never pinned at the same time
+            self.slots[slot][0] = self.slots[slot][1] = k = v = None
+            k = torch.empty((rows,) + self.row_shape, dtype=self.dtype, pin_memory=self.pin_memory)
+            v = torch.empty((rows,) + self.row_shape, dtype=self.dtype, pin_memory=self.pin_memory)
+            self.slots[slot][0], self.slots[slot][1] = k, v
+            self.allocations += 1
+        return slot, k[:num_rows], v[:num_rows]
+
+    def release(self, slot: int, event=None):
+        """event, if given, guards the asynchronous copies that still read or write the slot."""
+        self.slots[slot][2] = event
+
+
+class AttnSparsityStats:
+    """
+    Running per layer and per head statistics of the attention sparsity reported by the cpu kvcache.
+
+    add() only does a few vectorized tensor ops on a (q_head_num,) row, so it can stay enabled in the
+    decode path. flush() appends one json object with the summary of everything seen since the last
+    flush to a file, instead of one line per head and token.
+    """
+
+    def __init__(
+        self,
+        layer_num: int,
+        q_head_num: int,
+        bins: int = 20,
+        flush_path: Optional[str] = None,
+        flush_every: int = 0,
+    ):
+        self.layer_num = layer_num
+        self.q_head_num = q_head_num
+        self.bins = bins
+        self.flush_path = flush_path
+        # flush after this many added rows, 0 means only on explicit flush()
+        self.flush_every = flush_every
+        self.reset()
+
+    def reset(self):
+        shape = (self.layer_num, self.q_head_num)
+        self.count = torch.zeros(self.layer_num, dtype=torch.int64)
+        self.sum = torch.zeros(shape, dtype=torch.float64)
+        self.sum_sq = torch.zeros(shape, dtype=torch.float64)
+        self.min = torch.full(shape, float("inf"), dtype=torch.float64)
+        self.max = torch.full(shape, float("-inf"), dtype=torch.float64)
+        self.hist = torch.zeros(shape + (self.bins,), dtype=torch.int64)
+        self.head_offsets = torch.arange(self.q_head_num) * self.bins
+        self.pending = 0
+
+    def add(self, layer_idx: int, sparsity: torch.Tensor):
+        """sparsity: (q_head_num,) values in [0, 1]"""
+        sparsity = sparsity.detach().to("cpu", torch.float64).reshape(self.q_head_num)
+        self.count[layer_idx] += 1
+        self.sum[layer_idx] += sparsity
+        self.sum_sq[layer_idx] += sparsity * sparsity
+        torch.minimum(self.min[layer_idx], sparsity, out=self.min[layer_idx])
+        torch.maximum(self.max[layer_idx], sparsity, out=self.max[layer_idx])
+        bucket = (sparsity * self.bins).long().clamp_(0, self.bins - 1)
+        self.hist[layer_idx].view(-1).index_add_(
+            0, self.head_offsets + bucket, torch.ones_like(bucket)
+        )
+        self.pending += 1
+        if self.flush_path is not None and self.flush_every > 0 and self.pending >= self.flush_every:
+            self.flush()
+
+    def summary(self) -> dict:
+        count = self.count.clamp(min=1).to(torch.float64).unsqueeze(1)
+        mean = self.sum / count
+        std = (self.sum_sq / count - mean * mean).clamp_(min=0).sqrt_()
+        seen = self.count > 0
+        return {
+            "bins": self.bins,
+            "count": self.count.tolist(),
+            "mean": mean.tolist(),
+            "std": std.tolist(),
+            "min": torch.where(seen.unsqueeze(1), self.min, 0).tolist(),
+            "max": torch.where(seen.unsqueeze(1), self.max, 0).tolist(),
+            "layer_mean": mean.mean(dim=1).tolist(),
+            "histogram": self.hist.tolist(),
+        }
+
+    def flush(self, path: Optional[str] = None, reset: bool = True):
+        path = path or self.flush_path
+        if path is None:
+            raise ValueError("no path to flush attention sparsity statistics to")
+        with open(path, "a") as file:
+            json.dump(self.summary(), file)
+            file.write("\n")
+        if reset:
+            self.reset()
 
 
 class DynamicScaledDotProductAttention:
@@ -51,6 +175,9 @@ class DynamicScaledDotProductAttention:
         preselect_block_count: int = 96,
         prefill_chunk_size: int = 20480,
         use_attn_sparsity: bool = False,
+        attn_sparsity_flush_path: Optional[str] = None,
+        attn_sparsity_flush_every: int = 0,
+        kvcache_budget: int = 0,
     ):
         # assert anchor_num == 1
         # assert anchor_type == "DYNAMIC"
@@ -83,6 +210,12 @@ class DynamicScaledDotProductAttention:
         self.preselect_block_count = preselect_block_count
         self.block_selection_mode = block_selection_mode
         self.use_attn_sparsity = use_attn_sparsity
+        # tokens of the conversation the cpu kvcache keeps in decode, 0 keeps all of them
+        self.kvcache_budget = kvcache_budget
+        if kvcache_budget > 0:
+            # both read the cpu kvcache through tables of all positions, which eviction breaks
+            assert not preselect_block and not use_attn_sparsity
+            assert kvcache_budget < max_seq_len
 
         # model config
         self.kv_head_num = config.num_key_value_heads
@@ -108,6 +241,9 @@ class DynamicScaledDotProductAttention:
             device=device,
             dtype=torch.float16,
         )
+        self.staging_buffers = StagingBufferPool(
+            (self.kv_head_num, self.head_dim), torch.float16, max_rows=self.block_num * block_size
+        )
         # [max_num_block, block_size, head_num]
         self.cache_importance = torch.zeros(
             (self.block_num, block_size, self.q_head_num),
@@ -115,6 +251,8 @@ class DynamicScaledDotProductAttention:
             dtype=torch.float16,
         )
 
+        # pinned host memory needs cuda, the decode path also runs on cpu tensors without it
+        pin_memory = torch.cuda.is_available()
         # key_states: [bsz, q_len, kv_head_num, head_dim]
         # value_states: [bsz, q_len, kv_head_num, head_dim]
         # query_states: [bsz, q_len, q_head_num, head_dim]
@@ -122,33 +260,33 @@ class DynamicScaledDotProductAttention:
             (1, 1, self.q_head_num, self.head_dim),
             device="cpu",
             dtype=torch.float16,
-            pin_memory=True,
+            pin_memory=pin_memory,
         )
         self.k_in_cpu = torch.zeros(
             (1, 1, self.kv_head_num, self.head_dim),
             device="cpu",
             dtype=torch.float16,
-            pin_memory=True,
+            pin_memory=pin_memory,
         )
         self.v_in_cpu = torch.zeros(
             (1, 1, self.kv_head_num, self.head_dim),
             device="cpu",
             dtype=torch.float16,
-            pin_memory=True,
+            pin_memory=pin_memory,
         )
 
         self.cache_seqlens_cpu = torch.empty(
-            (1,), device="cpu", dtype=torch.int32, pin_memory=True
+            (1,), device="cpu", dtype=torch.int32, pin_memory=pin_memory
         )
 
         self.cache_seqlens_cuda = torch.empty((1,), device=device, dtype=torch.int32)
 
         self.prefix_block_table = torch.arange(
-            self.block_num, device="cpu", dtype=torch.int32, pin_memory=True
+            self.block_num, device="cpu", dtype=torch.int32, pin_memory=pin_memory
         ).view(1, -1)
 
         self.block_table_cpu = torch.arange(
-            self.block_num, device="cpu", dtype=torch.int32, pin_memory=True
+            self.block_num, device="cpu", dtype=torch.int32, pin_memory=pin_memory
         ).view(1, -1)
 
         # assert (
@@ -160,10 +298,10 @@ class DynamicScaledDotProductAttention:
             (1, 1, self.q_head_num, self.head_dim),
             device="cpu",
             dtype=torch.float16,
-            pin_memory=True,
+            pin_memory=pin_memory,
         )
         self.lse_cpu = torch.empty(
-            (1, 1, self.q_head_num), device="cpu", dtype=torch.float32, pin_memory=True
+            (1, 1, self.q_head_num), device="cpu", dtype=torch.float32, pin_memory=pin_memory
         )
 
         self.output_cuda = torch.empty(
@@ -171,7 +309,13 @@ class DynamicScaledDotProductAttention:
         )
 
         self.attn_sparsity = torch.zeros(
-            (1, 1, self.q_head_num), device="cpu", dtype=torch.float32, pin_memory=True
+            (1, 1, self.q_head_num), device="cpu", dtype=torch.float32, pin_memory=pin_memory
+        )
+        self.sparsity_stats = AttnSparsityStats(
+            self.layer_num,
+            self.q_head_num,
+            flush_path=attn_sparsity_flush_path,
+            flush_every=attn_sparsity_flush_every,
         )
 
         if preselect_block == True:
@@ -204,6 +348,15 @@ class DynamicScaledDotProductAttention:
             max_block_num=self.block_num,
             max_thread_num=self.threads_num,
         )
+        # the conversation is one sequence of the cpu kvcache. It is the only one, so its blocks are
+        # 0, 1, 2, ... in order when it is started over, and prefix_block_table is its block table. Eviction
+        # takes blocks out of it, so the table is read back before each prefill
+        self.seq_id = self.local_thread.alloc_seq()
+        self.seq_ids = torch.tensor([self.seq_id], device="cpu", dtype=torch.int32)
+        # tokens of the conversation evicted from the sequence before the current prefill
+        self.evicted_len = 0
+        # the number of leading blocks attn_with_kvcache always attends
+        self.init_block_num = 1 if self.block_size > 32 else 64 // self.block_size
 
         print(
             f"local_windows_len: {local_windows_len}, topk: {topk}, dense_layer_num: {dense_layer_num}, kv_type: {self.kv_type}, anchor_type: {self.anchor_type}, preselect_block: {self.preselect_block}, preselect_block_count: {self.preselect_block_count}, token_step: {self.token_step}, layer_step: {self.layer_step}"
@@ -268,6 +421,18 @@ class DynamicScaledDotProductAttention:
             qk = torch.sum(qk, dim=-2)
             importance[...,head_idx] += qk
 
+    @staticmethod
+    def union_with_last_layer_blocks(preselect_block_table: torch.Tensor, layer_num: int, topk: int):
+        """
+        Put the top blocks 1..5 of the last layer that a layer misses into its last slots, in place.
+        All layers at once, i stays sequential since each step can change what the next one finds in a row.
+        """
+        tables = preselect_block_table[: layer_num - 1]
+        for i in range(1, min(topk, 6)):
+            x = preselect_block_table[-1, i]
+            missing = (tables != x).all(dim=1)
+            tables[:, topk - i] = torch.where(missing, x, tables[:, topk - i])
+
     def get_preselect_block_table_and_attn_score(
         self,
         layer_idx: int,
@@ -334,12 +499,8 @@ class DynamicScaledDotProductAttention:
                 ].copy_(indices)
 
                 if union_with_last_layer and layer_idx == 31:
-                    for tmp_layer_idx in range(self.layer_num - 1):
-                        for i in range(1, min(topk, 6)):
-                            x = self.preselect_block_table[-1, i]
-                            if x not in self.preselect_block_table[tmp_layer_idx]:
-                                self.preselect_block_table[tmp_layer_idx, topk - i] = x
-        if self.anchor_type == "DYNAMIC":
+                    self.union_with_last_layer_blocks(self.preselect_block_table, self.layer_num, topk)
+        if self.anchor_type == "DYNAMIC" or self.kvcache_budget > 0:
             importance_cache = self.cache_importance.narrow(
                 0, 0, max_block_num * batch_size
             ).view(batch_size, max_block_num * self.block_size, self.q_head_num)
@@ -475,27 +636,31 @@ class DynamicScaledDotProductAttention:
             batch_size, max_block_num * self.block_size, self.kv_head_num, self.head_dim
         )
 
+        slot, k_staging, v_staging = self.staging_buffers.acquire(
+            batch_size * max_block_num * self.block_size
+        )
+        k_cache_cpu = k_staging.view(k_cache.shape)
+        v_cache_cpu = v_staging.view(v_cache.shape)
+        past_len_cpu = past_len.contiguous().to("cpu")
+
+        # the cpu kvcache only reads the new tokens and only writes the past ones,
+        # so each direction copies just the rows it needs instead of the whole window
         for batch_idx in range(batch_size):
-            offset = past_len[batch_idx]
+            offset = past_len_cpu[batch_idx].item()
             width = q_len
-            k_cache[batch_idx][offset : offset + width].copy_(
-                key[batch_idx].view(-1, self.kv_head_num, self.head_dim)
-            )
-            v_cache[batch_idx][offset : offset + width].copy_(
-                value[batch_idx].view(-1, self.kv_head_num, self.head_dim)
-            )
-
-        k_cache_cpu = torch.empty_like(k_cache, device="cpu", pin_memory=True)
-        v_cache_cpu = torch.empty_like(v_cache, device="cpu", pin_memory=True)
-
-        k_cache_cpu.copy_(k_cache)
-        v_cache_cpu.copy_(v_cache)
+            new_key = key[batch_idx].view(-1, self.kv_head_num, self.head_dim)
+            new_value = value[batch_idx].view(-1, self.kv_head_num, self.head_dim)
+            k_cache[batch_idx][offset : offset + width].copy_(new_key)
+            v_cache[batch_idx][offset : offset + width].copy_(new_value)
+            k_cache_cpu[batch_idx][offset : offset + width].copy_(new_key, non_blocking=True)
+            v_cache_cpu[batch_idx][offset : offset + width].copy_(new_value, non_blocking=True)
+        if k_cache.is_cuda:
+            torch.cuda.current_stream(k_cache.device).synchronize()
 
         cur_block_num = (
-            q_len + past_len[0].item() + self.block_size - 1
+            q_len + past_len_cpu[0].item() + self.block_size - 1
         ) // self.block_size
         block_table_cpu = self.prefix_block_table[:, :cur_block_num].to("cpu")
-        past_len_cpu = past_len.contiguous().to("cpu")
 
         self.cpu_infer.submit(
             self.local_thread.get_and_update_kvcache_fp16(
@@ -510,27 +675,63 @@ class DynamicScaledDotProductAttention:
         )
 
         self.cpu_infer.sync()
-        k_cache.copy_(k_cache_cpu)
-        v_cache.copy_(v_cache_cpu)
+        for batch_idx in range(batch_size):
+            offset = past_len_cpu[batch_idx].item()
+            k_cache[batch_idx][:offset].copy_(k_cache_cpu[batch_idx][:offset], non_blocking=True)
+            v_cache[batch_idx][:offset].copy_(v_cache_cpu[batch_idx][:offset], non_blocking=True)
+        # attention runs after the copies on the same stream, only reuse of the slot has to wait
+        self.staging_buffers.release(
+            slot, torch.cuda.current_stream(k_cache.device).record_event() if k_cache.is_cuda else None
+        )
 
         return k_cache, v_cache
 
-    def calc_anchor(self, cache_seqlens: int):
-        cur_block_num = (cache_seqlens + self.block_size - 1) // self.block_size
-        block_table_cpu = self.prefix_block_table[:, :cur_block_num].to("cpu")
-        cache_seqlens_cpu = torch.tensor(
-            [cache_seqlens], device="cpu", dtype=torch.int32
-        )
+    def read_seq_block_table(self):
+        """Copies the blocks of the sequence into prefix_block_table, for the paths that take a block table."""
+        block_table = self.local_thread.get_seq_block_table(self.seq_id)
+        self.prefix_block_table[0, : block_table.size(0)].copy_(block_table)
 
-        self.cpu_infer.submit(
-            self.local_thread.calc_anchor_all_layers(
-                block_table_cpu,
-                cache_seqlens_cpu,
-            )
-        )
+    def reset_seq(self, cache_seqlens: int = 0):
+        """Starts the sequence over with room for cache_seqlens tokens, the kv left in its blocks is kept."""
+        self.cpu_infer.sync()
+        self.local_thread.free_seq(self.seq_id)
+        self.seq_id = self.local_thread.alloc_seq()
+        self.seq_ids.fill_(self.seq_id)
+        if cache_seqlens > 0:
+            self.local_thread.extend_seq(self.seq_id, cache_seqlens)
+        self.evicted_len = 0
+        self.read_seq_block_table()
+
+    def prepare_seq(self, past_len: int, q_len: int):
+        """Makes the sequence hold the tokens before past_len and room for q_len new ones, before a prefill chunk."""
+        self.cpu_infer.sync()
+        seq_len = self.local_thread.get_seq_len(self.seq_id)
+        evicted_len = self.local_thread.get_seq_evicted_len(self.seq_id)
+        if seq_len + evicted_len > past_len:
+            # a new prompt that shares only part of the cached one, the blocks of the shared part come
+            # back with their kv, their anchors are computed again after the prefill. Eviction never
+            # drops the first blocks, so only they are still the start of the conversation
+            if evicted_len > 0 and past_len > self.init_block_num * self.block_size:
+                raise RuntimeError(
+                    f"the cpu kvcache evicted {evicted_len} tokens of the conversation, a new prompt can only "
+                    f"reuse its first {self.init_block_num * self.block_size} tokens, not {past_len}"
+                )
+            self.reset_seq(past_len)
+            seq_len, evicted_len = past_len, 0
+        self.local_thread.extend_seq(self.seq_id, past_len + q_len - seq_len - evicted_len)
+        # the prefill reads and writes the tokens the sequence kept, in the blocks they are in now
+        self.evicted_len = evicted_len
+        self.read_seq_block_table()
+
+    def calc_anchor(self, cache_seqlens: int):
+        assert self.local_thread.get_seq_len(self.seq_id) + self.evicted_len == int(cache_seqlens)
+        self.cpu_infer.submit(self.local_thread.calc_anchor_seqs(self.seq_ids))
         self.cpu_infer.sync()
 
     def clear_importance(self, cache_seqlens: int):
+        if self.kvcache_budget > 0:
+            # eviction ranks the blocks by the importance the prefills left
+            return
         print(f"clear importance: {cache_seqlens}")
         cur_block_num = (cache_seqlens + self.block_size - 1) // self.block_size
         block_table_cpu = self.prefix_block_table[:, :cur_block_num].to("cpu")
@@ -547,6 +748,7 @@ class DynamicScaledDotProductAttention:
         self.cpu_infer.sync()
 
     def clear_kvcache(self, cache_seqlens: int):
+        cache_seqlens = cache_seqlens - self.evicted_len
         cur_block_num = (cache_seqlens + self.block_size - 1) // self.block_size
         block_table_cpu = self.prefix_block_table[:, :cur_block_num].to("cpu")
         cache_seqlens_cpu = torch.tensor(
@@ -561,6 +763,46 @@ class DynamicScaledDotProductAttention:
         )
         self.cpu_infer.sync()
 
+    def submit(self, device: torch.device, task):
+        """Queues task behind the work already on the current cuda stream of device, or right away on cpu."""
+        if device.type == "cuda":
+            self.cpu_infer.submit_with_cuda_stream(torch.cuda.current_stream(device).cuda_stream, task)
+        else:
+            self.cpu_infer.submit(task)
+
+    def sync(self, device: torch.device):
+        if device.type == "cuda":
+            self.cpu_infer.sync_with_cuda_stream(torch.cuda.current_stream(device).cuda_stream)
+        else:
+            self.cpu_infer.sync()
+
+    def attn_seq(self, device: torch.device, layer_idx: int, topk: int | None = None, local: int | None = None):
+        """Writes the new token of layer_idx to the sequence and attends it, topk and local as in attn_with_kvcache."""
+        if topk is None or local is None or topk + local >= self.block_num:
+            topk = -1
+            local = -1
+        self.submit(
+            device,
+            self.local_thread.update_kvcache_seqs(self.k_in_cpu, self.v_in_cpu, layer_idx, self.seq_ids),
+        )
+        self.submit(
+            device,
+            self.local_thread.attn_seqs(
+                self.q_in_cpu,
+                self.output_cpu,
+                self.lse_cpu,
+                layer_idx,
+                self.seq_ids,
+                generate_token_idx=self.generate_token_idx,
+                pick_block_num=topk,
+                init_block_num=self.init_block_num,
+                local_block_num=local,
+            ),
+        )
+        # what get_attn_sparsity reads, attn_with_kvcache counts the new token in place
+        self.block_table_cpu.copy_(self.prefix_block_table, non_blocking=True)
+        self.cache_seqlens_cpu.copy_(self.cache_seqlens_cuda + 1, non_blocking=True)
+
     def get_attn_sparsity(
         self,
         q_in: torch.Tensor,
@@ -572,10 +814,9 @@ class DynamicScaledDotProductAttention:
         generate_token_idx: int = 0,
         topk: int | None = None,
         local: int | None = None,
-        output_path: str = "./attn_sparsity.json",
     ):
         self.attn_sparsity.zero_()
-        self.pcinfer.submit(
+        self.cpu_infer.submit(
             self.local_thread.get_attn_sparsity(
                 q_in,
                 self.attn_sparsity,
@@ -590,17 +831,7 @@ class DynamicScaledDotProductAttention:
             )
         )
         self.cpu_infer.sync()
-        with open(output_path, "a") as file:
-            for head_idx in range(self.q_head_num):
-                sparsity = self.attn_sparsity[0][0][head_idx].item()
-                json_obj = {
-                    "token_idx": generate_token_idx,
-                    "layer_idx": layer_idx,
-                    "head_idx": head_idx,
-                    "sparsity": sparsity,
-                }
-                json.dump(json_obj, file)
-                file.write("\n")
+        self.sparsity_stats.add(layer_idx, self.attn_sparsity[0][0])
 
     def apply(
         self,
@@ -627,7 +858,11 @@ class DynamicScaledDotProductAttention:
 
         q_len = query_states.size(1)
         batch_size = query_states.size(0)
-        self.cache_seqlens_cuda.fill_(past_len)
+        if mode == "prefill" and layer_idx == 0:
+            self.prepare_seq(int(past_len), q_len)
+        # the tokens evicted from the cpu kvcache are not in the gpu window either. In decode only the
+        # preselect path and attn_sparsity read this, neither runs with a kvcache budget
+        self.cache_seqlens_cuda.fill_(past_len - self.evicted_len)
         last_chunk = False
         if self.remaining_length <= self.prefill_chunk_size and q_len != 1:
             last_chunk = True
@@ -647,7 +882,7 @@ class DynamicScaledDotProductAttention:
                 value_states,
             )
 
-            if last_chunk and (self.anchor_type == "DYNAMIC" or self.preselect_block):
+            if last_chunk and (self.anchor_type == "DYNAMIC" or self.preselect_block or self.kvcache_budget > 0):
                 self.get_preselect_block_table_and_attn_score(
                     layer_idx,
                     bsz,
@@ -672,21 +907,19 @@ class DynamicScaledDotProductAttention:
             self.v_in_cpu.copy_(value_states, non_blocking=True)
             self.cache_seqlens_cpu.copy_(self.cache_seqlens_cuda, non_blocking=True)
             #            print(layer_idx)
+            if layer_idx == 0:
+                # apply only runs when a cuda graph is captured, so the sequence grows in a task
+                self.submit(device, self.local_thread.extend_seqs(self.seq_ids, 1))
+                if self.kvcache_budget > 0:
+                    # once the conversation outgrows the budget, its least important blocks are dropped
+                    self.submit(
+                        device,
+                        self.local_thread.evict_seq(
+                            self.seq_id, self.kvcache_budget, self.init_block_num, self.local_block_num
+                        ),
+                    )
             if layer_idx < self.dense_layer_num:
-                self.block_table_cpu.copy_(self.prefix_block_table, non_blocking=True)
-                self.cpu_infer.submit_with_cuda_stream(
-                    torch.cuda.current_stream("cuda").cuda_stream,
-                    self.local_thread.attn_with_kvcache(
-                        q_in=self.q_in_cpu,
-                        k_in=self.k_in_cpu,
-                        v_in=self.v_in_cpu,
-                        output=self.output_cpu,
-                        attn_lse=self.lse_cpu,
-                        layer_idx=layer_idx,
-                        block_table=self.block_table_cpu,
-                        cache_seqlens=self.cache_seqlens_cpu,
-                    ),
-                )
+                self.attn_seq(device, layer_idx)
             else:
                 if self.preselect_block:
                     self.cache_seqlens_cpu.copy_(
@@ -711,8 +944,8 @@ class DynamicScaledDotProductAttention:
                             non_blocking=True,
                         )
                     #                   print("submit_with_cuda_stream")
-                    self.cpu_infer.submit_with_cuda_stream(
-                        torch.cuda.current_stream("cuda").cuda_stream,
+                    self.submit(
+                        device,
                         self.local_thread.attn_with_kvcache(
                             q_in=self.q_in_cpu,
                             k_in=self.k_in_cpu,
@@ -733,49 +966,71 @@ class DynamicScaledDotProductAttention:
                     )
                 #                    print("submit_with_cuda_stream enqueue\n")
                 else:
-                    self.block_table_cpu.copy_(
-                        self.prefix_block_table, non_blocking=True
+                    self.attn_seq(
+                        device,
+                        layer_idx,
+                        topk=self.topk,
+                        local=self.local_windows_len // self.block_size,
                     )
-                    self.cpu_infer.submit_with_cuda_stream(
-                        torch.cuda.current_stream("cuda").cuda_stream,
-                        self.local_thread.attn_with_kvcache(
-                            q_in=self.q_in_cpu,
-                            k_in=self.k_in_cpu,
-                            v_in=self.v_in_cpu,
-                            output=self.output_cpu,
-                            attn_lse=self.lse_cpu,
-                            layer_idx=layer_idx,
-                            generate_token_idx=self.generate_token_idx,
-                            block_table=self.block_table_cpu,
-                            cache_seqlens=self.cache_seqlens_cpu,
-                            topk=self.topk,
-                            local=self.local_windows_len // self.block_size,
-                        ),
+            self.sync(device)
+            if self.use_attn_sparsity and layer_idx >= self.dense_layer_num:
+                if torch.cuda.is_current_stream_capturing():
+                    raise RuntimeError(
+                        "attn_sparsity reads the cpu kvcache on the host after every layer and cannot run in a "
+                        "cuda graph, disable use_cuda_graph or long_context.attn_sparsity"
                     )
-            self.cpu_infer.sync_with_cuda_stream(
-                torch.cuda.current_stream("cuda").cuda_stream
-            )
+                # sync_with_cuda_stream only queues the wait on the stream, it is this blocking copy that waits
+                # for the attention above, so get_attn_sparsity reads the same inputs after it has run
+                cache_seqlens_origin = self.cache_seqlens_cuda.to("cpu")
+                self.get_attn_sparsity(
+                    self.q_in_cpu,
+                    layer_idx,
+                    self.block_table_cpu,
+                    self.cache_seqlens_cpu,
+                    self.prefix_block_table,
+                    cache_seqlens_origin,
+                    generate_token_idx=self.generate_token_idx,
+                    topk=(
+                        self.topk
+                        if not self.preselect_block or self.topk <= self.preselect_block_count
+                        else None
+                    ),
+                    local=self.local_windows_len // self.block_size,
+                )
             #            print("submit_with_cuda_stream finished\n")
             self.output_cuda.copy_(self.output_cpu, non_blocking=True)
             return self.output_cuda.transpose(1, 2)
 
     def save(self, path: str, length: int):
+        if self.local_thread.get_seq_evicted_len(self.seq_id) > 0:
+            raise RuntimeError("the cpu kvcache evicted tokens of the conversation, it is not a prefix any more")
         cur_block_num = (length + self.block_size - 1) // self.block_size
         block_table_cpu = self.prefix_block_table[0, :cur_block_num].to("cpu")
-        cache_seqlens_cpu = torch.tensor([length], device="cpu", dtype=torch.int32)
         self.cpu_infer.submit(
             self.local_thread.dump_kvcache(
                 block_table_cpu,
-                cache_seqlens_cpu,
+                length,
                 path,
             )
         )
         self.cpu_infer.sync()
 
     def load(self, path: str, length: int):
+        # load_kvcache fills blocks 0, 1, 2, ..., which the sequence gets back when it starts over
+        self.reset_seq(length)
         self.cpu_infer.submit(
             self.local_thread.load_kvcache(
                 path,
             )
         )
         self.cpu_infer.sync()
+
+    def dump_prefix(self, path: str, length: int):
+        self.save(path, length)
+
+    def load_prefix(self, path: str) -> int:
+        # the cpu kvcache file starts with cache_total_len as a native int
+        with open(path, "rb") as f:
+            length = int.from_bytes(f.read(4), sys.byteorder, signed=True)
+        self.load(path, length)
+        return length
@@ -17,6 +17,7 @@ from torch import Tensor, nn
 import torch.nn.functional as F
 import torch
 import sys, os
+import threading
 from ktransformers.operators.base_operator import BaseInjectedModule
 from tqdm import tqdm
 
@@ -29,6 +30,8 @@ import ctypes
 from ktransformers.util.custom_gguf import GGUFLoader
 from ktransformers.util.utils import InferenceState
 from ktransformers.server.config.config import Config
+from ktransformers.server.config.log import logger
+from ktransformers.util.hugepages import BackedWeights
 from transformers.activations import ACT2FN
 from transformers.configuration_utils import PretrainedConfig
 from abc import ABC, abstractmethod
@@ -149,6 +152,18 @@ class KExpertsCPU(KExpertsBase):
         self.gate = w["gate"]
         self.up = w["up"]
         self.down = w["down"]
+        page_backing = Config().expert_page_backing
+        lock_memory = Config().expert_mlock
+        if (page_backing is not None or lock_memory) and not cpuinfer_ext.moe.copies_weights:
+            # MOE computes on these arrays, move them off the 4 KiB pages of the model files
+            backed = BackedWeights([self.gate, self.up, self.down], page_backing, lock_memory)
+            self.gguf_loader.mark_copied([self.gate, self.up, self.down])
+            self.gate, self.up, self.down = backed.arrays
+            report = backed.report()
+            logger.info(
+                f"{self.key} experts: {report['bytes']} bytes, {report['huge_page_bytes']} on huge pages ({backed.backing}), "
+                f"{report['locked_bytes']} locked"
+            )
         self.gate_type = w["gate_type"]
         self.up_type = w["up_type"]
         self.down_type = w["down_type"]
@@ -179,12 +194,16 @@ class KExpertsCPU(KExpertsBase):
             self.up_type,
             self.down_type,
             30, # TODO: get from model.dtype
+            page_backing is not None,
+            lock_memory,
         )
         # print(n_routed_experts, hidden_size, moe_intermediate_size)
         num_experts_per_tok = self.config.num_experts_per_tok
         self.moe = MOE(moe_config)
         self.cpu_infer = KExpertsCPU.CPU_INFER
-        if warmup:
+        # CPU_INFER is one queue shared by all layers, the lazy loading thread must not submit to it or
+        # sync it between the submit and sync of a forward on the main thread
+        if warmup and threading.current_thread() is threading.main_thread():
             self.cpu_infer.submit(self.moe.warm_up())
             self.cpu_infer.sync()
         if self.out_device not in KExpertsCPU.output_gpu_map:
@@ -249,12 +268,14 @@ class KExpertsCPU(KExpertsBase):
         for key in keys:
             if self.gguf_loader.safetensor_loader is not None:
                 # using a temp ugly way to temprary load the tensor
-                gate = self.gguf_loader.safetensor_loader.load_tensor(key + ".ffn_gate_exps.weight").numpy()
-                up = self.gguf_loader.safetensor_loader.load_tensor(key + ".ffn_up_exps.weight").numpy()
-                down = self.gguf_loader.safetensor_loader.load_tensor(key + ".ffn_down_exps.weight").numpy()
-                gate_type = self.gguf_loader.safetensor_loader.load_tensor(key + ".ffn_gate_exps.ggml_type").item()
-                up_type = self.gguf_loader.safetensor_loader.load_tensor(key + ".ffn_up_exps.ggml_type").item()
-                down_type = self.gguf_loader.safetensor_loader.load_tensor(key + ".ffn_down_exps.ggml_type").item()
+                names = [f".ffn_{proj}_exps.{kind}" for proj in ("gate", "up", "down") for kind in ("weight", "ggml_type")]
+                tensors = self.gguf_loader.safetensor_loader.load_tensors([key + name for name in names])
+                gate = tensors[key + ".ffn_gate_exps.weight"].numpy()
+                up = tensors[key + ".ffn_up_exps.weight"].numpy()
+                down = tensors[key + ".ffn_down_exps.weight"].numpy()
+                gate_type = tensors[key + ".ffn_gate_exps.ggml_type"].item()
+                up_type = tensors[key + ".ffn_up_exps.ggml_type"].item()
+                down_type = tensors[key + ".ffn_down_exps.ggml_type"].item()
             
             elif key + ".ffn_gate_exps.weight" in self.gguf_loader.tensor_info:
                 gate = self.gguf_loader.get_mmap_tensor(key + ".ffn_gate_exps.weight")
@@ -58,8 +58,9 @@ class KMoEGateBase(ABC):
             key = ".".join(key.split(".")[:-1])
             if self.gguf_loader.safetensor_loader is not None:
                 targets = [".ffn_gate_inp.weight", ".exp_probs_b.bias"]
-                weight = self.gguf_loader.safetensor_loader.load_tensor(key + ".ffn_gate_inp.weight") 
-                e_score_correction_bias = self.gguf_loader.safetensor_loader.load_tensor(key + ".exp_probs_b.bias")
+                tensors = self.gguf_loader.safetensor_loader.load_tensors([key + target for target in targets])
+                weight = tensors[key + ".ffn_gate_inp.weight"]
+                e_score_correction_bias = tensors[key + ".exp_probs_b.bias"]
                 weight_type = weight.dtype
                 e_score_correction_bias_type = e_score_correction_bias.dtype
                 res = {"weight": weight, "e_score_correction_bias": e_score_correction_bias,  "weight_type": weight_type, "e_score_correction_bias_type": e_score_correction_bias_type}
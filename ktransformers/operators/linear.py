@@ -12,11 +12,13 @@ Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 
 
 import ctypes
+import threading
 import torch
 from torch import Tensor, nn
 import KTransformersOps 
 from ktransformers.util.custom_gguf import GGUFLoader
 from ktransformers.util.utils import InferenceState
+from ktransformers.util.weight_cache import RepackCache
 from ktransformers.ktransformers_ext.operators.custom_marlin.quantize.utils.marlin_utils import (
     MarlinWorkspace,
     marlin_quantize,
@@ -83,8 +85,9 @@ class KLinearBase(ABC):
         for key in keys:
             if self.gguf_loader.safetensor_loader is not None:
                 # using safetensor_loader
-                tensor = self.gguf_loader.safetensor_loader.load_tensor(key+'.weight')
-                weight_scale_inv = self.gguf_loader.safetensor_loader.load_tensor(key+'.weight_scale_inv')
+                tensors = self.gguf_loader.safetensor_loader.load_tensors([key+'.weight', key+'.weight_scale_inv'])
+                tensor = tensors[key+'.weight']
+                weight_scale_inv = tensors[key+'.weight_scale_inv']
                 return nn.Parameter(tensor), nn.Parameter(weight_scale_inv)
                 
             elif key + ".weight" in self.gguf_loader.tensor_file_map:
@@ -109,6 +112,43 @@ class KLinearBase(ABC):
             tensors[k] = self.gguf_loader.load_gguf_tensor(key + "." + k, device=device)
         return tensors
 
+    def repack_cache(self, w: dict | nn.Parameter | tuple | None, **params) -> Tuple[Optional[RepackCache], Optional[str]]:
+        """
+        The cache of repacked weights and the digest of w and params in it, (None, None) when
+        repack_cache_dir is not set. Without w the GGUF bytes of the weight are hashed, so a hit
+        doesn't need to read and dequantize them.
+        """
+        path = Config().repack_cache_dir
+        if path is None:
+            return None, None
+        if w is not None:
+            sources = list(w) if isinstance(w, tuple) else [w]
+        elif self.gguf_loader.safetensor_loader is None and self.key + ".weight" in self.gguf_loader.tensor_file_map:
+            names = [self.key + "." + k for k in ("weight", "bias") if self.key + "." + k in self.gguf_loader.tensor_file_map]
+            sources = [self.gguf_loader.get_mmap_tensor(name) for name in names]
+            # the tensor kind matters, load_gguf_tensor permutes the llama attn_q and attn_k weights
+            params["gguf"] = [
+                (name.split(".")[-2], self.gguf_loader.tensor_info[name]["ggml_type"], self.gguf_loader.tensor_info[name]["shape"])
+                for name in names
+            ]
+            params["architecture"] = self.gguf_loader.gguf_file_meta.get("general.architecture")
+        else:
+            return None, None
+        return RepackCache(path), RepackCache.digest(sources, **params)
+
+    def load_packed(self, w: dict | nn.Parameter | tuple | None, device: str) -> Dict[str, torch.Tensor]:
+        """
+        The repacked tensors of w, read from the repack cache on a hit, made by _pack and saved
+        to the cache on a miss. For linears that define _pack and repack_params.
+        """
+        cache, digest = self.repack_cache(w, **self.repack_params())
+        packed = cache.load(digest) if cache is not None else None
+        if packed is None:
+            packed = self._pack(w, device)
+            if cache is not None:
+                cache.save(digest, packed)
+        return packed
+
     @abstractmethod
     def load(self, w: dict | nn.Parameter | tuple | None = None, device: str|None = "cuda"):
         pass
@@ -309,33 +349,39 @@ class KLinearQ8(KLinearBase):
     def load(self, w: Union[Dict, nn.Parameter, Tuple, None] = None, device: Optional[str] = None):
         if self.loaded: return
         if device is None: device = self.device 
+        packed = self.load_packed(w, device)
+
+        self.weight = packed["weight"].to(device)
+        self.weight_scale = packed["weight_scale"].to(device)
+        self.has_bias = "bias" in packed
+        if self.has_bias:
+            self.bias = packed["bias"].to(device)
+            
+        self.loaded = True
+
+    def repack_params(self) -> Dict:
+        return dict(kind="q8", bits=8, compute_dtype=str(self.compute_dtype), out_features=self.out_features, in_features=self.in_features)
+
+    def _pack(self, w: Union[Dict, nn.Parameter, Tuple, None], device: str) -> Dict[str, torch.Tensor]:
         if w is None: w = self.load_weight(device=device)
         
+        packed = {}
         if isinstance(w, nn.Parameter):
             try:
                 weight = w.to(dtype=self.compute_dtype).view(self.out_features, self.in_features)
             except:
                 weight = w.to(dtype=self.compute_dtype)
-            self.has_bias = False
         elif isinstance(w, tuple):
             try:
                 weight = w[0].to(dtype=self.compute_dtype).view(self.out_features, self.in_features)
             except:
                 weight = w[0].to(dtype=self.compute_dtype)
-            self.bias = w[1].to(dtype=self.compute_dtype).to(device)
-            self.has_bias = True
+            packed["bias"] = w[1].to(dtype=self.compute_dtype)
         else:
             raise ValueError("Invalid weight type")
         
-        self.weight, self.weight_scale = self._quantize_weight(weight, bits=8)
-        
-        self.weight = self.weight.to(device)
-        self.weight_scale = self.weight_scale.to(device)
-        
-        if self.has_bias:
-            self.bias = self.bias.to(device)
-            
-        self.loaded = True
+        packed["weight"], packed["weight_scale"] = self._quantize_weight(weight, bits=8)
+        return packed
     
     def unload(self):
         self.weight = None
@@ -441,26 +487,45 @@ class KLinearMarlin(KLinearBase):
         if self.loaded: return
         if device is None: device = self.device
         assert device.lower() != "cpu", "Marlin quantized linear only supports GPU device"
-        
+        packed = self.load_packed(w, device)
+
+        self.has_bias = "bias" in packed
+        if self.has_bias:
+            self.bias = packed["bias"].to(device)
+        self.workspace = MarlinWorkspace(
+            self.out_features, GPTQ_MARLIN_MIN_THREAD_N, GPTQ_MARLIN_MAX_PARALLEL,self.device
+        )
+        self.marlin_q_w = packed["marlin_q_w"].to(device)
+        self.weight = self.marlin_q_w # modeling_xxx.py may use linear.weight
+        self.marlin_s = packed["marlin_s"].to(device)
+        self.g_idx = packed["g_idx"].to(device)
+        self.sort_indices = packed["sort_indices"].to(device)
+        self.k = self.in_features
+        self.n = self.out_features
+        self.loaded = True
+
+    def repack_params(self) -> Dict:
+        return dict(
+            kind="marlin", num_bits=self.num_bits, group_size=self.group_size, act_order=self.act_order,
+            k=self.in_features, n=self.out_features, dtype=str(torch.get_default_dtype()),
+        )
+
+    def _pack(self, w: dict | nn.Parameter | tuple | None, device: str) -> Dict[str, torch.Tensor]:
         #if self.in_features * self.out_features:
         if w is None: 
             w = self.load_weight(device=device) 
 
+        packed = {}
         if isinstance(w, nn.Parameter):
             # pad weight
             weight = w.view(self.orin_out_features, self.orin_in_features).T
-            self.has_bias = False
         elif isinstance(w, tuple):
             w = list(w)
             weight = w[0].view(self.orin_out_features, self.orin_in_features).T
-            self.bias = w[1].view(self.orin_out_features)
-            self.bias = w[1]
-            self.has_bias = True
+            packed["bias"] = w[1]
         else:
             raise ValueError("Invalid weight type")
         weight = weight.to(device)
-        if self.has_bias:
-            self.bias = self.bias.to(device)
             
         if self.padding:
             padded_weight = torch.zeros(self.in_features, self.out_features, device=self.device)
@@ -468,20 +533,10 @@ class KLinearMarlin(KLinearBase):
             weight = padded_weight
 
         # Pack Marlin linear
-        marlin_q_w, marlin_s, g_idx, sort_indices, _ = marlin_quantize(
+        packed["marlin_q_w"], packed["marlin_s"], packed["g_idx"], packed["sort_indices"], _ = marlin_quantize(
             weight, self.num_bits, self.group_size, self.act_order
         )
-        self.workspace = MarlinWorkspace(
-            self.out_features, GPTQ_MARLIN_MIN_THREAD_N, GPTQ_MARLIN_MAX_PARALLEL,self.device
-        )
-        self.weight = marlin_q_w # modeling_xxx.py may use linear.weight
-        self.marlin_q_w = marlin_q_w
-        self.marlin_s = marlin_s
-        self.g_idx = g_idx
-        self.sort_indices = sort_indices
-        self.k = weight.shape[0]
-        self.n = weight.shape[1]
-        self.loaded = True
+        return packed
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         # Only support input x as BF16 and FP16
@@ -605,7 +660,8 @@ class KLinearCPUInfer(KLinearBase):
         config = cpuinfer_ext.linear.LinearConfig(self.in_features, self.out_features, self.stride, self.group_max_len, weight_ptr, self.weight_type, 30)
         self.linear = cpuinfer_ext.linear.Linear(config)
         
-        if warmup:
+        # only on the main thread, like the warm up of KExpertsCPU
+        if warmup and threading.current_thread() is threading.main_thread():
             KLinearCPUInfer.CPU_INFER.submit(self.linear.warm_up())
             KLinearCPUInfer.CPU_INFER.sync()
         self.input_tensor_cpu = torch.zeros((1, 1, self.in_features), device="cpu", pin_memory=True)
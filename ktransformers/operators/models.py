@@ -233,6 +233,9 @@ class KQwen2MoeModel(BaseInjectedModule):
             and per_layer_prefill_intput_threshold < seq_lenth
         ):
             per_layer_prefill_flag = True
+            if self.gguf_loader.lazy_loader is not None:
+                # layers are moved between devices below, so all of them need their weights
+                self.gguf_loader.lazy_loader.wait()
             for layer in self.layers:
                 self.load_layer_to(layer, InferenceState.UNLOAD)
         else:
@@ -580,6 +583,9 @@ class KDeepseekV2Model(BaseInjectedModule):
             and per_layer_prefill_intput_threshold < seq_lenth
         ):
             per_layer_prefill_flag = True
+            if self.gguf_loader.lazy_loader is not None:
+                # layers are moved between devices below, so all of them need their weights
+                self.gguf_loader.lazy_loader.wait()
             for layer in self.layers:
                 self.load_layer_to(layer, InferenceState.UNLOAD)
             torch.cuda.empty_cache()
@@ -1001,7 +1007,10 @@ class KLlamaModel(BaseInjectedModule):
             layer_step=self.long_context_config["layer_step"],
             token_step=self.long_context_config["token_step"],
             prefill_chunk_size=self.long_context_config["chunk_size"],
-            use_attn_sparsity=False,
+            use_attn_sparsity=self.long_context_config.get("attn_sparsity", False),
+            attn_sparsity_flush_path=self.long_context_config.get("attn_sparsity_flush_path", None),
+            attn_sparsity_flush_every=self.long_context_config.get("attn_sparsity_flush_every", 0),
+            kvcache_budget=self.long_context_config.get("kvcache_budget", 0),
         )
 
     def get_input_embeddings(self):
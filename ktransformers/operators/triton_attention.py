@@ -17,6 +17,7 @@ def _fwd_grouped_kernel_stage1(
     Q,
     K_Buffer,
     V_Buffer,
+    KV_Scale,
     sm_scale,
     Req_to_tokens,
     B_Seqlen,
@@ -28,6 +29,8 @@ def _fwd_grouped_kernel_stage1(
     stride_buf_kh,
     stride_buf_vbs,
     stride_buf_vh,
+    stride_scale_bs,
+    stride_scale_h,
     stride_mid_ob,
     stride_mid_oh,
     stride_mid_os,
@@ -43,6 +46,7 @@ def _fwd_grouped_kernel_stage1(
     logit_cap: tl.constexpr,
     Lk: tl.constexpr,
     Lv: tl.constexpr,
+    HAS_SCALE: tl.constexpr,
 ):
     cur_batch = tl.program_id(0)
     cur_head_id = tl.program_id(1)
@@ -105,6 +109,11 @@ def _fwd_grouped_kernel_stage1(
                 mask=(offs_n[None, :] < split_kv_end) & (mask_d[:, None]),
                 other=0.0,
             )
+            if HAS_SCALE:
+                # quantized slots, column 0 of the scales is for the compressed kv, which is also v, column 1 for k_pe
+                offs_scale = kv_loc * stride_scale_bs + cur_kv_head * stride_scale_h
+                kv_scale = tl.load(KV_Scale + offs_scale, mask=offs_n < split_kv_end, other=0.0)
+                k = k.to(tl.float32) * kv_scale[None, :]
             qk = tl.dot(q, k.to(q.dtype))
             
             if BLOCK_DPE > 0:
@@ -117,6 +126,9 @@ def _fwd_grouped_kernel_stage1(
                     (mask_dpe[:, None]),
                     other=0.0,
                 )
+                if HAS_SCALE:
+                    pe_scale = tl.load(KV_Scale + offs_scale + 1, mask=offs_n < split_kv_end, other=0.0)
+                    kpe = kpe.to(tl.float32) * pe_scale[None, :]
                 qk += tl.dot(qpe, kpe.to(qpe.dtype))
             qk *= sm_scale
 
@@ -133,6 +145,8 @@ def _fwd_grouped_kernel_stage1(
                 mask=(offs_n[:, None] < split_kv_end) & (mask_dv[None, :]),
                 other=0.0,
             )
+            if HAS_SCALE:
+                v = (v.to(tl.float32) * kv_scale[:, None]).to(q.dtype)
 
             n_e_max = tl.maximum(tl.max(qk, 1), e_max)
             re_scale = tl.exp(e_max - n_e_max)
@@ -173,6 +187,7 @@ def _decode_grouped_att_m_fwd(
     sm_scale,
     page_size,
     logit_cap,
+    kv_scale=None,
 ):
     BLOCK = 32
     Lk = k_buffer.shape[-1]
@@ -223,6 +238,7 @@ def _decode_grouped_att_m_fwd(
         q,
         k_buffer,
         v_buffer,
+        k_buffer if kv_scale is None else kv_scale,
         sm_scale,
         Req_to_tokens,
         B_Seqlen,
@@ -234,6 +250,8 @@ def _decode_grouped_att_m_fwd(
         k_buffer.stride(-2),  # Assume (..., PAGE_SIZE, NUM_HEADS, HEAD_DIM)
         v_buffer.stride(-3),  # Assume (..., PAGE_SIZE, NUM_HEADS, HEAD_DIM)
         v_buffer.stride(-2),  # Assume (..., PAGE_SIZE, NUM_HEADS, HEAD_DIM)
+        0 if kv_scale is None else kv_scale.stride(-3),
+        0 if kv_scale is None else kv_scale.stride(-2),
         att_out.stride(0),
         att_out.stride(1),
         att_out.stride(2),
@@ -251,6 +269,7 @@ def _decode_grouped_att_m_fwd(
         num_stages=2,
         Lk=Lk,
         Lv=Lv,
+        HAS_SCALE=kv_scale is not None,
         **extra_kargs,
     )
 
@@ -367,7 +386,13 @@ def decode_attention_fwd_grouped(
     sm_scale,
     page_size,
     logit_cap=0.0,
+    kv_scale=None,
 ):
+    """
+    kv_scale: the scales of an int8 or fp8 MLA cache, (..., PAGE_SIZE, 1, 2) with column 0 for the compressed
+    kv and column 1 for k_pe. k_buffer and v_buffer then hold the quantized values, which are scaled as they
+    are read instead of being dequantized into a full precision copy first.
+    """
     _decode_grouped_att_m_fwd(
         q,
         k_buffer,
@@ -379,6 +404,7 @@ def decode_attention_fwd_grouped(
         sm_scale,
         page_size,
         logit_cap,
+        kv_scale,
     )
 
     _decode_softmax_reducev_fwd(attn_logits, q, o, v_buffer, b_seq_len,
@@ -13,22 +13,33 @@ from transformers import AutoConfig
 from transformers.configuration_utils import PretrainedConfig
 # from operators import BaseInjectedModule
 from ktransformers.util.custom_gguf import GGUFLoader, translate_name_to_gguf
-from ktransformers.util.utils import set_module, load_weights
+from ktransformers.util.utils import set_module, load_weights, LazyWeightLoader, WeightLoadPipeline
+from ktransformers.util.weight_cache import RepackCache
+from ktransformers.util.prefault import PageCacheWarmer
+from ktransformers.server.config.config import Config
 import itertools
 import copy
+import functools
+import atexit
+
+@functools.lru_cache(maxsize=None)
+def import_class(class_path: str):
+    import_path = class_path.split(".")
+    import_module_name = ".".join(import_path[:-1])
+    import_class_name = import_path[-1]
+    return getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
 
 def inject(module, local_optimization_dict, model_config:AutoConfig ,gguf_loader:GGUFLoader, prefix=''):
+    # local_optimization_dict is keyed by full module names, so children look their entries up in it directly
     for name, child in module._modules.items():
         if child is not None:
             child_prefix = prefix + name
             if child_prefix in local_optimization_dict:
                 inject_module_meta=local_optimization_dict[child_prefix]
                 if inject_module_meta["class"] != "default":
-                    import_path = inject_module_meta["class"].split(".")
-                    import_module_name = ".".join(import_path[:-1])
                     gguf_loader.tensor_device_map[inject_module_meta["key"]] = inject_module_meta["kwargs"] if "kwargs" in inject_module_meta else dict()
-                    import_class_name = import_path[-1]
-                    module_cls=getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
+                    import_module_name, _, import_class_name = inject_module_meta["class"].rpartition(".")
+                    module_cls=import_class(inject_module_meta["class"])
                     print(f"Injecting {child_prefix} as", import_module_name, ".", import_class_name)
                     inject_module=module_cls(key = inject_module_meta["key"], gguf_loader = gguf_loader, config = model_config, orig_module=child, **inject_module_meta["kwargs"])
                     set_module(module, name, inject_module)
@@ -38,10 +49,9 @@ def inject(module, local_optimization_dict, model_config:AutoConfig ,gguf_loader
                 else:
                     raise Exception("inject_module_meta[\"class\"] must be \"default\" or a class path")
                 child_prefix += "."
-                child_optimization_dict = {k: v for k, v in local_optimization_dict.items() if k.startswith(child_prefix)}
-                inject(child, child_optimization_dict, model_config, gguf_loader, child_prefix)
+                inject(child, local_optimization_dict, model_config, gguf_loader, child_prefix)
 
-def del_meta(module:nn.Module):
+def del_meta(module:nn.Module, keep=()):
     #print("default loading weights", prefix)
     persistent_buffers = {k: v for k, v in module._buffers.items() if k not in module._non_persistent_buffers_set}
     local_name_params = itertools.chain(module._parameters.items(), persistent_buffers.items())
@@ -50,30 +60,37 @@ def del_meta(module:nn.Module):
         if param.device == "meta" or param.device == torch.device("meta"):
             module.__delattr__(name)
     for name, child in module._modules.items():
-        del_meta(child)
+        if child not in keep:
+            del_meta(child, keep)
 
-def gen_optimize_config(module: nn.Module, out_data: Mapping, rule_list: List, prefix: str="", default_device: str = "cuda:0"):
-    module_name = prefix[:-1]
-    translated_name = translate_name_to_gguf(prefix)[:-1]
-    #print("gen_optimize_config", prefix, module_name, translated_name)
-    recursive = True
+def compile_rules(rule_list: List) -> List:
+    """Compiles the name regex of each rule, match classes are imported on first use."""
+    compiled = []
     for rule in rule_list:
         match_meta = rule["match"]
         if "class" not in match_meta and "name" not in match_meta:
             raise Exception("match must have at least one of \"class\" and \"name\"")
-        if "class" in match_meta:
-            import_path = match_meta["class"].split(".")
-            import_module_name = ".".join(import_path[:-1])
-            import_class_name = import_path[-1]
-            module_cls=getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
-            if not isinstance(module, module_cls):
+        name_pattern = re.compile(match_meta["name"]) if "name" in match_meta else None
+        compiled.append((match_meta.get("class"), name_pattern, rule))
+    return compiled
+
+def gen_optimize_config(module: nn.Module, out_data: Mapping, rule_list: List, prefix: str="", default_device: str = "cuda:0"):
+    rules = compile_rules(rule_list)
+    # depth first in the order of module._modules, as the rules of the first match win
+    pending = [(module, prefix)]
+    while pending:
+        module, prefix = pending.pop()
+        module_name = prefix[:-1]
+        translated_name = translate_name_to_gguf(prefix)[:-1]
+        #print("gen_optimize_config", prefix, module_name, translated_name)
+        recursive = True
+        for match_class, name_pattern, rule in rules:
+            if match_class is not None and not isinstance(module, import_class(match_class)):
                 continue
-        if "name" in match_meta:
-            if re.search(match_meta["name"], module_name) is None:
+            if name_pattern is not None and name_pattern.search(module_name) is None:
                 continue
-        if "replace" not in rule:
-            raise Exception("replace must be in rule")
-        if "replace" in rule:
+            if "replace" not in rule:
+                raise Exception("replace must be in rule")
             replace_meta = rule["replace"]
             if module_name not in out_data:
                 out_data[module_name]={"key": translated_name,
@@ -84,26 +101,22 @@ def gen_optimize_config(module: nn.Module, out_data: Mapping, rule_list: List, p
                 if out_data[module_name]["class"] == "default":
                     out_data[module_name]["class"] = replace_meta["class"] if "class" in replace_meta else "default"
                 out_data[module_name]["kwargs"].update(copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict())
-        if "recursive" in rule:
-            recursive = bool(rule["recursive"])
-        break
-            
-    if module_name not in out_data:
-        out_data[module_name]= {
-            "class": "default",
-            "key": translated_name,
-            "kwargs": {"generate_device": default_device,
-                       "prefill_device": default_device}
-        }
+            if "recursive" in rule:
+                recursive = bool(rule["recursive"])
+            break
 
-    #print(out_data[module_name])
-    #input()
+        # a module no rule matches is placed on default_device, at any depth
+        if module_name not in out_data:
+            out_data[module_name]= {
+                "class": "default",
+                "key": translated_name,
+                "kwargs": {"generate_device": default_device,
+                           "prefill_device": default_device}
+            }
 
-    if recursive:
-        for name, child in module._modules.items():
-            if child is not None:
-                child_prefix = prefix + name + "."
-                gen_optimize_config(child, out_data, rule_list, child_prefix)
+        if recursive:
+            children = [(child, prefix + name + ".") for name, child in module._modules.items() if child is not None]
+            pending.extend(reversed(children))
     
 
 def translate_model_config(model_config: PretrainedConfig):
@@ -114,7 +127,12 @@ def translate_model_config(model_config: PretrainedConfig):
     return model_config
 
 
-def optimize_and_load_gguf(module: nn.Module, rule_file: str, gguf_path: str, model_config: PretrainedConfig, default_device: str = "cuda:0"):
+def optimize_and_load_gguf(module: nn.Module, rule_file: str, gguf_path: str, model_config: PretrainedConfig, default_device: str = "cuda:0", lazy: bool = False, load_workers: int = None):
+    '''
+    With lazy, only the weights outside the decoder layers are loaded before returning, each layer
+    is loaded by its first forward or by a background thread, see LazyWeightLoader.
+    load_workers threads read and dequantize the weights, see WeightLoadPipeline.
+    '''
     with open(rule_file, 'r', encoding='utf-8') as f:
         rule_list = yaml.load(f.read(), Loader=yaml.FullLoader)
     
@@ -124,11 +142,30 @@ def optimize_and_load_gguf(module: nn.Module, rule_file: str, gguf_path: str, mo
     model_config = translate_model_config(model_config)
 
     gguf_loader=GGUFLoader(gguf_path)
+    if gguf_loader.safetensor_loader is not None and Config().fp8_dequant_cache_dir is not None:
+        gguf_loader.safetensor_loader.dequant_cache = RepackCache(Config().fp8_dequant_cache_dir)
     with torch.device("meta"):
         inject(module, optimize_config, model_config, gguf_loader)
-    # pre load lm_head because its big inter result
-    load_weights(module.lm_head, gguf_loader, "lm_head.")
-    load_weights(module, gguf_loader)
+    if lazy:
+        gguf_loader.lazy_loader = LazyWeightLoader(module, gguf_loader, on_load=del_meta)
+    with WeightLoadPipeline(load_workers):
+        # pre load lm_head because its big inter result
+        load_weights(module.lm_head, gguf_loader, "lm_head.")
+        load_weights(module, gguf_loader)
     module.gguf_loader = gguf_loader
-    del_meta(module)
+    # layers that are not loaded yet keep their meta parameters, load_weights goes by them
+    del_meta(module, gguf_loader.lazy_loader.prefixes if lazy else ())
     torch.cuda.empty_cache()
+    if Config().prefault and gguf_loader.file_data_map:
+        warmer = PageCacheWarmer(gguf_loader.file_data_map, Config().prefault_profile_path, excluded=gguf_loader.copied_ranges)
+        gguf_loader.page_cache_warmer = warmer
+        # what loading read is not recorded, only what the model computes on afterwards
+        if lazy:
+            gguf_loader.lazy_loader.on_done = warmer.reset_accesses
+        else:
+            warmer.reset_accesses()
+        warmer.start()
+        # the chunks this run accessed are what the next start reads first
+        atexit.register(warmer.record)
+    if lazy:
+        gguf_loader.lazy_loader.start()
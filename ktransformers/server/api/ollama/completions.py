@@ -9,8 +9,8 @@ from fastapi import APIRouter, Request
 from pydantic import BaseModel, Field
 
 from ktransformers.server.config.config import Config
-from ktransformers.server.utils.create_interface import get_interface
-from ktransformers.server.schemas.assistants.streaming import check_link_response
+from ktransformers.server.utils.create_interface import get_interface, get_request_queue
+from ktransformers.server.schemas.assistants.streaming import check_link_response, check_client_link, CancellationToken
 from ktransformers.server.backend.base import BackendInterfaceBase
 
 from ktransformers.server.schemas.endpoints.chat import RawUsage
@@ -36,35 +36,66 @@ class OllamaGenerateCompletionRequest(BaseModel):
     context: Optional[str] = Field(
         None, description="The context parameter from a previous request to keep a short conversational memory.")
     stream: Optional[bool] = Field(
-        None, description="If false, the response will be returned as a single response object.")
+        True, description="If false, the response will be returned as a single response object.")
     raw: Optional[bool] = Field(
         None, description="If true, no formatting will be applied to the prompt.")
     keep_alive: Optional[str] = Field(
         "5m", description="Controls how long the model will stay loaded into memory following the request.")
 
-class OllamaGenerationStreamResponse(BaseModel):
+class OllamaMetrics(BaseModel):
+    total_duration: Optional[int] = Field(None, description="Total time spent in nanoseconds")
+    load_duration: Optional[int] = Field(
+        None, description="Time spent loading the model in nanoseconds, 0 as it is loaded at startup")
+    queue_duration: Optional[int] = Field(
+        None, description="Time spent waiting in the request queue in nanoseconds, not in the Ollama API")
+    prompt_eval_count: Optional[int] = Field(None, description="Number of tokens in prompt")
+    prompt_eval_duration: Optional[int] = Field(None, description="Time spent evaluating prompt in nanoseconds")
+    eval_count: Optional[int] = Field(None, description="Number of tokens generated")
+    eval_duration: Optional[int] = Field(None, description="Time spent generating response in nanoseconds")
+
+    def set_metrics(self, raw_usage: Optional[RawUsage], start_time: float, granted_time: float):
+        self.total_duration = int((time() - start_time) * 1_000_000_000)
+        self.load_duration = 0
+        self.queue_duration = int((granted_time - start_time) * 1_000_000_000)
+        if raw_usage is None:
+            return
+        prompt_eval_duration = int((raw_usage.tokenize_time + raw_usage.prefill_time) * 1_000_000_000)
+        self.eval_duration = int(raw_usage.decode_time * 1_000_000_000)
+        self.prompt_eval_duration = prompt_eval_duration
+        self.prompt_eval_count = raw_usage.prefill_count
+        self.eval_count = raw_usage.decode_count
+
+class OllamaGenerationStreamResponse(OllamaMetrics):
     model: str
     created_at: str
     response: str
     done: bool = Field(...)
+    done_reason: Optional[str] = None
 
-class OllamaGenerationResponse(BaseModel):
+class OllamaGenerationResponse(OllamaGenerationStreamResponse):
     pass
 
 @router.post("/generate", tags=['ollama'])
 async def generate(request: Request, input: OllamaGenerateCompletionRequest):
     id = str(uuid4())
+    start_time = time()
     interface: BackendInterfaceBase = get_interface()
     print(f'COMPLETION INPUT:----\n{input.prompt}\n----')
     config = Config()
+    cancel_token = CancellationToken()
+    events = await get_request_queue().schedule_request(request, interface.inference(input.prompt, id, cancel_token=cancel_token))
+    granted_time = time()
 
     if input.stream:
         async def inner():
-            async for res in interface.inference(input.prompt, id):
+            raw_usage = None
+            done_reason = None
+            async for res in events:
                 if isinstance(res, RawUsage):
                     raw_usage = res
                 else: 
                     token, finish_reason = res
+                    done_reason = finish_reason or done_reason
                     d = OllamaGenerationStreamResponse(
                         model=config.model_name,
                         created_at=str(datetime.now()),
@@ -76,12 +107,32 @@ async def generate(request: Request, input: OllamaGenerateCompletionRequest):
                 model=config.model_name,
                 created_at=str(datetime.now()),
                 response='',
-                done=True
+                done=True,
+                done_reason=done_reason
             )
+            d.set_metrics(raw_usage, start_time, granted_time)
             yield d.model_dump_json() + '\n'
-        return check_link_response(request, inner())
+        return check_link_response(request, inner(), cancel_token)
     else:
-        raise NotImplementedError
+        raw_usage = None
+        done_reason = None
+        response = ''
+        async for res in check_client_link(request, events, cancel_token):
+            if isinstance(res, RawUsage):
+                raw_usage = res
+            else:
+                token, finish_reason = res
+                done_reason = finish_reason or done_reason
+                response += token
+        d = OllamaGenerationResponse(
+            model=config.model_name,
+            created_at=str(datetime.now()),
+            response=response,
+            done=True,
+            done_reason=done_reason
+        )
+        d.set_metrics(raw_usage, start_time, granted_time)
+        return d
 
 # https://github.com/ollama/ollama/blob/main/docs/api.md#generate-a-chat-completion
 class OllamaChatCompletionMessage(BaseModel):
@@ -94,26 +145,22 @@ class OllamaChatCompletionRequest(BaseModel):
         ..., description="A list of messages to generate a response for.")
     stream: bool = Field(True, description="If true, the response will be streamed.")
 
-class OllamaChatCompletionStreamResponse(BaseModel):
+class OllamaChatCompletionStreamResponse(OllamaMetrics):
     model: str
     created_at: str
     message: dict
     done: bool = Field(...)
-    total_duration: Optional[int] = Field(None, description="Total time spent in nanoseconds")
-    load_duration: Optional[int] = Field(None, description="Time spent loading model in nanoseconds")
-    prompt_eval_count: Optional[int] = Field(None, description="Number of tokens in prompt")
-    prompt_eval_duration: Optional[int] = Field(None, description="Time spent evaluating prompt in nanoseconds")
-    eval_count: Optional[int] = Field(None, description="Number of tokens generated")
-    eval_duration: Optional[int] = Field(None, description="Time spent generating response in nanoseconds")
+    done_reason: Optional[str] = None
 
 
 
-class OllamaChatCompletionResponse(BaseModel):
+class OllamaChatCompletionResponse(OllamaChatCompletionStreamResponse):
     pass
 
 @router.post("/chat", tags=['ollama'])
 async def chat(request: Request, input: OllamaChatCompletionRequest):
     id = str(uuid4())
+    start_time = time()
     interface: BackendInterfaceBase = get_interface()
     config = Config()
 
@@ -122,18 +169,20 @@ async def chat(request: Request, input: OllamaChatCompletionRequest):
     for msg in input.messages:
         prompt += f"{msg.role}: {msg.content}\n"
     prompt += "assistant:"
+    cancel_token = CancellationToken()
+    events = await get_request_queue().schedule_request(request, interface.inference(prompt, id, cancel_token=cancel_token))
+    granted_time = time()
 
     if input.stream:
         async def inner():
-            start_time = time()  # 记录开始时间（秒）
-            eval_count = 0  # 统计生成的 token 数量
-            tokens = []
-
-            async for res in interface.inference(prompt, id):
+            raw_usage = None
+            done_reason = None
+            async for res in events:
                 if isinstance(res, RawUsage):
                     raw_usage = res
                 else: 
                     token, finish_reason = res
+                    done_reason = finish_reason or done_reason
                     d = OllamaChatCompletionStreamResponse(
                         model=config.model_name,
                         created_at=str(datetime.now()),
@@ -141,30 +190,36 @@ async def chat(request: Request, input: OllamaChatCompletionRequest):
                         done=False
                     )
                     yield d.model_dump_json() + '\n'
-            # 计算性能数据
-            end_time = time()
-            total_duration = int((end_time - start_time) * 1_000_000_000)  # 转换为纳秒
-            prompt_eval_count = len(prompt.split())  # 简单估算提示词数量
-            eval_duration = total_duration  # 假设全部时间用于生成（简化）
-            prompt_eval_duration = 0  # 假设无单独提示评估时间
-            load_duration = 0  # 假设加载时间未知
-
             d = OllamaChatCompletionStreamResponse(
                 model=config.model_name,
                 created_at=str(datetime.now()),
                 message={},
                 done=True,
-                total_duration=total_duration,
-                load_duration=load_duration,
-                prompt_eval_count=prompt_eval_count,
-                prompt_eval_duration=prompt_eval_duration,
-                eval_count=eval_count,
-                eval_duration=eval_duration
+                done_reason=done_reason
             )
+            d.set_metrics(raw_usage, start_time, granted_time)
             yield d.model_dump_json() + '\n'
-        return check_link_response(request, inner())
+        return check_link_response(request, inner(), cancel_token)
     else:
-        raise NotImplementedError("Non-streaming chat is not implemented.")
+        raw_usage = None
+        done_reason = None
+        content = ''
+        async for res in check_client_link(request, events, cancel_token):
+            if isinstance(res, RawUsage):
+                raw_usage = res
+            else:
+                token, finish_reason = res
+                done_reason = finish_reason or done_reason
+                content += token
+        d = OllamaChatCompletionResponse(
+            model=config.model_name,
+            created_at=str(datetime.now()),
+            message={"role": "assistant", "content": content},
+            done=True,
+            done_reason=done_reason
+        )
+        d.set_metrics(raw_usage, start_time, granted_time)
+        return d
 
 # https://github.com/ollama/ollama/blob/main/docs/api.md#list-local-models
 class OllamaModel(BaseModel):
@@ -6,8 +6,8 @@ from pydantic import BaseModel, Field
 import re
 from fastapi import APIRouter
 from fastapi.requests import Request
-from ktransformers.server.utils.create_interface import get_interface
-from ktransformers.server.schemas.assistants.streaming import chat_stream_response
+from ktransformers.server.utils.create_interface import get_interface, get_request_queue
+from ktransformers.server.schemas.assistants.streaming import chat_stream_response, check_client_link, CancellationToken
 from ktransformers.server.schemas.endpoints.chat import ChatCompletionCreate
 from ktransformers.server.schemas.endpoints.chat import RawUsage, Role
 from ktransformers.server.backend.base import BackendInterfaceBase
@@ -91,6 +91,11 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
     
     if Config().api_key != '':
         assert request.headers.get('Authorization', '').split()[-1] == Config().api_key
+
+    cancel_token = CancellationToken()
+    events = await get_request_queue().schedule_request(
+        request, interface.inference(input_message, id, create.temperature, create.top_p, cancel_token=cancel_token)
+    )
     
     if create.stream:
         async def inner():
@@ -116,7 +121,7 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
             tool_call_end_marker = "<｜tool▁call▁end｜>"
             tool_calls_end_marker = "<｜tool▁calls▁end｜>"
             
-            async for res in interface.inference(input_message, id, create.temperature, create.top_p):
+            async for res in events:
                 if isinstance(res, RawUsage):
                     # 最后返回使用情况
                     raw_usage = res
@@ -286,7 +291,7 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
                 }]
                 yield chunk
         
-        return chat_stream_response(request, inner())
+        return chat_stream_response(request, inner(), cancel_token)
     else:
         # 非流式响应处理
         full_content = ""
@@ -302,7 +307,7 @@ async def chat_completion(request: Request, create: ChatCompletionCreate):
         tool_call_end_marker = "<｜tool▁call▁end｜>"
         tool_calls_end_marker = "<｜tool▁calls▁end｜>"
         
-        async for res in interface.inference(input_message, id, create.temperature, create.top_p):
+        async for res in check_client_link(request, events, cancel_token):
             if isinstance(res, RawUsage):
                 raw_usage = res
                 usage = CompletionUsage(
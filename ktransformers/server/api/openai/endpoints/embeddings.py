@@ -0,0 +1,43 @@
+import base64
+
+from fastapi import APIRouter
+from fastapi.requests import Request
+
+from ktransformers.server.backend.base import BackendInterfaceBase
+from ktransformers.server.config.config import Config
+from ktransformers.server.exceptions import request_error
+from ktransformers.server.schemas.assistants.streaming import check_client_link, CancellationToken
+from ktransformers.server.schemas.endpoints.embeddings import Embedding, EmbeddingCreate, EmbeddingObject, EmbeddingUsage
+from ktransformers.server.utils.create_interface import get_interface, get_request_queue
+
+router = APIRouter()
+
+
+@router.post('/embeddings', tags=['openai'])
+async def create_embeddings(request: Request, create: EmbeddingCreate):
+    inputs = create.get_inputs()
+    if len(inputs) == 0:
+        raise request_error('input should not be empty')
+
+    interface: BackendInterfaceBase = get_interface()
+    if Config().api_key != '':
+        assert request.headers.get('Authorization', '').split()[-1] == Config().api_key
+
+    cancel_token = CancellationToken()
+    events = await get_request_queue().schedule_request(request, interface.embed(inputs, create.pooling))
+
+    data = [None] * len(inputs)
+    prompt_tokens = 0
+    async for index, embedding, token_count in check_client_link(request, events, cancel_token):
+        if create.encoding_format == 'base64':
+            value = base64.b64encode(embedding.numpy().astype('<f4').tobytes()).decode()
+        else:
+            value = embedding.tolist()
+        data[index] = Embedding(index=index, embedding=value)
+        prompt_tokens += token_count
+
+    return EmbeddingObject(
+        data=data,
+        model=Config().model_name,
+        usage=EmbeddingUsage(prompt_tokens=prompt_tokens, total_tokens=prompt_tokens),
+    )
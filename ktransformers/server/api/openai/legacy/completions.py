@@ -3,39 +3,68 @@ from time import time
 from uuid import uuid4
 from fastapi import APIRouter
 from fastapi.requests import Request
-from ktransformers.server.utils.create_interface import get_interface
-from ktransformers.server.schemas.assistants.streaming import stream_response
+from ktransformers.server.utils.create_interface import get_interface, get_request_queue
+from ktransformers.server.schemas.assistants.streaming import stream_response, check_client_link, CancellationToken
 from ktransformers.server.schemas.legacy.completions import CompletionCreate,CompletionObject
 from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.server.exceptions import request_error
 
 router = APIRouter()
 
+def batch_jobs(interface,create:CompletionCreate):
+    # every (prompt, sample) pair is one job, ordered by token ids so that neighbours share the longest
+    # prefix of tokens, which the backend reuses from its kv cache instead of prefilling it again
+    prompts = create.get_prompts()
+    ids = [interface.tokenize_prompt(prompt).flatten().tolist() for prompt in prompts]
+    jobs = [(prompt,i*create.n+j) for i,prompt in enumerate(prompts) for j in range(create.n)]
+    jobs.sort(key=lambda job:ids[job[1]//create.n])
+    return jobs
+
+async def batch_inference(interface,jobs,id:str,create:CompletionCreate,cancel_token:CancellationToken):
+    for prompt,index in jobs:
+        if cancel_token.cancelled:
+            break
+        async for res in interface.inference(prompt,f'{id}-{index}',create.temperature,create.top_p,cancel_token=cancel_token):
+            yield index,res
+
 @router.post("/completions",tags=['openai'])
 async def create_completion(request:Request,create:CompletionCreate):
     id = str(uuid4())
+    if create.n<1:
+        raise request_error('n should be at least 1')
 
     interface = get_interface()
     print(f'COMPLETION INPUT:----\n{create.prompt}\n----')
-
+    cancel_token = CancellationToken()
+    jobs = batch_jobs(interface,create)
+    events = await get_request_queue().schedule_request(
+        request, batch_inference(interface,jobs,id,create,cancel_token), jobs=len(jobs)
+    )
    
     if create.stream:
         async def inner():
-            async for res in interface.inference(create.prompt,id,create.temperature,create.top_p):     
+            finish_reasons = {}
+            async for index,res in events:
                 if isinstance(res, RawUsage):
                     raw_usage = res
                 else: 
                     token, finish_reason = res
-                    d = {'choices':[{'delta':{'content':token}}]}
+                    if finish_reason is not None:
+                        finish_reasons[index] = finish_reason
+                    d = {'choices':[{'index':index,'delta':{'content':token}}]}
                     yield f"data:{json.dumps(d)}\n\n"
-            d = {'choices':[{'delta':{'content':''},'finish_reason':''}]}
-            yield f"data:{json.dumps(d)}\n\n"
-        return stream_response(request,inner())
+            # one finish chunk per choice, a cancelled job has no finish reason
+            for index in range(len(jobs)):
+                d = {'choices':[{'index':index,'delta':{'content':''},'finish_reason':finish_reasons.get(index,'')}]}
+                yield f"data:{json.dumps(d)}\n\n"
+        return stream_response(request,inner(),cancel_token)
     else:
         comp = CompletionObject(id=id,object='text_completion',created=int(time()))
-        async for res in interface.inference(create.prompt,id,create.temperature,create.top_p):     
+        async for index,res in check_client_link(request,events,cancel_token):
             if isinstance(res, RawUsage):
                 raw_usage = res
             else: 
                 token, finish_reason = res
-                comp.append_token(token) 
+                comp.append_token(token,index) 
+                comp.set_finish_reason(finish_reason,index)
         return comp
@@ -1,6 +1,8 @@
 from fastapi import APIRouter
 from .system import router as system_router
+from .kvcache import router as kvcache_router
 
 
 router = APIRouter()
 router.include_router(system_router)
+router.include_router(kvcache_router)
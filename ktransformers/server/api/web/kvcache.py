@@ -0,0 +1,58 @@
+from fastapi import APIRouter
+from fastapi.requests import Request
+from pydantic import BaseModel, Field
+
+from ktransformers.server.backend.base import BackendInterfaceBase
+from ktransformers.server.exceptions import request_error
+from ktransformers.server.utils.create_interface import get_interface, get_request_queue
+
+router = APIRouter(prefix='/kvcache')
+
+
+class PrefixSnapshotCreate(BaseModel):
+    prompt: str = Field(..., description="Text whose kv cache is saved, usually a shared system prompt or document")
+
+
+class PrefixSnapshotObject(BaseModel):
+    key: str
+    tokens: int
+
+
+@router.post('/snapshots', tags=['web'])
+async def create_prefix_snapshot(request: Request, create: PrefixSnapshotCreate):
+    interface: BackendInterfaceBase = get_interface()
+    if getattr(interface, 'prefix_snapshots', None) is None:
+        raise request_error('prefix_snapshot_dir is not configured')
+
+    async def save():
+        yield await interface.save_prefix_snapshot(create.prompt)
+
+    # drain the queue iterator so that its slot is released before responding
+    async for key, tokens in await get_request_queue().schedule_request(request, save()):
+        snapshot = PrefixSnapshotObject(key=key, tokens=tokens)
+    return snapshot
+
+
+def get_sparsity_stats():
+    from ktransformers.operators.models import KLlamaModel
+    if KLlamaModel.dynamic_sdpa is None:
+        raise request_error('attention sparsity is only collected in long context mode')
+    return KLlamaModel.dynamic_sdpa.sparsity_stats
+
+
+@router.get('/sparsity', tags=['web'])
+async def get_attn_sparsity(reset: bool = False):
+    stats = get_sparsity_stats()
+    summary = stats.summary()
+    if reset:
+        stats.reset()
+    return summary
+
+
+@router.post('/sparsity/flush', tags=['web'])
+async def flush_attn_sparsity():
+    stats = get_sparsity_stats()
+    if stats.flush_path is None:
+        raise request_error('attn_sparsity_flush_path is not configured')
+    stats.flush()
+    return {'path': stats.flush_path}
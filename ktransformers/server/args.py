@@ -11,6 +11,8 @@ class ArgumentParser:
         parser.add_argument("--host", type=str, default=self.cfg.server_ip)
         parser.add_argument("--port", type=int, default=self.cfg.server_port)
         parser.add_argument("--api_key", type=str, default=self.cfg.api_key)
+        parser.add_argument("--max_queue_depth", type=int, default=self.cfg.max_queue_depth)
+        parser.add_argument("--queue_deadline", type=float, default=self.cfg.queue_deadline)
         parser.add_argument("--ssl_keyfile", type=str)
         parser.add_argument("--ssl_certfile", type=str)
         parser.add_argument("--web", type=bool, default=self.cfg.mount_web)
@@ -25,6 +27,15 @@ class ArgumentParser:
         parser.add_argument("--cpu_infer", type=int, default=self.cfg.cpu_infer)
         parser.add_argument("--type", type=str, default=self.cfg.backend_type)
         parser.add_argument("--chunk_prefill_size", type=int, default=8192)
+        parser.add_argument("--chunk_prefill_autotune", action=argparse.BooleanOptionalAction, type=bool, default=self.cfg.chunk_prefill_autotune)
+        parser.add_argument("--chunk_tuning_path", type=str, default=self.cfg.chunk_tuning_path)
+        parser.add_argument("--lazy_load", action=argparse.BooleanOptionalAction, type=bool, default=self.cfg.lazy_load)
+        parser.add_argument("--repack_cache_dir", type=str, default=self.cfg.repack_cache_dir)
+        parser.add_argument("--fp8_dequant_cache_dir", type=str, default=self.cfg.fp8_dequant_cache_dir)
+        parser.add_argument("--expert_page_backing", type=str, choices=["thp", "hugetlb"], default=self.cfg.expert_page_backing)
+        parser.add_argument("--expert_mlock", action=argparse.BooleanOptionalAction, type=bool, default=self.cfg.expert_mlock)
+        parser.add_argument("--prefault", action=argparse.BooleanOptionalAction, type=bool, default=self.cfg.prefault)
+        parser.add_argument("--prefault_profile_path", type=str, default=self.cfg.prefault_profile_path)
 
         # model configs
         # parser.add_argument("--model_cache_lens", type=int, default=self.cfg.cache_lens)  # int?
@@ -65,13 +76,19 @@ class ArgumentParser:
         parser.add_argument("--max_response_tokens", type=int, default=self.cfg.max_response_tokens)
         parser.add_argument("--response_chunk", type=int, default=self.cfg.response_chunk)
         parser.add_argument("--no_code_formatting", type=bool, default=self.cfg.no_code_formatting)
-        parser.add_argument("--cache_8bit", type=bool, default=self.cfg.cache_8bit)
-        parser.add_argument("--cache_q4", type=bool, default=self.cfg.cache_q4)
+        parser.add_argument("--cache_8bit", action=argparse.BooleanOptionalAction, type=bool, default=self.cfg.cache_8bit)
+        parser.add_argument("--cache_8bit_format", type=str, choices=["fp8", "int8"], default=self.cfg.cache_8bit_format)
+        parser.add_argument("--cache_q4", action=argparse.BooleanOptionalAction, type=bool, default=self.cfg.cache_q4)
         parser.add_argument("--ngram_decoding", type=bool, default=self.cfg.ngram_decoding)
         parser.add_argument("--print_timings", type=bool, default=self.cfg.print_timings)
         parser.add_argument("--amnesia", type=bool, default=self.cfg.amnesia)
         parser.add_argument("--batch_size", type=int, default=self.cfg.batch_size)
         parser.add_argument("--cache_lens", type=int, default=self.cfg.cache_lens)
+        parser.add_argument("--prefix_snapshot_dir", type=str, default=self.cfg.prefix_snapshot_dir)
+        parser.add_argument("--prefix_snapshot_preload", type=bool, default=self.cfg.prefix_snapshot_preload)
+        parser.add_argument("--kv_offload_pages", type=int, default=self.cfg.kv_offload_pages)
+        parser.add_argument("--kv_sink_tokens", type=int, default=self.cfg.kv_sink_tokens)
+        parser.add_argument("--kv_window_evict", type=int, default=self.cfg.kv_window_evict)
 
         # log configs
         # log level: debug, info, warn, error, crit
@@ -30,6 +30,13 @@ class ConfigArgs(BaseModel):
             " job is started, but at the expense of overall prompt ingestion speed"
         ),
     )
+    chunk_prefill_autotune: bool = Field(
+        False, description="Tune the prefill chunk size, up to chunk_prefill_size, from measured prefill time"
+    )
+    chunk_tuning_path: Optional[str] = Field(None, description="File that keeps the prefill chunk size measurements")
+    lazy_load: bool = Field(
+        False, description="Load each decoder layer on its first use, in the background, instead of before serving"
+    )
     max_new_tokens: int = Field(None, description="Max new tokens per completion. For this example applies to all jobs")
     json_mode: bool = Field(
         None, description="Use LMFE to constrain the output to JSON format. See schema and details below"
@@ -74,6 +81,7 @@ class ConfigArgs(BaseModel):
     response_chunk: int = Field(None, description="Space to reserve in context for reply, default = 250")
     no_code_formatting: bool = Field(None, description="Disable code formatting/syntax highlighting")
     cache_8bit: bool = Field(None, description="Use 8-bit (FP8) cache")
+    cache_8bit_format: str = Field("fp8", description="Storage of the 8-bit cache, fp8 or int8")
     cache_q4: bool = Field(None, description="Use Q4 cache")
     ngram_decoding: bool = Field(None, description="Use n-gram speculative decoding")
     print_timings: bool = Field(None, description="Output timings after each prompt")
@@ -83,6 +91,11 @@ class ConfigArgs(BaseModel):
     batch_size: int = Field(None, description="Batch Size")
     cache_lens: int = Field(None, description="Cache lens for transformers static cache")
     device: str = Field(None, description="device")
+    prefix_snapshot_dir: Optional[str] = Field(None, description="Directory of persistent prefix kv cache snapshots")
+    prefix_snapshot_preload: bool = Field(False, description="Read prefix kv cache snapshots into page cache at startup")
+    kv_offload_pages: int = Field(0, description="Pages of pinned host memory that keep the kv cache of idle sequences")
+    kv_sink_tokens: Optional[int] = Field(None, description="Keep these first tokens and a rolling window in the kv cache instead of stopping at cache_lens")
+    kv_window_evict: int = Field(256, description="Tokens evicted at once from the rolling window")
 
 
 cfg = Config()
@@ -37,7 +37,7 @@ class BackendInterfaceBase:
         raise NotImplementedError
 
     
-    async def inference(self,local_messages,request_unique_id:Optional[str])->AsyncIterator[str]:
+    async def inference(self,local_messages,request_unique_id:Optional[str],cancel_token=None)->AsyncIterator[str]:
         '''
         work can be called directly, or by ThreadContext
 
@@ -46,6 +46,8 @@ class BackendInterfaceBase:
             Please deal with different local_messages
         request_unique_id:
             unique id of different requests, useful when using cache
+        cancel_token:
+            CancellationToken set when the client disconnects, checked between decode steps
         
         return:
             async str output for stream update
@@ -54,6 +56,28 @@ class BackendInterfaceBase:
         raise NotImplementedError
 
 
+    async def embed(self,inputs:List,pooling:str='mean')->AsyncIterator[Tuple[int,torch.Tensor,int]]:
+        '''
+        inputs:
+            strings or token id lists to embed
+        pooling:
+            how to pool the final hidden states of each input, mean or last
+
+        return:
+            async (index in inputs, embedding, number of tokens), in any order
+        '''
+        raise NotImplementedError
+
+    async def save_prefix_snapshot(self,prompt:str)->Tuple[str,int]:
+        '''
+        prompt:
+            text whose kv cache is persisted, later requests starting with the same tokens restore it from disk
+
+        return:
+            (snapshot key, number of tokens)
+        '''
+        raise NotImplementedError
+
     def report_last_time_performance(self):
         try:
             tokenize_time = self.profiler.get_timer_sec('tokenize')
@@ -1,3 +1,4 @@
+import time
 import torch
 from typing import Optional, List
 import asyncio
@@ -11,13 +12,14 @@ from ktransformers.server.backend.interfaces.transformers import (
 )
 from ktransformers.server.config.log import logger
 from ktransformers.optimize.optimize import optimize_and_load_gguf
-from ktransformers.models.custom_cache import StaticCache
+from ktransformers.models.custom_cache import StaticCache, kv_quant_from_args
+from ktransformers.operators.models import KLlamaModel
 from ktransformers.util.cuda_graph_runner import CUDAGraphRunner
 from ktransformers.local_chat import custom_models, default_optimize_rules
-from ktransformers.util.utils import get_device
+from ktransformers.util.utils import get_device, get_all_used_cuda_device
+from ktransformers.util.chunk_tuner import ChunkSizeTuner, hardware_profile
 from typing import Optional
 from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled, MLAWrapperSingleton
-from ktransformers.server.schemas.endpoints.chat import RawUsage
 
 warm_uped = False
 
@@ -60,7 +62,7 @@ class KTransformersInterface(TransformersInterface):
                 "please input the path of your gguf file(gguf file in the dir containing input gguf file must all"
                 " belong to current model):"
             )
-        optimize_and_load_gguf(self.model, optimize_config_path, gguf_path, config)
+        optimize_and_load_gguf(self.model, optimize_config_path, gguf_path, config, lazy=args.lazy_load)
         self.model.generation_config = generation_config
         self.device_map = self.model.gguf_loader.tensor_device_map
         # logger.info(f"{args.model_name} loaded from {args.model_dir} to {self.device_map}")
@@ -70,12 +72,28 @@ class KTransformersInterface(TransformersInterface):
             max_cache_len=args.cache_lens,
             device=self.device_map,
             dtype=self.model.dtype,
+            kv_quant=kv_quant_from_args(args),
+            sink_tokens=args.kv_sink_tokens,
         )
         # logger.info(f"StaticCache (length={args.cache_lens}), batch size:{args.batch_size}")
 
         if self.model.generation_config.pad_token_id is None:
             self.model.generation_config.pad_token_id = self.model.generation_config.eos_token_id
         self.streamer = TextStreamer(self.tokenizer)
+        self.rope_shifts = {}
+        self.init_prefix_snapshots()
+        self.init_kv_offload()
+        self.max_chunk_size = args.chunk_prefill_size
+        if self.sink_window:
+            # the window is moved between chunks, a chunk takes at most half of what follows the sink tokens
+            self.max_chunk_size = min(self.max_chunk_size, (args.cache_lens - self.cache.sink_tokens) // 2)
+        self.chunk_tuner = None
+        if args.chunk_prefill_autotune:
+            self.chunk_tuner = ChunkSizeTuner(
+                args.chunk_tuning_path,
+                f"{args.model_dir}:{gguf_path}:{optimize_config_path}:{hardware_profile(get_all_used_cuda_device(self.device_map))}:{args.cpu_infer}",
+                self.max_chunk_size,
+            )
 
         self._infer_lock = asyncio.Lock()
 
@@ -131,7 +149,7 @@ class KTransformersInterface(TransformersInterface):
     @torch.no_grad
     def prefill(self, input_ids: torch.Tensor, is_new: bool, temperature: Optional[float], top_p: Optional[float]):
         input_ids_length = input_ids.shape[-1]
-        if(input_ids_length >= self.args.cache_lens):
+        if input_ids_length >= self.args.cache_lens and not self.sink_window:
             logger.warning(f"input_ids_length {input_ids_length} > cache_lens {self.args.cache_lens}")
             self.seq_length = input_ids_length
             return
@@ -160,6 +178,11 @@ class KTransformersInterface(TransformersInterface):
                 else:
                     break
             
+            if self.cache.evicted_tokens:
+                # after an eviction only the sink tokens were computed with their full context
+                same_prefix = min(same_prefix, self.cache.sink_tokens)
+            same_prefix = self.swap_sequence(input_ids, same_prefix)
+            same_prefix = self.restore_prefix_snapshot(input_ids, same_prefix)
             logger.debug(f"same prefix len: {same_prefix}")
             self.cache.remove_suffix(same_prefix)
             self.seq_length = same_prefix
@@ -172,22 +195,22 @@ class KTransformersInterface(TransformersInterface):
         logger.debug(f"input_ids: {input_ids.shape}")
         logger.debug(f"generate_ids: {self.generated_ids.shape}")
         
-        former_seq_length = self.seq_length
-        self.seq_length += input_ids_length
-        expected_length = min(self.seq_length + self.args.max_new_tokens + 1, self.args.cache_lens)
+        if self.sink_window:
+            # the window is moved between chunks, so generated_ids never grows past the cache
+            expected_length = self.args.cache_lens
+        else:
+            expected_length = min(self.seq_length + input_ids_length + self.args.max_new_tokens + 1, self.args.cache_lens)
+        # the tuner only offers sizes up to max_chunk_size, so it records the size that was used
+        chunk_size = self.max_chunk_size if self.chunk_tuner is None else self.chunk_tuner.choose(input_ids_length)
         delta_length = expected_length - self.generated_ids.shape[-1]
         if delta_length > 0:
             new_generate_ids = torch.zeros(
                 self.args.batch_size, delta_length, dtype=torch.int, device=self.args.device
             )
             self.generated_ids = torch.cat([self.generated_ids, new_generate_ids], dim=-1)
-        else:
+        elif not self.sink_window:
             logger.warning(f"seq_length bigger than cache_lens, killed")
             exit(0)
-        
-        logger.debug(f"cache position: {former_seq_length} to {self.seq_length}")
-        cache_position = torch.arange(former_seq_length, self.seq_length, device=device)
-        self.generated_ids[:, cache_position] = input_ids.to(self.args.device).to(torch.int)
 
         if not (type(self) is TransformersInterface):
             input_ids = input_ids.to("cpu")
@@ -210,35 +233,63 @@ class KTransformersInterface(TransformersInterface):
 
             return logits
 
+        prefill_start = time.perf_counter()
         chunk_start = 0
         while chunk_start < input_ids_length:
-            chunk_end = min(chunk_start + self.args.chunk_prefill_size, input_ids_length)
+            chunk_end = min(chunk_start + chunk_size, input_ids_length)
+            # leave room for the token sampled after the prefill
+            self.make_room(chunk_end - chunk_start + 1)
+            former_seq_length = self.seq_length
+            self.seq_length += chunk_end - chunk_start
+            logger.debug(f"cache position: {former_seq_length} to {self.seq_length}")
+            cache_position = torch.arange(former_seq_length, self.seq_length, device=device)
+            self.generated_ids[:, cache_position] = input_ids[:, chunk_start:chunk_end].to(self.args.device).to(torch.int)
             if self.cache != None:
-                self.cache.cur_idx=cache_position[chunk_start:chunk_end]
-            logits = chunk_prefill(input_ids[:, chunk_start:chunk_end], cache_position[chunk_start:chunk_end])
-            chunk_start += self.args.chunk_prefill_size
-            
+                self.cache.cur_idx=cache_position
+            logits = chunk_prefill(input_ids[:, chunk_start:chunk_end], cache_position)
+            chunk_start += chunk_size
+        if self.chunk_tuner is not None:
+            for cuda_device in get_all_used_cuda_device(self.device_map):
+                torch.cuda.synchronize(cuda_device)
+            self.chunk_tuner.record(input_ids_length, chunk_size, time.perf_counter() - prefill_start)
+
         if flashinfer_enabled:
             MLAWrapperSingleton.reset_buffer()
         self.prepare_logits_wrapper(input_ids, device, temperature, top_p)
         next_token = self.logits_to_token(logits[0, -1, :])
         yield self.append_new_tokens(next_token)
 
+    @torch.no_grad
+    def embedding_forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        device = self.device_map.get("blk.0.self_attn", {}).get("generate_device", "cuda:0")
+        device = "cuda:0" if device == "cuda" else device
+        inputs_embeds = self.model.model.embed_tokens(input_ids.to("cpu")).to(device)
+        torch.cuda.set_device(device)
+        # without a cache the MLA attention runs unpaged, the flashinfer plan of decode is left alone
+        return self.model.model(inputs_embeds=inputs_embeds, use_cache=False, return_dict=False)[0]
+
+    @property
+    def snapshot_target(self):
+        # the long context path keeps all kv in the cpu kvcache instead of the static cache
+        if KLlamaModel.dynamic_sdpa is not None:
+            return KLlamaModel.dynamic_sdpa
+        return self.cache
+
+    async def save_prefix_snapshot(self, prompt: str):
+        async with self._infer_lock:
+            return await super().save_prefix_snapshot(prompt)
+
+    async def embed(self, inputs, pooling: str = "mean"):
+        async with self._infer_lock:
+            async for v in super().embed(inputs, pooling):
+                yield v
+
     @property
     def active_cache_position(self):
         device = self.device_map.get("blk.0.self_attn", {}).get("generate_device", "cuda:0")
         return torch.tensor([self.seq_length - 1], device=device)
     
-    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None, tools: Optional[List] = None):
+    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None, tools: Optional[List] = None, cancel_token=None):
         async with self._infer_lock:
-            async for v in super().inference(local_messages, thread_id, temperature, top_p, tools):
-                yield v
-            
-            # return this inference raw usage
-            yield RawUsage(
-                tokenize_time = self.profiler.get_timer_sec('tokenize'),
-                prefill_time = self.profiler.get_timer_sec('prefill'),
-                decode_time = self.profiler.get_timer_sec('decode'),
-                prefill_count = self.profiler.get_counter('prefill'),
-                decode_count = self.profiler.get_counter('decode'),
-            )
\ No newline at end of file
+            async for v in super().inference(local_messages, thread_id, temperature, top_p, tools, cancel_token):
+                yield v
\ No newline at end of file
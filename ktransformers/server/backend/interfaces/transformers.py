@@ -1,7 +1,8 @@
-from typing import Any, List, Optional, Set
+from typing import Any, Dict, List, Optional, Set, Tuple
 import re
 import json
 import uuid
+import asyncio
 from transformers import (
     LlamaTokenizer,
     AutoTokenizer,
@@ -23,6 +24,10 @@ from ..base import ThreadContext, BackendInterfaceBase
 from ktransformers.server.config.log import logger
 from ..args import ConfigArgs, default_args
 from ktransformers.operators.flashinfer_wrapper import flashinfer_enabled, MLAWrapperSingleton
+from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.util.kvcache_snapshot import PrefixSnapshotStore
+from ktransformers.util.kv_offload import KVOffloadManager
+from ktransformers.operators.RoPE import rope_shift
 
 # This TextStreamer is a modified version from https://github.com/huggingface/transformers/blob/main/src/transformers/generation/streamers.py
 class TextStreamer:
@@ -134,6 +139,15 @@ class TransformersInterface(BackendInterfaceBase):
     last_request_id: Optional[str] = None
     ever_generated_ids: Set[int] = set()
 
+    max_embedding_batch: int = 8
+
+    prefix_snapshots: Optional[PrefixSnapshotStore] = None
+    kv_offload: Optional[KVOffloadManager] = None
+    # thread whose kv is in the device cache
+    cache_owner_id: Optional[str] = None
+    # evicted token count -> rope_shift cos and sin of the sink window, per interface since they depend on its model
+    rope_shifts: Dict[int, Tuple[torch.Tensor, torch.Tensor]]
+
     def __init__(self, args: ConfigArgs = default_args):
         self.args = args
 
@@ -151,6 +165,78 @@ class TransformersInterface(BackendInterfaceBase):
         # logger.info(f"StaticCache (length={args.cache_lens}) created at {args.device}, batch size:{args.batch_size}")
 
         self.streamer = TextStreamer(self.tokenizer)
+        self.rope_shifts = {}
+        self.init_prefix_snapshots()
+
+    def init_prefix_snapshots(self):
+        if getattr(self.args, "prefix_snapshot_dir", None) is None:
+            return
+        model_identity = f"{self.args.model_dir}:{getattr(self.args, 'gguf_path', None)}:{self.model.dtype}"
+        self.prefix_snapshots = PrefixSnapshotStore(
+            self.args.prefix_snapshot_dir, model_identity, getattr(self.args, "prefix_snapshot_preload", False)
+        )
+
+    def init_kv_offload(self):
+        if getattr(self.args, "kv_offload_pages", 0) > 0:
+            self.kv_offload = KVOffloadManager(self.cache, self.args.kv_offload_pages)
+
+    def swap_sequence(self, input_ids: torch.Tensor, same_prefix: int) -> int:
+        """
+        Keep the cache of the sequence being replaced on host, and bring back an offloaded sequence
+        if it shares a longer prefix with input_ids than the device cache does.
+        """
+        if self.kv_offload is None:
+            return same_prefix
+        # the kv of the last token in generated_ids is not in the cache yet
+        cached = self.seq_length - 1 if getattr(self, "generated_ids", None) is not None else 0
+        # a cache the sink window has moved is not the kv of the ids it holds
+        if cached - same_prefix >= self.kv_offload.page_size and not getattr(self.cache, "evicted_tokens", 0):
+            self.kv_offload.offload(self.cache_owner_id or "", self.generated_ids[0, :cached])
+        self.cache_owner_id = self.last_request_id
+        found = self.kv_offload.match(input_ids[..., :-1])
+        if found is None or found[1] <= same_prefix:
+            return same_prefix
+        seq_id, length = found
+        self.kv_offload.restore(seq_id, length)
+        self.generated_ids = input_ids[..., :length].to(device=self.args.device, dtype=torch.int)
+        return length
+
+    @property
+    def snapshot_target(self):
+        return self.cache
+
+    def restore_prefix_snapshot(self, input_ids: torch.Tensor, same_prefix: int) -> int:
+        """
+        Load the longest on-disk snapshot that covers more of input_ids than the cached same_prefix.
+        The last input token is never restored so that prefill still produces logits.
+        """
+        if self.prefix_snapshots is None:
+            return same_prefix
+        found = self.prefix_snapshots.match(input_ids[..., :-1], self.prefix_snapshots.format_of(self.snapshot_target))
+        if found is None or found[1] <= same_prefix:
+            return same_prefix
+        key, length = found
+        length = self.prefix_snapshots.load(self.snapshot_target, key)
+        self.generated_ids = input_ids[..., :length].to(device=self.args.device, dtype=torch.int)
+        return length
+
+    @torch.no_grad
+    def save_prefix_snapshot_sync(self, input_ids: torch.Tensor) -> str:
+        # run a prefill that does not reuse the context of any thread, then dump its kv cache
+        self.last_request_id = None
+        # KTransformersInterface.prefill takes the sampling arguments without defaults
+        for _ in self.prefill(input_ids, True, None, None):
+            pass
+        return self.prefix_snapshots.save(self.snapshot_target, input_ids)
+
+    async def save_prefix_snapshot(self, prompt: str) -> Tuple[str, int]:
+        """
+        Prefill prompt and persist its kv cache, returns the snapshot key and token count.
+        """
+        if self.prefix_snapshots is None:
+            raise ValueError("prefix_snapshot_dir is not configured")
+        input_ids = self.tokenize_prompt(prompt)
+        return self.save_prefix_snapshot_sync(input_ids), input_ids.shape[-1]
 
     @property
     def current_ids(self):
@@ -207,6 +293,33 @@ class TransformersInterface(BackendInterfaceBase):
         logger.debug(f"get input ids of shape {input_ids.shape}")
         return input_ids
 
+    @property
+    def sink_window(self) -> bool:
+        return getattr(self.cache, "sink_tokens", None) is not None
+
+    def make_room(self, num_tokens: int):
+        """
+        In attention sink window mode, evict from the kv cache and generated_ids so that `num_tokens` more tokens fit
+        in cache_lens. Later tokens then take positions relative to the window instead of the whole conversation.
+        """
+        overflow = self.seq_length + num_tokens - self.args.cache_lens
+        if not self.sink_window or overflow <= 0:
+            return
+        # evict a step of tokens at once, so the cache is not moved on every decode step
+        num_evict = max(overflow, self.args.kv_window_evict)
+        if num_evict not in self.rope_shifts:
+            rotary_emb = self.model.model.layers[0].self_attn.rotary_emb
+            self.rope_shifts[num_evict] = rope_shift(rotary_emb, -num_evict, rotary_emb.inv_freq.device)
+        evicted = self.cache.evict(num_evict, *self.rope_shifts[num_evict])
+        sink_tokens = self.cache.sink_tokens
+        self.generated_ids[:, sink_tokens:self.seq_length - evicted] = self.generated_ids[
+            :, sink_tokens + evicted:self.seq_length
+        ].clone()
+        self.seq_length -= evicted
+        logger.debug(f"evicted {evicted} tokens from the kv cache, seq_length: {self.seq_length}")
+        if overflow > evicted:
+            raise ValueError(f"{num_tokens} tokens do not fit in cache_lens {self.args.cache_lens} after the sink tokens")
+
     def append_new_tokens(self, new_tokens: int) -> Optional[str]:
         self.generated_ids[0, self.seq_length] = new_tokens
         self.seq_length += 1
@@ -291,6 +404,8 @@ class TransformersInterface(BackendInterfaceBase):
                 else:
                     break
             
+            same_prefix = self.swap_sequence(input_ids, same_prefix)
+            same_prefix = self.restore_prefix_snapshot(input_ids, same_prefix)
             logger.debug(f"same prefix len: {same_prefix}")
             self.cache.remove_suffix(same_prefix)
             self.seq_length = same_prefix
@@ -337,8 +452,11 @@ class TransformersInterface(BackendInterfaceBase):
         yield self.append_new_tokens(next_token)
 
     @torch.no_grad
-    def generate(self):
-        self.max_new_tokens = min(self.args.max_new_tokens, self.args.cache_lens - self.seq_length) - 1 
+    def generate(self, cancel_token=None):
+        if self.sink_window:
+            self.max_new_tokens = self.args.max_new_tokens - 1
+        else:
+            self.max_new_tokens = min(self.args.max_new_tokens, self.args.cache_lens - self.seq_length) - 1
         logger.info(f"args.max_new_tokens: {self.args.max_new_tokens}, cache_lens: {self.args.cache_lens}, seq_length: {self.seq_length}")
         if(self.max_new_tokens <= 0):
             logger.warning("max_new_tokens is less than 0")
@@ -348,6 +466,11 @@ class TransformersInterface(BackendInterfaceBase):
         self.profiler.set_counter("decode", 0)
 
         for i in range(1, self.max_new_tokens):
+            if cancel_token is not None and cancel_token.cancelled:
+                logger.info(f"request cancelled after {i - 1} decode steps")
+                yield self.streamer.end(), "cancelled"
+                break
+            self.make_room(1)
             with torch.nn.attention.sdpa_kernel(backends=[SDPBackend.FLASH_ATTENTION, SDPBackend.MATH, SDPBackend.EFFICIENT_ATTENTION]):
                 if flashinfer_enabled:
                     MLAWrapperSingleton.plan_all(None,None,None,self.active_cache_position.to(torch.int32)+1,
@@ -369,6 +492,51 @@ class TransformersInterface(BackendInterfaceBase):
         
         
 
+    @torch.no_grad
+    def embedding_forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        return self.model.model(input_ids=input_ids.to(self.args.device), use_cache=False, return_dict=False)[0]
+
+    @torch.no_grad
+    def embed_batch(self, input_ids_list: List[torch.Tensor], pooling: str = "mean") -> List[torch.Tensor]:
+        lengths = [ids.shape[-1] for ids in input_ids_list]
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        # right padding is exact under causal attention, real tokens never attend to the padding behind them
+        input_ids = torch.full((len(input_ids_list), max(lengths)), pad_token_id, dtype=torch.long)
+        for i, ids in enumerate(input_ids_list):
+            input_ids[i, : lengths[i]] = ids.flatten()
+        # only the decoder stack runs, lm_head, the sampler and the static cache are skipped
+        hidden_states = self.embedding_forward(input_ids).float()
+
+        embeddings = []
+        for i, length in enumerate(lengths):
+            if pooling == "mean":
+                embedding = hidden_states[i, :length].mean(dim=0)
+            elif pooling == "last":
+                embedding = hidden_states[i, length - 1]
+            else:
+                raise ValueError(f"unknown pooling {pooling}")
+            embeddings.append(torch.nn.functional.normalize(embedding, dim=-1).cpu())
+        return embeddings
+
+    async def embed(self, inputs: List[str | List[int]], pooling: str = "mean"):
+        """
+        Yields (index, embedding, token count) of inputs, running prefill only.
+        """
+        input_ids_list = []
+        for x in inputs:
+            if isinstance(x, str):
+                input_ids_list.append(self.tokenizer.encode(x, return_tensors="pt"))
+            else:
+                input_ids_list.append(torch.tensor([x], dtype=torch.long))
+        # sort by length so that each batch wastes little padding
+        order = sorted(range(len(inputs)), key=lambda i: input_ids_list[i].shape[-1])
+        for start in range(0, len(order), self.max_embedding_batch):
+            batch = order[start : start + self.max_embedding_batch]
+            embeddings = self.embed_batch([input_ids_list[i] for i in batch], pooling)
+            for i, embedding in zip(batch, embeddings):
+                yield i, embedding, input_ids_list[i].shape[-1]
+            await asyncio.sleep(0)
+
     def check_is_new(self, thread_id: str):
         if not self.use_static_cache:
             return True
@@ -382,7 +550,7 @@ class TransformersInterface(BackendInterfaceBase):
                 self.last_request_id = thread_id
                 return True
 
-    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None, tools: Optional[List] = None):
+    async def inference(self, local_messages, thread_id: str, temperature: Optional[float] = None, top_p: Optional[float] = None, tools: Optional[List] = None, cancel_token=None):
         self.streamer.reset()
         self.profiler.create_and_start_timer("tokenize")
         
@@ -428,7 +596,7 @@ class TransformersInterface(BackendInterfaceBase):
             collected_arguments = ""
             brackets_count = 0
             
-            for t, finish_reason in self.generate():
+            for t, finish_reason in self.generate(cancel_token):
                 if t is not None:
                     print(t, end="", flush=True)
                     collected_tokens += t
@@ -514,15 +682,28 @@ class TransformersInterface(BackendInterfaceBase):
                 # Handle finish reason
                 if finish_reason is not None:
                     yield "", finish_reason
-            
+                # tool call text is buffered without yielding, let the disconnect watcher run
+                await asyncio.sleep(0)
+
             print("")
         else:
             # Regular text generation (no tools)
-            for t, finish_reason in self.generate():
+            for t, finish_reason in self.generate(cancel_token):
                 if t is not None:
                     print(t, end="",flush=True)
                     yield t, finish_reason
+                # let the disconnect watcher run between decode steps
+                await asyncio.sleep(0)
             print("")
         
         self.profiler.pause_timer("decode")
-        self.report_last_time_performance()
\ No newline at end of file
+        self.report_last_time_performance()
+
+        # return this inference raw usage
+        yield RawUsage(
+            tokenize_time = self.profiler.get_timer_sec('tokenize'),
+            prefill_time = self.profiler.get_timer_sec('prefill'),
+            decode_time = self.profiler.get_timer_sec('decode'),
+            prefill_count = self.profiler.get_counter('prefill'),
+            decode_count = self.profiler.get_counter('decode'),
+        )
\ No newline at end of file
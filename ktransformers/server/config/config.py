@@ -70,6 +70,8 @@ class Config(metaclass=Singleton):
         self.server_ip = self.server.get("ip", "0.0.0.0")
         self.server_port = self.server.get("port", 9016)
         self.api_key = self.server.get("api_key", "")
+        self.max_queue_depth = self.server.get("max_queue_depth", 64)
+        self.queue_deadline: Optional[float] = self.server.get("queue_deadline", None)
 
         # db configs
         self.db_configs: dict = cfg.get("db", {})
@@ -106,6 +108,22 @@ class Config(metaclass=Singleton):
         self.total_context = self.model.get("total_context", 2**18)
         self.max_batch_size = self.model.get("max_batch_size", 20 if self.paged else 1)
         self.chunk_prefill_size = self.model.get("chunk_prefill_size", 8192)
+        self.chunk_prefill_autotune: bool = self.model.get("chunk_prefill_autotune", False)
+        self.chunk_tuning_path: str = self.model.get(
+            "chunk_tuning_path", os.path.join(self.localstore_path, "chunk_prefill_tuning.json")
+        )
+        self.lazy_load: bool = self.model.get("lazy_load", False)
+        # None disables the cache of repacked linear weights
+        self.repack_cache_dir: Optional[str] = self.model.get("repack_cache_dir", None)
+        # None disables the cache of fp8 weights dequantized on the cpu
+        self.fp8_dequant_cache_dir: Optional[str] = self.model.get("fp8_dequant_cache_dir", None)
+        # "thp", "hugetlb" or None to compute on the pages of the model files, see BackedWeights
+        self.expert_page_backing: Optional[str] = self.model.get("expert_page_backing", None)
+        self.expert_mlock: bool = self.model.get("expert_mlock", False)
+        self.prefault: bool = self.model.get("prefault", False)
+        self.prefault_profile_path: str = self.model.get(
+            "prefault_profile_path", os.path.join(self.localstore_path, "page_cache_profile.json")
+        )
         
         self.max_new_tokens = self.model.get("max_new_tokens", 2000)
         self.json_mode = self.model.get("json_mode", False)
@@ -142,12 +160,18 @@ class Config(metaclass=Singleton):
         self.response_chunk = self.model.get("response_chunk", 250)
         self.no_code_formatting = self.model.get("no_code_formatting", False)
         self.cache_8bit = self.model.get("cache_8bit", False)
-        self.cache_q4 = self.model.get("cache_q4", True)
+        self.cache_8bit_format = self.model.get("cache_8bit_format", "fp8")
+        self.cache_q4 = self.model.get("cache_q4", False)
         self.ngram_decoding = self.model.get("ngram_decoding", False)
         self.print_timings = self.model.get("print_timings", False)
         self.amnesia = self.model.get("amnesia", False)
         self.batch_size = self.model.get("batch_size", 1)
         self.cache_lens = self.model.get("cache_lens", 4096)
+        self.prefix_snapshot_dir: Optional[str] = self.model.get("prefix_snapshot_dir", None)
+        self.prefix_snapshot_preload: bool = self.model.get("prefix_snapshot_preload", False)
+        self.kv_offload_pages: int = self.model.get("kv_offload_pages", 0)
+        self.kv_sink_tokens: Optional[int] = self.model.get("kv_sink_tokens", None)
+        self.kv_window_evict: int = self.model.get("kv_window_evict", 256)
         self.device = self.model.get("device", "cuda:2")
 
         # web config
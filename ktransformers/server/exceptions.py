@@ -21,3 +21,11 @@ def internal_server_error(what):
 
 def request_error(what):
     return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"{what}")
+
+
+def too_many_requests(what, retry_after: int):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=f"{what}",
+        headers={"Retry-After": str(retry_after)},
+    )
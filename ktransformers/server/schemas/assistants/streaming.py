@@ -1,5 +1,6 @@
 import asyncio
-from typing import AsyncIterable, List, Union
+from contextlib import asynccontextmanager
+from typing import AsyncIterable, List, Optional, Union
 
 from fastapi import Request
 from fastapi.responses import StreamingResponse
@@ -76,11 +77,44 @@ class Done():
         return f"data: [DONE]\n\n"
 
 
-async def check_client_link(request: Request, async_events: AsyncIterable):
-    async for event in async_events:
-        if await request.is_disconnected():
-            break
-        yield event
+class CancellationToken():
+    '''
+    Set by the disconnect watcher of a request, checked by the decode loop between steps.
+    '''
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+async def wait_client_disconnect(request: Request, cancel_token: CancellationToken):
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            logger.debug('client disconnected, cancelling request')
+            cancel_token.cancel()
+            return
+
+
+@asynccontextmanager
+async def watch_client_link(request: Request, cancel_token: Optional[CancellationToken] = None):
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+    watcher = asyncio.create_task(wait_client_disconnect(request, cancel_token))
+    try:
+        yield cancel_token
+    finally:
+        watcher.cancel()
+
+
+async def check_client_link(request: Request, async_events: AsyncIterable, cancel_token: Optional[CancellationToken] = None):
+    async with watch_client_link(request, cancel_token) as cancel_token:
+        async for event in async_events:
+            if cancel_token.cancelled:
+                break
+            yield event
 
 
 async def add_done(async_events: AsyncIterable):
@@ -117,20 +151,20 @@ async def filter_by_types(async_events: AsyncIterable, types: List):
                 continue
 
 
-def api_stream_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(filter_api_event(async_events)))), media_type="text/event-stream")
+def api_stream_response(request: Request, async_events: AsyncIterable, cancel_token: Optional[CancellationToken] = None):
+    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(filter_api_event(async_events))), cancel_token), media_type="text/event-stream")
 
 
-def chat_stream_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(filter_chat_chunk(async_events)))), media_type="text/event-stream")
+def chat_stream_response(request: Request, async_events: AsyncIterable, cancel_token: Optional[CancellationToken] = None):
+    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(filter_chat_chunk(async_events))), cancel_token), media_type="text/event-stream")
 
 
-def stream_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(async_events))), media_type="text/event-stream")
+def stream_response(request: Request, async_events: AsyncIterable, cancel_token: Optional[CancellationToken] = None):
+    return StreamingResponse(check_client_link(request, to_stream_reply(add_done(async_events)), cancel_token), media_type="text/event-stream")
 
 
-def check_link_response(request: Request, async_events: AsyncIterable):
-    return StreamingResponse(check_client_link(request, async_events), media_type="text/event-stream")
+def check_link_response(request: Request, async_events: AsyncIterable, cancel_token: Optional[CancellationToken] = None):
+    return StreamingResponse(check_client_link(request, async_events, cancel_token), media_type="text/event-stream")
 
 
 def wrap_async_generator_into_queue(async_events: AsyncIterable) -> asyncio.Queue:
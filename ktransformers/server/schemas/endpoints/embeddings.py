@@ -0,0 +1,36 @@
+from typing import List, Optional, Union
+from typing_extensions import Literal
+
+from pydantic import BaseModel, Field
+
+
+class EmbeddingCreate(BaseModel):
+    input: Union[str, List[str], List[int], List[List[int]]]
+    model: str
+    encoding_format: Literal["float", "base64"] = "float"
+    pooling: Literal["mean", "last"] = Field("mean", description="How to pool the final hidden states")
+
+    def get_inputs(self) -> List[Union[str, List[int]]]:
+        if isinstance(self.input, str):
+            return [self.input]
+        if len(self.input) > 0 and isinstance(self.input[0], int):
+            return [self.input]
+        return self.input
+
+
+class Embedding(BaseModel):
+    index: int
+    embedding: Union[List[float], str]
+    object: Literal["embedding"] = "embedding"
+
+
+class EmbeddingUsage(BaseModel):
+    prompt_tokens: int
+    total_tokens: int
+
+
+class EmbeddingObject(BaseModel):
+    data: List[Embedding]
+    model: str
+    object: Literal["list"] = "list"
+    usage: Optional[EmbeddingUsage] = None
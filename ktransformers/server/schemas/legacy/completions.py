@@ -11,12 +11,18 @@ class CompletionCreate(BaseModel):
     stream: bool = False
     temperature: Optional[float] = None
     top_p: Optional[float] = None
+    n: int = 1
 
     def get_tokenizer_messages(self):
         if isinstance(self.prompt,List):
             self.get_tokenizer_messages('\n'.join(self.prompt))
         return [{'content':self.prompt,'role':'user'}]
 
+    def get_prompts(self) -> List[str]:
+        if isinstance(self.prompt,List):
+            return self.prompt
+        return [self.prompt]
+
 
 class FinishReason(Enum):
     stop = 'stop'
@@ -36,15 +42,20 @@ class CompletionObject(Object):
     system_fingerprint:str = 'not implmented'
     usage: Optional[str] = None
 
-    def set_token(self,token:str):
-        if len(self.choices)==0:
-            self.choices.append(Choice(index=0,text=''))
-        self.choices[0].text = token    
+    def get_choice(self,index:int=0) -> Choice:
+        while len(self.choices)<=index:
+            self.choices.append(Choice(index=len(self.choices),text=''))
+        return self.choices[index]
+
+    def set_token(self,token:str,index:int=0):
+        self.get_choice(index).text = token    
+
+    def append_token(self,token:str,index:int=0):
+        self.get_choice(index).text += token
 
-    def append_token(self,token:str):
-        if len(self.choices)==0:
-            self.choices.append(Choice(index=0,text=''))
-        self.choices[0].text += token
+    def set_finish_reason(self,finish_reason:str,index:int=0):
+        if finish_reason in FinishReason._value2member_map_:
+            self.get_choice(index).finish_reason = FinishReason(finish_reason)
 
     def to_stream_reply(self):
         return f"data:{self.model_dump_json()}\n\n"
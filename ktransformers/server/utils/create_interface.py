@@ -15,6 +15,7 @@ from ktransformers.server.backend.context_manager import ThreadContextManager
 from ktransformers.server.backend.interfaces.exllamav2 import ExllamaInterface
 from ktransformers.server.backend.interfaces.transformers import TransformersInterface
 from ktransformers.server.backend.interfaces.ktransformers import KTransformersInterface
+from ktransformers.server.utils.request_queue import RequestQueue
 def create_interface(config: Config, default_args: ConfigArgs):
     if config.backend_type=='transformers':
         from ktransformers.server.backend.interfaces.transformers import  TransformersInterface as BackendInterface
@@ -26,13 +27,18 @@ def create_interface(config: Config, default_args: ConfigArgs):
         raise NotImplementedError(f'{config.backend_type} not implemented')
     GlobalInterface.interface = BackendInterface(default_args)
     GlobalContextManager.context_manager = ThreadContextManager(GlobalInterface.interface)
+    GlobalRequestQueue.request_queue = RequestQueue(config.max_queue_depth, config.queue_deadline)
 
 class GlobalContextManager:
     context_manager: ThreadContextManager
 class GlobalInterface:
     interface:  TransformersInterface | KTransformersInterface | ExllamaInterface
+class GlobalRequestQueue:
+    request_queue: RequestQueue
     
 def get_thread_context_manager() -> ThreadContextManager:
     return GlobalContextManager.context_manager
 def get_interface() -> TransformersInterface | KTransformersInterface | ExllamaInterface:
-    return GlobalInterface.interface
\ No newline at end of file
+    return GlobalInterface.interface
+def get_request_queue() -> RequestQueue:
+    return GlobalRequestQueue.request_queue
\ No newline at end of file
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Admission control and priority queue in front of the backend interface
+'''
+import asyncio
+import math
+import time
+import weakref
+from collections import deque
+from enum import IntEnum
+from typing import AsyncIterable, AsyncIterator, Deque, Dict, Optional, Tuple
+
+from fastapi import Request
+
+from ktransformers.server.config.log import logger
+from ktransformers.server.exceptions import request_error, too_many_requests
+
+
+class Priority(IntEnum):
+    '''
+    Queue lanes, a smaller value is served first.
+    '''
+    high = 0
+    normal = 1
+    low = 2
+
+
+class QueueTicket:
+    def __init__(self, priority: Priority, deadline: Optional[float], jobs: int = 1):
+        self.priority = priority
+        # backend jobs the request runs one after another in its slot, e.g. the prompts of a batch
+        self.jobs = jobs
+        # absolute deadline in time.monotonic() seconds, None means wait forever
+        self.deadline = deadline
+        self.enqueue_time = time.monotonic()
+        self.start_time: Optional[float] = None
+        self.granted = asyncio.get_running_loop().create_future()
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+
+class RequestQueue:
+    '''
+    Serialize requests to the backend with per-priority lanes.
+
+    Requests are rejected up front with 429 and a Retry-After header when the queue is full
+    or when the estimated wait exceeds their queue deadline, so clients do not time out after
+    the server has already spent prefill on them.
+    '''
+
+    PRIORITY_HEADER = 'X-Priority'
+    DEADLINE_HEADER = 'X-Queue-Deadline'
+
+    def __init__(self, max_depth: int = 64, default_deadline: Optional[float] = None,
+                 max_running: int = 1, smoothing: float = 0.2):
+        self.max_depth = max_depth
+        self.default_deadline = default_deadline
+        self.max_running = max_running
+        self.smoothing = smoothing
+        self.lanes: Dict[Priority, Deque[QueueTicket]] = {p: deque() for p in Priority}
+        self.running: Dict[int, QueueTicket] = {}
+        # exponential moving average of the service time of one job, in seconds
+        self.avg_service_time: Optional[float] = None
+
+    @property
+    def depth(self) -> int:
+        return sum(len(lane) for lane in self.lanes.values())
+
+    def estimated_wait(self, priority: Priority) -> float:
+        if self.avg_service_time is None:
+            return 0.0
+        now = time.monotonic()
+        ahead = sum(t.jobs for p in Priority if p <= priority for t in self.lanes[p])
+        busy = [max(t.jobs * self.avg_service_time - (now - t.start_time), 0.0) for t in self.running.values()]
+        if len(busy) < self.max_running:
+            # a free slot drains the queue right away
+            return ahead * self.avg_service_time / self.max_running
+        return min(busy) + ahead * self.avg_service_time / self.max_running
+
+    def check_admission(self, priority: Priority, deadline: Optional[float]):
+        if self.depth >= self.max_depth:
+            retry_after = self.estimated_wait(Priority.low)
+            logger.warning(f'request queue full ({self.depth}), rejecting request')
+            raise too_many_requests('request queue is full', math.ceil(max(retry_after, 1.0)))
+        estimated = self.estimated_wait(priority)
+        if deadline is not None and estimated > deadline:
+            logger.warning(f'estimated queue wait {estimated:.2f}s exceeds deadline {deadline:.2f}s, rejecting request')
+            raise too_many_requests('estimated queue wait exceeds deadline', math.ceil(estimated))
+
+    def _enqueue(self, priority: Priority, deadline: Optional[float], jobs: int = 1) -> QueueTicket:
+        ticket = QueueTicket(priority, None if deadline is None else time.monotonic() + deadline, jobs)
+        self.lanes[priority].append(ticket)
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self):
+        while len(self.running) < self.max_running:
+            ticket = None
+            for p in Priority:
+                if len(self.lanes[p]) > 0:
+                    ticket = self.lanes[p].popleft()
+                    break
+            if ticket is None:
+                return
+            ticket.start_time = time.monotonic()
+            self.running[id(ticket)] = ticket
+            ticket.granted.set_result(None)
+
+    async def _acquire(self, ticket: QueueTicket):
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.granted), ticket.remaining())
+        except asyncio.TimeoutError:
+            if ticket.granted.done():
+                return
+            self.lanes[ticket.priority].remove(ticket)
+            waited = time.monotonic() - ticket.enqueue_time
+            raise too_many_requests(f'queue deadline exceeded after {waited:.2f}s',
+                                    math.ceil(max(self.estimated_wait(ticket.priority), 1.0)))
+        except asyncio.CancelledError:
+            if ticket.granted.done():
+                self._release(ticket)
+            else:
+                self.lanes[ticket.priority].remove(ticket)
+            raise
+
+    def _release(self, ticket: QueueTicket):
+        if self.running.pop(id(ticket), None) is None:
+            return
+        elapsed = (time.monotonic() - ticket.start_time) / ticket.jobs
+        if self.avg_service_time is None:
+            self.avg_service_time = elapsed
+        else:
+            self.avg_service_time += self.smoothing * (elapsed - self.avg_service_time)
+        self._dispatch()
+
+    async def _run(self, async_events: AsyncIterable, ticket: QueueTicket) -> AsyncIterator:
+        try:
+            async for event in async_events:
+                yield event
+        finally:
+            self._release(ticket)
+
+    async def schedule(self, async_events: AsyncIterable, priority: Priority = Priority.normal,
+                       deadline: Optional[float] = None, jobs: int = 1) -> AsyncIterator:
+        '''
+        Admit async_events into the queue, wait for its turn and return an iterator that runs it.
+
+        Admission is checked and the request enqueued before the first await, so concurrent
+        requests cannot all pass the depth check. A request whose queue deadline passes while
+        waiting raises 429 from here, so await this before a (streaming) response is started.
+        deadline is the maximum time in seconds the request may wait in the queue. jobs is the
+        number of backend jobs async_events runs one after another, its service time is split
+        among them and it counts as that many requests in the wait estimates.
+        '''
+        if deadline is None:
+            deadline = self.default_deadline
+        self.check_admission(priority, deadline)
+        ticket = self._enqueue(priority, deadline, jobs)
+        await self._acquire(ticket)
+        events = self._run(async_events, ticket)
+        # a response that is never iterated, e.g. the client left before the body was sent,
+        # gives the slot back once the iterator is collected
+        weakref.finalize(events, self._release, ticket)
+        return events
+
+    @classmethod
+    def parse_request(cls, request: Request) -> Tuple[Priority, Optional[float]]:
+        priority_str = request.headers.get(cls.PRIORITY_HEADER, Priority.normal.name).lower()
+        if priority_str not in Priority.__members__:
+            raise request_error(f'{cls.PRIORITY_HEADER} should be one of {list(Priority.__members__)}')
+        deadline_str = request.headers.get(cls.DEADLINE_HEADER)
+        try:
+            deadline = None if deadline_str is None else float(deadline_str)
+        except ValueError:
+            raise request_error(f'{cls.DEADLINE_HEADER} should be a number of seconds')
+        return Priority[priority_str], deadline
+
+    async def schedule_request(self, request: Request, async_events: AsyncIterable, jobs: int = 1) -> AsyncIterator:
+        priority, deadline = self.parse_request(request)
+        return await self.schedule(async_events, priority, deadline, jobs)
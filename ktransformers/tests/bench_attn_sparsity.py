@@ -0,0 +1,70 @@
+"""
+Description  : Cost of recording the attention sparsity of one decode step on cpu, per layer: AttnSparsityStats.add
+               against the json line per head that get_attn_sparsity used to append, and the size of what each
+               writes. Also checks the summary of AttnSparsityStats against statistics of the raw rows.
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.operators.dynamic_attention import AttnSparsityStats
+
+layer_num = 60
+q_head_num = 64
+token_num = 50
+bins = 20
+
+
+def write_json_lines(path: str, rows: torch.Tensor):
+    """The writes get_attn_sparsity did before, one file open per layer and one line per head."""
+    for token_idx in range(rows.shape[0]):
+        for layer_idx in range(layer_num):
+            with open(path, "a") as file:
+                for head_idx in range(q_head_num):
+                    json_obj = {
+                        "token_idx": token_idx,
+                        "layer_idx": layer_idx,
+                        "head_idx": head_idx,
+                        "sparsity": rows[token_idx, layer_idx, head_idx].item(),
+                    }
+                    json.dump(json_obj, file)
+                    file.write("\n")
+
+
+torch.manual_seed(0)
+rows = torch.rand(token_num, layer_num, q_head_num, dtype=torch.float32)
+
+with tempfile.TemporaryDirectory() as out_dir:
+    lines_path = os.path.join(out_dir, "attn_sparsity.json")
+    start = time.perf_counter()
+    write_json_lines(lines_path, rows)
+    lines_time = (time.perf_counter() - start) / (token_num * layer_num)
+
+    stats_path = os.path.join(out_dir, "attn_sparsity_stats.json")
+    stats = AttnSparsityStats(layer_num, q_head_num, bins=bins, flush_path=stats_path)
+    start = time.perf_counter()
+    for token_idx in range(token_num):
+        for layer_idx in range(layer_num):
+            stats.add(layer_idx, rows[token_idx, layer_idx])
+    add_time = (time.perf_counter() - start) / (token_num * layer_num)
+
+    summary = stats.summary()
+    values = rows.double()
+    assert summary["count"] == [token_num] * layer_num
+    assert torch.allclose(torch.tensor(summary["mean"], dtype=torch.float64), values.mean(dim=0))
+    assert torch.allclose(torch.tensor(summary["std"], dtype=torch.float64), values.std(dim=0, unbiased=False), atol=1e-6)
+    assert torch.equal(torch.tensor(summary["min"], dtype=torch.float64), values.min(dim=0).values)
+    assert torch.equal(torch.tensor(summary["max"], dtype=torch.float64), values.max(dim=0).values)
+    buckets = (rows * bins).long().clamp(0, bins - 1)
+    hist = torch.nn.functional.one_hot(buckets, bins).sum(dim=0)
+    assert torch.equal(torch.tensor(summary["histogram"]), hist)
+    stats.flush()
+
+    print("layers: ", layer_num, "heads: ", q_head_num, "tokens: ", token_num)
+    print("json line per head: ", lines_time * 1e6, "us per layer, ", os.path.getsize(lines_path), "bytes")
+    print("AttnSparsityStats.add: ", add_time * 1e6, "us per layer, ", os.path.getsize(stats_path), "bytes")
@@ -0,0 +1,107 @@
+"""
+Description  : Quantization error and update throughput of the quantized StaticCache on cpu tensors.
+               Checks the round trip error of every kv_quant format against its bound, checks that a
+               decode read of the quantized MLA storage with its scales, as the triton decode kernel
+               does it, gives the attention of the dequantized buffer, and times one decode update of
+               a layer with the dequantized buffer, without it, and for a full precision cache.
+"""
+import os
+import sys
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.custom_cache import StaticCache, KV_QUANT_TYPES, quantize_kv, dequantize_kv
+
+torch.manual_seed(0)
+kv_lora_rank = 512
+qk_rope_head_dim = 64
+num_heads = 16
+prefix_len = 4096
+test_iter = 20
+config = DeepseekV2Config(
+    hidden_size=1024, num_hidden_layers=1, num_attention_heads=num_heads, kv_lora_rank=kv_lora_rank,
+    qk_rope_head_dim=qk_rope_head_dim, architectures=["DeepseekV2ForCausalLM"],
+)
+
+
+def round_trip_bound(x: torch.Tensor, scale: torch.Tensor, kv_quant: str) -> torch.Tensor:
+    if kv_quant == "fp8":
+        # 3 mantissa bits round to 2^-4 relative, the smallest subnormal of e4m3 is 2^-9
+        return x.abs() * 2**-4 + scale * 2**-10
+    # half a step of the grid
+    return scale / 2
+
+
+def check_error(kv_quant: str):
+    x = torch.randn(4096, kv_lora_rank)
+    # a few outlier channels, as real kv has
+    x[:, :4] *= 20
+    q, scale = quantize_kv(x, kv_quant)
+    error = (dequantize_kv(q, scale, kv_quant, torch.float32) - x).abs()
+    assert (error <= round_trip_bound(x, scale, kv_quant) * (1 + 1e-5)).all(), kv_quant
+    relative = (error.norm(dim=-1) / x.norm(dim=-1)).mean().item()
+    print(kv_quant, "max abs error: ", error.max().item(), "mean relative error: ", relative)
+
+
+def fill(cache: StaticCache, length: int, dequantize: bool = True):
+    kv = torch.randn(length, 1, 1, kv_lora_rank, dtype=torch.bfloat16)
+    pe = torch.randn(length, 1, 1, qk_rope_head_dim, dtype=torch.bfloat16)
+    cache_kwargs = {"cache_position": torch.arange(length), "dequantize": dequantize}
+    return cache.update(kv.view(1, length, 1, -1), pe.view(1, length, 1, -1), 0, cache_kwargs)
+
+
+def scaled_read_attention(q_nope, q_pe, k_q, k_scale, length):
+    """The decode attention of the triton kernel over quantized slots: values are scaled as they are loaded."""
+    slots = k_q.view(-1, k_q.shape[-1])[:length].float()
+    scales = k_scale.view(-1, 2)[:length]
+    kv = slots[:, :kv_lora_rank] * scales[:, :1]
+    pe = slots[:, kv_lora_rank:] * scales[:, 1:]
+    weights = torch.softmax((q_nope @ kv.T + q_pe @ pe.T) / (kv_lora_rank + qk_rope_head_dim) ** 0.5, dim=-1)
+    return weights @ kv
+
+
+def buffer_attention(q_nope, q_pe, k_buf, length):
+    slots = k_buf.view(-1, k_buf.shape[-1])[:length].float()
+    kv, pe = slots[:, :kv_lora_rank], slots[:, kv_lora_rank:]
+    weights = torch.softmax((q_nope @ kv.T + q_pe @ pe.T) / (kv_lora_rank + qk_rope_head_dim) ** 0.5, dim=-1)
+    return weights @ kv
+
+
+def bench_update(kv_quant, dequantize: bool) -> float:
+    cache = StaticCache(config, 1, prefix_len + test_iter + 1, "cpu", torch.bfloat16, kv_quant=kv_quant)
+    fill(cache, prefix_len)
+    kv = torch.randn(1, 1, 1, kv_lora_rank, dtype=torch.bfloat16)
+    pe = torch.randn(1, 1, 1, qk_rope_head_dim, dtype=torch.bfloat16)
+    start = time.perf_counter()
+    for i in range(test_iter):
+        cache.update(kv, pe, 0, {"cache_position": torch.tensor([prefix_len + i]), "dequantize": dequantize})
+    return (time.perf_counter() - start) / test_iter
+
+
+for kv_quant in KV_QUANT_TYPES:
+    check_error(kv_quant)
+print("")
+
+q_nope = torch.randn(num_heads, kv_lora_rank)
+q_pe = torch.randn(num_heads, qk_rope_head_dim)
+for kv_quant in ("int8", "fp8"):
+    cache = StaticCache(config, 1, prefix_len, "cpu", torch.bfloat16, kv_quant=kv_quant)
+    k_buf, _ = fill(cache, prefix_len)
+    expected = buffer_attention(q_nope, q_pe, k_buf, prefix_len)
+    output = scaled_read_attention(q_nope, q_pe, cache.key_cache[0], cache.key_scale[0], prefix_len)
+    # the buffer holds bf16, the scaled read rounds only once
+    error = ((output - expected).norm() / expected.norm()).item()
+    assert error < 1e-2, (kv_quant, error)
+    print(kv_quant, "scaled read vs dequantized buffer attention, relative error: ", error)
+print("")
+
+full_time = bench_update(None, True)
+print("prefix: ", prefix_len, "tokens, one decode update of a layer")
+print("bf16: ", full_time * 1e6, "us")
+for kv_quant in KV_QUANT_TYPES:
+    buffer_time = bench_update(kv_quant, True)
+    storage_time = bench_update(kv_quant, False)
+    print(kv_quant, "dequantized buffer: ", buffer_time * 1e6, "us, scaled read: ", storage_time * 1e6, "us")
@@ -0,0 +1,131 @@
+"""
+Description  : Time load_weights on a synthetic GGUF file on the cpu, one tensor at a time
+               against WeightLoadPipeline with several worker counts.
+"""
+import os
+import sys
+import struct
+import tempfile
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import numpy as np
+import torch
+from torch import nn
+from ktransformers.util.custom_gguf import GGUFLoader, GGMLQuantizationType, DATA_TYPES, translate_name_to_gguf
+from ktransformers.util.utils import load_weights, WeightLoadPipeline
+
+layer_num = 8
+hidden_size = 2048
+intermediate_size = 4096
+alignment = 32
+
+
+def write_string(f, value: str):
+    data = value.encode("utf-8")
+    f.write(struct.pack("<Q", len(data)))
+    f.write(data)
+
+
+def q8_0_blocks(num_elements: int, rng: np.random.Generator) -> bytes:
+    """Random Q8_0 blocks, each a float16 scale followed by 32 int8 values."""
+    num_blocks = num_elements // 32
+    blocks = np.empty((num_blocks, 34), dtype=np.uint8)
+    blocks[:, :2] = np.full((num_blocks, 1), 0.01, dtype=np.float16).view(np.uint8)
+    blocks[:, 2:] = rng.integers(-127, 128, (num_blocks, 32), dtype=np.int8).view(np.uint8)
+    return blocks.tobytes()
+
+
+def write_gguf(path: str, tensors: dict):
+    """tensors maps a gguf name to (ggml shape, ggml type, raw bytes)."""
+    with open(path, "wb") as f:
+        f.write(b"GGUF")
+        f.write(struct.pack("<IQQ", 3, len(tensors), 1))
+        write_string(f, "general.architecture")
+        f.write(struct.pack("<I", DATA_TYPES["string"]))
+        write_string(f, "synthetic")
+        offset = 0
+        for name, (shape, ggml_type, data) in tensors.items():
+            write_string(f, name)
+            f.write(struct.pack("<I", len(shape)))
+            f.write(struct.pack(f"<{len(shape)}Q", *shape))
+            f.write(struct.pack("<IQ", ggml_type, offset))
+            offset += (len(data) + alignment - 1) // alignment * alignment
+        f.write(b"\0" * ((alignment - f.tell() % alignment) % alignment))
+        for shape, ggml_type, data in tensors.values():
+            f.write(data)
+            f.write(b"\0" * ((alignment - len(data) % alignment) % alignment))
+
+
+class Norm(nn.Module):
+    def __init__(self, size: int):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(size))
+
+
+class Layer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.input_layernorm = Norm(hidden_size)
+        self.mlp = nn.Module()
+        self.mlp.gate_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.mlp.up_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.mlp.down_proj = nn.Linear(intermediate_size, hidden_size, bias=False)
+        self.post_attention_layernorm = Norm(hidden_size)
+
+
+def build_model() -> nn.Module:
+    with torch.device("meta"):
+        model = nn.Module()
+        model.model = nn.Module()
+        model.model.layers = nn.ModuleList([Layer() for _ in range(layer_num)])
+    return model
+
+
+def build_gguf(gguf_dir: str):
+    rng = np.random.default_rng(0)
+    tensors = {}
+    for name, param in build_model().named_parameters():
+        shape = list(reversed(param.shape))
+        if param.dim() == 1:
+            data = rng.standard_normal(param.numel(), dtype=np.float32).tobytes()
+            tensors[translate_name_to_gguf(name)] = (shape, GGMLQuantizationType.F32, data)
+        else:
+            tensors[translate_name_to_gguf(name)] = (shape, GGMLQuantizationType.Q8_0, q8_0_blocks(param.numel(), rng))
+    write_gguf(os.path.join(gguf_dir, "synthetic.gguf"), tensors)
+
+
+def drop_page_cache(gguf_dir: str):
+    for file in os.listdir(gguf_dir):
+        fd = os.open(os.path.join(gguf_dir, file), os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def bench_load_weights(gguf_dir: str, num_workers: int | None):
+    gguf_loader = GGUFLoader(gguf_dir)
+    for name in gguf_loader.tensor_info:
+        gguf_loader.tensor_device_map[name[: name.rfind(".")]] = {"generate_device": "cpu"}
+    model = build_model()
+    drop_page_cache(gguf_dir)
+    start = time.perf_counter()
+    if num_workers is None:
+        load_weights(model, gguf_loader)
+    else:
+        with WeightLoadPipeline(num_workers):
+            load_weights(model, gguf_loader)
+    total_time = time.perf_counter() - start
+    size = sum(t["item_count"] * np.dtype(t["item_type"]).itemsize for t in gguf_loader.tensor_info.values())
+    assert all(param.device.type == "cpu" for param in model.parameters())
+    print("workers: ", "sequential" if num_workers is None else num_workers)
+    print("Time(s): ", total_time)
+    print("Bandwidth: ", size / total_time / 1000 / 1000 / 1000, "GB/s")
+    print("")
+
+
+with tempfile.TemporaryDirectory() as gguf_dir:
+    build_gguf(gguf_dir)
+    bench_load_weights(gguf_dir, None)
+    for num_workers in (1, 2, 4, 8):
+        bench_load_weights(gguf_dir, num_workers)
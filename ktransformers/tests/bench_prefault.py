@@ -0,0 +1,76 @@
+"""
+Description  : Record the page cache profile of a run that read a few regions of a large sparse
+               file, drop the file from the page cache, then time PageCacheWarmer bringing the
+               recorded regions back with several worker counts.
+"""
+import os
+import sys
+import tempfile
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import numpy as np
+from ktransformers.util.prefault import PageCacheWarmer, resident_pages, PAGE_SIZE
+
+file_size = 16 * 1024**3
+chunk_size = 2 * 1024 * 1024
+# [start, end) byte ranges the recorded run reads
+hot_ranges = [(0, 64 * chunk_size), (4 * 1024**3 + 5 * chunk_size, 4 * 1024**3 + 133 * chunk_size), (file_size - chunk_size, file_size)]
+
+
+def drop_page_cache(file_name: str):
+    fd = os.open(file_name, os.O_RDONLY)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    os.close(fd)
+
+
+def resident_bytes(data: np.ndarray, start: int, end: int) -> int:
+    return int(resident_pages(data, start, end).sum()) * PAGE_SIZE
+
+
+def build_profile(file_name: str, profile_path: str):
+    drop_page_cache(file_name)
+    data = np.memmap(file_name, dtype=np.uint8, mode="r")
+    warmer = PageCacheWarmer({file_name: data}, profile_path, chunk_size=chunk_size)
+    warmer.reset_accesses()
+    # the recorded run computes on the hot ranges through the mapping
+    for start, end in hot_ranges:
+        data[start:end:PAGE_SIZE].sum()
+    warmer.record()
+    del data
+
+
+def bench_prefault(file_name: str, profile_path: str, num_workers: int):
+    drop_page_cache(file_name)
+    data = np.memmap(file_name, dtype=np.uint8, mode="r")
+    hot_bytes = sum(end - start for start, end in hot_ranges)
+    assert sum(resident_bytes(data, start, end) for start, end in hot_ranges) == 0
+    warmer = PageCacheWarmer({file_name: data}, profile_path, num_workers, chunk_size)
+    start_time = time.perf_counter()
+    warmer.start()
+    warmer.wait()
+    total_time = time.perf_counter() - start_time
+    done_bytes, total_bytes = warmer.progress()
+    # only the chunks the recorded run accessed
+    assert done_bytes == total_bytes == hot_bytes, (done_bytes, total_bytes, hot_bytes)
+    assert sum(resident_bytes(data, start, end) for start, end in hot_ranges) == hot_bytes
+    print("workers: ", num_workers)
+    print("Prefaulted bytes: ", done_bytes, "of a", file_size, "byte file,", hot_bytes, "read by the recorded run")
+    print("Time(s): ", total_time)
+    print("Bandwidth: ", done_bytes / total_time / 1000 / 1000 / 1000, "GB/s")
+    print("")
+    del data
+
+
+with tempfile.TemporaryDirectory() as file_dir:
+    file_name = os.path.join(file_dir, "sparse.gguf")
+    with open(file_name, "wb") as f:
+        f.truncate(file_size)
+        # some of the hot data on disk, the rest stays a hole
+        f.seek(hot_ranges[1][0])
+        f.write(np.random.default_rng(0).integers(0, 255, 16 * chunk_size, dtype=np.uint8).tobytes())
+    profile_path = os.path.join(file_dir, "page_cache_profile.json")
+    build_profile(file_name, profile_path)
+    for num_workers in (1, 2, 4, 8, 16):
+        bench_prefault(file_name, profile_path, num_workers)
@@ -0,0 +1,70 @@
+"""
+Description  : Time SafeTensorLoader on synthetic safetensors shards on the cpu, one tensor
+               at a time against load_tensors with several worker counts.
+"""
+import os
+import sys
+import tempfile
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from safetensors.torch import save_file
+from ktransformers.util.custom_loader import SafeTensorLoader
+
+shard_num = 4
+layer_num = 8
+hidden_size = 2048
+intermediate_size = 4096
+
+
+def build_shards(shard_dir: str):
+    gen = torch.Generator().manual_seed(0)
+    layers_per_shard = layer_num // shard_num
+    for shard in range(shard_num):
+        tensors = {}
+        for layer in range(shard * layers_per_shard, (shard + 1) * layers_per_shard):
+            for proj, shape in (
+                ("gate", (intermediate_size, hidden_size)),
+                ("up", (intermediate_size, hidden_size)),
+                ("down", (hidden_size, intermediate_size)),
+            ):
+                tensors[f"blk.{layer}.ffn_{proj}.weight"] = torch.randn(shape, generator=gen).to(torch.bfloat16)
+            tensors[f"blk.{layer}.attn_norm.weight"] = torch.randn(hidden_size, generator=gen)
+        save_file(tensors, os.path.join(shard_dir, f"model-{shard + 1:05d}-of-{shard_num:05d}.safetensors"))
+
+
+def drop_page_cache(shard_dir: str):
+    for file in os.listdir(shard_dir):
+        fd = os.open(os.path.join(shard_dir, file), os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def bench_safetensor_loader(shard_dir: str, num_workers: int | None):
+    loader = SafeTensorLoader(shard_dir, num_workers=num_workers)
+    keys = list(loader.tensor_file_map)
+    drop_page_cache(shard_dir)
+    start = time.perf_counter()
+    if num_workers is None:
+        tensors = {key: loader.load_tensor(key) for key in keys}
+    else:
+        tensors = {}
+        for layer in range(layer_num):
+            tensors.update(loader.load_tensors([key for key in keys if key.startswith(f"blk.{layer}.")]))
+    total_time = time.perf_counter() - start
+    loader.close_all_handles()
+    size = sum(tensor.numel() * tensor.element_size() for tensor in tensors.values())
+    assert len(tensors) == len(keys)
+    print("workers: ", "sequential" if num_workers is None else num_workers)
+    print("Time(s): ", total_time)
+    print("Bandwidth: ", size / total_time / 1000 / 1000 / 1000, "GB/s")
+    print("")
+
+
+with tempfile.TemporaryDirectory() as shard_dir:
+    build_shards(shard_dir)
+    bench_safetensor_loader(shard_dir, None)
+    for num_workers in (1, 2, 4, 8):
+        bench_safetensor_loader(shard_dir, num_workers)
@@ -0,0 +1,97 @@
+"""
+Description  : Drive ChunkSizeTuner with a synthetic prefill cost model: a fixed cost per chunk, an attention cost
+               that grows with the chunk, and a memory cliff above 4096 tokens. Checks that every bucket ends on
+               the cheapest candidate after a bounded number of trials, that a cap on the chunk size, as the
+               attention sink window sets, is respected and still lets exploration finish, that the file is
+               written once per finished candidate instead of after every prefill, and that a new tuner picks
+               up the same choices from the file.
+"""
+import os
+import sys
+import math
+import random
+import tempfile
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+from ktransformers.util.chunk_tuner import ChunkSizeTuner
+
+chunk_overhead = 0.02
+attention_per_token = 0.02 / 1024**2
+cliff = 4096
+
+
+def per_token(chunk_size: int) -> float:
+    """Seconds per token of the model, the cheapest chunk is sqrt(chunk_overhead / attention_per_token) = 1024."""
+    seconds = chunk_overhead / chunk_size + attention_per_token * chunk_size
+    return seconds * 4 if chunk_size > cliff else seconds
+
+
+def prefill_seconds(prompt_len: int, chunk_size: int, rng: random.Random) -> float:
+    # a prompt shorter than the chunk is one chunk of its own length
+    return prompt_len * per_token(min(chunk_size, prompt_len)) * rng.uniform(0.98, 1.02)
+
+
+class CountingTuner(ChunkSizeTuner):
+    def __init__(self, *args, **kwargs):
+        self.saves = 0
+        super().__init__(*args, **kwargs)
+
+    def save(self):
+        self.saves += 1
+        super().save()
+
+
+def run(tuner: ChunkSizeTuner, requests: int, rng: random.Random):
+    exploring = {}
+    for _ in range(requests):
+        prompt_len = int(2 ** rng.uniform(math.log2(300), math.log2(30000)))
+        candidates = tuner.candidates(prompt_len)
+        chunk_size = tuner.choose(prompt_len)
+        assert chunk_size in candidates and chunk_size <= tuner.max_chunk_size
+        measured = tuner.stats.get(str(tuner.bucket(prompt_len)), {})
+        if measured.get(str(chunk_size), [0])[0] < tuner.trials:
+            exploring[tuner.bucket(prompt_len)] = exploring.get(tuner.bucket(prompt_len), 0) + 1
+        tuner.record(prompt_len, chunk_size, prefill_seconds(prompt_len, chunk_size, rng))
+    for bucket, count in exploring.items():
+        # every candidate is tried `trials` times, never more
+        assert count <= tuner.trials * len(tuner.candidates(1 << bucket)), (bucket, count)
+
+
+def expected_best(tuner: ChunkSizeTuner, bucket: int) -> int:
+    prompt_len = 1 << bucket
+    return min(tuner.candidates(prompt_len), key=lambda size: per_token(min(size, prompt_len)))
+
+
+rng = random.Random(0)
+with tempfile.TemporaryDirectory() as tuning_dir:
+    path = os.path.join(tuning_dir, "chunk_tuning.json")
+    tuner = CountingTuner(path, "model:gpu", 16384, save_interval=3600)
+    run(tuner, 400, rng)
+    finished = 0
+    for bucket in tuner.stats:
+        best = tuner.best(1 << int(bucket))
+        assert best == expected_best(tuner, int(bucket)), (bucket, best)
+        finished += sum(entry[0] >= tuner.trials for entry in tuner.stats[bucket].values())
+        print("bucket: ", 1 << int(bucket), "best chunk size: ", best)
+    assert tuner.saves == finished, (tuner.saves, finished)
+    tuner.flush()
+    assert tuner.saves == finished + 1
+    print("prefills: 400, file writes: ", tuner.saves)
+
+    reloaded = ChunkSizeTuner(path, "model:gpu", 16384)
+    for bucket in tuner.stats:
+        assert reloaded.choose(1 << int(bucket)) == tuner.best(1 << int(bucket))
+    # another profile starts over
+    assert ChunkSizeTuner(path, "model:other gpu", 16384).stats == {}
+
+    # the sink window caps chunks at half of what follows the sink tokens
+    cache_lens, sink_tokens = 4000, 4
+    capped = CountingTuner(path, "model:gpu:sink", (cache_lens - sink_tokens) // 2, save_interval=3600)
+    run(capped, 200, rng)
+    for bucket in capped.stats:
+        assert all(int(size) <= capped.max_chunk_size for size in capped.stats[bucket])
+        assert capped.best(1 << int(bucket)) == expected_best(capped, int(bucket))
+        # exploration has finished, the best size is used from now on
+        assert capped.choose(1 << int(bucket)) == capped.best(1 << int(bucket))
+    print("capped at: ", capped.max_chunk_size, "buckets: ", sorted(1 << int(b) for b in capped.stats))
@@ -0,0 +1,102 @@
+"""
+Description  : Check weight_dequant_cpu bit for bit against the math of weight_dequant_kernel,
+               one block at a time, and against the triton kernel when a gpu is present.
+               Check that SafeTensorLoader keeps the weights it dequantizes for the cpu in its
+               dequant cache and reads them back from it, while gpu loads bypass the cache,
+               then time weight_dequant_cpu on a DeepSeek-V3 sized weight.
+"""
+import os
+import sys
+import time
+import tempfile
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from safetensors.torch import save_file
+from ktransformers.ktransformers_ext.triton.fp8gemm import weight_dequant, weight_dequant_cpu
+from ktransformers.util.custom_loader import SafeTensorLoader
+
+block_size = 128
+
+
+def random_fp8_weight(M: int, N: int, gen: torch.Generator):
+    x = (torch.randn((M, N), generator=gen) * 100).clamp(-448, 448).to(torch.float8_e4m3fn)
+    s = torch.rand(((M + block_size - 1) // block_size, (N + block_size - 1) // block_size), generator=gen) / 100
+    return x, s
+
+
+def reference_dequant(x: torch.Tensor, s: torch.Tensor) -> torch.Tensor:
+    """weight_dequant_kernel in torch, y = x.to(float32) * s for each block, stored in the default dtype."""
+    M, N = x.size()
+    y = torch.empty((M, N), dtype=torch.get_default_dtype())
+    for i in range(0, M, block_size):
+        for j in range(0, N, block_size):
+            block = x[i : i + block_size, j : j + block_size].to(torch.float32)
+            y[i : i + block_size, j : j + block_size] = block * s[i // block_size, j // block_size]
+    return y
+
+
+def check_dequant(M: int, N: int, dtype: torch.dtype):
+    torch.set_default_dtype(dtype)
+    x, s = random_fp8_weight(M, N, torch.Generator().manual_seed(M * N))
+    expected = reference_dequant(x, s)
+    for num_threads in (1, 4):
+        y = weight_dequant_cpu(x, s, block_size, num_threads)
+        assert y.dtype == dtype and torch.equal(y, expected), f"mismatch for ({M}, {N}) {dtype} {num_threads} threads"
+    assert torch.equal(weight_dequant(x, s), expected)
+    if torch.cuda.is_available():
+        y = weight_dequant(x.cuda(), s.cuda())
+        assert torch.equal(y.cpu(), expected), f"mismatch against the triton kernel for ({M}, {N}) {dtype}"
+    print(f"({M}, {N}) {dtype}: bit exact")
+
+
+def check_dequant_cache():
+    torch.set_default_dtype(torch.bfloat16)
+    x, s = random_fp8_weight(256, 384, torch.Generator().manual_seed(1))
+    expected = reference_dequant(x, s)
+    with tempfile.TemporaryDirectory() as model_dir, tempfile.TemporaryDirectory() as cache_dir:
+        key = "model.layers.0.mlp.experts.0.down_proj.weight"
+        save_file({key: x, key[:-7] + ".weight_scale_inv": s}, os.path.join(model_dir, "model.safetensors"))
+
+        def entries():
+            return sum(len(files) for _, _, files in os.walk(cache_dir))
+
+        loader = SafeTensorLoader(model_dir, dequant_cache_dir=cache_dir)
+        assert torch.equal(loader.load_dequantized_tensor(key, "cpu"), expected) and entries() == 1
+        # a new loader reads the entry, the shard's fp8 tensors are not dequantized again
+        reloaded = SafeTensorLoader(model_dir, dequant_cache_dir=cache_dir)
+        reloaded.load_tensor = None
+        assert torch.equal(reloaded.load_dequantized_tensor(key, "cpu"), expected) and entries() == 1
+        if torch.cuda.is_available():
+            y = SafeTensorLoader(model_dir, dequant_cache_dir=cache_dir).load_dequantized_tensor(key, "cuda")
+            assert torch.equal(y.cpu(), expected) and entries() == 1
+        # a rewritten shard is a new entry
+        time.sleep(0.01)
+        save_file({key: x, key[:-7] + ".weight_scale_inv": s * 2}, os.path.join(model_dir, "model.safetensors"))
+        loader = SafeTensorLoader(model_dir, dequant_cache_dir=cache_dir)
+        assert torch.equal(loader.load_dequantized_tensor(key, "cpu"), reference_dequant(x, s * 2)) and entries() == 2
+    print("dequant cache: cpu loads cached, gpu loads not")
+
+
+def bench_dequant(M: int, N: int, num_threads: int, test_iter: int = 5):
+    torch.set_default_dtype(torch.bfloat16)
+    x, s = random_fp8_weight(M, N, torch.Generator().manual_seed(0))
+    weight_dequant_cpu(x, s, block_size, num_threads)
+    start = time.perf_counter()
+    for _ in range(test_iter):
+        weight_dequant_cpu(x, s, block_size, num_threads)
+    total_time = time.perf_counter() - start
+    print("threads: ", num_threads)
+    print("Time(ms) per weight: ", total_time / test_iter * 1000)
+    print("Bandwidth: ", M * N * 3 * test_iter / total_time / 1000 / 1000 / 1000, "GB/s")
+    print("")
+
+
+for M, N in ((256, 512), (576, 7168), (300, 200), (7168, 1536)):
+    for dtype in (torch.bfloat16, torch.float16, torch.float32):
+        check_dequant(M, N, dtype)
+check_dequant_cache()
+
+for num_threads in (1, 2, 4, 8):
+    bench_dequant(18432, 7168, num_threads)
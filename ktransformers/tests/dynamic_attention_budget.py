@@ -0,0 +1,210 @@
+"""
+Description  : Decode with DynamicScaledDotProductAttention on cpu tensors and a kvcache_budget, so that the
+               decode path evicts blocks of its cpu kvcache sequence once the conversation outgrows the budget.
+               Without importance the oldest blocks after the first go first, so a second cpu kvcache that
+               keeps every token and attends the kept blocks through a block table gives the expected outputs
+               of a dense layer and a layer with block retrieval. Checks the outputs and the kept length at every
+               step, a prefill that continues the conversation after evictions, and that a new prompt may reuse
+               only the first block of an evicted conversation. Needs the built cpuinfer_ext.
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.operators.cpuinfer import CPUInferKVCache
+from ktransformers.operators.dynamic_attention import DynamicScaledDotProductAttention
+
+layer_num = 2
+kv_head_num = 2
+q_head_num = 8
+head_dim = 128
+block_size = 64
+max_seq_len = 16 * block_size
+local_windows_len = block_size
+topk = 1
+budget = 6 * block_size
+config = SimpleNamespace(
+    num_key_value_heads=kv_head_num,
+    num_attention_heads=q_head_num,
+    hidden_size=q_head_num * head_dim,
+    num_hidden_layers=layer_num,
+)
+
+
+class Reference:
+    """Every token at its position in blocks 0, 1, 2, ..., and the blocks the budget keeps."""
+
+    def __init__(self, attention: DynamicScaledDotProductAttention):
+        self.attention = attention
+        self.kvcache = CPUInferKVCache(
+            layer_num,
+            kv_head_num,
+            q_head_num,
+            head_dim,
+            block_size,
+            anchor_num=attention.anchor_num,
+            anchor_type=attention.anchor_type,
+            kv_type=attention.kv_type,
+            retrieval_type=attention.block_selection_mode,
+            layer_step=attention.layer_step,
+            token_step=attention.token_step,
+            layer_offset=attention.dense_layer_num % attention.layer_step,
+            max_batch_size=1,
+            max_block_num=attention.block_num,
+            max_thread_num=attention.threads_num,
+        )
+        self.keys = [torch.empty(0, kv_head_num, head_dim, dtype=torch.float16) for _ in range(layer_num)]
+        self.start(0)
+
+    def start(self, past_len):
+        self.kept_blocks = list(range((past_len + block_size - 1) // block_size))
+        self.kept_len = past_len
+        self.keys = [k[:past_len] for k in self.keys]
+
+    def append(self, position):
+        if position % block_size == 0:
+            self.kept_blocks.append(position // block_size)
+        self.kept_len += 1
+
+    def evict(self):
+        # evict_seq without importance: the oldest blocks between the first init_block_num and the last
+        # local_block_num ones
+        over_len = self.kept_len - budget
+        first = self.attention.init_block_num
+        last = len(self.kept_blocks) - self.attention.local_block_num
+        if over_len <= 0 or last <= first:
+            return
+        evict_num = min((over_len + block_size - 1) // block_size, last - first)
+        del self.kept_blocks[first : first + evict_num]
+        self.kept_len -= evict_num * block_size
+
+    def block_table(self):
+        table = torch.zeros(1, self.attention.block_num, dtype=torch.int32)
+        table[0, : len(self.kept_blocks)] = torch.tensor(self.kept_blocks, dtype=torch.int32)
+        return table
+
+    def kept_keys(self, layer_idx):
+        return torch.cat([self.keys[layer_idx][b * block_size : (b + 1) * block_size] for b in self.kept_blocks])
+
+
+def prefill(attention, reference, past_len, q_len):
+    """What apply does in a prefill chunk apart from flash attention, and the same on the reference cache."""
+    attention.prepare_seq(past_len, q_len)
+    assert attention.local_thread.get_seq_len(attention.seq_id) + attention.evicted_len == past_len + q_len
+    past_len_cpu = torch.tensor([past_len], dtype=torch.int32)
+    block_num = (past_len + q_len + block_size - 1) // block_size
+    identity = torch.arange(block_num, dtype=torch.int32).view(1, -1)
+    for position in range(past_len, past_len + q_len):
+        reference.append(position)
+    for layer_idx in range(layer_num):
+        key = torch.randn(1, q_len, kv_head_num, head_dim).half()
+        value = torch.randn(1, q_len, kv_head_num, head_dim).half()
+        reference.keys[layer_idx] = torch.cat([reference.keys[layer_idx], key[0]])
+        # the gpu window holds the kept tokens, followed by the new ones
+        k_window, _ = attention.swap_in_and_swap_out(
+            layer_idx, torch.tensor([past_len - attention.evicted_len], dtype=torch.int32), q_len, key, value
+        )
+        assert torch.equal(k_window[0, : reference.kept_len], reference.kept_keys(layer_idx)), layer_idx
+        k_cache = torch.zeros(1, block_num * block_size, kv_head_num, head_dim, dtype=torch.float16)
+        v_cache = torch.zeros_like(k_cache)
+        k_cache[0, past_len : past_len + q_len] = key[0]
+        v_cache[0, past_len : past_len + q_len] = value[0]
+        attention.cpu_infer.submit(
+            reference.kvcache.get_and_update_kvcache_fp16(
+                k_cache, v_cache, layer_idx, identity, block_num, past_len_cpu, q_len
+            )
+        )
+        attention.cpu_infer.sync()
+    attention.calc_anchor(past_len + q_len)
+    lengths = torch.tensor([past_len + q_len], dtype=torch.int32)
+    attention.cpu_infer.submit(reference.kvcache.calc_anchor_all_layers(identity, lengths))
+    attention.cpu_infer.sync()
+    return past_len + q_len
+
+
+def decode(attention, reference, past_len, steps):
+    for _ in range(steps):
+        reference.append(past_len)
+        reference.evict()
+        for layer_idx in range(layer_num):
+            query = torch.randn(1, 1, q_head_num, head_dim).half()
+            key = torch.randn(1, 1, kv_head_num, head_dim).half()
+            value = torch.randn(1, 1, kv_head_num, head_dim).half()
+            reference.keys[layer_idx] = torch.cat([reference.keys[layer_idx], key[0]])
+            output = attention.apply(layer_idx, 1, past_len, query, key, value, mode="generate").clone()
+
+            expected = torch.empty(1, 1, q_head_num, head_dim, dtype=torch.float16)
+            lse = torch.empty(1, 1, q_head_num, dtype=torch.float32)
+            dense = layer_idx < attention.dense_layer_num
+            # submit runs asynchronously, the tensors passed by pointer are kept alive until sync
+            block_table = reference.block_table()
+            cache_seqlens = torch.tensor([reference.kept_len - 1], dtype=torch.int32)
+            attention.cpu_infer.submit(
+                reference.kvcache.attn_with_kvcache(
+                    q_in=query,
+                    k_in=key,
+                    v_in=value,
+                    output=expected,
+                    attn_lse=lse,
+                    layer_idx=layer_idx,
+                    block_table=block_table,
+                    cache_seqlens=cache_seqlens,
+                    generate_token_idx=attention.generate_token_idx,
+                    topk=None if dense else topk,
+                    local=None if dense else local_windows_len // block_size,
+                )
+            )
+            attention.cpu_infer.sync()
+            assert torch.equal(output.transpose(1, 2), expected), (layer_idx, past_len)
+        past_len += 1
+        seq_len = attention.local_thread.get_seq_len(attention.seq_id)
+        assert seq_len == reference.kept_len and seq_len <= budget + block_size, (seq_len, reference.kept_len)
+        assert seq_len + attention.local_thread.get_seq_evicted_len(attention.seq_id) == past_len
+    return past_len
+
+
+torch.manual_seed(0)
+with torch.inference_mode(mode=True):
+    attention = DynamicScaledDotProductAttention(
+        max_seq_len=max_seq_len,
+        block_size=block_size,
+        config=config,
+        device=torch.device("cpu"),
+        local_windows_len=local_windows_len,
+        topk=topk,
+        threads_num=2,
+        anchor_type="BLOCK_MEAN",
+        dense_layer_num=1,
+        token_step=1,
+        kvcache_budget=budget,
+    )
+    reference = Reference(attention)
+
+    past_len = prefill(attention, reference, 0, 5 * block_size - 10)
+    past_len = decode(attention, reference, past_len, 200)
+    evicted_len = attention.local_thread.get_seq_evicted_len(attention.seq_id)
+    assert evicted_len > 0
+    print("decode: ", past_len, "tokens, ", evicted_len, "evicted, outputs identical to the kept blocks")
+
+    # the next turn of the conversation, prefilled after the kept tokens
+    past_len = prefill(attention, reference, past_len, 100)
+    past_len = decode(attention, reference, past_len, 20)
+    print("next turn: ", past_len, "tokens, ", attention.local_thread.get_seq_len(attention.seq_id), "kept")
+
+    # a new prompt may reuse the first block, which is never evicted, but nothing after it
+    try:
+        attention.prepare_seq(3 * block_size, 10)
+        raise AssertionError("a prefix with evicted tokens was reused")
+    except RuntimeError as e:
+        print("new prompt sharing 3 blocks: ", e)
+    shared = block_size // 2
+    reference.start(shared)
+    past_len = prefill(attention, reference, shared, 4 * block_size)
+    assert attention.evicted_len == 0 and torch.equal(
+        attention.prefix_block_table[0, :5], torch.arange(5, dtype=torch.int32)
+    )
+    past_len = decode(attention, reference, past_len, 10)
+    print("new prompt sharing half a block: ", past_len, "tokens, outputs identical")
@@ -0,0 +1,141 @@
+"""
+Description  : Decode with DynamicScaledDotProductAttention on cpu tensors, its cpu kvcache held as one
+               sequence, against a second cpu kvcache driven the way it was before, through block tables
+               with attn_with_kvcache. A dense layer and a layer with block retrieval must give identical
+               outputs over a prompt and decode steps, then over a second prompt that shares only the start
+               of the first one, which starts the sequence over. Prefill runs swap_in_and_swap_out without
+               the flash attention part, which needs a gpu. Needs the built cpuinfer_ext.
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.operators.cpuinfer import CPUInferKVCache
+from ktransformers.operators.dynamic_attention import DynamicScaledDotProductAttention
+
+layer_num = 2
+kv_head_num = 2
+q_head_num = 8
+head_dim = 128
+block_size = 64
+max_seq_len = 16 * block_size
+local_windows_len = 2 * block_size
+topk = 2
+config = SimpleNamespace(
+    num_key_value_heads=kv_head_num,
+    num_attention_heads=q_head_num,
+    hidden_size=q_head_num * head_dim,
+    num_hidden_layers=layer_num,
+)
+
+
+def reference_cache(attention: DynamicScaledDotProductAttention):
+    return CPUInferKVCache(
+        layer_num,
+        kv_head_num,
+        q_head_num,
+        head_dim,
+        block_size,
+        anchor_num=attention.anchor_num,
+        anchor_type=attention.anchor_type,
+        kv_type=attention.kv_type,
+        retrieval_type=attention.block_selection_mode,
+        layer_step=attention.layer_step,
+        token_step=attention.token_step,
+        layer_offset=attention.dense_layer_num % attention.layer_step,
+        max_batch_size=1,
+        max_block_num=attention.block_num,
+        max_thread_num=attention.threads_num,
+    )
+
+
+def prefill(attention, reference, past_len, q_len):
+    """What apply does in a prefill chunk apart from flash attention, and the same on the reference cache."""
+    attention.prepare_seq(past_len, q_len)
+    past_len_cpu = torch.tensor([past_len], dtype=torch.int32)
+    block_num = (past_len + q_len + block_size - 1) // block_size
+    block_table = attention.prefix_block_table[:, :block_num].clone()
+    for layer_idx in range(layer_num):
+        key = torch.randn(1, q_len, kv_head_num, head_dim).half()
+        value = torch.randn(1, q_len, kv_head_num, head_dim).half()
+        attention.swap_in_and_swap_out(layer_idx, past_len_cpu, q_len, key, value)
+        k_cache = torch.zeros(1, block_num * block_size, kv_head_num, head_dim, dtype=torch.float16)
+        v_cache = torch.zeros_like(k_cache)
+        k_cache[0, past_len : past_len + q_len] = key[0]
+        v_cache[0, past_len : past_len + q_len] = value[0]
+        attention.cpu_infer.submit(
+            reference.get_and_update_kvcache_fp16(k_cache, v_cache, layer_idx, block_table, block_num, past_len_cpu, q_len)
+        )
+        attention.cpu_infer.sync()
+    attention.calc_anchor(past_len + q_len)
+    lengths = torch.tensor([past_len + q_len], dtype=torch.int32)
+    attention.cpu_infer.submit(reference.calc_anchor_all_layers(block_table, lengths))
+    attention.cpu_infer.sync()
+
+
+def decode(attention, reference, past_len, steps):
+    reference_block_table = torch.arange(attention.block_num, dtype=torch.int32).view(1, -1)
+    for _ in range(steps):
+        for layer_idx in range(layer_num):
+            query = torch.randn(1, 1, q_head_num, head_dim).half()
+            key = torch.randn(1, 1, kv_head_num, head_dim).half()
+            value = torch.randn(1, 1, kv_head_num, head_dim).half()
+            output = attention.apply(layer_idx, 1, past_len, query, key, value, mode="generate").clone()
+
+            expected = torch.empty(1, 1, q_head_num, head_dim, dtype=torch.float16)
+            lse = torch.empty(1, 1, q_head_num, dtype=torch.float32)
+            cache_seqlens = torch.tensor([past_len], dtype=torch.int32)
+            dense = layer_idx < attention.dense_layer_num
+            attention.cpu_infer.submit(
+                reference.attn_with_kvcache(
+                    q_in=query,
+                    k_in=key,
+                    v_in=value,
+                    output=expected,
+                    attn_lse=lse,
+                    layer_idx=layer_idx,
+                    block_table=reference_block_table,
+                    cache_seqlens=cache_seqlens,
+                    generate_token_idx=attention.generate_token_idx,
+                    topk=None if dense else topk,
+                    local=None if dense else local_windows_len // block_size,
+                )
+            )
+            attention.cpu_infer.sync()
+            assert torch.equal(output.transpose(1, 2), expected), (layer_idx, past_len)
+        past_len += 1
+        assert attention.local_thread.get_seq_len(attention.seq_id) == past_len
+    return past_len
+
+
+torch.manual_seed(0)
+with torch.inference_mode(mode=True):
+    attention = DynamicScaledDotProductAttention(
+        max_seq_len=max_seq_len,
+        block_size=block_size,
+        config=config,
+        device=torch.device("cpu"),
+        local_windows_len=local_windows_len,
+        topk=topk,
+        threads_num=2,
+        anchor_type="BLOCK_MEAN",
+        dense_layer_num=1,
+        token_step=1,
+    )
+    reference = reference_cache(attention)
+
+    # two chunks, then decode steps that cross a block boundary
+    prefill(attention, reference, 0, 5 * block_size)
+    prefill(attention, reference, 5 * block_size, 3 * block_size - 3)
+    past_len = decode(attention, reference, 8 * block_size - 3, 6)
+    print("first prompt: ", past_len, "tokens, outputs identical to the block table path")
+
+    # a prompt that shares the first two and a half blocks of the first one
+    shared = 2 * block_size + block_size // 2
+    prefill(attention, reference, shared, 4 * block_size)
+    assert attention.local_thread.get_seq_len(attention.seq_id) == shared + 4 * block_size
+    past_len = decode(attention, reference, shared + 4 * block_size, 4)
+    print("second prompt: ", past_len, "tokens, outputs identical to the block table path")
@@ -0,0 +1,142 @@
+"""
+Description  : Compare translate_name_to_gguf with the chain of str.replace calls it replaced, kept below. The
+               fixtures are the module and parameter names of the models the optimize rules target, built on the
+               meta device, each also as the prefix with a trailing dot that gen_optimize_config translates, and
+               names glued together at random from the fragments the renames look for, so that they overlap and
+               follow each other in every way.
+"""
+import os
+import sys
+import random
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from transformers import Qwen2MoeConfig, MixtralConfig
+from ktransformers.util.custom_gguf import translate_name_to_gguf, translate_name_to_gguf_mixtral, GGUF_NAME_STAGES
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.modeling_deepseek import DeepseekV2ForCausalLM
+from ktransformers.models.configuration_deepseek_v3 import DeepseekV3Config
+from ktransformers.models.modeling_deepseek_v3 import DeepseekV3ForCausalLM
+from ktransformers.models.modeling_qwen2_moe import Qwen2MoeForCausalLM
+from ktransformers.models.configuration_llama import LlamaConfig
+from ktransformers.models.modeling_llama import LlamaForCausalLM
+from ktransformers.models.modeling_mixtral import MixtralForCausalLM
+
+
+def reference_translate_name_to_gguf(name):
+    name = translate_name_to_gguf_mixtral(name)
+
+    name = name.replace("lm_head.", "output.")
+    name = name.replace("model.embed_tokens.", "token_embd.")
+    name = name.replace("model.norm.", "output_norm.")
+
+    name = name.replace("model.layers.", "blk.")
+    name = name.replace(".input_layernorm", ".attn_norm")
+    name = name.replace(".mlp.down_proj", ".ffn_down")
+    name = name.replace(".mlp.gate_proj", ".ffn_gate")
+    name = name.replace(".mlp.up_proj", ".ffn_up")
+    name = name.replace(".post_attention_layernorm", ".ffn_norm")
+    name = name.replace(".self_attn.q_proj", ".attn_q")
+    name = name.replace(".self_attn.k_proj", ".attn_k")
+    name = name.replace(".self_attn.v_proj", ".attn_v")
+    name = name.replace(".self_attn.o_proj", ".attn_output")
+    name = name.replace(".self_attn.qkv_proj", ".attn_qkv")
+    name = name.replace(".self_attn.kv_a_proj_with_mqa", ".attn_kv_a_mqa")
+    name = name.replace(".self_attn.kv_a_layernorm", ".attn_kv_a_norm")
+    name = name.replace(".self_attn.kv_b_proj", ".attn_kv_b")
+    name = name.replace(".self_attn.q_a_proj", ".attn_q_a")
+    name = name.replace(".self_attn.q_a_layernorm", ".attn_q_a_norm")
+    name = name.replace(".self_attn.q_b_proj", ".attn_q_b")
+
+    name = name.replace(".shared_expert.", ".shared_experts.")
+    name = name.replace(".shared_expert_", ".shared_experts_")
+    name = name.replace(".gate_up_proj.", ".up_proj")
+
+    name = name.replace(".mlp.shared_experts.down_proj", ".ffn_down_shexp")
+    name = name.replace(".mlp.gate", ".ffn_gate_inp")
+    name = name.replace(".mlp.shared_experts.gate_proj", ".ffn_gate_shexp")
+    name = name.replace(".mlp.shared_experts.up_proj", ".ffn_up_shexp")
+    name = name.replace(".mlp.shared_experts_gate", ".ffn_gate_inp_shexp")
+    name = name.replace(".mlp.experts", "")
+    name = name.replace(".mlp.experts.ffn_down_exps", ".ffn_down_exps")
+    name = name.replace(".mlp.experts.ffn_gate_exps", ".ffn_gate_exps")
+    name = name.replace(".mlp.experts.ffn_up_exps", ".ffn_up_exps")
+
+    name = name.replace(".block_sparse_moe.gate.", ".ffn_gate_inp.")
+    name = name.replace(".block_sparse_moe.experts", "")
+
+    return name
+
+
+small = dict(hidden_size=64, intermediate_size=128, num_attention_heads=4, num_key_value_heads=2, vocab_size=100)
+mla = dict(
+    q_lora_rank=32,
+    kv_lora_rank=16,
+    qk_rope_head_dim=8,
+    qk_nope_head_dim=8,
+    v_head_dim=8,
+    moe_intermediate_size=32,
+    n_shared_experts=1,
+    first_k_dense_replace=1,
+    num_experts_per_tok=2,
+    n_routed_experts=8,
+    num_hidden_layers=3,
+)
+models = {
+    "DeepseekV2": lambda: DeepseekV2ForCausalLM(DeepseekV2Config(**small, **mla)),
+    "DeepseekV3": lambda: DeepseekV3ForCausalLM(
+        DeepseekV3Config(
+            **small,
+            **mla,
+            moe_layer_freq=1,
+            scoring_func="sigmoid",
+            topk_method="noaux_tc",
+            n_group=1,
+            topk_group=1,
+            norm_topk_prob=True,
+            routed_scaling_factor=1.0,
+            seq_aux=True,
+            aux_loss_alpha=0.0,
+        )
+    ),
+    "Qwen2Moe": lambda: Qwen2MoeForCausalLM(
+        Qwen2MoeConfig(
+            **small,
+            num_hidden_layers=3,
+            moe_intermediate_size=32,
+            shared_expert_intermediate_size=64,
+            num_experts=8,
+            num_experts_per_tok=2,
+        )
+    ),
+    "Mixtral": lambda: MixtralForCausalLM(MixtralConfig(**small, num_hidden_layers=3, num_local_experts=8)),
+    "Llama": lambda: LlamaForCausalLM(LlamaConfig(**small, num_hidden_layers=3)),
+}
+
+
+def check(name: str):
+    expected = reference_translate_name_to_gguf(name)
+    assert translate_name_to_gguf(name) == expected, (name, translate_name_to_gguf(name), expected)
+    # the second time comes from the memo
+    assert translate_name_to_gguf(name) == expected, name
+
+
+for model_name, build in models.items():
+    with torch.device("meta"):
+        model = build()
+    names = [name for name, _ in model.named_modules()] + [name for name, _ in model.named_parameters()]
+    for name in names:
+        check(name)
+        check(name + ".")
+    print(f"{model_name:10s} {len(names):5d} module and parameter names identical to the str.replace chain")
+
+# the fragments the renames look for and what they become, glued with digits, dots and the ends of names
+fragments = [fragment for stage in GGUF_NAME_STAGES for pair in stage.items() for fragment in pair]
+fragments += ["model.layers.1.block_sparse_moe.experts.2.w1.weight", ".mlp.experts.ffn_up_exps", ".weight", "."]
+fragments += [".mlp", ".experts", ".gate", "_proj", "shared_expert", "model.", "layers.", "0", "12", ""]
+rng = random.Random(0)
+for _ in range(200000):
+    name = "".join(rng.choice(fragments) for _ in range(rng.randint(1, 6)))
+    check(name)
+print("200000 names glued from the renamed fragments identical to the str.replace chain")
@@ -0,0 +1,45 @@
+"""
+Description  : Back synthetic expert weights with BackedWeights in every mode and print the backing
+               the kernel reports, a missing hugetlbfs pool or a low RLIMIT_MEMLOCK shows as fallback.
+               Then time a pass over random experts of the memory mapped file against the backed copy.
+"""
+import os
+import sys
+import tempfile
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import numpy as np
+from ktransformers.util.hugepages import BackedWeights
+
+expert_num = 64
+expert_bytes = 4 * 1024 * 1024
+test_iter = 256
+
+
+def read_random_experts(weights: np.ndarray, rng: np.random.Generator) -> float:
+    start = time.perf_counter()
+    for expert_id in rng.integers(0, expert_num, test_iter):
+        # one byte per 4 KiB page, the cost is in the page walks and faults
+        weights[expert_id, ::4096].sum()
+    return time.perf_counter() - start
+
+
+with tempfile.TemporaryDirectory() as weight_dir:
+    file_name = os.path.join(weight_dir, "experts.bin")
+    np.random.default_rng(0).integers(0, 255, (expert_num, expert_bytes), dtype=np.uint8).tofile(file_name)
+    mapped = np.memmap(file_name, dtype=np.uint8, mode="r", shape=(expert_num, expert_bytes))
+    print("memmap: ", read_random_experts(mapped, np.random.default_rng(1)), "s")
+    print("")
+
+    for backing in (None, "thp", "hugetlb"):
+        for lock in (False, True):
+            backed = BackedWeights([mapped], backing, lock)
+            assert np.array_equal(backed.arrays[0], mapped)
+            report = backed.report()
+            print("backing: ", backing, "obtained: ", backed.backing, "lock: ", lock, "locked: ", backed.locked)
+            print("bytes: ", report["bytes"], "huge page bytes: ", report["huge_page_bytes"], "locked bytes: ", report["locked_bytes"])
+            print("time: ", read_random_experts(backed.arrays[0], np.random.default_rng(1)), "s")
+            print("")
+            del backed
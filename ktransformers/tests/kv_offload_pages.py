@@ -0,0 +1,106 @@
+"""
+Description  : Offload sequences of a StaticCache to the host pool of KVOffloadManager and restore them on cpu,
+               for the llama and MLA layouts with and without kv_quant, and check that the restored tokens of
+               every cache tensor are bit exact. Host pages are fragmented on purpose so that copies are split
+               into several runs, and the last page of the llama cache is cut by max_cache_len.
+"""
+import os
+import sys
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.util.kv_offload import KVOffloadManager
+from transformers import LlamaConfig
+
+# not a multiple of the page size, the last llama page is cut
+cache_len = 200
+
+llama_config = LlamaConfig(
+    hidden_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, architectures=["LlamaForCausalLM"]
+)
+mla_config = DeepseekV2Config(
+    hidden_size=64, num_hidden_layers=2, num_attention_heads=4, kv_lora_rank=32, qk_rope_head_dim=8,
+    architectures=["DeepseekV2ForCausalLM"],
+)
+
+
+def fill(cache: StaticCache, length: int):
+    """Random contents for the first `length` tokens, as a prefill of a new sequence would write."""
+    for layer_idx in range(cache.num_hidden_layers):
+        for t in cache._layer_storage(layer_idx):
+            if t.dtype.is_floating_point:
+                t.copy_(torch.randn(t.shape).to(t.dtype))
+            else:
+                t.copy_(torch.randint(-128, 128, t.shape, dtype=t.dtype))
+        cache.past_tokens[layer_idx] = cache_len
+    cache.remove_suffix(length)
+
+
+def prefix(cache: StaticCache, length: int):
+    return [
+        [cache._token_slice(t, 0, length).clone() for t in cache._layer_storage(layer_idx)]
+        for layer_idx in range(cache.num_hidden_layers)
+    ]
+
+
+def check_restored(cache: StaticCache, expected, length: int):
+    for layer_idx in range(cache.num_hidden_layers):
+        for saved, t in zip(expected[layer_idx], cache._layer_storage(layer_idx)):
+            restored, saved = cache._token_slice(t, 0, length), cache._token_slice(saved, 0, length)
+            assert torch.equal(restored.view(torch.uint8), saved.view(torch.uint8))
+
+
+def check_offload(config, kv_quant):
+    cache = StaticCache(config, 1, cache_len, "cpu", torch.bfloat16, kv_quant=kv_quant)
+    manager = KVOffloadManager(cache, max_host_pages=6)
+    ps = manager.page_size
+
+    # fragment the pool: pages 0 and 2 stay taken, "a" gets 1, 3, 4 and 5
+    for i in range(3):
+        fill(cache, ps)
+        assert manager.offload(f"hole-{i}", torch.arange(ps) + i)
+    manager.restore("hole-1", 0)
+
+    a_ids = torch.arange(cache_len) + 3
+    fill(cache, cache_len)
+    a = prefix(cache, cache_len)
+    assert manager.offload("a", a_ids)
+    assert manager.sequences["a"].host_pages == [1, 3, 4, 5]
+    # offloaded copies leave nothing to wait on for a cpu cache
+    assert not cache.pending_reads
+
+    # another sequence overwrites the device pages
+    fill(cache, cache_len)
+    assert manager.match(torch.cat([a_ids[:150], torch.tensor([-1])])) == ("a", 150)
+    manager.restore("a", 150)
+    check_restored(cache, a, 150)
+    assert sorted(manager.free_pages) == [1, 3, 4, 5]
+
+    # the whole cache, last page included
+    fill(cache, cache_len)
+    b = prefix(cache, cache_len)
+    assert manager.offload("b", a_ids)
+    fill(cache, cache_len)
+    manager.restore("b", cache_len)
+    check_restored(cache, b, cache_len)
+
+    # the pool is full, the least recently offloaded sequence goes first
+    fill(cache, 3 * ps)
+    assert manager.offload("c", torch.arange(3 * ps))
+    fill(cache, 2 * ps)
+    d = prefix(cache, 2 * ps)
+    assert manager.offload("d", torch.arange(2 * ps) + 7)
+    assert list(manager.sequences) == ["hole-2", "c", "d"]
+    assert manager.sequences["d"].host_pages == [0, 5]
+    fill(cache, cache_len)
+    manager.restore("d", 2 * ps)
+    check_restored(cache, d, 2 * ps)
+    print(config.architectures[0], "kv_quant: ", kv_quant, "page size: ", ps, "restored bit exact")
+
+
+for config in (llama_config, mla_config):
+    for kv_quant in (None, "int8"):
+        check_offload(config, kv_quant)
@@ -0,0 +1,106 @@
+"""
+Description  : Load KExpertsCPU layers on a background thread, as LazyWeightLoader does, while the main thread runs
+               expert forwards, with a fake MOE and a CPU_INFER that records who submits and syncs. Checks that
+               only the main thread uses the shared CPU_INFER queue, every submit followed by its own sync, so the
+               loading thread cannot sync a forward half way or slip its warm up between a forward and its sync.
+               A load on the main thread still warms up.
+"""
+import os
+import sys
+import threading
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import numpy as np
+import torch
+from transformers.configuration_utils import PretrainedConfig
+import ktransformers.operators.experts as experts
+from ktransformers.operators.experts import KExpertsCPU
+
+hidden_size = 16
+moe_intermediate_size = 8
+n_routed_experts = 4
+num_experts_per_tok = 2
+layer_num = 8
+
+
+class FakeMOE:
+    def __init__(self, config):
+        # building the real MOE takes a while, give the main thread time to run forwards meanwhile
+        time.sleep(0.01)
+
+    def warm_up(self):
+        return ("warm_up", id(self))
+
+    def forward(self, *args):
+        return ("forward", id(self))
+
+
+class RecordingCPUInfer:
+    def __init__(self):
+        self.log = []
+        self.lock = threading.Lock()
+
+    def submit(self, task):
+        with self.lock:
+            self.log.append((threading.current_thread().name, task[0]))
+
+    def sync(self):
+        with self.lock:
+            self.log.append((threading.current_thread().name, "sync"))
+
+
+def new_layer(i: int) -> KExpertsCPU:
+    layer = KExpertsCPU.__new__(KExpertsCPU)
+    layer.key = f"blk.{i}"
+    layer.config = config
+    layer.n_routed_experts = n_routed_experts
+    layer.out_device = "cpu"
+    return layer
+
+
+def weights():
+    return {
+        "gate": np.zeros(n_routed_experts * hidden_size * moe_intermediate_size, dtype=np.float32),
+        "up": np.zeros(n_routed_experts * hidden_size * moe_intermediate_size, dtype=np.float32),
+        "down": np.zeros(n_routed_experts * hidden_size * moe_intermediate_size, dtype=np.float32),
+        "gate_type": 0,
+        "up_type": 0,
+        "down_type": 0,
+    }
+
+
+config = PretrainedConfig(
+    hidden_size=hidden_size, moe_intermediate_size=moe_intermediate_size, num_experts_per_tok=num_experts_per_tok
+)
+experts.MOE = FakeMOE
+experts.MOEConfig = lambda *args: args
+cpu_infer = RecordingCPUInfer()
+KExpertsCPU.CPU_INFER = cpu_infer
+# the pinned buffers need cuda, the cpu forward does not use them
+KExpertsCPU.input_tensor_cpu = torch.zeros(hidden_size)
+
+first = new_layer(0)
+first.load(weights(), warmup=True)
+assert cpu_infer.log == [("MainThread", "warm_up"), ("MainThread", "sync")]
+
+layers = [new_layer(i) for i in range(1, layer_num)]
+loader = threading.Thread(
+    target=lambda: [layer.load(weights(), warmup=True) for layer in layers], name="lazy_weight_loader"
+)
+loader.start()
+forwards = 0
+hidden = torch.randn(3, hidden_size)
+expert_ids = torch.randint(0, n_routed_experts, (3, num_experts_per_tok))
+routing_weights = torch.rand(3, num_experts_per_tok)
+while loader.is_alive():
+    first.forward(hidden, expert_ids, routing_weights)
+    forwards += 1
+loader.join()
+
+assert all(isinstance(layer.moe, FakeMOE) for layer in layers)
+assert all(name == "MainThread" for name, _ in cpu_infer.log), set(name for name, _ in cpu_infer.log)
+ops = [op for _, op in cpu_infer.log]
+assert ops == ["warm_up", "sync"] + ["forward", "sync"] * forwards, ops
+print("layers loaded off the main thread: ", len(layers), "forwards meanwhile: ", forwards, "warm ups: ", ops.count("warm_up"))
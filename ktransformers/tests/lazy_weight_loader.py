@@ -0,0 +1,210 @@
+"""
+Description  : Load a tiny model built on meta from a synthetic GGUF file with optimize_and_load_gguf(lazy=True) on
+               the cpu. The background thread of LazyWeightLoader is held back at first, so that the forward pre-hooks
+               load the layers that run, and a load that fails is left to the next forward, which loads the layer. Then
+               the thread is let go while forwards run, every tensor must be read exactly once whichever of them gets to
+               a layer first. The outputs must be identical to the ones of the same model loaded eagerly.
+"""
+import os
+import sys
+import struct
+import tempfile
+import threading
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import numpy as np
+import torch
+from torch import nn
+from transformers.configuration_utils import PretrainedConfig
+import ktransformers.optimize.optimize as optimize
+from ktransformers.optimize.optimize import optimize_and_load_gguf
+from ktransformers.util.custom_gguf import GGUFLoader, GGMLQuantizationType, DATA_TYPES, translate_name_to_gguf
+from ktransformers.util.utils import LazyWeightLoader
+
+layer_num = 8
+vocab_size = 32
+hidden_size = 64
+intermediate_size = 128
+alignment = 32
+
+
+def write_string(f, value: str):
+    data = value.encode("utf-8")
+    f.write(struct.pack("<Q", len(data)))
+    f.write(data)
+
+
+def write_gguf(path: str, tensors: dict):
+    """tensors maps a gguf name to (ggml shape, ggml type, raw bytes)."""
+    with open(path, "wb") as f:
+        f.write(b"GGUF")
+        f.write(struct.pack("<IQQ", 3, len(tensors), 1))
+        write_string(f, "general.architecture")
+        f.write(struct.pack("<I", DATA_TYPES["string"]))
+        write_string(f, "synthetic")
+        offset = 0
+        for name, (shape, ggml_type, data) in tensors.items():
+            write_string(f, name)
+            f.write(struct.pack("<I", len(shape)))
+            f.write(struct.pack(f"<{len(shape)}Q", *shape))
+            f.write(struct.pack("<IQ", ggml_type, offset))
+            offset += (len(data) + alignment - 1) // alignment * alignment
+        f.write(b"\0" * ((alignment - f.tell() % alignment) % alignment))
+        for shape, ggml_type, data in tensors.values():
+            f.write(data)
+            f.write(b"\0" * ((alignment - len(data) % alignment) % alignment))
+
+
+class Norm(nn.Module):
+    def __init__(self, size: int):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(size))
+
+    def forward(self, x):
+        return x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + 1e-6) * self.weight
+
+
+class Layer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.input_layernorm = Norm(hidden_size)
+        self.mlp = nn.Module()
+        self.mlp.gate_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.mlp.up_proj = nn.Linear(hidden_size, intermediate_size, bias=False)
+        self.mlp.down_proj = nn.Linear(intermediate_size, hidden_size, bias=False)
+
+    def forward(self, x):
+        h = self.input_layernorm(x)
+        return x + self.mlp.down_proj(nn.functional.silu(self.mlp.gate_proj(h)) * self.mlp.up_proj(h))
+
+
+class TinyModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.model = nn.Module()
+        self.model.embed_tokens = nn.Embedding(vocab_size, hidden_size)
+        self.model.layers = nn.ModuleList([Layer() for _ in range(layer_num)])
+        self.model.norm = Norm(hidden_size)
+        self.lm_head = nn.Linear(hidden_size, vocab_size, bias=False)
+
+    def forward(self, input_ids):
+        x = self.model.embed_tokens(input_ids)
+        for layer in self.model.layers:
+            x = layer(x)
+        return self.lm_head(self.model.norm(x))
+
+
+def build_model() -> nn.Module:
+    with torch.device("meta"):
+        return TinyModel()
+
+
+def build_gguf(gguf_dir: str):
+    rng = np.random.default_rng(0)
+    tensors = {}
+    for name, param in build_model().named_parameters():
+        data = (rng.standard_normal(param.numel(), dtype=np.float32) / 8).tobytes()
+        tensors[translate_name_to_gguf(name)] = (list(reversed(param.shape)), GGMLQuantizationType.F32, data)
+    write_gguf(os.path.join(gguf_dir, "synthetic.gguf"), tensors)
+
+
+class GatedLazyWeightLoader(LazyWeightLoader):
+    """Its background thread waits for gate before loading anything."""
+
+    gate = threading.Event()
+
+    def load_all(self):
+        if threading.current_thread() is self.thread:
+            self.gate.wait()
+        super().load_all()
+
+
+loads = {}
+loads_lock = threading.Lock()
+failing = set()
+load_gguf_tensor = GGUFLoader.load_gguf_tensor
+
+
+def counting_load_gguf_tensor(self, name: str, *args, **kwargs):
+    with loads_lock:
+        if name in failing:
+            failing.discard(name)
+            raise RuntimeError(f"failed to read {name}")
+    # reading takes a while, so the background thread and a forward meet on the same layer
+    time.sleep(0.001)
+    tensor = load_gguf_tensor(self, name, *args, **kwargs)
+    with loads_lock:
+        loads[name] = loads.get(name, 0) + 1
+    return tensor
+
+
+def load(gguf_dir: str, rule_path: str, lazy: bool) -> nn.Module:
+    model = build_model()
+    optimize_and_load_gguf(model, rule_path, gguf_dir, PretrainedConfig(), default_device="cpu", lazy=lazy)
+    return model
+
+
+def on_meta(layer: nn.Module) -> bool:
+    return all(param.device.type == "meta" for param in layer.parameters())
+
+
+def on_cpu(module: nn.Module) -> bool:
+    return all(param.device.type == "cpu" for param in module.parameters())
+
+
+GGUFLoader.load_gguf_tensor = counting_load_gguf_tensor
+optimize.LazyWeightLoader = GatedLazyWeightLoader
+torch.manual_seed(0)
+input_ids = torch.randint(0, vocab_size, (2, 16))
+with tempfile.TemporaryDirectory() as gguf_dir, torch.inference_mode():
+    build_gguf(gguf_dir)
+    rule_path = os.path.join(gguf_dir, "rules.yaml")
+    with open(rule_path, "w") as f:
+        f.write("[]\n")
+
+    eager = load(gguf_dir, rule_path, lazy=False)
+    assert on_cpu(eager)
+    expected = eager(input_ids)
+    loads.clear()
+
+    model = load(gguf_dir, rule_path, lazy=True)
+    layers = model.model.layers
+    assert on_cpu(model.model.embed_tokens) and on_cpu(model.lm_head) and on_cpu(model.model.norm)
+    assert all(on_meta(layer) for layer in layers) and not any(name.startswith("blk.") for name in loads)
+    print("lazy load: ", len(loads), "tensors read, the", layer_num, "layers left on meta")
+    # only the tensors of the layers are counted from here on
+    loads.clear()
+
+    # the pre-hook loads a layer on its first forward, the others stay on meta
+    x = model.model.embed_tokens(input_ids)
+    x = layers[0](x)
+    assert on_cpu(layers[0]) and all(on_meta(layer) for layer in layers[1:])
+    print("first forward of layer 0: loaded by its hook, layers 1 to", layer_num - 1, "still on meta")
+
+    # a failed load leaves the layer to be loaded again, by the next forward
+    failing.add(translate_name_to_gguf("model.layers.1.input_layernorm.weight"))
+    try:
+        layers[1](x)
+        raise AssertionError("the failed load of layer 1 was not raised")
+    except RuntimeError as e:
+        print("first forward of layer 1: ", e)
+    assert on_meta(layers[1]) and layers[1] in model.gguf_loader.lazy_loader.prefixes
+    x = layers[1](x)
+    assert on_cpu(layers[1])
+    print("second forward of layer 1: loaded")
+
+    # the background thread and the forwards of the remaining layers race for them
+    GatedLazyWeightLoader.gate.set()
+    for layer in layers[2:]:
+        x = layer(x)
+    output = model.lm_head(model.model.norm(x))
+    model.gguf_loader.lazy_loader.wait()
+    assert on_cpu(model) and not model.gguf_loader.lazy_loader.prefixes
+    assert all(count == 1 for count in loads.values()), {name: count for name, count in loads.items() if count != 1}
+    assert len(loads) == sum(len(list(layer.parameters())) for layer in layers)
+    print("background thread and forwards: every tensor read once")
+
+    assert torch.equal(output, expected) and torch.equal(model(input_ids), expected)
+    print("outputs identical to the eager load")
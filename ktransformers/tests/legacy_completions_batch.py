@@ -0,0 +1,98 @@
+"""
+Description  : Send a list of prompts with n samples each to the legacy /completions endpoint in front
+               of a tiny cpu model with greedy sampling. Every choice must match the completion of its
+               prompt alone, and the prompts sharing a prefix must reuse it from the kv cache. The
+               request is one queue slot whose service time is split among its jobs. Streamed, every
+               choice gets its own finish chunk.
+"""
+import os
+import sys
+import tempfile
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import asyncio
+import json
+import httpx
+from fastapi import FastAPI
+from ktransformers.server.api.openai.legacy.completions import router
+from ktransformers.server.utils.create_interface import GlobalInterface, GlobalRequestQueue
+from ktransformers.server.utils.request_queue import RequestQueue
+from tiny_model import save_tiny_llama, tiny_args, TinyInterface
+
+prompts = [
+    "The quick brown fox jumps over the lazy dog. Then it",
+    "Once upon a time there was a",
+    "The quick brown fox jumps over the lazy dog. After that",
+    "The quick brown fox jumps over the lazy cat",
+]
+n = 2
+
+
+class CountingInterface(TinyInterface):
+    """Counts the prompt tokens prefill computes, a prefix reused from the kv cache is not among them."""
+
+    prefilled = 0
+
+    def prefill(self, input_ids, is_new, temperature=None, top_p=None):
+        yield from super().prefill(input_ids, is_new, temperature, top_p)
+        self.prefilled += self.profiler.get_counter("prefill")
+
+
+async def complete(interface, prompt: str, thread_id: str) -> str:
+    text = ""
+    async for res in interface.inference(prompt, thread_id):
+        if isinstance(res, tuple):
+            text += res[0]
+    return text
+
+
+with tempfile.TemporaryDirectory() as model_dir:
+    save_tiny_llama(model_dir)
+    # top_k 1 makes sampling greedy
+    args = tiny_args(model_dir, max_new_tokens=16, top_k=1)
+    reference = [asyncio.run(complete(CountingInterface(args), prompt, "reference")) for prompt in prompts]
+
+    interface = CountingInterface(args)
+    GlobalInterface.interface = interface
+    queue = RequestQueue()
+    GlobalRequestQueue.request_queue = queue
+    app = FastAPI()
+    app.include_router(router)
+
+    async def main():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+            start = time.perf_counter()
+            response = await client.post("/completions", json={"model": "tiny", "prompt": prompts, "n": n})
+            total_time = time.perf_counter() - start
+            prefilled = interface.prefilled
+            stream = await client.post("/completions", json={"model": "tiny", "prompt": prompts, "n": n, "stream": True})
+            return response.json(), total_time, prefilled, stream.text
+
+    completion, total_time, prefilled, stream = asyncio.run(main())
+    choices = sorted(completion["choices"], key=lambda choice: choice["index"])
+    assert [choice["index"] for choice in choices] == list(range(len(prompts) * n)), choices
+    for choice in choices:
+        assert choice["text"] == reference[choice["index"] // n], (choice, reference)
+    prompt_tokens = sum(len(interface.tokenizer.encode(prompt)) for prompt in prompts) * n
+    print("choices: ", len(choices), "time(s): ", total_time)
+    print("prompt tokens: ", prompt_tokens, "prefilled: ", prefilled)
+    assert prefilled < prompt_tokens // 2, prefilled
+    # the first request measured its jobs, not itself as one
+    jobs = len(prompts) * n
+    assert queue.avg_service_time < 2 * total_time / jobs, (queue.avg_service_time, total_time)
+    print("service time per job(s): ", queue.avg_service_time)
+
+    chunks = [json.loads(line[len("data:"):]) for line in stream.split("\n\n") if line.startswith("data:{")]
+    texts, finish_reasons = [""] * jobs, {}
+    for chunk in chunks:
+        choice = chunk["choices"][0]
+        texts[choice["index"]] += choice["delta"]["content"]
+        if choice.get("finish_reason"):
+            assert choice["index"] not in finish_reasons, choice
+            finish_reasons[choice["index"]] = choice["finish_reason"]
+    assert texts == [reference[index // n] for index in range(jobs)], texts
+    assert sorted(finish_reasons) == list(range(jobs)), finish_reasons
+    print("stream finish reasons: ", [finish_reasons[index] for index in range(jobs)])
@@ -0,0 +1,90 @@
+"""
+Description  : Run a tiny DeepSeek V2 model on cpu without a kv cache, as the embedding endpoint does,
+               once with the reference attention and once with KDeepseekV2Attention injected, for
+               inputs of one and of several tokens, and compare the hidden states. Then embed a right
+               padded batch of prompts of different lengths in one forward, as the embedding endpoint
+               batches them, and compare every prompt with its forward alone.
+"""
+import os
+import sys
+import copy
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from torch import nn
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.modeling_deepseek import DeepseekV2Model
+from ktransformers.operators.attention import KDeepseekV2Attention
+
+config = DeepseekV2Config(
+    vocab_size=128,
+    hidden_size=64,
+    intermediate_size=128,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=4,
+    kv_lora_rank=32,
+    q_lora_rank=48,
+    qk_rope_head_dim=8,
+    v_head_dim=16,
+    qk_nope_head_dim=16,
+    max_position_embeddings=256,
+)
+config._attn_implementation = "eager"
+
+
+class SlicedMaskAttention(nn.Module):
+    """The reference attention, given only the columns of the mask that a forward without cache attends to."""
+
+    def __init__(self, attention: nn.Module):
+        super().__init__()
+        self.attention = attention
+
+    def forward(self, hidden_states, attention_mask=None, **kwargs):
+        if attention_mask is not None:
+            attention_mask = attention_mask[:, :, :, : hidden_states.shape[1]]
+        return self.attention(hidden_states, attention_mask, **kwargs)
+
+
+torch.manual_seed(0)
+reference = DeepseekV2Model(config).eval()
+model = copy.deepcopy(reference)
+for layer in reference.layers:
+    layer.self_attn = SlicedMaskAttention(layer.self_attn)
+for i, layer in enumerate(model.layers):
+    weights = layer.self_attn.state_dict()
+    # the injected module initializes its original module again, the weights are put back after
+    layer.self_attn = KDeepseekV2Attention(f"blk.{i}.self_attn", None, config, layer.self_attn, "cpu", "cpu")
+    layer.self_attn.orig_module.load_state_dict(weights)
+model.eval()
+
+with torch.no_grad():
+    for q_len in (1, 2, 9):
+        inputs_embeds = reference.embed_tokens(torch.randint(0, config.vocab_size, (2, q_len)))
+        expected = reference(inputs_embeds=inputs_embeds, use_cache=False, return_dict=False)[0]
+        hidden_states = model(inputs_embeds=inputs_embeds, use_cache=False, return_dict=False)[0]
+        error = (hidden_states - expected).abs().max().item()
+        print("q_len: ", q_len, "max error: ", error)
+        assert error < 1e-5, error
+
+    # no mask, as an sdpa model passes for unpadded inputs, is causal as well
+    attention = model.layers[0].self_attn
+    hidden_states = torch.randn(1, 9, config.hidden_size)
+    expected = reference.layers[0].self_attn(
+        hidden_states, attention_mask=torch.full((9, 9), float("-inf")).triu(1)[None, None],
+        position_ids=torch.arange(9)[None]
+    )[0]
+    output, _, past_key_value = attention(hidden_states, position_ids=torch.arange(9)[None])
+    assert past_key_value is None and (output - expected).abs().max().item() < 1e-5
+    print("unmasked: ok")
+
+    # a batch of different lengths, padded on the right, the real tokens never attend to the padding
+    lengths = [3, 11, 1, 7]
+    inputs_embeds = model.embed_tokens(torch.randint(0, config.vocab_size, (len(lengths), max(lengths))))
+    batched = model(inputs_embeds=inputs_embeds, use_cache=False, return_dict=False)[0]
+    for i, length in enumerate(lengths):
+        alone = model(inputs_embeds=inputs_embeds[i : i + 1, :length], use_cache=False, return_dict=False)[0]
+        error = (batched[i, :length] - alone[0]).abs().max().item()
+        assert error < 1e-5, (length, error)
+    print("padded batch of ", len(lengths), "prompts: same as one at a time")
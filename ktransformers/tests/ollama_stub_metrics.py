@@ -0,0 +1,89 @@
+"""
+Description  : Call the Ollama /api/generate and /api/chat endpoints, streaming and not, in front of
+               a stub interface that yields tokens and a known RawUsage, and check the reported
+               timings against it. The model is loaded at startup, so load_duration is 0. The second of
+               two concurrent requests waits behind the first, which must show up as its queue_duration.
+"""
+import os
+import sys
+import asyncio
+import json
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import httpx
+from fastapi import FastAPI
+from ktransformers.server.api.ollama.completions import router
+from ktransformers.server.schemas.endpoints.chat import RawUsage
+from ktransformers.server.utils.create_interface import GlobalInterface, GlobalRequestQueue
+from ktransformers.server.utils.request_queue import RequestQueue
+
+tokens = ["Hello", ",", " world", "!"]
+usage = RawUsage(tokenize_time=0.01, prefill_time=0.05, decode_time=0.08, prefill_count=12, decode_count=len(tokens))
+
+
+class StubInterface:
+    """Takes the time it reports in its RawUsage."""
+
+    async def inference(self, local_messages, thread_id: str, temperature=None, top_p=None, tools=None, cancel_token=None):
+        await asyncio.sleep(usage.tokenize_time + usage.prefill_time)
+        for i, token in enumerate(tokens):
+            await asyncio.sleep(usage.decode_time / len(tokens))
+            yield token, "stop" if i == len(tokens) - 1 else None
+        yield usage
+
+
+GlobalInterface.interface = StubInterface()
+GlobalRequestQueue.request_queue = RequestQueue()
+app = FastAPI()
+app.include_router(router)
+to_ns = 1_000_000_000
+# scheduling slack of the event loop
+tolerance = 0.03 * to_ns
+
+
+def check_metrics(response: dict, waited: float = 0.0):
+    assert response["done"] and response["done_reason"] == "stop", response
+    assert response["prompt_eval_count"] == usage.prefill_count, response
+    assert response["eval_count"] == usage.decode_count, response
+    assert response["prompt_eval_duration"] == int((usage.tokenize_time + usage.prefill_time) * to_ns), response
+    assert response["eval_duration"] == int(usage.decode_time * to_ns), response
+    assert response["load_duration"] == 0, response
+    assert abs(response["queue_duration"] - waited * to_ns) < tolerance, response
+    total = response["queue_duration"] + response["prompt_eval_duration"] + response["eval_duration"]
+    assert abs(response["total_duration"] - total) < tolerance, response
+
+
+async def main():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        generate = {"model": "stub", "prompt": "hi", "stream": False}
+        response = (await client.post("/api/generate", json=generate)).json()
+        assert response["response"] == "".join(tokens), response
+        check_metrics(response)
+        print("generate: ", {k: v for k, v in response.items() if k.endswith("duration") or k.endswith("count")})
+
+        chat = {"model": "stub", "messages": [{"role": "user", "content": "hi"}], "stream": False}
+        response = (await client.post("/api/chat", json=chat)).json()
+        assert response["message"] == {"role": "assistant", "content": "".join(tokens)}, response
+        check_metrics(response)
+        print("chat: ", {k: v for k, v in response.items() if k.endswith("duration") or k.endswith("count")})
+
+        for path, body in (("/api/generate", dict(generate, stream=True)), ("/api/chat", dict(chat, stream=True))):
+            lines = (await client.post(path, json=body)).text.strip().split("\n")
+            chunks = [json.loads(line) for line in lines]
+            assert not any(chunk["done"] for chunk in chunks[:-1]) and len(chunks) == len(tokens) + 1, chunks
+            check_metrics(chunks[-1])
+            print(path, "stream: ", len(chunks), "chunks")
+
+        # one request at a time runs, the second one's wait for the first is its queue_duration
+        first, second = await asyncio.gather(
+            client.post("/api/generate", json=generate), client.post("/api/generate", json=generate)
+        )
+        check_metrics(first.json())
+        service_time = usage.tokenize_time + usage.prefill_time + usage.decode_time
+        check_metrics(second.json(), waited=service_time)
+        print("queue_duration(ms): ", second.json()["queue_duration"] / 1_000_000)
+
+
+asyncio.run(main())
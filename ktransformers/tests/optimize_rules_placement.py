@@ -0,0 +1,189 @@
+"""
+Description  : Run gen_optimize_config on the meta device for every shipped optimize_rules yaml, against the model it
+               targets with its real layer and expert counts, and compare with the recursive implementation it replaced,
+               kept below. The configs must be identical, including their order. The recursion passed default_device
+               to the root only, its children got cuda:0 whatever the caller asked for. gen_optimize_config passes it
+               down, so with the default cuda:0 nothing changes, and with another device every module no rule matches
+               is placed there, the modules the rules place are not affected.
+"""
+import os
+import sys
+import re
+import copy
+import glob
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+import yaml
+from transformers import Qwen2MoeConfig, MixtralConfig
+from ktransformers.optimize.optimize import gen_optimize_config
+from ktransformers.util.custom_gguf import translate_name_to_gguf
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.modeling_deepseek import DeepseekV2ForCausalLM
+from ktransformers.models.configuration_deepseek_v3 import DeepseekV3Config
+from ktransformers.models.modeling_deepseek_v3 import DeepseekV3ForCausalLM
+from ktransformers.models.modeling_qwen2_moe import Qwen2MoeForCausalLM
+from ktransformers.models.configuration_llama import LlamaConfig
+from ktransformers.models.modeling_llama import LlamaForCausalLM
+from ktransformers.models.modeling_mixtral import MixtralForCausalLM
+
+rules_dir = os.path.join(current_path, "../optimize/optimize_rules")
+small = dict(hidden_size=64, intermediate_size=128, num_attention_heads=4, num_key_value_heads=2, vocab_size=100)
+mla = dict(
+    q_lora_rank=32,
+    kv_lora_rank=16,
+    qk_rope_head_dim=8,
+    qk_nope_head_dim=8,
+    v_head_dim=8,
+    moe_intermediate_size=32,
+    n_shared_experts=1,
+    first_k_dense_replace=1,
+    num_experts_per_tok=2,
+)
+v3_routing = dict(
+    moe_layer_freq=1,
+    scoring_func="sigmoid",
+    topk_method="noaux_tc",
+    n_group=1,
+    topk_group=1,
+    norm_topk_prob=True,
+    routed_scaling_factor=1.0,
+    seq_aux=True,
+    aux_loss_alpha=0.0,
+)
+# the model each yaml targets, by a part of its file name, with the layer and expert counts of the real model
+models = {
+    "DeepSeek-V2-Lite": lambda: DeepseekV2ForCausalLM(
+        DeepseekV2Config(**small, **mla, num_hidden_layers=27, n_routed_experts=64)
+    ),
+    "DeepSeek-V2-Chat": lambda: DeepseekV2ForCausalLM(
+        DeepseekV2Config(**small, **mla, num_hidden_layers=60, n_routed_experts=160)
+    ),
+    "DeepSeek-V3": lambda: DeepseekV3ForCausalLM(
+        DeepseekV3Config(**small, **mla, **v3_routing, num_hidden_layers=61, n_routed_experts=256)
+    ),
+    "Moonlight": lambda: DeepseekV3ForCausalLM(
+        DeepseekV3Config(**small, **mla, **v3_routing, num_hidden_layers=27, n_routed_experts=64)
+    ),
+    "Qwen2": lambda: Qwen2MoeForCausalLM(
+        Qwen2MoeConfig(
+            **small,
+            num_hidden_layers=28,
+            moe_intermediate_size=32,
+            shared_expert_intermediate_size=64,
+            num_experts=64,
+            num_experts_per_tok=2,
+        )
+    ),
+    "Mixtral": lambda: MixtralForCausalLM(MixtralConfig(**small, num_hidden_layers=32, num_local_experts=8)),
+    "Internlm": lambda: LlamaForCausalLM(LlamaConfig(**small, num_hidden_layers=32)),
+}
+
+
+def reference_gen_optimize_config(module, out_data, rule_list, prefix="", default_device="cuda:0", pass_device=True):
+    """The recursive gen_optimize_config, pass_device=False is how it called itself, without default_device."""
+    module_name = prefix[:-1]
+    translated_name = translate_name_to_gguf(prefix)[:-1]
+    recursive = True
+    for rule in rule_list:
+        match_meta = rule["match"]
+        if "class" not in match_meta and "name" not in match_meta:
+            raise Exception("match must have at least one of \"class\" and \"name\"")
+        if "class" in match_meta:
+            import_path = match_meta["class"].split(".")
+            import_module_name = ".".join(import_path[:-1])
+            import_class_name = import_path[-1]
+            module_cls = getattr(__import__(import_module_name, fromlist=[""]), import_class_name)
+            if not isinstance(module, module_cls):
+                continue
+        if "name" in match_meta:
+            if re.search(match_meta["name"], module_name) is None:
+                continue
+        if "replace" not in rule:
+            raise Exception("replace must be in rule")
+        replace_meta = rule["replace"]
+        if module_name not in out_data:
+            out_data[module_name] = {
+                "key": translated_name,
+                "class": replace_meta["class"] if "class" in replace_meta else "default",
+                "kwargs": copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict(),
+            }
+        else:
+            if out_data[module_name]["class"] == "default":
+                out_data[module_name]["class"] = replace_meta["class"] if "class" in replace_meta else "default"
+            out_data[module_name]["kwargs"].update(
+                copy.deepcopy(replace_meta["kwargs"]) if "kwargs" in replace_meta else dict()
+            )
+        if "recursive" in rule:
+            recursive = bool(rule["recursive"])
+        break
+
+    if module_name not in out_data:
+        out_data[module_name] = {
+            "class": "default",
+            "key": translated_name,
+            "kwargs": {"generate_device": default_device, "prefill_device": default_device},
+        }
+
+    if recursive:
+        for name, child in module._modules.items():
+            if child is not None:
+                child_device = default_device if pass_device else "cuda:0"
+                reference_gen_optimize_config(
+                    child, out_data, rule_list, prefix + name + ".", child_device, pass_device
+                )
+
+
+built = {}
+
+
+def model_for(path: str) -> torch.nn.Module:
+    for name, build in models.items():
+        if name in path:
+            if name not in built:
+                with torch.device("meta"):
+                    built[name] = build()
+            return built[name]
+    raise KeyError(f"no model for {path}")
+
+
+paths = sorted(glob.glob(os.path.join(rules_dir, "**/*.yaml"), recursive=True))
+assert len(paths) > 0
+for path in paths:
+    with open(path, "r", encoding="utf-8") as f:
+        rule_list = yaml.load(f.read(), Loader=yaml.FullLoader)
+    model = model_for(path)
+
+    # the default device, as every caller passes it
+    start = time.perf_counter()
+    expected = {}
+    reference_gen_optimize_config(model, expected, rule_list, pass_device=False)
+    reference_time = time.perf_counter() - start
+    start = time.perf_counter()
+    config = {}
+    gen_optimize_config(model, config, rule_list)
+    gen_time = time.perf_counter() - start
+    assert list(config.items()) == list(expected.items()), path
+
+    # another device, every module without a rule is placed on it
+    on_cpu = {}
+    gen_optimize_config(model, on_cpu, rule_list, default_device="cpu")
+    expected = {}
+    reference_gen_optimize_config(model, expected, rule_list, default_device="cpu")
+    assert list(on_cpu.items()) == list(expected.items()), path
+    assert list(on_cpu) == list(config)
+    moved = 0
+    for name, meta in config.items():
+        cpu_meta = on_cpu[name]
+        if meta["kwargs"] == {"generate_device": "cuda:0", "prefill_device": "cuda:0"} and cpu_meta != meta:
+            assert cpu_meta == dict(meta, kwargs={"generate_device": "cpu", "prefill_device": "cpu"}), (path, name)
+            moved += 1
+        else:
+            assert cpu_meta == meta, (path, name)
+    assert moved > 0, path
+    print(
+        f"{os.path.relpath(path, rules_dir):55s} modules {len(config):6d}, {moved:6d} without a rule on cpu,",
+        f"identical, recursion {reference_time:.2f}s, gen_optimize_config {gen_time:.2f}s",
+    )
@@ -0,0 +1,75 @@
+"""
+Description  : Check what PageCacheWarmer.record saves: not the chunks the warmer itself prefaulted, not what
+               loading read before reset_accesses, only the chunks the run accessed through the mapping
+               afterwards, and nothing inside the ranges that were copied out while loading, such as experts
+               moved to huge pages. Then check that the next start prefaults exactly the recorded chunks.
+"""
+import os
+import sys
+import tempfile
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import json
+import numpy as np
+from ktransformers.util.prefault import PageCacheWarmer, PAGE_SIZE, mapped_pages
+
+# the default, a file mapping may be faulted in huge page sized folios
+chunk_size = 2 * 1024 * 1024
+chunk_num = 32
+
+
+def recorded_chunks(profile_path: str, file_name: str):
+    with open(profile_path, "r", encoding="utf-8") as f:
+        return json.load(f)["files"][os.path.realpath(file_name)]["chunks"]
+
+
+def access(data: np.ndarray, chunks):
+    # pages in the middle of each chunk, fault around stays inside the chunk
+    for chunk in chunks:
+        start = chunk * chunk_size + chunk_size // 4
+        data[start : start + chunk_size // 2 : PAGE_SIZE].sum()
+
+
+with tempfile.TemporaryDirectory() as file_dir:
+    file_name = os.path.join(file_dir, "model.gguf")
+    with open(file_name, "wb") as f:
+        f.write(np.random.default_rng(0).integers(0, 255, chunk_num * chunk_size, dtype=np.uint8).tobytes())
+    profile_path = os.path.join(file_dir, "page_cache_profile.json")
+
+    # no profile yet, the small file is prefaulted whole but the warmer's reads are not accesses
+    data = np.memmap(file_name, dtype=np.uint8, mode="r")
+    warmer = PageCacheWarmer({file_name: data}, profile_path, chunk_size=chunk_size)
+    assert warmer.ranges() == [(file_name, 0, data.nbytes)]
+    warmer.start()
+    warmer.wait()
+    assert warmer.progress() == (data.nbytes, data.nbytes)
+    assert not mapped_pages(data).any()
+    warmer.record()
+    assert recorded_chunks(profile_path, file_name) == []
+
+    # loading reads everything, copies chunks 12 to 15 out, then the run uses a few chunks
+    copied = {file_name: [(12 * chunk_size, 16 * chunk_size)]}
+    warmer = PageCacheWarmer({file_name: data}, profile_path, chunk_size=chunk_size, excluded=copied)
+    data[::PAGE_SIZE].sum()
+    assert mapped_pages(data).all()
+    warmer.reset_accesses()
+    assert not mapped_pages(data).any()
+    access(data, [3, 4, 10, 14, 31])
+    warmer.record()
+    assert recorded_chunks(profile_path, file_name) == [[3, 5], [10, 11], [31, 32]], recorded_chunks(profile_path, file_name)
+    print("recorded: ", recorded_chunks(profile_path, file_name))
+
+    # the next start reads back the recorded chunks only, and never the copied out range
+    warmer = PageCacheWarmer({file_name: data}, profile_path, chunk_size=chunk_size, excluded=copied)
+    assert warmer.ranges() == [
+        (file_name, 3 * chunk_size, 5 * chunk_size),
+        (file_name, 10 * chunk_size, 11 * chunk_size),
+        (file_name, 31 * chunk_size, 32 * chunk_size),
+    ]
+    # without a profile, the whole file but the copied out range
+    os.remove(profile_path)
+    warmer = PageCacheWarmer({file_name: data}, profile_path, chunk_size=chunk_size, excluded=copied)
+    assert warmer.ranges() == [(file_name, 0, 12 * chunk_size), (file_name, 16 * chunk_size, data.nbytes)]
+    print("prefaulted next start: recorded chunks, copied out range skipped")
+    del data
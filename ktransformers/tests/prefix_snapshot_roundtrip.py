@@ -0,0 +1,89 @@
+"""
+Description  : Dump the prefix of a StaticCache with PrefixSnapshotStore and load it into a fresh cache
+               on cpu, for the llama and MLA layouts and every kv_quant format, and check that every
+               cache tensor comes back bit exact. Then save a snapshot through an interface whose
+               prefill takes the sampling arguments without defaults, as KTransformersInterface does,
+               and restore it in another interface.
+"""
+import os
+import sys
+import asyncio
+import tempfile
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.models.configuration_deepseek import DeepseekV2Config
+from ktransformers.models.custom_cache import StaticCache, KV_QUANT_TYPES
+from ktransformers.util.kvcache_snapshot import PrefixSnapshotStore
+from tiny_model import save_tiny_llama, tiny_args, TinyInterface
+from transformers import LlamaConfig
+
+cache_len = 256
+prefix_len = 100
+
+llama_config = LlamaConfig(
+    hidden_size=64, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2, architectures=["LlamaForCausalLM"]
+)
+mla_config = DeepseekV2Config(
+    hidden_size=64, num_hidden_layers=2, num_attention_heads=4, kv_lora_rank=32, qk_rope_head_dim=8,
+    architectures=["DeepseekV2ForCausalLM"],
+)
+
+
+def fill(cache: StaticCache, length: int):
+    for layer_idx in range(cache.num_hidden_layers):
+        for t in cache._layer_storage(layer_idx):
+            if t.dtype.is_floating_point:
+                t.copy_(torch.randn(t.shape).to(t.dtype))
+            else:
+                t.copy_(torch.randint(-128, 128, t.shape, dtype=t.dtype))
+        cache.past_tokens[layer_idx] = cache_len
+    cache.remove_suffix(length)
+
+
+def check_round_trip(config, kv_quant, snapshot_dir: str):
+    cache = StaticCache(config, 1, cache_len, "cpu", torch.bfloat16, kv_quant=kv_quant)
+    fill(cache, prefix_len)
+    store = PrefixSnapshotStore(snapshot_dir, f"{config.architectures[0]}:{kv_quant}")
+    token_ids = torch.arange(prefix_len)
+    key = store.save(cache, token_ids)
+    restored = StaticCache(config, 1, cache_len, "cpu", torch.bfloat16, kv_quant=kv_quant)
+    assert store.match(torch.arange(prefix_len + 10), store.format_of(restored)) == (key, prefix_len)
+    assert store.load(restored, key) == prefix_len
+    for layer_idx in range(cache.num_hidden_layers):
+        for saved, loaded in zip(cache._layer_storage(layer_idx), restored._layer_storage(layer_idx)):
+            # the suffix is zero in both
+            assert torch.equal(saved.view(torch.uint8), loaded.view(torch.uint8)), (config.architectures, kv_quant)
+        assert restored.past_tokens[layer_idx] == prefix_len
+    print(config.architectures[0], "kv_quant: ", kv_quant, "round trip: bit exact")
+
+
+class KTransformersLikeInterface(TinyInterface):
+    """Its prefill has no defaults for temperature and top_p, like KTransformersInterface.prefill."""
+
+    def prefill(self, input_ids, is_new, temperature, top_p):
+        yield from super().prefill(input_ids, is_new, temperature, top_p)
+
+
+with tempfile.TemporaryDirectory() as snapshot_dir:
+    for config in (llama_config, mla_config):
+        for kv_quant in [None] + list(KV_QUANT_TYPES):
+            check_round_trip(config, kv_quant, os.path.join(snapshot_dir, f"{config.architectures[0]}-{kv_quant}"))
+
+with tempfile.TemporaryDirectory() as model_dir, tempfile.TemporaryDirectory() as snapshot_dir:
+    save_tiny_llama(model_dir)
+    args = tiny_args(model_dir, prefix_snapshot_dir=snapshot_dir)
+    prompt = "A long system prompt that every request of the day starts with. " * 2
+    saver = KTransformersLikeInterface(args)
+    key, length = asyncio.run(saver.save_prefix_snapshot(prompt))
+    saved = [[t[..., :length, :].clone() for t in saver.cache._layer_storage(i)] for i in range(saver.cache.num_hidden_layers)]
+
+    loader = KTransformersLikeInterface(args)
+    input_ids = loader.tokenize_prompt(prompt + "And the question.")
+    # the last prompt token is never restored, prefill needs its logits
+    assert loader.restore_prefix_snapshot(input_ids, 0) == length
+    for layer_idx in range(loader.cache.num_hidden_layers):
+        for expected, t in zip(saved[layer_idx], loader.cache._layer_storage(layer_idx)):
+            assert torch.equal(t[..., :length, :], expected)
+    print("interface: snapshot of", length, "tokens saved and restored bit exact")
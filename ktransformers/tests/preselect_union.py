@@ -0,0 +1,34 @@
+"""
+Description  : Check DynamicScaledDotProductAttention.union_with_last_layer_blocks, which merges the top blocks
+               of the last layer into every other layer's preselect table at once, against the loop over layers
+               it replaced, on cpu tables with many shared blocks. The fp16 anchors of the cpu kvcache are checked
+               against the old loops by ktransformers_ext/examples/test_anchor.py, which needs the built extension.
+"""
+import os
+import sys
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.operators.dynamic_attention import DynamicScaledDotProductAttention
+
+
+def old_union(preselect_block_table, layer_num, topk):
+    for tmp_layer_idx in range(layer_num - 1):
+        for i in range(1, min(topk, 6)):
+            x = preselect_block_table[-1, i]
+            if x not in preselect_block_table[tmp_layer_idx]:
+                preselect_block_table[tmp_layer_idx, topk - i] = x
+
+
+torch.manual_seed(0)
+layer_num = 32
+for block_num, preselect_block_count, topk in ((16, 12, 12), (64, 96, 40), (8, 8, 3), (200, 96, 96)):
+    for _ in range(20):
+        # few distinct blocks, so rows often hold some of the last layer's blocks already
+        table = torch.randint(0, block_num, (layer_num, preselect_block_count), dtype=torch.int32)
+        expected = table.clone()
+        old_union(expected, layer_num, topk)
+        DynamicScaledDotProductAttention.union_with_last_layer_blocks(table, layer_num, topk)
+        assert torch.equal(table, expected), (block_num, topk)
+    print("blocks: ", block_num, "topk: ", topk, "identical to the loop over layers")
@@ -0,0 +1,115 @@
+"""
+Description  : Check the repack cache of KLinearQ8 and KLinearMarlin with their cpu reference quantizers: the
+               first load packs and saves, a second linear over the same weight reads the same tensors back
+               without packing, and changing one element of the weight, adding a bias or changing a parameter of
+               the repacking (compute dtype, group size, bits) is a miss. Also checks the digest of raw buffers,
+               as GGUF mmap slices are hashed, and that an unreadable entry is packed again. Importing the linear
+               operators needs a torch build with cuda, the packing itself runs on cpu.
+"""
+import os
+import sys
+import tempfile
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import numpy as np
+import torch
+from torch import nn
+from ktransformers.operators.linear import KLinearMarlin, KLinearQ8
+from ktransformers.server.config.config import Config
+from ktransformers.util.weight_cache import RepackCache
+
+in_features = 256
+out_features = 128
+
+
+class CountingQ8(KLinearQ8):
+    packs = 0
+
+    def _pack(self, w, device):
+        CountingQ8.packs += 1
+        return super()._pack(w, device)
+
+
+class CountingMarlin(KLinearMarlin):
+    packs = 0
+
+    def _pack(self, w, device):
+        CountingMarlin.packs += 1
+        return super()._pack(w, device)
+
+
+def assert_same(a: dict, b: dict):
+    assert a.keys() == b.keys()
+    for name in a:
+        assert torch.equal(a[name], b[name]), name
+
+
+def cache_files(path: str):
+    return sorted(os.path.join(d, f) for d, _, files in os.walk(path) for f in files)
+
+
+torch.manual_seed(0)
+orig_module = nn.Linear(in_features, out_features)
+weight = nn.Parameter(torch.randn(out_features, in_features), requires_grad=False)
+changed = nn.Parameter(weight.clone(), requires_grad=False)
+changed.data[3, 5] += 1
+bias = torch.randn(out_features)
+
+with tempfile.TemporaryDirectory() as cache_dir:
+    Config().repack_cache_dir = cache_dir
+
+    # Q8, through load() on cpu
+    first = CountingQ8("blk.0.ffn_down", None, None, orig_module, device="cpu")
+    first.load(weight, device="cpu")
+    assert CountingQ8.packs == 1 and len(cache_files(cache_dir)) == 1
+    second = CountingQ8("blk.1.ffn_down", None, None, orig_module, device="cpu")
+    second.load(weight, device="cpu")
+    assert CountingQ8.packs == 1, "same weight and parameters should hit"
+    assert torch.equal(first.weight, second.weight) and torch.equal(first.weight_scale, second.weight_scale)
+    fresh = first._pack(weight, "cpu")
+    assert torch.equal(second.weight, fresh["weight"]) and torch.equal(second.weight_scale, fresh["weight_scale"])
+
+    CountingQ8("blk.2.ffn_down", None, None, orig_module, device="cpu").load(changed, device="cpu")
+    assert CountingQ8.packs == 3, "a changed weight should miss"
+    with_bias = CountingQ8("blk.3.ffn_down", None, None, orig_module, device="cpu")
+    with_bias.load((weight, bias), device="cpu")
+    assert CountingQ8.packs == 4 and with_bias.has_bias, "a bias is a source too"
+    other_dtype = CountingQ8("blk.4.ffn_down", None, None, orig_module, device="cpu")
+    other_dtype.compute_dtype = torch.bfloat16
+    other_dtype.load(weight, device="cpu")
+    assert CountingQ8.packs == 5, "another compute dtype should miss"
+    print("q8: ", CountingQ8.packs, "packs for 6 loads, entries: ", len(cache_files(cache_dir)))
+
+    # Marlin, through load_packed on cpu, load() itself needs cuda for the workspace
+    marlin = CountingMarlin("blk.0.attn_output", None, None, orig_module, device="cuda", group_size=64)
+    packed = marlin.load_packed(weight, "cpu")
+    again = CountingMarlin("blk.1.attn_output", None, None, orig_module, device="cuda", group_size=64).load_packed(weight, "cpu")
+    assert CountingMarlin.packs == 1
+    assert_same(packed, again)
+    assert_same(packed, marlin._pack(weight, "cpu"))
+    CountingMarlin("blk.2.attn_output", None, None, orig_module, device="cuda", group_size=128).load_packed(weight, "cpu")
+    assert CountingMarlin.packs == 3, "another group size should miss"
+    CountingMarlin("blk.3.attn_output", None, None, orig_module, device="cuda", num_bits=8).load_packed(weight, "cpu")
+    assert CountingMarlin.packs == 4, "other bits should miss"
+    CountingMarlin("blk.4.attn_output", None, None, orig_module, device="cuda").load_packed(changed, "cpu")
+    assert CountingMarlin.packs == 5, "a changed weight should miss"
+    print("marlin: ", CountingMarlin.packs, "packs for 6 loads, entries: ", len(cache_files(cache_dir)))
+
+    # GGUF sources are hashed as raw bytes
+    raw = np.frombuffer(np.random.default_rng(0).bytes(4096), dtype=np.uint8).copy()
+    digest = RepackCache.digest([raw], kind="q8")
+    assert digest == RepackCache.digest([raw.copy()], kind="q8")
+    flipped = raw.copy()
+    flipped[1000] ^= 1
+    assert digest != RepackCache.digest([flipped], kind="q8")
+    assert digest != RepackCache.digest([raw], kind="marlin")
+
+    # a truncated entry is ignored and packed again
+    entry = RepackCache(cache_dir)._file(RepackCache.digest([weight], **first.repack_params()))
+    with open(entry, "r+b") as f:
+        f.truncate(16)
+    CountingQ8("blk.5.ffn_down", None, None, orig_module, device="cpu").load(weight, device="cpu")
+    assert CountingQ8.packs == 6
+    assert RepackCache(cache_dir).load(RepackCache.digest([weight], **first.repack_params())) is not None
+    print("unreadable entry: packed again and replaced")
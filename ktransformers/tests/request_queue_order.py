@@ -0,0 +1,151 @@
+"""
+Description  : Check the scheduling order and the rejections of RequestQueue in front of a fake
+               backend that takes a fixed time per request. Concurrent arrivals must not overfill the
+               queue, and a streaming request whose queue deadline passes must get a 429 with
+               Retry-After instead of a broken stream.
+"""
+import os
+import sys
+import asyncio
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import httpx
+from fastapi import FastAPI, HTTPException
+from ktransformers.server.api.ollama.completions import router
+from ktransformers.server.utils.create_interface import GlobalInterface, GlobalRequestQueue
+from ktransformers.server.utils.request_queue import RequestQueue, Priority
+
+service_time = 0.05
+
+
+async def slow_backend(name: str, served: list):
+    """One request of the fake backend, it yields its name once its service time has passed."""
+    served.append(name)
+    await asyncio.sleep(service_time)
+    yield name
+
+
+async def consume(queue: RequestQueue, name: str, served: list, priority=Priority.normal, deadline=None):
+    return [event async for event in await queue.schedule(slow_backend(name, served), priority, deadline)]
+
+
+async def check_priority_order():
+    queue = RequestQueue(max_depth=16)
+    served = []
+    # the first request runs while the others wait in their lanes
+    tasks = [asyncio.create_task(consume(queue, "first", served))]
+    await asyncio.sleep(0)
+    for name, priority in (("low", Priority.low), ("normal_1", Priority.normal), ("high", Priority.high), ("normal_2", Priority.normal)):
+        tasks.append(asyncio.create_task(consume(queue, name, served, priority)))
+    await asyncio.gather(*tasks)
+    assert served == ["first", "high", "normal_1", "normal_2", "low"], served
+    assert abs(queue.avg_service_time - service_time) < service_time, queue.avg_service_time
+    print("priority order: ", served)
+
+
+async def check_full_queue():
+    queue = RequestQueue(max_depth=2)
+    served = []
+    tasks = [asyncio.create_task(consume(queue, f"request_{i}", served)) for i in range(3)]
+    await asyncio.sleep(0)
+    try:
+        await queue.schedule(slow_backend("rejected", served))
+        raise AssertionError("a full queue admitted a request")
+    except HTTPException as e:
+        assert e.status_code == 429 and int(e.headers["Retry-After"]) >= 1, e
+    await asyncio.gather(*tasks)
+    assert "rejected" not in served
+    print("full queue: rejected with 429")
+
+
+async def check_deadlines():
+    queue = RequestQueue(max_depth=16)
+    served = []
+    # measure the service time first
+    await consume(queue, "warm_up", served)
+    tasks = [asyncio.create_task(consume(queue, f"request_{i}", served)) for i in range(4)]
+    await asyncio.sleep(0)
+    # four requests ahead cannot be served within one service time
+    try:
+        await queue.schedule(slow_backend("too_late", served), deadline=service_time)
+        raise AssertionError("a request with an unreachable deadline was admitted")
+    except HTTPException as e:
+        assert e.status_code == 429, e
+    # admitted while the estimate is optimistic, then times out waiting
+    queue.avg_service_time = service_time / 100
+    start = time.monotonic()
+    try:
+        await consume(queue, "timed_out", served, deadline=service_time)
+        raise AssertionError("a request waited past its deadline")
+    except HTTPException as e:
+        assert e.status_code == 429 and time.monotonic() - start < 2 * service_time, e
+    await asyncio.gather(*tasks)
+    assert "too_late" not in served and "timed_out" not in served and queue.depth == 0, served
+    print("deadlines: rejected up front and after waiting")
+
+
+async def check_cancel():
+    queue = RequestQueue(max_depth=16)
+    served = []
+    running = asyncio.create_task(consume(queue, "running", served))
+    await asyncio.sleep(0)
+    waiting = asyncio.create_task(consume(queue, "cancelled", served))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.gather(running, waiting, return_exceptions=True)
+    assert served == ["running"] and queue.depth == 0 and not queue.running, served
+    print("cancel: waiting request left the queue")
+
+
+async def check_concurrent_admission():
+    queue = RequestQueue(max_depth=4)
+    served = []
+    running = asyncio.create_task(consume(queue, "running", served))
+    await asyncio.sleep(0)
+    # all arrive before any of them is served, only max_depth of them fit in the queue
+    results = await asyncio.gather(*[consume(queue, f"request_{i}", served) for i in range(10)], return_exceptions=True)
+    await running
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+    assert len(rejected) == 6 and all(e.status_code == 429 for e in rejected), results
+    assert len(served) == 5 and queue.depth == 0 and not queue.running, served
+    print("concurrent arrivals: ", len(served) - 1, "queued, ", len(rejected), "rejected")
+
+
+class StubInterface:
+    async def inference(self, local_messages, thread_id: str, temperature=None, top_p=None, tools=None, cancel_token=None):
+        await asyncio.sleep(service_time)
+        yield "token", "stop"
+
+
+async def check_streaming_deadline():
+    queue = RequestQueue(max_depth=16)
+    GlobalInterface.interface = StubInterface()
+    GlobalRequestQueue.request_queue = queue
+    app = FastAPI()
+    app.include_router(router)
+    served = []
+    # holds the only slot for longer than the deadline below
+    running = asyncio.create_task(consume(queue, "running", served))
+    await asyncio.sleep(0)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        body = {"model": "stub", "prompt": "hi", "stream": True}
+        response = await client.post(
+            "/api/generate", json=body, headers={RequestQueue.DEADLINE_HEADER: str(service_time / 5)}
+        )
+        assert response.status_code == 429 and int(response.headers["Retry-After"]) >= 1, response
+        await running
+        response = await client.post("/api/generate", json=body)
+        assert response.status_code == 200 and '"done":true' in response.text.strip().split("\n")[-1], response.text
+    assert queue.depth == 0 and not queue.running
+    print("streaming deadline: 429 with Retry-After before the stream started")
+
+
+asyncio.run(check_priority_order())
+asyncio.run(check_full_queue())
+asyncio.run(check_deadlines())
+asyncio.run(check_cancel())
+asyncio.run(check_concurrent_admission())
+asyncio.run(check_streaming_deadline())
@@ -0,0 +1,77 @@
+"""
+Description  : Generate past cache_lens with a tiny llama on cpu in attention sink window mode and check the
+               eviction bookkeeping after every decode step: generated_ids keeps the sink tokens followed by the
+               latest tokens of the whole stream, seq_length and the cache agree, and every evicted token is
+               counted. Also checks that two interfaces do not share their rope shift tables.
+"""
+import os
+import sys
+import tempfile
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.server.backend.interfaces.transformers import TransformersInterface
+from tiny_model import save_tiny_llama, tiny_args, TinyInterface
+
+sink_tokens = 4
+cache_lens = 64
+kv_window_evict = 16
+max_new_tokens = 100
+
+
+class CheckedInterface(TinyInterface):
+    """Records every token of the stream and checks the bookkeeping after each of them."""
+
+    def __init__(self, args):
+        super().__init__(args, sink_tokens=sink_tokens)
+        self.stream = []
+
+    def logits_to_token(self, logits):
+        # run to max_new_tokens
+        logits[self.tokenizer.eos_token_id] = float("-inf")
+        return super().logits_to_token(logits)
+
+    def append_new_tokens(self, new_tokens):
+        text = super().append_new_tokens(new_tokens)
+        self.stream.append(int(new_tokens))
+        self.check()
+        return text
+
+    def check(self):
+        stream = self.prompt + self.stream
+        kept = self.generated_ids[0, : self.seq_length].tolist()
+        assert self.seq_length <= cache_lens
+        assert kept[:sink_tokens] == stream[:sink_tokens]
+        assert kept[sink_tokens:] == stream[len(stream) - (self.seq_length - sink_tokens):]
+        # the kv of the last token is written by the next decode step
+        assert self.cache.past_tokens[0] == self.seq_length - 1
+        assert self.cache.evicted_tokens == len(stream) - self.seq_length
+        # whole steps of kv_window_evict tokens at a time
+        assert self.cache.evicted_tokens % kv_window_evict == 0
+
+
+with tempfile.TemporaryDirectory() as model_dir:
+    save_tiny_llama(model_dir)
+    args = tiny_args(
+        model_dir, cache_lens=cache_lens, max_new_tokens=max_new_tokens, kv_window_evict=kv_window_evict
+    )
+    interface = CheckedInterface(args)
+    interface.model.generation_config.top_k = 1
+    input_ids = interface.tokenize_prompt("A prompt that fills half of the window.")
+    interface.prompt = input_ids.flatten().tolist()
+    assert len(interface.prompt) < cache_lens
+    with torch.no_grad():
+        for _ in interface.prefill(input_ids, True):
+            pass
+        for _ in interface.generate():
+            pass
+    total = len(interface.prompt) + len(interface.stream)
+    assert total > 2 * cache_lens and interface.cache.evicted_tokens > 0
+    print("tokens: ", total, "evicted: ", interface.cache.evicted_tokens, "kept: ", interface.seq_length)
+
+    # the rope shifts depend on the rotary embedding of each model, they are not shared between interfaces
+    other = CheckedInterface(args)
+    assert list(interface.rope_shifts) == [kv_window_evict] and other.rope_shifts == {}
+    assert "rope_shifts" not in vars(TransformersInterface)
+    print("rope shifts: per interface")
@@ -0,0 +1,139 @@
+"""
+Description  : Check StagingBufferPool on cpu tensors: slots are handed out round robin, grow geometrically up
+               to max_rows and are reused without new allocations, and a slot waits for the event of its last
+               copy before it is handed out again. Then run swap_in_and_swap_out of
+               DynamicScaledDotProductAttention for several layers over a prefill and decode steps, with a
+               python kvcache in place of the cpu kvcache, and check that every layer gets its own history
+               back although the layers share two staging slots.
+"""
+import os
+import sys
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from ktransformers.operators.dynamic_attention import DynamicScaledDotProductAttention, StagingBufferPool
+
+
+class RecordingEvent:
+    def __init__(self):
+        self.synchronized = False
+
+    def synchronize(self):
+        self.synchronized = True
+
+
+def check_pool():
+    pool = StagingBufferPool((2, 4), torch.float16, num_slots=2, max_rows=100)
+    slot, k, v = pool.acquire(10)
+    assert slot == 0 and k.shape == (10, 2, 4) and v.shape == (10, 2, 4) and pool.allocations == 1
+    k_ptr = k.data_ptr()
+    pool.release(slot)
+    slot, k, _ = pool.acquire(10)
+    assert slot == 1 and pool.allocations == 2
+    pool.release(slot)
+
+    # the same rows again and fewer are views of the buffers already there
+    for rows in (10, 3, 10):
+        slot, k, _ = pool.acquire(rows)
+        assert k.shape[0] == rows and pool.allocations == 2
+        if slot == 0:
+            assert k.data_ptr() == k_ptr
+        pool.release(slot)
+
+    # a slot grows to twice its size, so growing by one row at a time allocates rarely
+    allocations = pool.allocations
+    for rows in range(11, 41):
+        slot, _, _ = pool.acquire(rows)
+        pool.release(slot)
+    assert pool.allocations - allocations == 4, pool.allocations
+    assert [s[0].shape[0] for s in pool.slots] == [40, 40]
+
+    # capped by max_rows, unless a single request needs more
+    for rows in (41, 41, 81):
+        slot, k, _ = pool.acquire(rows)
+        pool.release(slot)
+    assert pool.slots[slot][0].shape[0] == 100
+    slot, k, _ = pool.acquire(120)
+    assert pool.slots[slot][0].shape[0] == 120
+    pool.release(slot)
+
+    # a slot is handed out again only after the event of its last copy
+    event = RecordingEvent()
+    slot, _, _ = pool.acquire(1)
+    pool.release(slot, event)
+    other, _, _ = pool.acquire(1)
+    pool.release(other)
+    assert not event.synchronized
+    again, _, _ = pool.acquire(1)
+    assert again == slot and event.synchronized and pool.slots[slot][2] is None
+    pool.release(again)
+    print("pool: allocations: ", pool.allocations, "reuse and events ok")
+
+
+class PythonKVCache:
+    """get_and_update_kvcache_fp16 of the cpu kvcache: stores the new rows of a layer, fills in the past ones."""
+
+    def __init__(self):
+        self.layers = {}
+
+    def get_and_update_kvcache_fp16(self, k_cache_cpu, v_cache_cpu, layer_idx, block_table, max_block_num, past_len, q_len):
+        def task():
+            for batch_idx in range(k_cache_cpu.shape[0]):
+                offset = past_len[batch_idx].item()
+                k, v = self.layers.get(layer_idx, (k_cache_cpu[batch_idx][:0].clone(), v_cache_cpu[batch_idx][:0].clone()))
+                assert k.shape[0] == offset
+                k_cache_cpu[batch_idx][:offset].copy_(k)
+                v_cache_cpu[batch_idx][:offset].copy_(v)
+                self.layers[layer_idx] = (
+                    torch.cat([k, k_cache_cpu[batch_idx][offset : offset + q_len]]),
+                    torch.cat([v, v_cache_cpu[batch_idx][offset : offset + q_len]]),
+                )
+
+        return task
+
+
+class InlineCPUInfer:
+    def __init__(self):
+        self.tasks = []
+
+    def submit(self, task):
+        self.tasks.append(task)
+
+    def sync(self):
+        for task in self.tasks:
+            task()
+        self.tasks = []
+
+
+def check_swap(layer_num=3, block_size=8, block_num=16, kv_head_num=2, head_dim=4):
+    # the constructor pins host memory, which needs cuda, so only what swap_in_and_swap_out uses is set up
+    attention = DynamicScaledDotProductAttention.__new__(DynamicScaledDotProductAttention)
+    attention.block_size, attention.kv_head_num, attention.head_dim = block_size, kv_head_num, head_dim
+    attention.cache_key_states = torch.zeros((block_num, block_size, kv_head_num, head_dim), dtype=torch.float16)
+    attention.cache_value_states = torch.zeros_like(attention.cache_key_states)
+    attention.prefix_block_table = torch.arange(block_num, dtype=torch.int32).view(1, -1)
+    attention.staging_buffers = StagingBufferPool((kv_head_num, head_dim), torch.float16, max_rows=block_num * block_size)
+    attention.local_thread = PythonKVCache()
+    attention.cpu_infer = InlineCPUInfer()
+
+    history = {layer_idx: ([], []) for layer_idx in range(layer_num)}
+    past_len = 0
+    for q_len in [13] + [1] * 30:
+        for layer_idx in range(layer_num):
+            key = torch.randn(1, q_len, kv_head_num, head_dim).half()
+            value = torch.randn(1, q_len, kv_head_num, head_dim).half()
+            history[layer_idx][0].append(key[0])
+            history[layer_idx][1].append(value[0])
+            k_cache, v_cache = attention.swap_in_and_swap_out(layer_idx, torch.tensor([past_len]), q_len, key, value)
+            length = past_len + q_len
+            assert torch.equal(k_cache[0, :length], torch.cat(history[layer_idx][0]))
+            assert torch.equal(v_cache[0, :length], torch.cat(history[layer_idx][1]))
+        past_len += q_len
+    # two slots shared by all layers, grown a few times as the window passes block boundaries
+    assert attention.staging_buffers.allocations <= 6, attention.staging_buffers.allocations
+    print("swap: layers: ", layer_num, "tokens: ", past_len, "allocations: ", attention.staging_buffers.allocations)
+
+
+check_pool()
+check_swap()
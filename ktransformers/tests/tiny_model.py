@@ -0,0 +1,71 @@
+"""
+Description  : A randomly initialized two layer llama with a character level tokenizer, saved to a
+               directory, and a TransformersInterface over it that runs on cpu. Used by the server
+               test scripts next to this file.
+"""
+import os
+import sys
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast, LlamaConfig, LlamaForCausalLM
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.server.backend.args import ConfigArgs
+from ktransformers.server.backend.interfaces.transformers import TransformersInterface, TextStreamer
+
+
+def save_tiny_llama(model_dir: str, seed: int = 0):
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+    for c in [chr(i) for i in range(32, 127)] + ["\n"]:
+        vocab[c] = len(vocab)
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>", bos_token="<s>", eos_token="</s>")
+    tokenizer.chat_template = "{% for m in messages %}{{ m['role'] }}: {{ m['content'] }}\n{% endfor %}assistant:"
+    tokenizer.save_pretrained(model_dir)
+    config = LlamaConfig(
+        vocab_size=len(vocab),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=1024,
+        bos_token_id=1,
+        eos_token_id=2,
+    )
+    torch.manual_seed(seed)
+    LlamaForCausalLM(config).save_pretrained(model_dir)
+
+
+def tiny_args(model_dir: str, **kwargs) -> ConfigArgs:
+    args = dict(model_name="tiny", model_dir=model_dir, device="cpu", cache_lens=256, batch_size=1, max_new_tokens=8)
+    args.update(kwargs)
+    return ConfigArgs(**args)
+
+
+class TinyInterface(TransformersInterface):
+    """TransformersInterface with the ktransformers StaticCache, which keeps prefixes across requests."""
+
+    def __init__(self, args: ConfigArgs, kv_quant=None, sink_tokens=None):
+        self.args = args
+        self.tokenizer = PreTrainedTokenizerFast.from_pretrained(args.model_dir)
+        self.model = LlamaForCausalLM.from_pretrained(args.model_dir)
+        self.model.generation_config.temperature = 1.0
+        self.model.generation_config.top_p = 1.0
+        self.cache = StaticCache(
+            config=self.model.config,
+            max_batch_size=args.batch_size,
+            max_cache_len=args.cache_lens,
+            device=args.device,
+            dtype=self.model.dtype,
+            kv_quant=kv_quant,
+            sink_tokens=sink_tokens,
+        )
+        self.streamer = TextStreamer(self.tokenizer)
+        self.rope_shifts = {}
+        self.init_prefix_snapshots()
+        self.init_kv_offload()
@@ -0,0 +1,120 @@
+"""
+Description  : Disconnect a client while a fake backend streams a tool call through
+               TransformersInterface.inference and measure how long decoding goes on after it.
+               The tool call text is buffered, nothing reaches the client until it completes.
+"""
+import os
+import sys
+import asyncio
+import time
+
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/../..")
+import torch
+from fastapi import FastAPI
+from fastapi.requests import Request
+from ktransformers.server.backend.interfaces.transformers import TransformersInterface
+from ktransformers.server.schemas.assistants.streaming import check_link_response, CancellationToken
+
+step_time = 0.005
+max_steps = 400
+disconnect_after = 0.1
+
+
+class FakeStreamer:
+    def reset(self):
+        pass
+
+    def end(self):
+        return ""
+
+
+class FakeToolInterface(TransformersInterface):
+    """Decodes an endless tool call, one blocking step_time sleep per token like a real decode step."""
+
+    def __init__(self):
+        self.streamer = FakeStreamer()
+        self.steps = 0
+        self.stopped_at = None
+
+    def tokenize_prompt(self, prompt: str):
+        return torch.zeros((1, 4), dtype=torch.long)
+
+    def prefill(self, input_ids, is_new, temperature=None, top_p=None):
+        yield None
+
+    def generate(self, cancel_token=None):
+        # stopped by the cancel token, or closed when the response task is cancelled
+        try:
+            yield '{"name": "get_weather", "arguments": {"city": "', None
+            for _ in range(max_steps):
+                if cancel_token is not None and cancel_token.cancelled:
+                    yield "", "cancelled"
+                    return
+                time.sleep(step_time)
+                self.steps += 1
+                yield "a", None
+            yield "", "length"
+        finally:
+            self.stopped_at = time.perf_counter()
+
+
+interface = FakeToolInterface()
+app = FastAPI()
+
+
+@app.post("/chat")
+async def chat(request: Request):
+    cancel_token = CancellationToken()
+
+    async def inner():
+        async for res in interface.inference("hello", "thread", tools=[{"type": "function"}], cancel_token=cancel_token):
+            if isinstance(res, tuple):
+                yield res[0]
+
+    return check_link_response(request, inner(), cancel_token)
+
+
+async def disconnecting_client():
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/chat",
+        "raw_path": b"/chat",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"test"), (b"content-length", b"0")],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    start = time.perf_counter()
+    body_sent = False
+    body = []
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await asyncio.sleep(max(0, start + disconnect_after - time.perf_counter()))
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            body.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return start, b"".join(body)
+
+
+start, body = asyncio.run(disconnecting_client())
+disconnected_at = start + disconnect_after
+latency = interface.stopped_at - disconnected_at
+print("decode steps: ", interface.steps, "of", max_steps)
+print("steps before disconnect: ", int(disconnect_after / step_time))
+print("stop latency(ms): ", latency * 1000)
+print("streamed bytes: ", len(body))
+assert interface.steps < max_steps // 2 and latency < 10 * step_time, (interface.steps, latency)
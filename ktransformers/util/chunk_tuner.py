@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Online tuning of the prefill chunk size from measured prefill latency
+'''
+import atexit
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+from ktransformers.server.config.log import logger
+
+
+def hardware_profile(cuda_devices: List[str]) -> str:
+    """Names the cuda devices in use and the cpu count, so measurements are not shared across machines."""
+    names = [torch.cuda.get_device_name(device) for device in sorted(cuda_devices)] if torch.cuda.is_available() else []
+    return ",".join(names + [f"{os.cpu_count()} cpus"])
+
+
+class ChunkSizeTuner:
+    '''
+    Picks chunk_prefill_size per prompt length from measured prefill time.
+
+    Prompt lengths are bucketed by powers of two, bucket b holds lengths in (2 ** (b - 1), 2 ** b].
+    The candidates of a bucket are the powers of two from min_chunk_size up to max_chunk_size, and
+    at most one of them covers the whole bucket in a single chunk. Each candidate is tried `trials`
+    times, largest first, then the one with the lowest mean seconds per token is used. Costs are
+    not assumed to be unimodal in the chunk size, a too large chunk can fall off a memory cliff.
+
+    Measurements are kept under `profile`, which should name the model and the hardware, in the
+    json file at `path`, so tuning survives restarts and is redone when either changes. The file is
+    written when a candidate has had its trials, since that can change the choice, and otherwise at
+    most every `save_interval` seconds and at exit.
+
+    The caller must prefill with the size `choose` returns, a smaller cap on the chunk size belongs
+    in max_chunk_size.
+    '''
+
+    def __init__(
+        self,
+        path: Optional[str],
+        profile: str,
+        max_chunk_size: int,
+        min_chunk_size: int = 256,
+        trials: int = 2,
+        save_interval: float = 60.0,
+    ):
+        self.path = None if path is None else os.path.expanduser(path)
+        self.profile = profile
+        self.max_chunk_size = max_chunk_size
+        self.min_chunk_size = min(min_chunk_size, max_chunk_size)
+        self.trials = trials
+        self.save_interval = save_interval
+        self.last_save = time.monotonic()
+        self.dirty = False
+        # bucket -> chunk size -> [samples, sum of seconds per token]
+        self.stats: Dict[str, Dict[str, List[float]]] = {}
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.stats = json.load(f).get(profile, {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"ignoring unreadable chunk size tuning file {self.path}: {e}")
+        if self.path is not None:
+            atexit.register(self.flush)
+
+    @staticmethod
+    def bucket(prompt_len: int) -> int:
+        return max(prompt_len - 1, 0).bit_length()
+
+    def candidates(self, prompt_len: int) -> List[int]:
+        bucket_end = 1 << self.bucket(prompt_len)
+        sizes = []
+        size = self.min_chunk_size
+        while size <= self.max_chunk_size:
+            sizes.append(size)
+            if size >= bucket_end:
+                # larger chunks prefill the bucket the same way
+                break
+            size *= 2
+        return sizes
+
+    def best(self, prompt_len: int) -> Optional[int]:
+        """The fastest chunk size measured for prompt_len, None before any measurement."""
+        measured = self.stats.get(str(self.bucket(prompt_len)), {})
+        timings = {
+            size: measured[str(size)][1] / measured[str(size)][0]
+            for size in self.candidates(prompt_len)
+            if str(size) in measured
+        }
+        if not timings:
+            return None
+        return min(timings, key=timings.get)
+
+    def choose(self, prompt_len: int) -> int:
+        measured = self.stats.get(str(self.bucket(prompt_len)), {})
+        for size in reversed(self.candidates(prompt_len)):
+            if measured.get(str(size), [0, 0.0])[0] < self.trials:
+                return size
+        return self.best(prompt_len)
+
+    def record(self, prompt_len: int, chunk_size: int, seconds: float):
+        """Add the time it took to prefill prompt_len tokens in chunks of chunk_size."""
+        if prompt_len <= 0:
+            return
+        measured = self.stats.setdefault(str(self.bucket(prompt_len)), {})
+        entry = measured.setdefault(str(chunk_size), [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds / prompt_len
+        self.dirty = True
+        if entry[0] == self.trials or time.monotonic() - self.last_save >= self.save_interval:
+            self.save()
+
+    def flush(self):
+        """Save measurements not written yet."""
+        if self.dirty:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        self.last_save = time.monotonic()
+        self.dirty = False
+        try:
+            data = {}
+            if os.path.exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            data[self.profile] = self.stats
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"failed to save chunk size tuning to {self.path}: {e}")
@@ -25,6 +25,10 @@ class CUDAGraphRunner:
         **kwargs,
     ) -> None:
         assert self.graph is None
+        gguf_loader = getattr(model, "gguf_loader", None)
+        if gguf_loader is not None and gguf_loader.lazy_loader is not None:
+            # no other thread may use the device while the graph is captured
+            gguf_loader.lazy_loader.wait()
         # Capture the graph.
         torch.cuda.synchronize()
         self.graph = torch.cuda.CUDAGraph()
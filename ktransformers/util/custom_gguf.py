@@ -187,6 +187,12 @@ class GGUFLoader:
         self.file_data_map = {}
         self.gguf_file_meta = {}
         self.tensor_device_map = {}
+        # set by optimize_and_load_gguf when layers are loaded on first use
+        self.lazy_loader = None
+        # set by optimize_and_load_gguf when the files are prefaulted into the page cache
+        self.page_cache_warmer = None
+        # file -> byte ranges copied out while loading, not read from the file afterwards
+        self.copied_ranges = {}
 
         # I know this is ugly, but I don't want to change the original code too much
         # TODO: merge gguf load and other loads.
@@ -208,6 +214,16 @@ class GGUFLoader:
         if not found_gguf:
             raise FileNotFoundError(f"Cannot find any .gguf files in: {gguf_path}")
                             
+    def mark_copied(self, arrays):
+        """Records the parts of the files that arrays view as copied out, see PageCacheWarmer."""
+        for array in arrays:
+            address = array.ctypes.data
+            for file_name, data in self.file_data_map.items():
+                offset = address - data.ctypes.data
+                if 0 <= offset < data.nbytes:
+                    self.copied_ranges.setdefault(file_name, []).append((offset, offset + array.nbytes))
+                    break
+
     def load_gguf(self, f):
         f.seek(0)
         assert f.read(4) == b'GGUF'
@@ -864,74 +880,105 @@ GGML_DEQUANTIZE_GPU = {
 }
 
 
-def translate_name_to_gguf_mixtral(name):
-    
-    replacement_template = {
-        "w1.weight": "ffn_gate",
-        "w2.weight": "ffn_down",
-        "w3.weight": "ffn_up"
-    }  
+MIXTRAL_EXPERT_PATTERN = re.compile(r"model.layers\.(\d+)\.block_sparse_moe\.experts\.(\d+)\.(w\d\.weight)")
+MIXTRAL_EXPERT_WEIGHTS = {
+    "w1.weight": "ffn_gate",
+    "w2.weight": "ffn_down",
+    "w3.weight": "ffn_up"
+}
 
-    pattern = re.compile(r"model.layers\.(\d+)\.block_sparse_moe\.experts\.(\d+)\.(w\d\.weight)")
+def translate_name_to_gguf_mixtral(name):
 
     def replace_match(match):
         blk_id = match.group(1)
         expert_id = match.group(2)
         weight_type = match.group(3)
-        if weight_type in replacement_template:
-            return f"blk.{blk_id}.{replacement_template[weight_type]}.{expert_id}.weight"
+        if weight_type in MIXTRAL_EXPERT_WEIGHTS:
+            return f"blk.{blk_id}.{MIXTRAL_EXPERT_WEIGHTS[weight_type]}.{expert_id}.weight"
         else:
             return match.group(0)
 
-    new_name = re.sub(pattern, replace_match, name)
-    
-    return new_name
-
-def translate_name_to_gguf(name):
-
-    name = translate_name_to_gguf_mixtral(name)
+    return MIXTRAL_EXPERT_PATTERN.sub(replace_match, name)
+
+# Renames from module names to GGUF names, applied stage by stage. A stage replaces all its
+# fragments in one pass and sees the output of the stages before it, so a rename that has to
+# see the result of another one goes to a later stage, e.g. qwen2 moe .shared_expert.down_proj,
+# and so does one that a replacement could make appear or disappear.
+GGUF_NAME_STAGES = [
+    {
+        "lm_head.": "output.",
+        "model.embed_tokens.": "token_embd.",
+        "model.norm.": "output_norm.",
+        "model.layers.": "blk.",
+        ".input_layernorm": ".attn_norm",
+        ".mlp.down_proj": ".ffn_down",
+        ".mlp.gate_proj": ".ffn_gate",
+        ".mlp.up_proj": ".ffn_up",
+        ".post_attention_layernorm": ".ffn_norm",
+        ".self_attn.q_proj": ".attn_q",
+        ".self_attn.k_proj": ".attn_k",
+        ".self_attn.v_proj": ".attn_v",
+        ".self_attn.o_proj": ".attn_output",
+        ".self_attn.qkv_proj": ".attn_qkv",
+        ".self_attn.kv_a_proj_with_mqa": ".attn_kv_a_mqa",
+        ".self_attn.kv_a_layernorm": ".attn_kv_a_norm",
+        ".self_attn.kv_b_proj": ".attn_kv_b",
+        ".self_attn.q_a_proj": ".attn_q_a",
+        ".self_attn.q_a_layernorm": ".attn_q_a_norm",
+        ".self_attn.q_b_proj": ".attn_q_b",
+    },
+    {
+        ".shared_expert.": ".shared_experts.",
+        ".shared_expert_": ".shared_experts_",
+    },
+    {
+        ".gate_up_proj.": ".up_proj",
+    },
+    {
+        ".mlp.shared_experts.down_proj": ".ffn_down_shexp",
+        ".mlp.gate": ".ffn_gate_inp",
+        ".mlp.shared_experts.gate_proj": ".ffn_gate_shexp",
+        ".mlp.shared_experts.up_proj": ".ffn_up_shexp",
+        ".mlp.shared_experts_gate": ".ffn_gate_inp_shexp",
+        ".mlp.experts": "",
+    },
+    {
+        ".block_sparse_moe.gate.": ".ffn_gate_inp.",
+        ".block_sparse_moe.experts": "",
+    },
+]
+
+def _compile_stage(renames: dict):
+    # Matches the fragments as the chain of str.replace calls they stand for would. A trailing
+    # dot that is kept is only looked at, as the next fragment may start with it, unless the
+    # fragment follows right after, which str.replace skips as it starts inside the match.
+    table = {}
+    fragments = []
+    for old, new in renames.items():
+        if old.endswith(".") and new.endswith("."):
+            body = old[:-1]
+            table[body], table[old] = new[:-1], new
+            repeat = re.escape(old[1:]) if old.startswith(".") else "(?!)"
+            fragments.append((old, f"{re.escape(body)}(?:\\.(?={repeat})|(?=\\.))"))
+        else:
+            table[old] = new
+            fragments.append((old, re.escape(old)))
+    # longest first, so a fragment wins over any fragment it starts with
+    fragments.sort(key=lambda fragment: len(fragment[0]), reverse=True)
+    pattern = re.compile("|".join(regex for _, regex in fragments))
+    return lambda name: pattern.sub(lambda match: table[match.group(0)], name)
 
-    name = name.replace("lm_head.", "output.")
-    name = name.replace("model.embed_tokens.", "token_embd.")
-    name = name.replace("model.norm.", "output_norm.")
-    
-    name = name.replace("model.layers.", "blk.")
-    name = name.replace(".input_layernorm", ".attn_norm")
-    name = name.replace(".mlp.down_proj", ".ffn_down")
-    name = name.replace(".mlp.gate_proj", ".ffn_gate")
-    name = name.replace(".mlp.up_proj", ".ffn_up")
-    name = name.replace(".post_attention_layernorm", ".ffn_norm")
-    name = name.replace(".self_attn.q_proj", ".attn_q")
-    name = name.replace(".self_attn.k_proj", ".attn_k")
-    name = name.replace(".self_attn.v_proj", ".attn_v")
-    name = name.replace(".self_attn.o_proj", ".attn_output")
-    name = name.replace(".self_attn.qkv_proj", ".attn_qkv")
-    name = name.replace(".self_attn.kv_a_proj_with_mqa", ".attn_kv_a_mqa")
-    name = name.replace(".self_attn.kv_a_layernorm", ".attn_kv_a_norm")
-    name = name.replace(".self_attn.kv_b_proj", ".attn_kv_b")
-    name = name.replace(".self_attn.q_a_proj", ".attn_q_a")
-    name = name.replace(".self_attn.q_a_layernorm", ".attn_q_a_norm")
-    name = name.replace(".self_attn.q_b_proj", ".attn_q_b")
-    
-    name = name.replace(".shared_expert.", ".shared_experts.")
-    name = name.replace(".shared_expert_", ".shared_experts_")
-    name = name.replace(".gate_up_proj.", ".up_proj")
-    
-    name = name.replace(".mlp.shared_experts.down_proj", ".ffn_down_shexp")
-    name = name.replace(".mlp.gate", ".ffn_gate_inp")
-    name = name.replace(".mlp.shared_experts.gate_proj", ".ffn_gate_shexp")
-    name = name.replace(".mlp.shared_experts.up_proj", ".ffn_up_shexp")
-    name = name.replace(".mlp.shared_experts_gate", ".ffn_gate_inp_shexp")
-    name = name.replace(".mlp.experts", "")
-    name = name.replace(".mlp.experts.ffn_down_exps", ".ffn_down_exps")
-    name = name.replace(".mlp.experts.ffn_gate_exps", ".ffn_gate_exps")
-    name = name.replace(".mlp.experts.ffn_up_exps", ".ffn_up_exps")
+_gguf_name_stages = [translate_name_to_gguf_mixtral] + [_compile_stage(renames) for renames in GGUF_NAME_STAGES]
+_gguf_names: dict[str, str] = {}
 
-    
-    name = name.replace(".block_sparse_moe.gate.", ".ffn_gate_inp.")
-    name = name.replace(".block_sparse_moe.experts", "")
-    
-    return name
+def translate_name_to_gguf(name):
+    gguf_name = _gguf_names.get(name)
+    if gguf_name is None:
+        gguf_name = name
+        for stage in _gguf_name_stages:
+            gguf_name = stage(gguf_name)
+        _gguf_names[name] = gguf_name
+    return gguf_name
 
 if __name__ == '__main__':
     gguf_path = '/mnt/data/model/DeepSeek-Coder-V2-GGUF-WJH'
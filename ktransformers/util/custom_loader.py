@@ -5,21 +5,50 @@ import re
 import numpy.typing as npt
 from typing import Sequence
 import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
 import torch
 import KTransformersOps
 from safetensors import safe_open
 from ktransformers.ktransformers_ext.triton.fp8gemm import fp8_gemm, act_quant, weight_dequant
 from safetensors.torch import save_file
+from ktransformers.util.weight_cache import RepackCache
 
 class SafeTensorLoader:
-    tensor_file_map = {}
-    tensor_type_map = {}
-    file_handle_map = {}
-    
-    def __init__(self, file_path: str):
+    '''
+    Index of the tensors in the .safetensors shards under a path.
+
+    Only the json header of each shard is read when the loader is built. A shard is memory
+    mapped the first time one of its tensors is loaded, once per thread, so the loads of
+    different threads never share a handle. load_tensors reads a batch of tensors, for
+    example all of one layer, with num_workers threads across the shards.
+
+    fp8 weights with a weight_scale_inv are dequantized by load_dequantized_tensor, on the
+    cpu as well as on a gpu. With dequant_cache_dir the weights dequantized for the cpu are
+    kept there and later loads memory map them, a gpu dequantizes faster than it reads them.
+    '''
+
+    def __init__(self, file_path: str, num_workers: int = None, dequant_cache_dir: str = None):
+        self.tensor_file_map = {}  # {tensor_name: file_name}
+        self.file_path_map = {}  # {file_name: file_path}
+        self.num_workers = num_workers or min(8, os.cpu_count() or 1)
+        self.dequant_cache = None if dequant_cache_dir is None else RepackCache(dequant_cache_dir)
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+        self._executor = None
         self.__load_tensor_file_map(file_path)
 
+    @staticmethod
+    def read_keys(file_path: str):
+        """The tensor names of a safetensors file, from its header alone."""
+        with open(file_path, "rb") as f:
+            header_size = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_size))
+        return [key for key in header if key != "__metadata__"]
+
     def __load_tensor_file_map(self, file_path: str):
         # 处理传入路径，确保是文件夹路径
         if not os.path.exists(file_path):
@@ -29,58 +58,83 @@ class SafeTensorLoader:
         else:
             folder_path = file_path
 
-        found_safetensor = False
         for root, _, files in os.walk(folder_path):
             files = sorted(files)
             for file in files:
                 if file.endswith(".safetensors"):
-                    found_safetensor = True
                     file_path = os.path.join(root, file)
-                    if file not in self.file_handle_map:
-                        try:
-                            handle = safe_open(file_path, framework="pt")
-                            self.file_handle_map[file] = handle
-                        except Exception as e:
-                            print(f"Error opening Safetensor file {file_path}: {e}")
-                            continue
-
-                    f = self.file_handle_map.get(file)
-                    if f is None:
-                        continue
                     try:
-                        for key in f.keys():
-                            self.tensor_file_map[key] = file
+                        keys = self.read_keys(file_path)
                     except Exception as e:
                         print(f"Error reading Safetensor file {file_path}: {e}")
+                        continue
+                    self.file_path_map[file] = file_path
+                    for key in keys:
+                        self.tensor_file_map[key] = file
 
-        # if not found_safetensor:
-        #     raise FileNotFoundError(f"No Safetensor files found in {folder_path}")
-
-    def load_tensor(self, key: str, device: str="cpu"):
+    def get_handle(self, key: str):
         if key not in self.tensor_file_map:
             raise KeyError(f"Key {key} not found in Safetensor files")
         file = self.tensor_file_map[key]
-        f = self.file_handle_map.get(file)
+        handles = getattr(self._local, "handles", None)
+        if handles is None:
+            handles = self._local.handles = {}
+            with self._lock:
+                self._handles.append(handles)
+        f = handles.get(file)
         if f is None:
-            raise FileNotFoundError(f"File {file} not found in Safetensor files")
-        tensor = f.get_tensor(key)
-        return tensor.to(device)
+            try:
+                f = handles[file] = safe_open(self.file_path_map[file], framework="pt")
+            except Exception as e:
+                raise FileNotFoundError(f"File {file} can't be opened: {e}")
+        return f
 
-    def close_all_handles(self):
-        for handle in self.file_handle_map.values():
-            handle.close()
-        self.file_handle_map.clear()
+    def load_tensor(self, key: str, device: str="cpu"):
+        tensor = self.get_handle(key).get_tensor(key)
+        return tensor.to(device)
 
     def load_dequantized_tensor(self, key:str, device: str="cpu"):
-        if key not in self.tensor_file_map:
-            raise KeyError(f"Key {key} not found in Safetensor files")
-        file = self.tensor_file_map[key]
-        f = self.file_handle_map.get(file)
-        if f is None:
-            raise FileNotFoundError(f"File {file} not found in Safetensor files")
-        tensor = f.get_tensor(key).to(device)
-        if key.endswith(".weight"):
-            if key[:-7] + ".weight_scale_inv" in self.tensor_file_map:
-                weight_scale_inv = f.get_tensor(key[:-7] + ".weight_scale_inv").to(device)
-                tensor = weight_dequant(tensor, weight_scale_inv)
-        return tensor.to(device)
\ No newline at end of file
+        if not (key.endswith(".weight") and key[:-7] + ".weight_scale_inv" in self.tensor_file_map):
+            return self.load_tensor(key, device)
+        digest = None
+        if self.dequant_cache is not None and torch.device(device).type == "cpu":
+            # the shard is not read to key the cache, it is named by its path, size and mtime
+            file_path = os.path.realpath(self.file_path_map[self.tensor_file_map[key]])
+            stat = os.stat(file_path)
+            digest = self.dequant_cache.digest(
+                (), kind="fp8_dequant", key=key, file=file_path, size=stat.st_size, mtime=stat.st_mtime_ns,
+                dtype=str(torch.get_default_dtype()),
+            )
+            cached = self.dequant_cache.load(digest)
+            if cached is not None:
+                return cached["weight"].to(device)
+        tensor = self.load_tensor(key, device)
+        weight_scale_inv = self.load_tensor(key[:-7] + ".weight_scale_inv", device)
+        tensor = weight_dequant(tensor, weight_scale_inv)
+        if digest is not None:
+            self.dequant_cache.save(digest, {"weight": tensor})
+        return tensor.to(device)
+
+    def load_tensors(self, keys: Sequence[str], device: str="cpu", dequantize: bool=False):
+        """{key: tensor} for all keys, read concurrently, fp8 weights dequantized if dequantize."""
+        load = self.load_dequantized_tensor if dequantize else self.load_tensor
+        for key in keys:
+            if key not in self.tensor_file_map:
+                raise KeyError(f"Key {key} not found in Safetensor files")
+        if len(keys) <= 1 or self.num_workers <= 1:
+            return {key: load(key, device) for key in keys}
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.num_workers, thread_name_prefix="safetensor_reader")
+        futures = [self._executor.submit(load, key, device) for key in keys]
+        return {key: future.result() for key, future in zip(keys, futures)}
+
+    def close_all_handles(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            for handles in self._handles:
+                handles.clear()
+            self._handles.clear()
+        self._local = threading.local()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Huge page and locked memory backing of read only weights
+'''
+import ctypes
+import ctypes.util
+import mmap
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ktransformers.server.config.log import logger
+
+PAGE_BACKINGS = ("thp", "hugetlb")
+# not exported by the mmap module before python 3.13
+MAP_HUGETLB = getattr(mmap, "MAP_HUGETLB", 0x40000)
+
+
+def huge_page_size() -> int:
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("Hugepagesize:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 2 * 1024 * 1024
+
+
+def smaps_usage(start: int, end: int) -> Dict[str, int]:
+    """Bytes of the mappings overlapping [start, end) per /proc/self/smaps field, such as AnonHugePages and Locked."""
+    usage: Dict[str, int] = {}
+    try:
+        with open("/proc/self/smaps", "r") as f:
+            inside = False
+            for line in f:
+                fields = line.split()
+                if "-" in fields[0] and not fields[0].endswith(":"):
+                    low, high = (int(address, 16) for address in fields[0].split("-"))
+                    inside = low < end and high > start
+                elif inside and len(fields) == 3 and fields[2] == "kB":
+                    usage[fields[0][:-1]] = usage.get(fields[0][:-1], 0) + int(fields[1]) * 1024
+    except OSError:
+        pass
+    return usage
+
+
+class BackedWeights:
+    '''
+    Copies arrays into one anonymous mapping backed by huge pages, so that weights read from
+    np.memmap pages of the model files are served from few TLB entries and are not evicted
+    with the page cache.
+
+    backing "hugetlb" takes pages from the hugetlbfs pool, see /proc/sys/vm/nr_hugepages, and
+    falls back to "thp" when the pool is too small. "thp" asks for transparent huge pages with
+    madvise, the kernel backs what it can. With lock the mapping is mlocked, which needs a large
+    enough RLIMIT_MEMLOCK or CAP_IPC_LOCK. Failures are logged and the weights stay usable, the
+    backing actually obtained is in report().
+    '''
+
+    def __init__(self, arrays: List[np.ndarray], backing: Optional[str] = "thp", lock: bool = False):
+        if backing is not None and backing not in PAGE_BACKINGS:
+            raise ValueError(f"page backing must be one of {PAGE_BACKINGS} or None, not {backing}")
+        self.page_size = huge_page_size()
+        sizes = [array.nbytes for array in arrays]
+        # every array starts on a huge page
+        offsets = np.cumsum([0] + [(size + self.page_size - 1) // self.page_size * self.page_size for size in sizes])
+        self.size = int(offsets[-1])
+        self.backing = backing
+        self.mapping = None
+        if backing == "hugetlb":
+            try:
+                self.mapping = mmap.mmap(-1, self.size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | MAP_HUGETLB)
+                self.start = 0
+            except OSError as e:
+                logger.warning(f"no {self.size} bytes of hugetlbfs pages ({e}), using transparent huge pages")
+                self.backing = "thp"
+        if self.mapping is None:
+            # one extra huge page to align the start
+            self.mapping = mmap.mmap(-1, self.size + self.page_size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+            self.start = -self.address(0) % self.page_size
+            if self.backing == "thp":
+                try:
+                    self.mapping.madvise(mmap.MADV_HUGEPAGE, self.start, self.size)
+                except (AttributeError, OSError) as e:
+                    logger.warning(f"transparent huge pages are not available: {e}")
+        self.arrays = []
+        for array, offset in zip(arrays, offsets):
+            backed = np.frombuffer(self.mapping, dtype=np.uint8, count=array.nbytes, offset=self.start + int(offset))
+            backed = backed.view(array.dtype).reshape(array.shape)
+            np.copyto(backed, array)
+            self.arrays.append(backed)
+        self.locked = False
+        if lock:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            if libc.mlock(ctypes.c_void_p(self.address(self.start)), ctypes.c_size_t(self.size)) == 0:
+                self.locked = True
+            else:
+                logger.warning(f"failed to mlock {self.size} bytes of weights: {os.strerror(ctypes.get_errno())}")
+
+    def address(self, offset: int) -> int:
+        return ctypes.addressof(ctypes.c_char.from_buffer(self.mapping, offset))
+
+    def report(self) -> Dict[str, int]:
+        """Bytes of the weights in total, on huge pages and locked in memory, as the kernel reports them."""
+        start = self.address(self.start)
+        usage = smaps_usage(start, start + self.size)
+        huge_page_bytes = usage.get("AnonHugePages", 0) + usage.get("Private_Hugetlb", 0) + usage.get("Shared_Hugetlb", 0)
+        return {"bytes": self.size, "huge_page_bytes": huge_page_bytes, "locked_bytes": usage.get("Locked", 0)}
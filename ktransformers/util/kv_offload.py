@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Host memory tier for the kv cache of idle sequences
+'''
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from ktransformers.models.custom_cache import StaticCache
+from ktransformers.server.config.log import logger
+
+
+class OffloadedSequence:
+    def __init__(self, token_ids: torch.Tensor, host_pages: List[int], event):
+        self.token_ids = token_ids
+        self.host_pages = host_pages
+        # recorded on the copy stream once the pages of every layer are on host, empty for synchronous copies
+        self.event = event
+
+    @property
+    def length(self) -> int:
+        return self.token_ids.shape[0]
+
+
+class KVOffloadManager:
+    '''
+    Moves the pages of a StaticCache sequence to a pinned host pool and back.
+
+    Pages follow the MLA page layout of StaticCache, page i of a sequence holds tokens
+    [i * page_size, (i + 1) * page_size) of every layer and every storage tensor (including the
+    scales of a quantized cache). Non-MLA caches are split along the token dim with the same page size.
+    Copies run on a side stream, the compute stream only waits for them before it overwrites or reads
+    the pages involved: an offload leaves one event per layer in `StaticCache.pending_reads`, which the cache
+    waits on before its first write to that layer. The pool is allocated on first use and entries are evicted least recently used.
+    '''
+
+    def __init__(self, cache: StaticCache, max_host_pages: int, page_size: int = 64):
+        self.cache = cache
+        self.max_host_pages = max_host_pages
+        self.page_size = cache.page_size if cache.is_MLA else page_size
+        self.host_pool: Optional[List[List[torch.Tensor]]] = None
+        self.free_pages: List[int] = list(range(max_host_pages - 1, -1, -1))
+        self.sequences: "OrderedDict[str, OffloadedSequence]" = OrderedDict()
+        self.streams: Dict[torch.device, torch.cuda.Stream] = {}
+
+    def _slice(self, t: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        return t[start:end] if self.cache.is_MLA else t[..., start:end, :]
+
+    def _init_host_pool(self):
+        pin = torch.cuda.is_available()
+        pool_tokens = self.max_host_pages * self.page_size
+        self.host_pool = []
+        for layer_idx in range(self.cache.num_hidden_layers):
+            layer = []
+            for t in self.cache._layer_storage(layer_idx):
+                shape = list(t.shape)
+                shape[0 if self.cache.is_MLA else -2] = pool_tokens
+                layer.append(torch.empty(shape, dtype=t.dtype, device="cpu", pin_memory=pin))
+            self.host_pool.append(layer)
+        logger.info(f"allocated host kv pool of {self.max_host_pages} pages")
+
+    def _stream(self, device: torch.device) -> Optional[torch.cuda.Stream]:
+        if device.type != "cuda":
+            return None
+        if device not in self.streams:
+            self.streams[device] = torch.cuda.Stream(device)
+        return self.streams[device]
+
+    def _copy_pages(self, host_pages: List[int], to_host: bool):
+        '''
+        Copy device pages 0..len(host_pages) from or to the given host pages, consecutive host pages are
+        copied as one run. Returns the events to wait on per layer, one per cuda device the layer is on.
+        '''
+        runs: List[Tuple[int, int, int]] = []  # (device page, host page, number of pages)
+        for i, h in enumerate(host_pages):
+            if runs and runs[-1][1] + runs[-1][2] == h:
+                runs[-1] = (runs[-1][0], runs[-1][1], runs[-1][2] + 1)
+            else:
+                runs.append((i, h, 1))
+        synced = set()
+        layer_events = []
+        ps = self.page_size
+        token_dim = 0 if self.cache.is_MLA else -2
+        for layer_idx in range(self.cache.num_hidden_layers):
+            events = {}
+            for t, host in zip(self.cache._layer_storage(layer_idx), self.host_pool[layer_idx]):
+                stream = self._stream(t.device)
+                if stream is not None and t.device not in synced:
+                    # the copy must see everything the compute stream wrote to the cache
+                    stream.wait_stream(torch.cuda.current_stream(t.device))
+                    synced.add(t.device)
+                if stream is not None:
+                    events[t.device] = None
+                with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                    for d, h, n in runs:
+                        dev_view = self._slice(t, d * ps, (d + n) * ps)
+                        # the last page of a non-MLA cache may be cut by max_cache_len
+                        host_view = self._slice(host, h * ps, h * ps + dev_view.shape[token_dim])
+                        if to_host:
+                            host_view.copy_(dev_view, non_blocking=True)
+                        else:
+                            dev_view.copy_(host_view, non_blocking=True)
+            for device in events:
+                events[device] = self.streams[device].record_event()
+            layer_events.append(events)
+        return layer_events
+
+    @staticmethod
+    def _wait(events, block: bool = False):
+        for device, event in (events or {}).items():
+            if block:
+                event.synchronize()
+            else:
+                torch.cuda.current_stream(device).wait_event(event)
+
+    def _evict(self, seq_id: str):
+        seq = self.sequences.pop(seq_id)
+        # a later offload may reuse the pages, so the host copy must be finished
+        self._wait(seq.event, block=True)
+        self.free_pages.extend(seq.host_pages)
+
+    def offload(self, seq_id: str, token_ids: torch.Tensor) -> bool:
+        '''
+        Copy the cache of token_ids, which must currently be in the device cache, to host.
+        The compute stream waits for the copy of a layer only before it next writes to that layer.
+        '''
+        token_ids = token_ids.flatten().to("cpu")
+        n_pages = (token_ids.shape[0] + self.page_size - 1) // self.page_size
+        if n_pages == 0 or n_pages > self.max_host_pages:
+            return False
+        if seq_id in self.sequences:
+            self._evict(seq_id)
+        while len(self.free_pages) < n_pages:
+            self._evict(next(iter(self.sequences)))
+        if self.host_pool is None:
+            self._init_host_pool()
+        # free_pages is kept so that popping from the end yields ascending, mostly consecutive pages
+        self.free_pages.sort(reverse=True)
+        host_pages = [self.free_pages.pop() for _ in range(n_pages)]
+        layer_events = self._copy_pages(host_pages, to_host=True)
+        for layer_idx, events in enumerate(layer_events):
+            if events:
+                # copies on the side stream run in order, so an earlier offload of the layer is done by then
+                self.cache.pending_reads[layer_idx] = list(events.items())
+        # the last event on each device marks the copy of every layer there
+        done = {}
+        for events in layer_events:
+            done.update(events)
+        self.sequences[seq_id] = OffloadedSequence(token_ids, host_pages, done)
+        logger.debug(f"offloaded {token_ids.shape[0]} tokens of {seq_id} to {n_pages} host pages")
+        return True
+
+    def match(self, input_ids: torch.Tensor) -> Optional[Tuple[str, int]]:
+        '''
+        Returns (sequence id, common prefix length) of the offloaded sequence sharing the longest prefix with input_ids.
+        '''
+        input_ids = input_ids.flatten().to("cpu")
+        best = None
+        for seq_id, seq in self.sequences.items():
+            n = min(seq.length, input_ids.shape[0])
+            diff = (seq.token_ids[:n] != input_ids[:n]).nonzero()
+            common = n if diff.shape[0] == 0 else diff[0, 0].item()
+            if best is None or common > best[1]:
+                best = (seq_id, common)
+        return best
+
+    def restore(self, seq_id: str, length: int):
+        '''
+        Copy the first `length` tokens of an offloaded sequence back to the device cache and release its host pages.
+        '''
+        seq = self.sequences.pop(seq_id)
+        n_pages = (length + self.page_size - 1) // self.page_size
+        # the copy back runs on the side stream after the copy to host, both are waited on before the pages are read
+        layer_events = self._copy_pages(seq.host_pages[:n_pages], to_host=False)
+        for layer_idx, events in enumerate(layer_events):
+            self.cache.pending_reads.pop(layer_idx, None)
+            self._wait(events)
+        # the host pages are refilled by a later offload only after this copy, which runs on the same stream
+        self.free_pages.extend(seq.host_pages)
+        logger.debug(f"restored {length} tokens of {seq_id} from host")
+
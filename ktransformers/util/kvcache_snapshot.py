@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Persistent on-disk snapshots of prefix kv caches, keyed by token ids and model identity
+'''
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from ktransformers.server.config.log import logger
+
+
+class PrefixSnapshotStore:
+    '''
+    Every snapshot is a pair of files in snapshot_dir:
+        <key>.kv    the kv cache of the prefix, written by target.dump_prefix
+        <key>.json  metadata, {"length", "model", "format"}
+    key is the sha256 of the model identity and the int64 token ids of the prefix, so a snapshot
+    can only be restored for the exact same tokens on the same model and cache format.
+
+    target is either a StaticCache or the DynamicScaledDotProductAttention of the long context
+    path, both implement dump_prefix(path, length) and load_prefix(path) -> length.
+    '''
+
+    def __init__(self, snapshot_dir: str, model_identity: str, preload: bool = False):
+        self.snapshot_dir = os.path.expanduser(snapshot_dir)
+        self.model_identity = model_identity
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        # prefix length -> keys of snapshots with that length
+        self.lengths: Dict[int, List[str]] = {}
+        self.scan(preload)
+
+    @staticmethod
+    def format_of(target) -> str:
+        # a quantized static cache stores a different layout than a full precision one
+        kv_quant = getattr(target, "kv_quant", None)
+        return type(target).__name__ if kv_quant is None else f"{type(target).__name__}:{kv_quant}"
+
+    def key(self, token_ids: torch.Tensor) -> str:
+        h = hashlib.sha256(self.model_identity.encode())
+        h.update(token_ids.flatten().to(device="cpu", dtype=torch.int64).numpy().tobytes())
+        return h.hexdigest()
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.snapshot_dir, key + suffix)
+
+    def scan(self, preload: bool = False):
+        self.lengths.clear()
+        for name in os.listdir(self.snapshot_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[: -len(".json")]
+            try:
+                with open(self._path(key, ".json")) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f"skip broken kv cache snapshot {name}")
+                continue
+            if meta.get("model") != self.model_identity or not os.path.exists(self._path(key, ".kv")):
+                continue
+            self.lengths.setdefault(meta["length"], []).append(key)
+            if preload:
+                self.preload(key)
+        logger.info(f"found {sum(len(v) for v in self.lengths.values())} kv cache snapshots in {self.snapshot_dir}")
+
+    def preload(self, key: str):
+        # ask the kernel to read the snapshot into page cache, so that the mmap in load does not fault on disk
+        if not hasattr(os, "posix_fadvise"):
+            return
+        fd = os.open(self._path(key, ".kv"), os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def match(self, token_ids: torch.Tensor, format: str) -> Optional[Tuple[str, int]]:
+        '''
+        Returns (key, length) of the longest stored snapshot that is a prefix of token_ids.
+        '''
+        token_ids = token_ids.flatten()
+        for length in sorted(self.lengths.keys(), reverse=True):
+            if length > token_ids.shape[0]:
+                continue
+            key = self.key(token_ids[:length])
+            if key not in self.lengths[length]:
+                continue
+            with open(self._path(key, ".json")) as f:
+                if json.load(f).get("format") != format:
+                    continue
+            return key, length
+        return None
+
+    def save(self, target, token_ids: torch.Tensor) -> str:
+        token_ids = token_ids.flatten()
+        length = token_ids.shape[0]
+        key = self.key(token_ids)
+        tmp_path = self._path(key, ".kv.tmp")
+        target.dump_prefix(tmp_path, length)
+        # rename last, a crash while dumping never leaves a snapshot that looks valid
+        os.replace(tmp_path, self._path(key, ".kv"))
+        meta = {"length": length, "model": self.model_identity, "format": self.format_of(target)}
+        with open(self._path(key, ".json.tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(self._path(key, ".json.tmp"), self._path(key, ".json"))
+        if key not in self.lengths.setdefault(length, []):
+            self.lengths[length].append(key)
+        logger.info(f"saved kv cache snapshot {key} of {length} tokens")
+        return key
+
+    def load(self, target, key: str) -> int:
+        length = target.load_prefix(self._path(key, ".kv"))
+        logger.info(f"restored kv cache snapshot {key} of {length} tokens")
+        return length
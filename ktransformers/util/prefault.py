@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Parallel prefaulting of the memory mapped model files guided by a recorded access profile
+'''
+import ctypes
+import ctypes.util
+import json
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ktransformers.server.config.log import logger
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+# bump when the profile layout changes
+PROFILE_VERSION = 1
+
+
+def resident_pages(data: np.ndarray, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+    """mincore of the bytes [start, end) of a page aligned mapping, one bool per page."""
+    end = data.nbytes if end is None else end
+    start -= start % PAGE_SIZE
+    page_num = (end - start + PAGE_SIZE - 1) // PAGE_SIZE
+    residency = np.zeros(page_num, dtype=np.uint8)
+    if page_num == 0:
+        return residency.astype(bool)
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.mincore(
+        ctypes.c_void_p(data.ctypes.data + start), ctypes.c_size_t(end - start), residency.ctypes.data_as(ctypes.c_void_p)
+    ) != 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    return (residency & 1).astype(bool)
+
+
+def mapped_pages(data: np.ndarray, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+    """The pages of [start, end) of a page aligned mapping this process has accessed, from /proc/self/pagemap."""
+    end = data.nbytes if end is None else end
+    start -= start % PAGE_SIZE
+    page_num = (end - start + PAGE_SIZE - 1) // PAGE_SIZE
+    if page_num == 0:
+        return np.zeros(0, dtype=bool)
+    with open("/proc/self/pagemap", "rb") as f:
+        f.seek((data.ctypes.data + start) // PAGE_SIZE * 8)
+        entries = np.frombuffer(f.read(page_num * 8), dtype=np.uint64)
+    # bit 63 is set for a page present in the page table
+    return (entries >> np.uint64(63)).astype(bool)
+
+
+def unmap_pages(data: np.ndarray):
+    """Drops the pages of a read only file mapping from this process, they stay in the page cache."""
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.madvise(ctypes.c_void_p(data.ctypes.data), ctypes.c_size_t(data.nbytes), mmap.MADV_DONTNEED) != 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+
+def available_memory() -> int:
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class PageCacheWarmer:
+    '''
+    Brings the memory mapped model files into the page cache before they are computed on.
+
+    record() keeps which chunk_size chunks of each file the run accessed through its mapping
+    since reset_accesses(), in the json file at profile_path. Calling reset_accesses() once the
+    weights are loaded leaves out what loading read, such as weights copied to a gpu. start()
+    reads the recorded chunks back in a background pool of num_workers threads: each chunk gets
+    a readahead hint and is then read into the page cache with pread, which does not map it, so
+    the warmer's reads are not recorded either and decode takes no major fault on them. Without
+    a profile for a file the whole file is read when all files fit in the available memory. A
+    profile is dropped when its file changes size or mtime.
+
+    excluded maps a file to the byte ranges that are copied out of it while loading, such as
+    experts moved to huge pages, they are neither prefaulted nor recorded. It is read again by
+    record(), so ranges added by later loads count.
+
+        warmer = PageCacheWarmer(gguf_loader.file_data_map, profile_path, excluded=gguf_loader.copied_ranges)
+        warmer.reset_accesses()
+        warmer.start()
+        ...
+        warmer.record()
+    '''
+
+    def __init__(
+        self,
+        file_data_map: Dict[str, np.ndarray],
+        profile_path: Optional[str] = None,
+        num_workers: int = None,
+        chunk_size: int = 2 * 1024 * 1024,
+        excluded: Optional[Dict[str, List[Tuple[int, int]]]] = None,
+    ):
+        self.file_data_map = file_data_map
+        self.excluded = {} if excluded is None else excluded
+        self.profile_path = None if profile_path is None else os.path.expanduser(profile_path)
+        self.num_workers = num_workers or min(16, 2 * (os.cpu_count() or 1))
+        self.chunk_size = chunk_size // PAGE_SIZE * PAGE_SIZE or PAGE_SIZE
+        self.done_bytes = 0
+        self.total_bytes = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.profile = {}
+        if self.profile_path is not None and os.path.exists(self.profile_path):
+            try:
+                with open(self.profile_path, "r", encoding="utf-8") as f:
+                    profile = json.load(f)
+                if profile.get("version") == PROFILE_VERSION and profile.get("chunk_size") == self.chunk_size:
+                    self.profile = profile["files"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"ignoring unreadable page cache profile {self.profile_path}: {e}")
+
+    @staticmethod
+    def file_key(file_name: str) -> Tuple[str, dict]:
+        stat = os.stat(file_name)
+        return os.path.realpath(file_name), {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    def without_excluded(self, file_name: str, start: int, end: int) -> List[Tuple[str, int, int]]:
+        """The parts of [start, end) of a file outside its excluded ranges."""
+        ranges = []
+        for excluded_start, excluded_end in sorted(self.excluded.get(file_name, ())):
+            if excluded_end <= start or excluded_start >= end:
+                continue
+            if excluded_start > start:
+                ranges.append((file_name, start, excluded_start))
+            start = max(start, excluded_end)
+        if start < end:
+            ranges.append((file_name, start, end))
+        return ranges
+
+    def ranges(self) -> List[Tuple[str, int, int]]:
+        """(file, start, end) byte ranges to prefault, the recorded chunks of every file."""
+        ranges = []
+        unprofiled = []
+        for file_name, data in self.file_data_map.items():
+            path, identity = self.file_key(file_name)
+            entry = self.profile.get(path)
+            if entry is None or entry["size"] != identity["size"] or entry["mtime"] != identity["mtime"]:
+                unprofiled += self.without_excluded(file_name, 0, data.nbytes)
+                continue
+            for first, last in entry["chunks"]:
+                ranges += self.without_excluded(file_name, first * self.chunk_size, min(last * self.chunk_size, data.nbytes))
+        unprofiled_bytes = sum(end - start for _, start, end in unprofiled)
+        if unprofiled_bytes > 0:
+            if unprofiled_bytes + sum(end - start for _, start, end in ranges) <= available_memory():
+                ranges += unprofiled
+            else:
+                logger.info(f"no page cache profile for {len(set(f for f, _, _ in unprofiled))} files too large to prefault whole")
+        return ranges
+
+    def prefault(self, file_name: str, start: int, end: int):
+        buffer = memoryview(bytearray(min(self.chunk_size, end - start)))
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_WILLNEED)
+            # through the file rather than the mapping, pages read here are not accesses of the run
+            offset = start
+            while offset < end:
+                read = os.preadv(fd, [buffer[: min(len(buffer), end - offset)]], offset)
+                if read <= 0:
+                    break
+                offset += read
+        finally:
+            os.close(fd)
+        with self.lock:
+            done = self.done_bytes * 10 // self.total_bytes
+            self.done_bytes += end - start
+            if self.done_bytes * 10 // self.total_bytes > done:
+                seconds = time.perf_counter() - self.start_time
+                logger.info(
+                    f"prefaulted {self.done_bytes / 2**30:.1f} of {self.total_bytes / 2**30:.1f} GiB, "
+                    f"{self.done_bytes / 2**30 / max(seconds, 1e-6):.2f} GiB/s"
+                )
+
+    def run(self):
+        items = []
+        for file_name, start, end in self.ranges():
+            # chunks of one file at a time keep each worker's reads sequential
+            step = self.chunk_size * 8
+            items += [(file_name, offset, min(offset + step, end)) for offset in range(start, end, step)]
+        self.total_bytes = sum(end - start for _, start, end in items)
+        self.done_bytes = 0
+        self.start_time = time.perf_counter()
+        if not items:
+            return
+        with ThreadPoolExecutor(self.num_workers, thread_name_prefix="prefault") as executor:
+            for future in [executor.submit(self.prefault, *item) for item in items]:
+                future.result()
+
+    def start(self):
+        """Prefaults in a daemon thread, see progress() and wait()."""
+        self.thread = threading.Thread(target=self._run_logged, name="page_cache_warmer", daemon=True)
+        self.thread.start()
+
+    def _run_logged(self):
+        try:
+            self.run()
+        except Exception as e:
+            logger.warning(f"page cache prefaulting stopped: {e}")
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def progress(self) -> Tuple[int, int]:
+        """Bytes prefaulted so far and in total."""
+        return self.done_bytes, self.total_bytes
+
+    def reset_accesses(self):
+        """Forgets the accesses so far, record() saves the chunks accessed from here on."""
+        for data in self.file_data_map.values():
+            try:
+                unmap_pages(data)
+            except OSError as e:
+                logger.warning(f"failed to reset the page accesses of the model files: {e}")
+                return
+
+    def record(self):
+        """Saves the chunks of each file accessed since reset_accesses() as the profile of the next start."""
+        if self.profile_path is None:
+            return
+        pages_per_chunk = self.chunk_size // PAGE_SIZE
+        # at most this many pages are checked per pagemap read
+        pages_per_call = pages_per_chunk * 512
+        accessed_pages = mapped_pages
+        if not os.access("/proc/self/pagemap", os.R_OK):
+            logger.warning("/proc/self/pagemap is not readable, recording what is in the page cache instead of accesses")
+            accessed_pages = resident_pages
+        files = {}
+        for file_name, data in self.file_data_map.items():
+            path, identity = self.file_key(file_name)
+            chunks = []
+            for start in range(0, data.nbytes, pages_per_call * PAGE_SIZE):
+                accessed = accessed_pages(data, start, min(start + pages_per_call * PAGE_SIZE, data.nbytes))
+                for excluded_start, excluded_end in self.excluded.get(file_name, ()):
+                    # pages wholly inside the range, the pages at its ends may hold other tensors
+                    first = max(-(-excluded_start // PAGE_SIZE) * PAGE_SIZE, start)
+                    last = min(excluded_end // PAGE_SIZE * PAGE_SIZE, start + len(accessed) * PAGE_SIZE)
+                    if first < last:
+                        accessed[(first - start) // PAGE_SIZE : (last - start) // PAGE_SIZE] = False
+                padded = np.zeros(-(-len(accessed) // pages_per_chunk) * pages_per_chunk, dtype=bool)
+                padded[: len(accessed)] = accessed
+                used = np.flatnonzero(padded.reshape(-1, pages_per_chunk).any(axis=1)) + start // self.chunk_size
+                chunks += used.tolist()
+            # runs of consecutive chunks as [first, last + 1)
+            ranges = []
+            for chunk in chunks:
+                if ranges and ranges[-1][1] == chunk:
+                    ranges[-1][1] = chunk + 1
+                else:
+                    ranges.append([chunk, chunk + 1])
+            files[path] = dict(identity, chunks=ranges)
+        try:
+            os.makedirs(os.path.dirname(self.profile_path) or ".", exist_ok=True)
+            tmp_path = self.profile_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": PROFILE_VERSION, "chunk_size": self.chunk_size, "files": files}, f)
+            os.replace(tmp_path, self.profile_path)
+        except OSError as e:
+            logger.warning(f"failed to save page cache profile to {self.profile_path}: {e}")
@@ -9,7 +9,11 @@ Copyright (c) 2024 by KVCache.AI, All Rights Reserved.
 import torch
 from torch import nn
 import itertools
+import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import enum
 from ktransformers.util.custom_gguf import translate_name_to_gguf
 from ktransformers.util.custom_gguf import GGUFLoader
@@ -70,6 +74,75 @@ def get_all_used_cuda_device(device_map:dict):
     all_device_list = list(all_device_list)
     return all_device_list
 
+class WeightLoadPipeline:
+    '''
+    Loads the tensors load_cur_state_dict asks for in the background while it is active.
+
+    A pool of num_workers threads reads and dequantizes the tensors, gguf tensors meant for a
+    gpu are dequantized there as before. One more thread moves each result to its device and
+    dtype and sets it on its module, in the order the tensors were asked for. At most max_pending tensors are in flight between
+    the stages, which bounds the memory held by finished reads waiting for their upload.
+
+        with WeightLoadPipeline():
+            load_weights(module, gguf_loader)
+
+    All parameters are set when the with block exits, which raises the first loading error.
+    '''
+
+    _local = threading.local()
+
+    def __init__(self, num_workers: int = None, max_pending: int = None):
+        self.num_workers = num_workers or min(8, os.cpu_count() or 1)
+        self.max_pending = max_pending or 2 * self.num_workers
+        self.error = None
+
+    @classmethod
+    def current(cls):
+        """The pipeline active on this thread, None when tensors are loaded one by one."""
+        return getattr(cls._local, "pipeline", None)
+
+    def __enter__(self):
+        self.outer = WeightLoadPipeline.current()
+        self.readers = ThreadPoolExecutor(self.num_workers, thread_name_prefix="weight_reader")
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.uploads = queue.Queue()
+        self.uploader = threading.Thread(target=self._upload, name="weight_uploader", daemon=True)
+        self.uploader.start()
+        WeightLoadPipeline._local.pipeline = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        WeightLoadPipeline._local.pipeline = self.outer
+        self.uploads.put(None)
+        self.uploader.join()
+        self.readers.shutdown()
+        if exc_type is None and self.error is not None:
+            raise self.error
+
+    def submit(self, module: nn.Module, name: str, load, key: str, device: str, dtype: torch.dtype):
+        """Sets load(key) as parameter name of module once it is read, blocks while max_pending are in flight."""
+        if self.error is not None:
+            raise self.error
+        self.slots.acquire()
+        self.uploads.put((module, name, self.readers.submit(load, key, device=device), device, dtype))
+
+    def _upload(self):
+        while True:
+            item = self.uploads.get()
+            if item is None:
+                return
+            module, name, future, device, dtype = item
+            try:
+                weights = future.result()
+                if self.error is None:
+                    set_param(module, name, weights.to(device=device, dtype=dtype))
+                del weights
+            except BaseException as e:
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.slots.release()
+
 def load_cur_state_dict(module: nn.Module, gguf_loader: GGUFLoader, prefix: str = ""):
     prefix = prefix.replace("orig_module.", "")
     persistent_buffers = {k: v for k, v in module._buffers.items() if k not in module._non_persistent_buffers_set}
@@ -92,7 +165,10 @@ def load_cur_state_dict(module: nn.Module, gguf_loader: GGUFLoader, prefix: str
             target_dtype = torch.get_default_dtype()
             device = get_device(translated_key[:translated_key.rfind(".")], gguf_loader.tensor_device_map)
             print(f"loading {translated_key} to {device}")
-            torch.cuda.empty_cache()
+            pipeline = WeightLoadPipeline.current()
+            if pipeline is not None:
+                pipeline.submit(module, name, load_dequantized_tensor, translated_key, device, target_dtype)
+                continue
             weights = load_dequantized_tensor(translated_key, device=device).to(dtype=target_dtype)
             set_param(module, name, weights)
             del weights
@@ -102,6 +178,8 @@ def load_cur_state_dict(module: nn.Module, gguf_loader: GGUFLoader, prefix: str
         
 def load_weights(module:nn.Module, gguf_loader:GGUFLoader, prefix=''):
     #print(f"recursively loading weights {prefix}")
+    if gguf_loader.lazy_loader is not None and gguf_loader.lazy_loader.defer(module, prefix):
+        return
     if not isinstance(module, base_operator.BaseInjectedModule):
         load_cur_state_dict(module, gguf_loader, prefix)
         for name, child in module._modules.items():
@@ -109,9 +187,90 @@ def load_weights(module:nn.Module, gguf_loader:GGUFLoader, prefix=''):
     else:
         module.load()
 
+class LazyWeightLoader:
+    '''
+    Loads the layers of a model the first time they run instead of before serving.
+
+    The elements of the outermost nn.ModuleLists (the decoder layers) are left on meta while
+    load_weights goes over the model, it only records the prefix each of them loads from.
+    A forward pre-hook loads a layer before its first forward, and start() loads the layers
+    that have not run yet in order on a background thread, so requests can be served while
+    most of the weights are still being read. wait() returns once every layer is loaded.
+    on_done is called once, after the last layer is loaded.
+    '''
+
+    def __init__(self, module: nn.Module, gguf_loader: GGUFLoader, on_load=None):
+        self.gguf_loader = gguf_loader
+        # called with each layer after its weights are loaded
+        self.on_load = on_load
+        self.layers = []
+        self._find_layers(module)
+        # layer -> prefix of its weights, None until load_weights reaches it, removed once loaded
+        self.prefixes = {layer: None for layer in self.layers}
+        self.locks = {layer: threading.Lock() for layer in self.layers}
+        self.loading = set()
+        self.hooks = {layer: layer.register_forward_pre_hook(self._pre_hook) for layer in self.layers}
+        self.thread = None
+        self.on_done = None
+
+    def _find_layers(self, module: nn.Module):
+        for child in module._modules.values():
+            if isinstance(child, nn.ModuleList):
+                self.layers.extend(child)
+            elif child is not None:
+                self._find_layers(child)
+
+    def _pre_hook(self, layer: nn.Module, args):
+        self.load(layer)
+
+    def defer(self, module: nn.Module, prefix: str) -> bool:
+        """Called by load_weights, records where a layer loads from instead of loading it."""
+        if module not in self.prefixes or module in self.loading:
+            return False
+        self.prefixes[module] = prefix
+        return True
+
+    def load(self, layer: nn.Module):
+        with self.locks[layer]:
+            prefix = self.prefixes.pop(layer, None)
+            if prefix is None:
+                return
+            self.loading.add(layer)
+            try:
+                load_weights(layer, self.gguf_loader, prefix)
+            except BaseException:
+                self.prefixes[layer] = prefix
+                raise
+            finally:
+                self.loading.discard(layer)
+            if self.on_load is not None:
+                self.on_load(layer)
+            self.hooks.pop(layer).remove()
+
+    def start(self):
+        # layers load_weights never reached are not loaded by it either
+        for layer in [layer for layer, prefix in self.prefixes.items() if prefix is None]:
+            del self.prefixes[layer]
+            self.hooks.pop(layer).remove()
+        self.thread = threading.Thread(target=self.load_all, name="lazy_weight_loader", daemon=True)
+        self.thread.start()
+
+    def load_all(self):
+        for layer in self.layers:
+            self.load(layer)
+        on_done, self.on_done = self.on_done, None
+        if on_done is not None:
+            on_done()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+        # loads whatever the background thread did not get to if it failed
+        self.load_all()
+
 def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cuda_graph: bool = True,
                          mode = 'normal', force_think: bool = False, chunk_prefill_size = 16384, use_flashinfer_mla = False,
-                         num_heads = None, head_dim_ckv = None, head_dim_kpe = None, q_head_dim = None):
+                         num_heads = None, head_dim_ckv = None, head_dim_kpe = None, q_head_dim = None, chunk_tuner = None):
     import os
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
     torch._dynamo.config.suppress_errors = True
@@ -200,6 +359,8 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
         generated_ids[:, cache_position] = inputs.to(torch_device).to(torch.int)
         start_time = time.time()
 
+        if chunk_tuner is not None:
+            chunk_prefill_size = min(chunk_prefill_size, chunk_tuner.choose(seq_length))
         chunk_start = 0
         while chunk_start < seq_length:
             chunk_end = min(chunk_start + chunk_prefill_size, seq_length)
@@ -207,6 +368,10 @@ def prefill_and_generate(model, tokenizer, inputs, max_new_tokens=10000, use_cud
                 past_key_values.cur_idx=cache_position[chunk_start:chunk_end]
             logits = chunk_prefill(inputs[:, chunk_start:chunk_end], cache_position[chunk_start:chunk_end], past_key_values)
             chunk_start += chunk_prefill_size
+        if chunk_tuner is not None:
+            for device in all_cuda_device:
+                torch.cuda.synchronize(device)
+            chunk_tuner.record(seq_length, chunk_prefill_size, time.time() - start_time)
 
         next_token_scores = logits_warper(inputs, logits[:, -1, :])
         if generation_config.do_sample:
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding=utf-8
+'''
+Description  : Content addressed disk cache of repacked linear weights
+'''
+import hashlib
+import os
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import torch
+
+from ktransformers.server.config.log import logger
+
+# bump when the layout of the cached tensors changes
+CACHE_FORMAT_VERSION = 1
+
+
+class RepackCache:
+    '''
+    Keeps post-processed linear weights, such as Marlin packed or int8 quantized matrices,
+    in the directory `path` under a digest of their source tensors and of the parameters of
+    the repacking. Later starts memory map them instead of quantizing again. A changed
+    source or parameter gives another digest, so stale entries are never read.
+    '''
+
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+
+    @staticmethod
+    def digest(sources: Iterable, **params) -> str:
+        """sha256 of params and of each source, a tensor or a buffer such as a GGUF mmap slice."""
+        h = hashlib.sha256()
+        h.update(repr((CACHE_FORMAT_VERSION, sorted(params.items()))).encode())
+        for source in sources:
+            if isinstance(source, torch.Tensor):
+                source = source.detach().cpu().contiguous()
+                h.update(repr((str(source.dtype), tuple(source.shape))).encode())
+                source = source.reshape(-1).view(torch.uint8).numpy()
+            h.update(memoryview(np.ascontiguousarray(source)))
+        return h.hexdigest()
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.path, digest[:2], digest + ".pt")
+
+    def load(self, digest: str) -> Optional[Dict[str, torch.Tensor]]:
+        """The cpu tensors saved under digest, memory mapped, None on a miss."""
+        file = self._file(digest)
+        if not os.path.exists(file):
+            return None
+        try:
+            return torch.load(file, mmap=True, weights_only=True)
+        except Exception as e:
+            logger.warning(f"ignoring unreadable repacked weights {file}: {e}")
+            return None
+
+    def save(self, digest: str, tensors: Dict[str, torch.Tensor]):
+        file = self._file(digest)
+        try:
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            tmp_file = f"{file}.{os.getpid()}.tmp"
+            torch.save({k: v.detach().cpu().contiguous() for k, v in tensors.items()}, tmp_file)
+            os.replace(tmp_file, file)
+        except OSError as e:
+            logger.warning(f"failed to save repacked weights to {file}: {e}")
@@ -0,0 +1,244 @@
+# this script rewrites gguf files so that the expert weights KExpertsCPU reads are laid out for the page cache.
+#
+# All tensors go to one file, ordered by layer. The ffn_gate_exps, ffn_up_exps and ffn_down_exps tensors of
+# a layer are written back to back at the end of the layer, and every tensor starts at a multiple of
+# --alignment, a page by default or 2 MiB to allow huge page backing. Within the stacked tensors each
+# expert is one contiguous slice, MOE indexes them by expert id from a single base pointer.
+#
+# With --expert_frequency the experts of each layer are reordered by how often the router picked them,
+# so the hot experts share pages and readahead. The router rows (ffn_gate_inp.weight, exp_probs_b.bias)
+# are permuted the same way. Routers that first pick groups of experts, like DeepSeek-V3's, take the
+# groups as contiguous ranges of expert ids, so experts are only reordered within their group and the
+# router picks the same experts with the same weights as before, up to ties. The group count is read from
+# <architecture>.expert_group_count or given with --expert_group_count. Anything else keyed by expert
+# id, such as a frequency file or experts placed by id in an optimize rule, refers to the new ids
+# afterwards. The order is kept in the metadata under ktransformers.blk.<layer>.expert_order, new expert
+# i is old expert expert_order[i].
+
+import os
+import sys
+current_path = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(current_path + "/..")
+import argparse
+import json
+import re
+import struct
+import numpy as np
+import torch
+from ktransformers.util.custom_gguf import GGUFLoader, DATA_TYPES, read_value
+
+EXPERT_TENSORS = ["ffn_gate_exps.weight", "ffn_up_exps.weight", "ffn_down_exps.weight"]
+# tensors indexed by expert along their outermost dimension besides the experts themselves
+ROUTER_TENSORS = ["ffn_gate_inp.weight", "exp_probs_b.bias"]
+layer_pattern = re.compile(r'^blk\.(\d+)\.(.+)$')
+
+
+def pack_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def pack_uint32_array(values) -> bytes:
+    return struct.pack("<IQ", DATA_TYPES["uint32"], len(values)) + struct.pack(f"<{len(values)}I", *values)
+
+
+def read_raw_metadata(file_name: str) -> dict:
+    """
+    :param file_name: gguf file
+    :return: {key: the raw bytes of its value type and value}, so values are written back unchanged
+    """
+    metadata = {}
+    with open(file_name, "rb") as f:
+        assert f.read(4) == b'GGUF'
+        version, n_tensors, n_kv = struct.unpack("<IQQ", f.read(4 + 8 + 8))
+        for _ in range(n_kv):
+            name = read_value(f, DATA_TYPES["string"])
+            start = f.tell()
+            data_type = struct.unpack("<I", f.read(4))[0]
+            read_value(f, data_type)
+            end = f.tell()
+            f.seek(start)
+            metadata[name] = f.read(end - start)
+    return metadata
+
+
+def expert_group_count(gguf_loader: GGUFLoader, group_count: int | None) -> int:
+    """
+    :return: the number of routing groups, from the GGUF metadata, else group_count
+    """
+    architecture = gguf_loader.gguf_file_meta.get("general.architecture")
+    metadata_count = gguf_loader.gguf_file_meta.get(f"{architecture}.expert_group_count")
+    if metadata_count is not None:
+        if group_count is not None and group_count != metadata_count:
+            raise ValueError(f"--expert_group_count {group_count} but the GGUF metadata has {metadata_count} groups")
+        return int(metadata_count)
+    if group_count is None:
+        raise ValueError(
+            f"{architecture}.expert_group_count is not in the GGUF metadata, give the number of routing groups "
+            "with --expert_group_count (n_group of the model config, 1 if the router does not group experts)"
+        )
+    return group_count
+
+
+def expert_orders(gguf_loader: GGUFLoader, frequency_file: str | None, group_count: int | None) -> dict:
+    """
+    :return: {layer: permutation}, the most often routed expert first within each routing group, for the
+             layers in frequency_file
+    """
+    if frequency_file is None:
+        return {}
+    group_count = expert_group_count(gguf_loader, group_count)
+    with open(frequency_file, "r", encoding="utf-8") as f:
+        frequency = json.load(f)
+    orders = {}
+    for layer, counts in frequency.items():
+        name = f"blk.{int(layer)}.{EXPERT_TENSORS[0]}"
+        if name not in gguf_loader.tensor_info:
+            raise ValueError(f"Layer {layer} of {frequency_file} has no stacked experts")
+        expert_num = gguf_loader.tensor_info[name]["shape"][-1]
+        if len(counts) != expert_num:
+            raise ValueError(f"Layer {layer} has {expert_num} experts but {len(counts)} counts")
+        if group_count < 1 or expert_num % group_count != 0:
+            raise ValueError(f"Layer {layer} has {expert_num} experts, they can't be split into {group_count} groups")
+        # [group, expert in group], sorted along the experts of each group
+        counts = np.asarray(counts).reshape(group_count, -1)
+        group_size = counts.shape[1]
+        order = np.argsort(-counts, axis=1, kind="stable") + np.arange(group_count)[:, None] * group_size
+        orders[int(layer)] = order.reshape(-1).tolist()
+    return orders
+
+
+def tensor_order(gguf_loader: GGUFLoader) -> list:
+    """Tensors outside the layers first, then each layer with its stacked experts last, in layer order."""
+    layers = {}
+    others = []
+    for name in gguf_loader.tensor_info:
+        match = layer_pattern.match(name)
+        if match:
+            layers.setdefault(int(match.group(1)), []).append(name)
+        else:
+            others.append(name)
+    order = others
+    for layer in sorted(layers):
+        names = layers[layer]
+        experts = [f"blk.{layer}.{suffix}" for suffix in EXPERT_TENSORS if f"blk.{layer}.{suffix}" in names]
+        order += [name for name in names if name not in experts] + experts
+    return order
+
+
+def permutation_of(name: str, orders: dict):
+    match = layer_pattern.match(name)
+    if match is None or int(match.group(1)) not in orders:
+        return None
+    if match.group(2) in EXPERT_TENSORS or match.group(2) in ROUTER_TENSORS:
+        return orders[int(match.group(1))]
+    return None
+
+
+def write_repacked_gguf(gguf_loader: GGUFLoader, output_file: str, alignment: int, orders: dict):
+    metadata = {}
+    for file_name in gguf_loader.file_data_map:
+        for key, value in read_raw_metadata(file_name).items():
+            # all tensors go to one file
+            if not key.startswith("split.") and key not in metadata:
+                metadata[key] = value
+    metadata["general.alignment"] = struct.pack("<II", DATA_TYPES["uint32"], alignment)
+    for layer, order in sorted(orders.items()):
+        metadata[f"ktransformers.blk.{layer}.expert_order"] = struct.pack("<I", DATA_TYPES["array"]) + pack_uint32_array(order)
+
+    names = tensor_order(gguf_loader)
+    offsets = []
+    offset = 0
+    for name in names:
+        offsets.append(offset)
+        offset += (gguf_loader.get_mmap_tensor(name).nbytes + alignment - 1) // alignment * alignment
+
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(b'GGUF')
+        f.write(struct.pack("<IQQ", 3, len(names), len(metadata)))
+        for key, value in metadata.items():
+            f.write(pack_string(key))
+            f.write(value)
+        for name, offset in zip(names, offsets):
+            t = gguf_loader.tensor_info[name]
+            f.write(pack_string(name))
+            f.write(struct.pack("<I", len(t["shape"])))
+            f.write(struct.pack(f"<{len(t['shape'])}Q", *t["shape"]))
+            f.write(struct.pack("<IQ", t["ggml_type"], offset))
+        f.write(b"\0" * ((alignment - f.tell() % alignment) % alignment))
+        data_start = f.tell()
+        for name, offset in zip(names, offsets):
+            f.write(b"\0" * (data_start + offset - f.tell()))
+            data = gguf_loader.get_mmap_tensor(name)
+            order = permutation_of(name, orders)
+            if order is None:
+                f.write(data)
+            else:
+                rows = data.reshape(len(order), -1)
+                for expert_id in order:
+                    f.write(rows[expert_id])
+            print(f"Wrote {name}")
+        f.write(b"\0" * ((alignment - f.tell() % alignment) % alignment))
+    os.replace(tmp_file, output_file)
+
+
+def validate_repacked_gguf(gguf_loader: GGUFLoader, repacked_loader: GGUFLoader, orders: dict, experts_to_check: int):
+    """Compares the cpu dequantized tensors of both files, experts_to_check experts of each stacked tensor."""
+    for name, t in gguf_loader.tensor_info.items():
+        order = permutation_of(name, orders)
+        new_ids = {old: new for new, old in enumerate(order)} if order is not None else None
+        if name.split(".", 2)[-1] in EXPERT_TENSORS:
+            expert_num = t["shape"][-1]
+            elements_per_expert = int(np.prod(t["shape"][:-1]))
+            data = gguf_loader.get_mmap_tensor(name)
+            repacked_data = repacked_loader.get_mmap_tensor(name)
+            for expert_id in sorted(set(np.linspace(0, expert_num - 1, experts_to_check, dtype=int).tolist())):
+                expected = gguf_loader.load_expert_tensor(name, data, expert_id, elements_per_expert, "cpu")
+                new_id = expert_id if new_ids is None else new_ids[expert_id]
+                actual = repacked_loader.load_expert_tensor(name, repacked_data, new_id, elements_per_expert, "cpu")
+                if not torch.equal(expected, actual):
+                    raise ValueError(f"Expert {expert_id} of {name} differs after repacking")
+        else:
+            expected = gguf_loader.load_gguf_tensor(name, "cpu")
+            actual = repacked_loader.load_gguf_tensor(name, "cpu")
+            if order is not None:
+                expected = expected.view(len(order), -1)[order].view(expected.shape)
+            if not torch.equal(expected, actual):
+                raise ValueError(f"{name} differs after repacking")
+    print("Repacked tensors match the original ones")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Repack the expert tensors of GGUF files for the page cache")
+    parser.add_argument("--gguf_path", type=str, help="Path to the GGUF files", required=True)
+    parser.add_argument("--output_path", type=str, help="Directory of the repacked GGUF file", required=True)
+    parser.add_argument("--alignment", type=int, help="Alignment of each tensor in bytes, 2097152 for huge pages", default=4096)
+    parser.add_argument("--expert_frequency", type=str, help="json file mapping a layer index to the routing count of each expert", default=None)
+    parser.add_argument("--expert_group_count", type=int, help="Routing groups of the experts when the GGUF metadata lacks them", default=None)
+    parser.add_argument("--validate", action="store_true", help="Compare the dequantized tensors after repacking")
+    parser.add_argument("--validate_experts", type=int, help="Experts checked per stacked tensor by --validate", default=4)
+    args = parser.parse_args()
+    print("All the arguments:")
+    print(args)
+
+    gguf_loader = GGUFLoader(args.gguf_path)
+    if gguf_loader.safetensor_loader is not None:
+        raise ValueError(f"{args.gguf_path} holds safetensors, only GGUF files can be repacked")
+    if args.alignment % 32 != 0:
+        raise ValueError("alignment must be a multiple of 32")
+    if os.path.realpath(args.output_path) == os.path.realpath(gguf_loader.gguf_path):
+        raise ValueError("output_path must not be the directory of the input GGUF files")
+    os.makedirs(args.output_path, exist_ok=True)
+    architecture = gguf_loader.gguf_file_meta.get("general.architecture", "model")
+    output_file = os.path.join(args.output_path, f"{architecture}-experts-repacked.gguf")
+
+    orders = expert_orders(gguf_loader, args.expert_frequency, args.expert_group_count)
+    write_repacked_gguf(gguf_loader, output_file, args.alignment, orders)
+    print(f"Saved repacked GGUF to {output_file}")
+    if args.validate:
+        validate_repacked_gguf(gguf_loader, GGUFLoader(args.output_path), orders, args.validate_experts)
+
+
+if __name__ == "__main__":
+    main()